@@ -2,8 +2,8 @@
 Data Analyst Agent - 智能数据分析助手
 """
 
-from .core import AvailableFunctions, InterProject, DataFlowAgent
-from .functions_lib import python_inter, sql_inter, extract_data,fig_inter
+from .core import AvailableFunctions, InterProject, DataFlowAgent, BatchRunner, run_batch, AgentService, serve
+from .functions_lib import python_inter, sql_inter, extract_data,fig_inter, fetch_blob, export_data, profile_data, extract_sample
 
 
 __version__ = "0.1.0"
@@ -14,18 +14,28 @@ __all__ = [
     "AvailableFunctions",
     "InterProject",
     "DataFlowAgent",
+    "BatchRunner",
+    "run_batch",
+    "AgentService",
+    "serve",
 ]
 
+# create_agent默认提供的外部函数
+DEFAULT_FUNCTIONS = [sql_inter, extract_data, extract_sample, python_inter, profile_data, fig_inter, fetch_blob,
+                     export_data]
+
+
 # 便捷函数
 def create_agent(
         model='deepseek-chat',
         env_path='.env',
         is_enhanced_mode=False,
-        is_developer_mode=False
+        is_developer_mode=False,
+        project=None
 ):
-    """创建数据分析代理"""
+    """创建数据分析代理，设置project后export_data导出的文件保存到项目的产物存储中"""
     af = AvailableFunctions(
-        functions_list=[sql_inter, extract_data, python_inter, fig_inter]
+        functions_list=list(DEFAULT_FUNCTIONS)
     )
     data_dictionary = open('D:/LZL/workspace/NLP/06agent/ARGC/00Learning/telco_data/telco_data_dictionary.md').read()
 
@@ -35,5 +45,6 @@ def create_agent(
         available_functions=af,
         system_content_list=[data_dictionary],
         is_enhanced_mode=is_enhanced_mode,
-        is_developer_mode=is_developer_mode
+        is_developer_mode=is_developer_mode,
+        project=project
     )
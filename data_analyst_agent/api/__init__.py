@@ -1 +1,2 @@
-from .llms import LlmBox
\ No newline at end of file
+from .llms import LlmBox
+from .rate_limiter import RateLimiter
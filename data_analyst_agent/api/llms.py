@@ -1,27 +1,121 @@
 import os
+import copy
+import time
+import threading
+from types import SimpleNamespace
+import httpx
 import openai
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
 from dotenv import load_dotenv
 
+from ..utils.tracing import span
+
 MessageDict = dict
 MessageType = ChatCompletionMessage
 
+# 调用位置 -> 模型档案 的默认路由表
+# main：最终回答；task_decomposition：任务拆解；debug：深度debug的引导对话；schema：工具函数描述生成；
+# compaction：会话压缩摘要
+DEFAULT_ROUTES = {
+    'main': 'strong',
+    'task_decomposition': 'fast',
+    'debug': 'fast',
+    'schema': 'fast',
+    'compaction': 'fast',
+}
+
+
+# 存在备用模型时，由LlmBox自行重试超时以外的可重试错误，重试间隔（秒）按指数增长，最长为RETRY_MAX_BACKOFF
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 8.0
+
+
+def _retryable(error) -> bool:
+    """与openai SDK一致的可重试错误：连接错误、408、409、429和5xx"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+class ModelProfile:
+    '''
+    模型档案：描述某一类调用所使用的模型、服务地址、超时时间和最大输出token数
+    1、api_key、api_url为None时沿用主模型的配置
+    2、fallback为另一个模型档案的名称，当前档案调用超时时会自动切换到该档案（流式输出时只在收到第一段文本之前切换）
+    '''
+    def __init__(self,
+                 model_name,
+                 api_key=None,
+                 api_url=None,
+                 timeout=None,
+                 max_tokens=None,
+                 fallback=None):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.api_url = api_url
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.fallback = fallback
+
+    def __repr__(self):
+        return f"ModelProfile(model_name={self.model_name!r}, api_url={self.api_url!r}, " \
+               f"timeout={self.timeout}, max_tokens={self.max_tokens}, fallback={self.fallback!r})"
+
+
+def _env_float(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+def _env_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
 
 class LlmBox:
     '''
     提供大模型调用服务
     1、默认使用deepseek-chat模型
     2、需要在根目录下配置好.env文件
+    3、支持按调用位置（route）路由到不同的模型档案，例如辅助调用使用快速模型、最终回答使用强模型
+    4、按route统计调用次数、耗时和token消耗
+    5、可以传入RateLimiter进行限流；share()创建共享client和限流器、单独统计指标的副本，供并发的多个会话使用
     '''
-    def __init__(self, env_path='../../.env', model_name="deepseek-chat"):
+    def __init__(self,
+                 env_path='../../.env',
+                 model_name="deepseek-chat",
+                 profiles=None,
+                 routes=None,
+                 rate_limiter=None):
         api_key, api_url = self.init(env_path)
-        self.client = openai.OpenAI(
-            api_key=api_key,
-            base_url=api_url,
-        )
+        self.api_key = api_key
+        self.api_url = api_url
         self.model_name = model_name
 
+        # 模型档案：未传入时根据.env中的配置创建
+        self.profiles:dict = profiles if profiles is not None else self.default_profiles(model_name)
+        self.routes:dict = dict(DEFAULT_ROUTES)
+        if routes:
+            self.routes.update(routes)
+
+        # 限流器，可以在多个LlmBox之间共享
+        self.rate_limiter = rate_limiter
+
+        # 不同服务地址对应的client
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self.client = self.get_client(self.profiles['strong'])
+
+        # 按route统计的调用指标
+        self.route_metrics = {}
+
         print(f"▌ Model set to {self.model_name}")
+        for name, profile in self.profiles.items():
+            if profile.model_name != self.model_name:
+                print(f"▌ Profile {name} set to {profile.model_name}")
 
     def init(self, env_path:str) -> tuple[str, str]:
         print(f"[1] load env from {env_path}...")
@@ -36,7 +130,69 @@ class LlmBox:
 
         return api_key, api_url
 
+    def default_profiles(self, model_name) -> dict:
+        '''
+        根据环境变量创建默认的模型档案：
+        strong：主模型，用于最终回答；
+        fast：快速模型，用于任务拆解、debug引导和工具描述生成，未配置FAST_MODEL_NAME时与主模型一致；
+        fallback：备用模型，配置FALLBACK_MODEL_NAME后，strong和fast超时时会切换到备用模型。
+        '''
+        fallback_name = os.getenv("FALLBACK_MODEL_NAME")
+        fallback = 'fallback' if fallback_name else None
 
+        profiles = {
+            'strong': ModelProfile(
+                model_name=model_name,
+                timeout=_env_float("LLM_TIMEOUT"),
+                max_tokens=_env_int("LLM_MAX_TOKENS"),
+                fallback=fallback
+            ),
+            'fast': ModelProfile(
+                model_name=os.getenv("FAST_MODEL_NAME") or model_name,
+                api_key=os.getenv("FAST_API_KEY") or None,
+                api_url=os.getenv("FAST_API_URL") or None,
+                timeout=_env_float("FAST_TIMEOUT"),
+                max_tokens=_env_int("FAST_MAX_TOKENS"),
+                fallback=fallback
+            ),
+        }
+        if fallback_name:
+            profiles['fallback'] = ModelProfile(
+                model_name=fallback_name,
+                api_key=os.getenv("FALLBACK_API_KEY") or None,
+                api_url=os.getenv("FALLBACK_API_URL") or None,
+                timeout=_env_float("FALLBACK_TIMEOUT"),
+                max_tokens=_env_int("FALLBACK_MAX_TOKENS"),
+            )
+        return profiles
+
+    def get_client(self, profile:ModelProfile) -> openai.OpenAI:
+        '''根据模型档案的服务地址获取client，相同地址复用同一个client（及其连接池）'''
+        api_key = profile.api_key or self.api_key
+        api_url = profile.api_url or self.api_url
+        key = (api_key, api_url)
+        with self._clients_lock:
+            if key not in self._clients:
+                self._clients[key] = openai.OpenAI(
+                    api_key=api_key,
+                    base_url=api_url,
+                )
+            return self._clients[key]
+
+    def share(self) -> 'LlmBox':
+        '''
+        创建一个共享client（及其连接池）、模型档案和限流器的副本，调用指标单独统计，
+        用于并发运行的多个会话，每个会话可以单独统计自己的token消耗
+        '''
+        shared = copy.copy(self)
+        shared.route_metrics = {}
+        shared._metrics_lock = threading.Lock()
+        return shared
+
+    def get_profile(self, route='main') -> ModelProfile:
+        '''根据调用位置获取模型档案，未知的route使用主模型'''
+        profile_name = self.routes.get(route, 'strong')
+        return self.profiles.get(profile_name, self.profiles['strong'])
 
     def build_messages(self, prompt:str, system_pt=None) -> MessageDict:
         messages = []
@@ -47,38 +203,193 @@ class LlmBox:
 
         return messages
 
+    def _record(self, route, latency, response=None, error=None):
+        '''记录某个route的一次调用结果'''
+        with self._metrics_lock:
+            self._record_locked(route, latency, response, error)
+
+    def _record_locked(self, route, latency, response=None, error=None):
+        metrics = self.route_metrics.setdefault(route, {
+            'calls': 0,
+            'errors': 0,
+            'timeouts': 0,
+            'fallbacks': 0,
+            'latency': 0.0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+        })
+        metrics['calls'] += 1
+        metrics['latency'] += latency
+        if error is not None:
+            metrics['errors'] += 1
+            if isinstance(error, openai.APITimeoutError):
+                metrics['timeouts'] += 1
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            metrics['prompt_tokens'] += usage.prompt_tokens or 0
+            metrics['completion_tokens'] += usage.completion_tokens or 0
+
+    def get_metrics(self) -> dict:
+        '''按route汇总调用指标，附带平均耗时'''
+        summary = {}
+        with self._metrics_lock:
+            route_metrics = {route: dict(metrics) for route, metrics in self.route_metrics.items()}
+        for route, metrics in route_metrics.items():
+            summary[route] = dict(metrics)
+            summary[route]['avg_latency'] = metrics['latency'] / metrics['calls'] if metrics['calls'] else 0.0
+        return summary
+
+    def _collect_stream(self, stream, on_token):
+        '''读取流式输出，逐段回调文本内容，并将文本和tool_calls片段拼接为完整的message'''
+        content = []
+        tool_calls = {}
+        usage = None
+        for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content.append(delta.content)
+                on_token(delta.content)
+            for call in delta.tool_calls or []:
+                entry = tool_calls.setdefault(call.index, {
+                    'id': None, 'type': 'function', 'function': {'name': '', 'arguments': ''}
+                })
+                if call.id:
+                    entry['id'] = call.id
+                if call.function is not None:
+                    entry['function']['name'] += call.function.name or ''
+                    entry['function']['arguments'] += call.function.arguments or ''
+        message = ChatCompletionMessage.model_validate({
+            'role': 'assistant',
+            'content': ''.join(content) or None,
+            'tool_calls': [tool_calls[i] for i in sorted(tool_calls)] or None,
+        })
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    def _request(self, client, kwargs, on_token=None):
+        if on_token is None:
+            return client.chat.completions.create(**kwargs)
+        stream = client.chat.completions.create(stream=True, stream_options={'include_usage': True}, **kwargs)
+        try:
+            return self._collect_stream(stream, on_token)
+        except httpx.TimeoutException as e:
+            # 读取流的过程中超时时，SDK直接抛出httpx的异常，统一转换为APITimeoutError
+            try:
+                request = e.request
+            except RuntimeError:
+                request = None
+            raise openai.APITimeoutError(request=request) from e
+
+    def _create(self, profile:ModelProfile, route, messages, tools=None, tool_choice='auto', n=None, on_token=None,
+                streamed=None):
+        kwargs = {'model': profile.model_name, 'messages': messages}
+        if n is not None:
+            kwargs['n'] = n
+        if tools is not None:
+            kwargs['tools'] = tools
+            kwargs['tool_choice'] = tool_choice
+        if profile.max_tokens is not None:
+            kwargs['max_tokens'] = profile.max_tokens
+        if profile.timeout is not None:
+            kwargs['timeout'] = profile.timeout
+
+        client = self.get_client(profile)
+        # 存在备用模型时，超时不在client内部重试，直接切换；其余可重试的错误仍按client的max_retries重试
+        retries = 0
+        if profile.fallback is not None:
+            retries = client.max_retries
+            client = client.with_options(max_retries=0)
+
+        start = time.perf_counter()
+        with span(f"llm.{route}", 'llm', route=route, model=profile.model_name, messages=len(messages),
+                  stream=on_token is not None) as llm_span:
+            attempt = 0
+            while True:
+                try:
+                    if self.rate_limiter is not None:
+                        with self.rate_limiter:
+                            response = self._request(client, kwargs, on_token)
+                    else:
+                        response = self._request(client, kwargs, on_token)
+                    break
+                except Exception as e:
+                    # 已经输出过文本的流式调用不再重试，避免重复输出
+                    if (isinstance(e, openai.APITimeoutError) or attempt >= retries or streamed
+                            or not _retryable(e)):
+                        self._record(route, time.perf_counter() - start, error=e)
+                        raise
+                    time.sleep(min(RETRY_BACKOFF * 2 ** attempt, RETRY_MAX_BACKOFF))
+                    attempt += 1
+            self._record(route, time.perf_counter() - start, response=response)
+            if attempt:
+                llm_span.set(retries=attempt)
+            usage = getattr(response, 'usage', None)
+            if usage is not None:
+                llm_span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+        return response
+
+    def _call(self, route, messages, tools=None, tool_choice='auto', n=None, on_token=None):
+        '''
+        按route选择模型档案并调用，超时时切换到备用模型。
+        流式输出时只在收到第一段文本之前切换，已经输出的文本不会被备用模型的回答重复输出。
+        '''
+        profile = self.get_profile(route)
+        streamed = []
+        if on_token is not None:
+            callback = on_token
+
+            def on_token(text):
+                streamed.append(len(text))
+                callback(text)
+
+        try:
+            return self._create(profile, route, messages, tools, tool_choice, n=n, on_token=on_token,
+                                streamed=streamed)
+        except openai.APITimeoutError:
+            if streamed or profile.fallback is None or profile.fallback not in self.profiles:
+                raise
+            fallback = self.profiles[profile.fallback]
+            print(f">>> {profile.model_name} 调用超时，切换至备用模型 {fallback.model_name}")
+            with self._metrics_lock:
+                self.route_metrics[route]['fallbacks'] += 1
+            return self._create(fallback, route, messages, tools, tool_choice, n=n, on_token=on_token,
+                                streamed=streamed)
 
     def chat(self, prompt='你好。',
              system_pt=None,
              messages=None,
              tools=None,
-             tool_choice='auto') -> MessageType:
+             tool_choice='auto',
+             route='main',
+             on_token=None) -> MessageType:
         '''基础的大模型问答接口，可以传入提示词，也可以直接传入message
         :param prompt: 提示词
         :param system_pt: 系统提示词
         :param messages: 传入的message
         :param tools: function calls工具
         :param tool_choice: 是否调用外部工具
+        :param route: 调用位置，用于选择模型档案，默认为main（最终回答）
+        :param on_token: 可选参数，传入后使用流式输出，每收到一段文本调用一次on_token(text)
         :return: 返回大模型输出的message
         '''
         if messages is None:
             messages = self.build_messages(prompt, system_pt)
 
-        if tools is None:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages
-            )
-        else:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                tools=tools,
-                tool_choice=tool_choice
-            )
+        response = self._call(route, messages, tools, tool_choice, on_token=on_token)
         return response.choices[0].message
 
+    def chat_n(self, messages, n=3, tools=None, tool_choice='auto', route='main') -> list:
+        '''
+        一次请求返回n个候选回答（需要服务端支持n参数），用于并行生成多个候选方案，超时时同样切换到备用模型
+        :return: 由n个大模型输出的message所组成的list
+        '''
+        response = self._call(route, messages, tools, tool_choice, n=n)
+        return [choice.message for choice in response.choices]
+
 
 if __name__ == '__main__':
     llmbox = LlmBox()
-    llmbox.chat()
\ No newline at end of file
+    llmbox.chat()
@@ -0,0 +1,71 @@
+import time
+import threading
+
+
+class RateLimiter:
+    '''
+    大模型调用限流：令牌桶控制每分钟请求数，信号量控制同时进行的请求数。
+    多个会话（LlmBox）共享同一个RateLimiter时，限流对它们的调用总和生效。
+    '''
+    def __init__(self, requests_per_minute=None, max_concurrent=None, burst=None):
+        '''
+        :param requests_per_minute: 每分钟最多发起的请求数，None表示不限制
+        :param max_concurrent: 同时进行的最大请求数，None表示不限制
+        :param burst: 令牌桶容量，即允许的瞬时突发请求数，默认为max(1, requests_per_minute / 60)
+        '''
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrent = max_concurrent
+        self._rate = requests_per_minute / 60.0 if requests_per_minute else None
+        self._capacity = burst if burst is not None else max(1.0, (self._rate or 0))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+        self.metrics = {
+            'requests': 0,
+            'throttled': 0,
+            'wait_time': 0.0,
+        }
+
+    def _take_token(self) -> float:
+        '''取出一个令牌，返回需要等待的秒数'''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+    def acquire(self):
+        start = time.perf_counter()
+        if self._rate is not None:
+            wait = self._take_token()
+            if wait > 0:
+                time.sleep(wait)
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.metrics['requests'] += 1
+            self.metrics['wait_time'] += waited
+            if waited > 1e-3:
+                self.metrics['throttled'] += 1
+
+    def release(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return dict(self.metrics)
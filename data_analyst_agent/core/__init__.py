@@ -1,3 +1,9 @@
 from .functions import AvailableFunctions
 from .agent import DataFlowAgent
-from .project import InterProject
\ No newline at end of file
+from .chat_engine import TurnBudget
+from .project import InterProject
+from .session_store import SessionStore
+from .rollup import RollupMaterializer
+from .answer_cache import AnswerCache
+from .batch import BatchRunner, run_batch
+from .service import AgentService, serve
@@ -1,10 +1,37 @@
 from .project import InterProject
 from .messages import ChatMessages
 from .functions import AvailableFunctions
-from .chat_engine import get_chat_response
+import os
+import copy
+import time
+import uuid
+import builtins
+
+from .chat_engine import ChatTurn, TurnBudget, TurnState
+from .parallel_debug import ParallelDebugger
+from .validation import get_validator, StaticValidator, VALIDATOR_KEY
+from .namespace import SessionNamespace, release_namespace
+from .compaction import SessionCompactor
+from .session_store import message_from_dict
+from .checkpoint import SessionCheckpoint
+from .artifact_store import ARTIFACT_STORE_KEY, SESSION_ID_KEY
+from .watchdog import CELL_TIMEOUT_KEY, DEFAULT_CELL_TIMEOUT
+from .retrieval import DictionaryIndex, is_dictionary
+from .tokens import get_token_counter
+from .answer_cache import AnswerCache, context_fingerprint
 
 from ..api import LlmBox
 
+def final_answer(messages:ChatMessages) -> str:
+    """取出对话中最后一条包含文本内容的assistant消息"""
+    for message in reversed(messages.history_messages):
+        role = message.get('role') if isinstance(message, dict) else getattr(message, 'role', None)
+        content = message.get('content') if isinstance(message, dict) else getattr(message, 'content', None)
+        if role == 'assistant' and content:
+            return content
+    return ''
+
+
 class DataFlowAgent:
     '''
     数据自动分析agent
@@ -17,20 +44,42 @@ class DataFlowAgent:
                  messages=None,
                  available_functions=None,
                  is_enhanced_mode=False,
-                 is_developer_mode=False):
+                 is_developer_mode=False,
+                 compact_history=False,
+                 dictionary_token_budget=4000,
+                 retrieval_top_k=10,
+                 turn_budget=None,
+                 step_hook=None,
+                 debug_candidates=3,
+                 static_validation=True,
+                 llm_api:LlmBox=None,
+                 namespace:dict=None,
+                 answer_cache:AnswerCache=None,
+                 cell_timeout:float=DEFAULT_CELL_TIMEOUT):
         """
         初始参数解释：
         api_key：必选参数，表示调用OpenAI模型所必须的字符串密钥，没有默认取值，需要用户提前设置才可使用MateGen；
         model：可选参数，表示当前选择的Chat模型类型，默认为deepseek-chat，具体当前OpenAI账户可以调用哪些模型，可以参考官网Limit链接：https://platform.openai.com/account/limits ；
         system_content_list：可选参数，表示输入的系统消息或者外部文档，默认为空列表，表示不输入外部文档；
-        project：可选参数，表示当前对话所归属的项目名称，需要输入InterProject类对象，用于表示当前对话的本地存储方法，默认为None，表示不进行本地保存；
+        project：可选参数，表示当前对话所归属的项目名称，需要输入InterProject类对象，用于表示当前对话的本地存储方法，设置后每轮对话新增的消息会追加到项目的会话存储中，默认为None，表示不进行本地保存；
         messages：可选参数，表示当前对话所继承的Messages，需要是ChatMessages对象、或者是字典所构成的list，默认为None，表示不继承Messages；
         available_functions：可选参数，表示当前对话的外部工具，需要是AvailableFunction对象，默认为None，表示当前对话没有外部函数；
         is_enhanced_mode：可选参数，表示当前对话是否开启增强模式，增强模式下会自动开启复杂任务拆解流程以及深度debug功能，会需要耗费更多的计算时间和金额，不过会换来Agent整体性能提升，默认为False；
         is_developer_mode：可选参数，表示当前对话是否开启开发者模式，在开发者模式下，模型会先和用户确认文本或者代码是否正确，再选择是否进行保存或者执行，对于开发者来说借助开发者模式可以极大程度提升模型可用性，但并不推荐新人使用，默认为False；
+        compact_history：可选参数，表示是否开启会话压缩，开启后当对话token数量接近上限时，会在后台将较早的对话总结为会话状态摘要，而不是直接删除，默认为False；
+        dictionary_token_budget：可选参数，表示系统消息（数据字典）的token预算，当system_content_list中的数据字典（以markdown表格逐行说明字段的文档）超出该预算时，将对数据字典建立检索索引，每次只注入与当前问题和最近的函数调用相关的片段，其余系统消息仍然整体注入，设置为None时始终注入全部文档，默认为4000；
+        retrieval_top_k：可选参数，表示每次检索的数据字典片段数量，默认为10；
+        turn_budget：可选参数，TurnBudget对象，表示单轮对话的最大步数、最大耗时和最大token消耗，超出后提前结束本轮对话，默认为TurnBudget()，即最多50步；
+        step_hook：可选参数，单轮对话中每一步执行前调用的函数step_hook(state)，可用于统计指标，返回False时取消本轮对话，默认为None；
+        debug_candidates：可选参数，表示增强模式下代码报错时并行尝试的候选修改方案数量，各方案在变量空间的隔离快照上运行，采用第一个运行成功的方案，全部失败时再进行逐步的深度debug，设置为0时直接进行深度debug，默认为3；
+        static_validation：可选参数，表示是否在运行代码前进行静态检查（Python的语法、变量名和DataFrame字段，SQL的语法、数据表和字段），检查未通过时不执行代码，直接返回报错信息，默认为True；
+        llm_api：可选参数，表示已经创建好的大模型调用接口（LlmBox对象），传入后不再根据model和env_path重新创建，默认为None；
+        namespace：可选参数，表示外部函数运行时使用的变量空间（字典），默认为None，表示在首次使用时为当前会话创建独立的SessionNamespace，调用reset()时释放其中的变量；
+        answer_cache：可选参数，AnswerCache对象，表示问题级的回答缓存，新对话的第一个问题与缓存中的问题相同（规范化后）、系统上下文不变且依赖的数据表没有变化时，直接返回缓存的回答，开发者模式下会先由用户确认是否使用，默认为None，表示不使用回答缓存；
+        cell_timeout：可选参数，表示python_inter和fig_inter中单个代码单元的最长运行时间（秒），超时后由看门狗中断运行，并将中断时所在的代码行返回给模型，以便改写为向量化的写法，默认为None，即不限制，需要时设置为秒数（例如120）开启。运行外部函数时按Ctrl-C只中断当前的外部函数并结束本轮对话，不会退出会话；
         example:
             >>> af = AvailableFunctions(
-                    functions_list=[sql_inter, extract_data, python_inter, fig_inter]
+                    functions_list=[sql_inter, extract_data, python_inter, fig_inter, fetch_blob, export_data]
                 )
             >>> data_dictionary = open('telco_data_dictionary.md').read()
 
@@ -46,37 +95,338 @@ class DataFlowAgent:
         """
         self.model:str = model
         self.project:InterProject = project
+        # 会话存储中的会话id，以及上一次保存时的对话历史（用于找出本轮新增的消息）
+        self._namespace = None
+        self.session_id = uuid.uuid4().hex
+        self._saved_messages = []
         self.system_content_list:list = system_content_list
 
         self.tokens_thr:int = 12000
-        self.messages = ChatMessages(
-            system_content_list=self.system_content_list,
-            tokens_thr=self.tokens_thr,
-        )
+
+        # 数据字典超出token预算时，建立检索索引，只注入相关片段；数据字典以外的系统消息（指令等）始终整体注入
+        self.retriever = None
+        self._static_content_list = self.system_content_list
+        if dictionary_token_budget is not None and self.system_content_list:
+            flags = [is_dictionary(content) for content in self.system_content_list]
+            dictionaries = [content for content, flag in zip(self.system_content_list, flags) if flag]
+            counter = get_token_counter()
+            dictionary_tokens = sum(counter.count_text(content) for content in dictionaries)
+            if dictionary_tokens > dictionary_token_budget:
+                self.retriever = DictionaryIndex(
+                    dictionaries,
+                    top_k=retrieval_top_k,
+                    token_budget=dictionary_token_budget
+                )
+                self._static_content_list = [content for content, flag in zip(self.system_content_list, flags)
+                                             if not flag]
+                print(f"====>>> 数据字典共{dictionary_tokens} tokens，已建立检索索引（{len(self.retriever)}个片段）")
+
+        self.compactor = None
+        self.messages = self._new_messages()
         if messages:
             self.messages.messages_append(messages)
 
         self.available_functions:AvailableFunctions = available_functions
         self.is_enhanced_mode:bool = is_enhanced_mode
         self.is_developer_mode:bool = is_developer_mode
+        self.turn_budget:TurnBudget = turn_budget if turn_budget is not None else TurnBudget()
+        self.step_hook = step_hook
+
+        # 外部函数运行时使用的变量空间，未传入时在首次使用时创建
+        self.static_validation:bool = static_validation
+        self.cell_timeout = cell_timeout
+        self._schema_catalog = None
+        self._namespace = None
+        if namespace is not None:
+            self.namespace = namespace
+
+        self.llm_api = llm_api if llm_api is not None else LlmBox(env_path, self.model)
+        # 开启enrich_schemas时，借助当前的大模型接口完善自动生成的函数描述
+        if self.available_functions is not None and self.available_functions.llm_api is None:
+            self.available_functions.llm_api = self.llm_api
+
+        # 会话压缩器：较早的对话会被总结为会话状态，而不是直接删除
+        if compact_history:
+            self.compactor = SessionCompactor(self.llm_api, namespace=self._namespace)
+        self.messages.compactor = self.compactor
 
-        self.llm_api = LlmBox(env_path, self.model)
+        # 增强模式下的并行debug
+        self.debugger = None
+        if is_enhanced_mode and debug_candidates and self.available_functions is not None:
+            self.debugger = ParallelDebugger(self.llm_api, self.available_functions, n_candidates=debug_candidates)
+
+        # 最近一轮对话的运行状态（步数、token消耗、外部函数调用记录等）
+        self.last_turn = None
+        # 运行外部函数的线程池，服务模式下由多个会话共享，None表示在当前线程中运行
+        self.tool_executor = None
+        # 问题级的回答缓存，由新会话共享
+        self.answer_cache:AnswerCache = answer_cache
 
         if is_enhanced_mode:
             print("====>>> 开启增强模式中...")
         if is_developer_mode:
             print("====>>> 开启开发者模式中...")
 
-    def _base_chat(self):
-        messages = get_chat_response(
+    @property
+    def session_id(self) -> str:
+        return self._session_id
+
+    @session_id.setter
+    def session_id(self, session_id:str):
+        # 变量空间中同步记录会话id，外部函数保存产物时使用
+        self._session_id = session_id
+        if self._namespace is not None:
+            self._namespace[SESSION_ID_KEY] = session_id
+
+    @property
+    def namespace(self) -> dict:
+        """当前会话的变量空间，首次访问时创建"""
+        if self._namespace is None:
+            self.namespace = SessionNamespace()
+        return self._namespace
+
+    @namespace.setter
+    def namespace(self, namespace:dict):
+        # 预先放入__builtins__，避免exec将其作为新变量写入变量空间
+        namespace.setdefault('__builtins__', builtins)
+        if VALIDATOR_KEY not in namespace:
+            namespace[VALIDATOR_KEY] = StaticValidator(catalog=self._schema_catalog, enabled=self.static_validation)
+        else:
+            namespace[VALIDATOR_KEY].enabled = self.static_validation
+        if self.project is not None:
+            namespace[ARTIFACT_STORE_KEY] = self.project.artifact_store
+        namespace[SESSION_ID_KEY] = self._session_id
+        namespace[CELL_TIMEOUT_KEY] = self.cell_timeout
+        self._namespace = namespace
+        if self.compactor is not None:
+            self.compactor.namespace = namespace
+
+    def _new_messages(self):
+        """创建新的ChatMessages，使用检索索引时，数据字典不再整体作为系统消息"""
+        return ChatMessages(
+            system_content_list=self._static_content_list,
+            tokens_thr=self.tokens_thr,
+            compactor=self.compactor,
+            retriever=self.retriever
+        )
+
+    def _base_chat(self, on_event=None, step_hook=None):
+        turn = ChatTurn(
             llm_api=self.llm_api,
-            messages=self.messages,
             available_functions=self.available_functions,
             is_developer_mode=self.is_developer_mode,
+            budget=self.turn_budget,
+            step_hook=step_hook if step_hook is not None else self.step_hook,
+            debugger=self.debugger,
+            namespace=self.namespace,
+            on_event=on_event,
+            tool_executor=self.tool_executor
+        )
+        self.last_turn = turn.state
+        messages = turn.run(
+            messages=self.messages,
             is_enhanced_mode=self.is_enhanced_mode
         )
         return messages
 
+    def _is_fresh(self) -> bool:
+        """当前对话中还没有assistant的回答，此时问题的回答只取决于问题本身和系统上下文"""
+        for message in self.messages.history_messages:
+            role = message.get('role') if isinstance(message, dict) else getattr(message, 'role', None)
+            if role == 'assistant':
+                return False
+        return True
+
+    def context_fingerprint(self) -> str:
+        """回答缓存使用的系统上下文指纹：数据字典、模型、外部函数以及增强模式"""
+        return context_fingerprint(
+            self.system_content_list,
+            self.available_functions,
+            self.model,
+            enhanced=self.is_enhanced_mode
+        )
+
+    def _cached_answer(self, question:str):
+        """
+        查找回答缓存，命中时将问题和缓存的回答追加到对话中并返回回答，未命中或用户选择跳过时返回None
+        """
+        if self.answer_cache is None or not self._is_fresh():
+            return None
+        start = time.perf_counter()
+        fingerprint = self.context_fingerprint()
+        entry = self.answer_cache.get(question, fingerprint)
+        if entry is None:
+            return None
+        seconds = time.perf_counter() - start
+
+        if self.is_developer_mode:
+            print(f">>> 找到缓存的回答（原先耗时{entry['seconds']:.1f}秒，已使用{entry['hits']}次），"
+                  f"依赖的数据表：{', '.join(entry['tables']) or '无'}")
+            for call in entry['tool_trace']:
+                print(f">>> {call.get('name')}：{call.get('arguments')}")
+            print(entry['answer'])
+            user_input = input("使用缓存的回答请输入1，重新分析请输入2：")
+            if user_input != '1':
+                self.answer_cache.bypass()
+                return None
+
+        self.messages.messages_append({"role": "user", "content": question})
+        self.messages.messages_append({"role": "assistant", "content": entry['answer']})
+        state = TurnState()
+        state.tool_trace = entry['tool_trace']
+        state.cached = True
+        self.last_turn = state
+        self.save_turn()
+        self.answer_cache.confirm_hit(question, fingerprint, entry, seconds)
+        return entry['answer']
+
+    def _store_answer(self, question:str, answer:str, seconds:float):
+        """将新对话第一个问题的回答保存到回答缓存，提前结束的对话不保存"""
+        state = self.last_turn
+        if not answer or state is None or state.stop_reason:
+            return
+        self.answer_cache.put(question, self.context_fingerprint(), answer, state.tool_trace, seconds)
+
+    def _answer(self, question:str, on_event=None, step_hook=None) -> str:
+        answer = self._cached_answer(question)
+        if answer is not None:
+            return answer
+        cacheable = self.answer_cache is not None and self._is_fresh()
+        start = time.perf_counter()
+        self.messages.messages_append({"role": "user", "content": question})
+        self.messages = self._base_chat(on_event=on_event, step_hook=step_hook)
+        self.save_turn()
+        answer = final_answer(self.messages)
+        if cacheable:
+            self._store_answer(question, answer, time.perf_counter() - start)
+        return answer
+
+    def ask(self, question:str, on_event=None, step_hook=None) -> str:
+        """
+        回答一个问题并返回最终的文本回答，不进行任何人工交互，供批量问答和服务模式使用
+        :param question: 用户问题
+        :param on_event: 可选参数，接收运行事件（步骤、流式文本、外部函数进度）的函数
+        :param step_hook: 可选参数，本轮对话使用的step_hook，默认为初始化时传入的step_hook
+        """
+        return self._answer(question, on_event=on_event, step_hook=step_hook)
+
+    def save_turn(self, flush=False):
+        """
+        将上一次保存之后新增的消息作为一轮对话追加到项目的会话存储中，未设置project时不进行保存
+        :param flush: 是否立即写入数据库，默认为False，由会话存储批量写入
+        :return: 保存的消息数量
+        """
+        if self.project is None:
+            return 0
+        history = self.messages.history_messages
+        # 对话历史中未变化的消息是同一个对象，按对象id找出新增的消息；
+        # _saved_messages持有上一次的消息对象，保证其id不会被新消息复用
+        saved = {id(message) for message in self._saved_messages}
+        new_messages = [message for message in history if id(message) not in saved]
+        if new_messages:
+            self.project.append_turn(self.session_id, new_messages)
+        if flush:
+            self.project.session_store.flush()
+        self._saved_messages = list(history)
+        return len(new_messages)
+
+    def resume(self, session_id:str, last_turns:int=None):
+        """
+        从项目的会话存储中恢复某个会话最近last_turns轮的对话，之后的对话继续保存到该会话中
+        :param session_id: 会话id，可以通过project.list_sessions()查看
+        :param last_turns: 可选参数，恢复的轮次数量，默认为None，表示恢复全部对话（超出token上限的较早消息会被淘汰）
+        """
+        if self.project is None:
+            raise ValueError("需要先输入project参数（需要是一个InterProject对象），才可恢复会话")
+        self._restore_messages(self.project.load_last_turns(session_id, last_turns))
+        self.session_id = session_id
+        return self
+
+    def _restore_messages(self, messages:list, session_state:str=None):
+        self.messages = self._new_messages()
+        if messages:
+            # 去掉ChatMessages默认的首条问题，恢复的对话中已经包含
+            if self.messages.history_messages:
+                self.messages.messages_pop(manual=True, index=0)
+            self.messages.messages_append([message_from_dict(message) for message in messages])
+        if session_state is not None:
+            self.messages.set_session_state(session_state)
+        # 恢复的消息已经保存在会话存储中
+        self._saved_messages = list(self.messages.history_messages)
+
+    def _checkpoint_path(self, session_id:str=None) -> str:
+        if self.project is None:
+            raise ValueError("需要先输入project参数（需要是一个InterProject对象），或者指定检查点目录path")
+        return os.path.join(self.project.folder_id, 'checkpoints', session_id or self.session_id)
+
+    def checkpoint(self, path:str=None) -> dict:
+        """
+        保存当前会话的检查点（对话历史和变量空间），只写入上一次检查点之后发生变化的列和变量
+        :param path: 可选参数，检查点目录，默认为项目文件夹下的checkpoints/会话id
+        :return: 统计信息：变量数量、写入和复用的文件数量、写入字节数、跳过的变量、耗时（秒）
+        """
+        checkpoint = SessionCheckpoint(path or self._checkpoint_path())
+        stats = checkpoint.save(self.messages, self.namespace)
+        if stats['skipped']:
+            print(f">>> 以下变量无法保存，已跳过：{', '.join(stats['skipped'])}")
+        return stats
+
+    def restore(self, session_id:str=None, path:str=None):
+        """
+        从检查点恢复会话：对话历史原样恢复，DataFrame的数值列以内存映射方式打开，访问时才读入数据。
+        恢复后的会话继续使用该会话id保存对话和检查点
+        :param session_id: 会话id，检查点位于项目文件夹下的checkpoints/会话id
+        :param path: 可选参数，检查点目录，指定后不使用session_id查找
+        """
+        if path is None and session_id is None:
+            raise ValueError("需要指定session_id或检查点目录path")
+        checkpoint = SessionCheckpoint(path or self._checkpoint_path(session_id))
+        state = checkpoint.load()
+        self._restore_messages(state['messages'], state['session_state'])
+        if session_id is not None:
+            self.session_id = session_id
+        if self._namespace is not None:
+            release_namespace(self._namespace)
+        self.namespace.update(state['variables'])
+        return self
+
+    def new_session(self, namespace:dict=None) -> 'DataFlowAgent':
+        """
+        创建一个独立的会话：共享模型配置、外部函数、数据字典检索索引以及大模型client和限流器，
+        使用独立的对话历史、变量空间、会话压缩器和指标统计，可以与其他会话并发运行。
+        开发者模式需要人工输入，新会话中不开启。
+        :param namespace: 可选参数，新会话的变量空间，默认在首次使用时创建新的SessionNamespace
+        """
+        session = copy.copy(self)
+        session.is_developer_mode = False
+        session.llm_api = self.llm_api.share()
+        if self._namespace is not None:
+            session._schema_catalog = get_validator(self._namespace).catalog
+        session._namespace = None
+        session.compactor = None
+        if namespace is not None:
+            session.namespace = namespace
+        if self.compactor is not None:
+            session.compactor = SessionCompactor(
+                session.llm_api,
+                high_water=self.compactor.high_water,
+                keep_turns=self.compactor.keep_turns,
+                background=self.compactor.background,
+                namespace=session._namespace
+            )
+        if self.debugger is not None:
+            session.debugger = ParallelDebugger(
+                session.llm_api,
+                self.available_functions,
+                n_candidates=self.debugger.n_candidates,
+                use_n=self.debugger.use_n
+            )
+        session.messages = session._new_messages()
+        session.last_turn = None
+        session.session_id = uuid.uuid4().hex
+        session._saved_messages = []
+        return session
+
     def run(self, question=None):
         """
         MateGen类主方法，支持单次对话和多轮对话两种模式，当用户没有输入question时开启多轮对话，反之则开启单轮对话。\
@@ -85,6 +435,7 @@ class DataFlowAgent:
         if question is None:
             while True:
                 self.messages = self._base_chat()
+                self.save_turn()
                 user_input = input("🤖: 您还有其他问题吗？(输入cls清除之前对话，输入Q或q以结束对话): ")
                 if user_input == 'cls':
                     self.reset()
@@ -101,27 +452,46 @@ class DataFlowAgent:
                 # print("$$$$$$################", self.messages.messages[-3:])
 
         else:
-            self.messages.messages_append({"role": "user", "content": question})
-            self.messages = self._base_chat()
+            answer = self._answer(question)
+            if self.last_turn is not None and self.last_turn.cached and not self.is_developer_mode:
+                print("🤖: Mate Response（缓存的回答）：\n")
+                print(answer)
+
 
+    def get_validation_metrics(self) -> dict:
+        """静态检查的统计：检查次数、避免的执行往返次数及各类错误数量"""
+        return get_validator(self.namespace).get_metrics()
 
+    def get_memory_usage(self) -> dict:
+        """当前会话变量空间中各变量占用的内存（字节），变量空间尚未创建时返回空字典"""
+        if self._namespace is None:
+            return {}
+        if isinstance(self._namespace, SessionNamespace):
+            return self._namespace.memory_usage()
+        return SessionNamespace(self._namespace).memory_usage()
 
     def reset(self):
         """
-        重置当前的MateGen对象的messages
+        重置当前的MateGen对象的messages，并释放变量空间中的变量（DataFrame等）和结果存储
+        :return: 释放前变量空间估算的内存占用（字节）
         """
-        self.messages = ChatMessages(
-            system_content_list=self.system_content_list
-        )
+        self.messages = self._new_messages()
+        # 重置后的对话保存为新的会话
+        self.session_id = uuid.uuid4().hex
+        self._saved_messages = []
+        if self._namespace is None:
+            return 0
+        return release_namespace(self._namespace)
 
     def upload_messages(self):
        """
-       将当前messages上传至project项目中
+       将当前messages中尚未保存的消息写入project项目的会话存储
+       :return: 会话id
        """
        if self.project is None:
            print("需要先输入project参数（需要是一个InterProject对象），才可上传messages")
            return None
        else:
-           self.project.append_doc_content(
-               content=self.messages.history_messages
-           )
+           self.save_turn(flush=True)
+           print(">>> 数据持久化保存：", self.project.session_store.path)
+           return self.session_id
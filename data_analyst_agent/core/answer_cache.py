@@ -0,0 +1,241 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+from .validation import referenced_tables
+
+# 外部函数中包含SQL的参数，用于找出回答依赖的数据表
+SQL_ARGS = ('sql_query',)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    question TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    tool_trace TEXT NOT NULL,
+    versions TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    created REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def normalize_question(question:str) -> str:
+    """问题文本规范化：全角转半角、小写、合并空白、去掉末尾的标点"""
+    text = unicodedata.normalize('NFKC', question).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('。.？?！!；;，, ')
+
+
+def context_fingerprint(system_content_list=(), available_functions=None, model=None, **extra) -> str:
+    """
+    系统上下文指纹：数据字典等系统消息、模型、外部函数（名称和源代码哈希）以及其他影响回答的设置，
+    其中任一项变化时，缓存的回答不再使用
+    """
+    from .functions import source_hash
+    digest = hashlib.blake2b(digest_size=16)
+    for content in system_content_list or ():
+        digest.update(hashlib.blake2b(str(content).encode('utf-8'), digest_size=16).digest())
+    functions = getattr(available_functions, 'functions_list', None) or []
+    parts = {
+        'model': model,
+        'functions': sorted(f"{f.__name__}:{source_hash(f)}" for f in functions),
+        **extra,
+    }
+    digest.update(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def trace_tables(tool_trace:list):
+    """
+    外部函数调用记录中SQL引用的数据表。
+    任一条SQL无法解析出数据表时返回None：此时无法判断回答依赖哪些数据，回答不能缓存
+    """
+    tables = []
+    for call in tool_trace:
+        try:
+            arguments = json.loads(call.get('arguments') or '{}')
+        except (TypeError, ValueError):
+            continue
+        if not isinstance(arguments, dict):
+            continue
+        for arg in SQL_ARGS:
+            if isinstance(arguments.get(arg), str):
+                referenced = referenced_tables(arguments[arg])
+                if not referenced:
+                    return None
+                tables.extend(t for t in referenced if t not in tables)
+    return tables
+
+
+class AnswerCache:
+    """
+    问题级的回答缓存：以规范化的问题文本和系统上下文指纹为键，保存最终回答和产生该回答的外部函数调用记录，
+    以及回答依赖的数据表（调用记录中SQL引用的表）当时的版本（行数，配置了版本字段时还包括该字段的最大值）。
+    读取时重新获取这些数据表的版本，任一数据表发生变化时删除该条缓存。
+    多个分析人员的会话可以共享同一个AnswerCache（传入文件路径时可以跨进程共享）。
+    """
+    def __init__(self, path=':memory:', connect=None, version_columns=None, max_age=None):
+        """
+        :param path: 缓存数据库文件路径，默认为':memory:'
+        :param connect: 获取源数据库连接的上下文管理器函数，默认为run_sql.db_connection
+        :param version_columns: 数据表名 -> 版本字段名（例如更新时间或自增主键），与行数一起作为数据表的版本
+        :param max_age: 缓存的最长有效期（秒），默认为None，表示只按数据表版本失效
+        """
+        self.path = path
+        self._connect = connect
+        self.version_columns = {table.lower(): column for table, column in (version_columns or {}).items()}
+        self.max_age = max_age
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+        self._lock = threading.RLock()
+        self._stats = {'lookups': 0, 'hits': 0, 'misses': 0, 'invalidated': 0, 'bypassed': 0, 'stores': 0,
+                       'seconds_saved': 0.0, 'lookup_seconds': 0.0}
+
+    @staticmethod
+    def key(question:str, fingerprint:str) -> str:
+        return hashlib.blake2b(f"{normalize_question(question)}\n{fingerprint}".encode('utf-8'),
+                               digest_size=16).hexdigest()
+
+    def _source(self):
+        if self._connect is not None:
+            return self._connect()
+        from ..functions_lib.run_sql import db_connection
+        return db_connection()
+
+    def table_versions(self, tables) -> dict:
+        """
+        数据表的当前版本：{表名: [行数, 版本字段最大值]}，在一次查询中获取全部数据表的版本
+        """
+        if not tables:
+            return {}
+        selects = []
+        for i, table in enumerate(tables):
+            column = self.version_columns.get(table.split('.')[-1].lower())
+            selects.append(f"SELECT {i}, COUNT(*), {f'MAX({column})' if column else 'NULL'} FROM {table}")
+        with self._source() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(' UNION ALL '.join(selects))
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        versions = {}
+        for index, count, stamp in rows:
+            # 时间等类型统一转换为字符串，便于保存和比较
+            versions[tables[int(index)]] = [int(count), stamp if stamp is None or isinstance(stamp, (int, float))
+                                            else str(stamp)]
+        return versions
+
+    def get(self, question:str, fingerprint:str):
+        """
+        查找缓存的回答，依赖的数据表发生变化或超过有效期时删除该条缓存并返回None
+        :return: 字典：answer、tool_trace、seconds（原先的端到端耗时）、created、hits，未命中时返回None
+        """
+        start = time.perf_counter()
+        key = self.key(question, fingerprint)
+        with self._lock:
+            self._stats['lookups'] += 1
+            row = self._connection.execute(
+                "SELECT answer, tool_trace, versions, seconds, created, hits FROM answers WHERE key = ?",
+                (key,)).fetchone()
+        entry = None
+        if row is not None:
+            versions = json.loads(row[2])
+            expired = self.max_age is not None and time.time() - row[4] > self.max_age
+            try:
+                changed = expired or self.table_versions(list(versions)) != versions
+            except Exception as e:
+                print(f">>> 无法获取数据表版本，不使用缓存的回答：{e}")
+                changed = True
+            if changed:
+                with self._lock:
+                    self._connection.execute("DELETE FROM answers WHERE key = ?", (key,))
+                    self._stats['invalidated'] += 1
+            else:
+                entry = {'answer': row[0], 'tool_trace': json.loads(row[1]), 'tables': list(versions),
+                         'seconds': row[3], 'created': row[4], 'hits': row[5]}
+        with self._lock:
+            self._stats['lookup_seconds'] += time.perf_counter() - start
+            self._stats['hits' if entry else 'misses'] += 1
+        return entry
+
+    def confirm_hit(self, question:str, fingerprint:str, entry:dict, seconds:float):
+        """记录一次被使用的缓存回答：seconds为本次从查找到返回回答的耗时"""
+        with self._lock:
+            self._connection.execute("UPDATE answers SET hits = hits + 1 WHERE key = ?",
+                                     (self.key(question, fingerprint),))
+            self._stats['seconds_saved'] += max(0.0, entry['seconds'] - seconds)
+
+    def bypass(self):
+        """开发者模式下用户选择不使用缓存的回答"""
+        with self._lock:
+            self._stats['hits'] -= 1
+            self._stats['bypassed'] += 1
+
+    def put(self, question:str, fingerprint:str, answer:str, tool_trace:list, seconds:float):
+        """
+        保存回答及其外部函数调用记录，同时记录依赖的数据表当前的版本；
+        调用记录中有无法解析出数据表的SQL时不保存，返回False
+        :param seconds: 产生该回答的端到端耗时（秒）
+        """
+        tables = trace_tables(tool_trace)
+        if tables is None:
+            print(">>> 无法解析调用记录中SQL引用的数据表，不缓存本次回答")
+            return False
+        try:
+            versions = self.table_versions(tables)
+        except Exception as e:
+            print(f">>> 无法获取数据表版本，不缓存本次回答：{e}")
+            return False
+        trace = [{k: v for k, v in call.items() if isinstance(v, (str, int, float, bool, type(None)))}
+                 for call in tool_trace]
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO answers (key, question, fingerprint, answer, tool_trace, versions, seconds, "
+                "created, hits) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (self.key(question, fingerprint), question, fingerprint, answer,
+                 json.dumps(trace, ensure_ascii=False), json.dumps(versions, ensure_ascii=False), seconds, time.time()))
+            self._stats['stores'] += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM answers")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def get_stats(self) -> dict:
+        """
+        命中率（使用缓存回答的次数占查找次数的比例）、因数据表变化失效的次数、开发者模式下跳过的次数，
+        以及估算节省的端到端耗时（原先的耗时减去本次查找和返回的耗时）
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['hit_rate'] = stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+        stats['entries'] = len(self)
+        return stats
+
+    def report(self) -> str:
+        stats = self.get_stats()
+        return (f"查找回答缓存{stats['lookups']}次，使用缓存回答{stats['hits']}次（命中率{stats['hit_rate']:.1%}），"
+                f"估算节省{stats['seconds_saved']:.3f}秒；因数据表变化失效{stats['invalidated']}次，"
+                f"开发者模式下跳过{stats['bypassed']}次，保存回答{stats['stores']}次，当前缓存{stats['entries']}条")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
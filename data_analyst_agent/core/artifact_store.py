@@ -0,0 +1,261 @@
+"""
+项目级的产物存储：保存fig_inter生成的图片、模型导出的数据表等文件，外部函数结果中只返回产物id，不直接放入数据。
+1、按内容寻址：文件以内容的SHA-256命名，相同内容（例如对同一份数据重复绘制的图片）只保存一份；
+2、元数据（类型、大小、创建和最近访问时间）以及引用（会话、外部函数调用id、名称）保存在artifacts.db（SQLite）中；
+3、gc()删除没有引用的产物以及目录中不属于任何产物的文件，写入前超出容量上限时先进行gc，仍然超出时拒绝写入。
+
+目录结构：
+    artifacts/artifacts.db
+    artifacts/objects/ab/ab12...ef.png
+"""
+import io
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import contextvars
+
+ARTIFACT_STORE_KEY = '_artifact_store'
+SESSION_ID_KEY = '_session_id'
+# 产物id的长度（SHA-256的前若干个十六进制字符）
+ID_LENGTH = 20
+
+# 当前正在运行的外部函数调用id，由function_to_call设置，用于记录产物的来源
+current_tool_call = contextvars.ContextVar('current_tool_call', default=None)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    id TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    artifact TEXT NOT NULL,
+    session TEXT,
+    tool_call TEXT,
+    name TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_refs_artifact ON refs (artifact);
+CREATE INDEX IF NOT EXISTS idx_refs_session ON refs (session);
+"""
+
+
+class QuotaExceededError(Exception):
+    """产物存储超出容量上限"""
+
+
+class ArtifactStore:
+    """
+    按内容寻址的产物存储
+    example:
+        >>> store = ArtifactStore('./project/artifacts', quota_bytes=1024 ** 3)
+        >>> artifact_id = store.put_figure(fig, session='s1', name='fig')
+        >>> store.path(artifact_id)
+    """
+    def __init__(self, root, quota_bytes=None, fsync=False):
+        """
+        :param root: 存储目录
+        :param quota_bytes: 可选参数，容量上限（字节），默认为None，表示不限制
+        :param fsync: 是否在写入文件后调用fsync，默认为False
+        """
+        self.root = root
+        self.object_dir = os.path.join(root, 'objects')
+        self.quota_bytes = quota_bytes
+        self.fsync = fsync
+        os.makedirs(self.object_dir, exist_ok=True)
+
+        self._connection = sqlite3.connect(os.path.join(root, 'artifacts.db'), check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        self._lock = threading.RLock()
+
+        self.metrics = {'puts': 0, 'deduplicated': 0, 'bytes_written': 0, 'bytes_deduplicated': 0}
+
+    def _object_path(self, artifact_id, ext) -> str:
+        return os.path.join(self.object_dir, artifact_id[:2], f"{artifact_id}{ext}")
+
+    def total_size(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+
+    def put_bytes(self, data:bytes, ext:str='', kind:str='file', session:str=None, tool_call:str=None,
+                  name:str=None) -> str:
+        """
+        保存一段内容并记录一次引用，内容已存在时只记录引用
+        :param data: 文件内容
+        :param ext: 文件扩展名，例如.png
+        :param kind: 产物类型，例如figure、frame
+        :param session: 可选参数，产生该产物的会话id
+        :param tool_call: 可选参数，产生该产物的外部函数调用id，默认为当前正在运行的外部函数调用
+        :param name: 可选参数，产物名称（例如变量名）
+        :return: 产物id
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        artifact_id = sha256[:ID_LENGTH]
+        tool_call = tool_call if tool_call is not None else current_tool_call.get()
+        now = time.time()
+        with self._lock:
+            connection = self._connection
+            exists = connection.execute("SELECT 1 FROM artifacts WHERE id = ?", (artifact_id,)).fetchone()
+            if exists:
+                self.metrics['deduplicated'] += 1
+                self.metrics['bytes_deduplicated'] += len(data)
+                connection.execute("UPDATE artifacts SET accessed = ? WHERE id = ?", (now, artifact_id))
+            else:
+                if self.quota_bytes is not None and self.total_size() + len(data) > self.quota_bytes:
+                    self.gc()
+                    if self.total_size() + len(data) > self.quota_bytes:
+                        raise QuotaExceededError(
+                            f"产物存储超出容量上限{self.quota_bytes}字节，请删除不需要的产物后重试")
+                self._write(self._object_path(artifact_id, ext), data)
+                connection.execute(
+                    "INSERT INTO artifacts (id, sha256, kind, ext, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (artifact_id, sha256, kind, ext, len(data), now, now))
+                self.metrics['bytes_written'] += len(data)
+            connection.execute("INSERT INTO refs (artifact, session, tool_call, name, created) VALUES (?, ?, ?, ?, ?)",
+                               (artifact_id, session, tool_call, name, now))
+            self.metrics['puts'] += 1
+        return artifact_id
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+            if self.fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    def put_figure(self, fig, session=None, tool_call=None, name=None, dpi=100) -> str:
+        """将matplotlib的Figure保存为PNG"""
+        buffer = io.BytesIO()
+        # 去掉PNG中的软件版本信息，使相同的图片得到相同的内容
+        fig.savefig(buffer, format='png', dpi=dpi, metadata={'Software': None})
+        return self.put_bytes(buffer.getvalue(), ext='.png', kind='figure', session=session, tool_call=tool_call,
+                              name=name)
+
+    def put_frame(self, df, file_format='csv', session=None, tool_call=None, name=None) -> str:
+        """
+        将DataFrame保存为csv或parquet文件
+        :param file_format: csv或parquet，parquet需要安装pyarrow或fastparquet
+        """
+        if file_format == 'parquet':
+            try:
+                data = df.to_parquet(index=False)
+            except ImportError as e:
+                raise ValueError(f"保存为parquet需要安装pyarrow或fastparquet：{e}")
+        elif file_format == 'csv':
+            data = df.to_csv(index=False).encode('utf-8')
+        else:
+            raise ValueError(f"不支持的文件格式：{file_format}，可选csv或parquet")
+        return self.put_bytes(data, ext=f'.{file_format}', kind='frame', session=session, tool_call=tool_call,
+                              name=name)
+
+    def info(self, artifact_id) -> dict:
+        """产物的元数据以及全部引用"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, kind, ext, size, created, accessed FROM artifacts WHERE id = ?", (artifact_id,)).fetchone()
+            if row is None:
+                raise KeyError(f"不存在产物{artifact_id}")
+            refs = self._connection.execute(
+                "SELECT session, tool_call, name, created FROM refs WHERE artifact = ? ORDER BY id",
+                (artifact_id,)).fetchall()
+        info = dict(zip(('id', 'kind', 'ext', 'size', 'created', 'accessed'), row))
+        info['path'] = self._object_path(artifact_id, info['ext'])
+        info['refs'] = [dict(zip(('session', 'tool_call', 'name', 'created'), ref)) for ref in refs]
+        return info
+
+    def path(self, artifact_id) -> str:
+        """产物文件的路径"""
+        return self.info(artifact_id)['path']
+
+    def read_bytes(self, artifact_id) -> bytes:
+        path = self.path(artifact_id)
+        with self._lock:
+            self._connection.execute("UPDATE artifacts SET accessed = ? WHERE id = ?", (time.time(), artifact_id))
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def list(self, session=None, kind=None) -> list:
+        """列出产物（可以按会话和类型筛选），按创建时间倒序排列"""
+        conditions, params = [], []
+        if session is not None:
+            conditions.append("id IN (SELECT artifact FROM refs WHERE session = ?)")
+            params.append(session)
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT id, kind, ext, size, created FROM artifacts {where} ORDER BY created DESC", params).fetchall()
+        return [dict(zip(('id', 'kind', 'ext', 'size', 'created'), row)) for row in rows]
+
+    def release(self, session=None, artifact_id=None) -> int:
+        """
+        删除某个会话或某个产物的引用，失去全部引用的产物在gc()时删除
+        :return: 删除的引用数量
+        """
+        if session is None and artifact_id is None:
+            raise ValueError("需要指定session或artifact_id")
+        column, value = ('session', session) if session is not None else ('artifact', artifact_id)
+        with self._lock:
+            return self._connection.execute(f"DELETE FROM refs WHERE {column} = ?", (value,)).rowcount
+
+    def gc(self) -> dict:
+        """
+        删除没有引用的产物，以及目录中不属于任何产物的文件（例如中断写入留下的临时文件）
+        :return: 删除的产物数量和释放的字节数
+        """
+        removed, freed = 0, 0
+        with self._lock:
+            connection = self._connection
+            rows = connection.execute(
+                "SELECT id, ext, size FROM artifacts WHERE id NOT IN (SELECT artifact FROM refs)").fetchall()
+            for artifact_id, ext, size in rows:
+                try:
+                    os.remove(self._object_path(artifact_id, ext))
+                except FileNotFoundError:
+                    pass
+                removed += 1
+                freed += size
+            connection.executemany("DELETE FROM artifacts WHERE id = ?", [(row[0],) for row in rows])
+
+            known = {os.path.basename(self._object_path(artifact_id, ext))
+                     for artifact_id, ext in connection.execute("SELECT id, ext FROM artifacts")}
+            for directory, _, files in os.walk(self.object_dir):
+                for file_name in files:
+                    if file_name not in known:
+                        path = os.path.join(directory, file_name)
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+        return {'removed': removed, 'bytes_freed': freed}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            artifacts, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts").fetchone()
+            refs = self._connection.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+        stats = dict(self.metrics)
+        stats.update(artifacts=artifacts, refs=refs, bytes=size, quota_bytes=self.quota_bytes)
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_artifact_store(g:dict):
+    """获取分析环境中的产物存储，未设置项目时返回None"""
+    return g.get(ARTIFACT_STORE_KEY)
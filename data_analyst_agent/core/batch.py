@@ -0,0 +1,245 @@
+import io
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ..api import RateLimiter
+from ..functions_lib import run_sql
+
+
+class ThreadRoutedStream:
+    """
+    按线程分流的标准输出：并发运行的会话各自把打印内容写入自己的缓冲区，互不干扰
+    """
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    def set_stream(self, stream):
+        self._local.stream = stream
+
+    def _stream(self):
+        return getattr(self._local, 'stream', None) or self.default
+
+    def write(self, text):
+        return self._stream().write(text)
+
+    def flush(self):
+        return self._stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+@contextmanager
+def routed_stdout():
+    original = sys.stdout
+    routed = ThreadRoutedStream(original)
+    sys.stdout = routed
+    try:
+        yield routed
+    finally:
+        sys.stdout = original
+
+
+def read_questions(path) -> list:
+    """
+    读取JSONL格式的问题文件，每行为{"id": ..., "question": ...}，id可以省略（默认为行号）
+    """
+    questions = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line_no, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {'question': item}
+            if 'question' not in item:
+                raise ValueError(f"第{line_no}行缺少question字段")
+            item.setdefault('id', line_no)
+            questions.append(item)
+    return questions
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class BatchRunner:
+    """
+    批量问答：在线程池中并发运行一组问题，每个问题使用独立的会话（对话历史、变量空间），
+    会话之间共享大模型client、限流器和数据库连接池，结果按完成顺序写入JSONL文件。
+    """
+    def __init__(self,
+                 agent,
+                 concurrency=4,
+                 requests_per_minute=None,
+                 max_concurrent_requests=None,
+                 db_pool_size=None,
+                 capture_logs=False):
+        """
+        :param agent: DataFlowAgent对象，作为各会话的模板（模型配置、外部函数、数据字典）
+        :param concurrency: 同时运行的问题数量
+        :param requests_per_minute: 所有会话合计每分钟最多发起的大模型请求数，None表示不限制
+        :param max_concurrent_requests: 所有会话合计同时进行的大模型请求数，None表示不限制
+        :param db_pool_size: 共享数据库连接池的连接数，默认与concurrency相同，设置为0时不使用连接池
+        :param capture_logs: 是否在结果中保留每个问题运行过程的打印内容
+        """
+        self.agent = agent
+        self.concurrency = concurrency
+        self.capture_logs = capture_logs
+        self.db_pool_size = concurrency if db_pool_size is None else db_pool_size
+        self.rate_limiter = None
+        if requests_per_minute or max_concurrent_requests:
+            self.rate_limiter = RateLimiter(requests_per_minute, max_concurrent_requests)
+
+    def run_one(self, item:dict, index:int=0) -> dict:
+        """在独立会话中回答一个问题，返回结果记录"""
+        session = self.agent.new_session()
+        log = io.StringIO()
+        if isinstance(sys.stdout, ThreadRoutedStream):
+            sys.stdout.set_stream(log)
+
+        record = {'id': item.get('id', index), 'index': index, 'question': item['question']}
+        start = time.perf_counter()
+        try:
+            record['answer'] = session.ask(item['question'])
+            record['status'] = 'ok'
+            record['error'] = None
+        except Exception as e:
+            record['status'] = 'error'
+            record['answer'] = None
+            record['error'] = f"{type(e).__name__}: {e}"
+        finally:
+            if isinstance(sys.stdout, ThreadRoutedStream):
+                sys.stdout.set_stream(None)
+        record['latency'] = time.perf_counter() - start
+
+        state = session.last_turn
+        if state is not None and state.stop_reason and record['status'] == 'ok':
+            record['status'] = 'stopped'
+        usage = {'prompt': 0, 'completion': 0}
+        get_metrics = getattr(session.llm_api, 'get_metrics', None)
+        for metrics in (get_metrics() if get_metrics else {}).values():
+            usage['prompt'] += metrics.get('prompt_tokens', 0)
+            usage['completion'] += metrics.get('completion_tokens', 0)
+        usage['estimated'] = state.tokens if state is not None else 0
+        record['tokens'] = usage
+        record['llm_calls'] = state.llm_calls if state is not None else 0
+        record['steps'] = state.steps if state is not None else 0
+        record['stop_reason'] = state.stop_reason if state is not None else None
+        record['tool_trace'] = state.tool_trace if state is not None else []
+        if self.capture_logs:
+            record['log'] = log.getvalue()
+
+        # 释放会话的变量空间和结果存储
+        session.reset()
+        return record
+
+    def run(self, questions:list, output_path=None) -> list:
+        """
+        并发运行全部问题
+        :param questions: 由{"id": ..., "question": ...}组成的list
+        :param output_path: 可选参数，结果JSONL文件路径，每完成一个问题写入一行
+        :return: 按输入顺序排列的结果记录
+        """
+        results = [None] * len(questions)
+        write_lock = threading.Lock()
+        output = open(output_path, 'w', encoding='utf-8') if output_path else None
+
+        pool = None
+        previous_pool = run_sql._connection_pool
+        if self.db_pool_size:
+            pool = run_sql.ConnectionPool(size=self.db_pool_size)
+            run_sql.set_connection_pool(pool)
+        # 各会话的LlmBox由agent.llm_api.share()创建，共享同一个限流器；运行结束后恢复模板agent原来的限流器
+        previous_limiter = getattr(self.agent.llm_api, 'rate_limiter', None)
+        if self.rate_limiter is not None:
+            self.agent.llm_api.rate_limiter = self.rate_limiter
+
+        start = time.perf_counter()
+        try:
+            with routed_stdout(), ThreadPoolExecutor(max_workers=self.concurrency,
+                                                      thread_name_prefix='batch') as executor:
+                futures = {executor.submit(self.run_one, item, i): i for i, item in enumerate(questions)}
+                for future in as_completed(futures):
+                    record = future.result()
+                    results[record['index']] = record
+                    if output is not None:
+                        with write_lock:
+                            output.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                            output.flush()
+                    print(f">>> [{sum(r is not None for r in results)}/{len(questions)}] "
+                          f"{record['id']} {record['status']} {record['latency']:.2f}s")
+        finally:
+            if output is not None:
+                output.close()
+            if self.rate_limiter is not None:
+                self.agent.llm_api.rate_limiter = previous_limiter
+            if pool is not None:
+                run_sql.set_connection_pool(previous_pool)
+                pool.close()
+
+        self.wall_time = time.perf_counter() - start
+        return results
+
+    def summarize(self, results:list) -> dict:
+        latencies = [r['latency'] for r in results]
+        return {
+            'questions': len(results),
+            'ok': sum(r['status'] == 'ok' for r in results),
+            'errors': sum(r['status'] == 'error' for r in results),
+            'stopped': sum(r['status'] == 'stopped' for r in results),
+            'wall_time': getattr(self, 'wall_time', 0.0),
+            'latency_p50': _percentile(latencies, 0.5),
+            'latency_p95': _percentile(latencies, 0.95),
+            'prompt_tokens': sum(r['tokens']['prompt'] for r in results),
+            'completion_tokens': sum(r['tokens']['completion'] for r in results),
+        }
+
+
+def run_batch(agent, input_path, output_path, concurrency=4, **kwargs) -> dict:
+    """
+    批量回答JSONL文件中的问题，并将结果写入JSONL文件
+    :param agent: DataFlowAgent对象，作为各会话的模板
+    :param input_path: 问题文件路径
+    :param output_path: 结果文件路径
+    :param concurrency: 同时运行的问题数量
+    :return: 汇总统计
+    """
+    runner = BatchRunner(agent, concurrency=concurrency, **kwargs)
+    results = runner.run(read_questions(input_path), output_path)
+    return runner.summarize(results)
+
+
+def add_batch_arguments(parser:argparse.ArgumentParser):
+    parser.add_argument("--batch", type=str, default=None, help="批量问答的问题文件（JSONL）")
+    parser.add_argument("--output", type=str, default="batch_results.jsonl", help="批量问答的结果文件（JSONL）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时运行的问题数量")
+    parser.add_argument("--rpm", type=int, default=None, help="每分钟最多发起的大模型请求数")
+    parser.add_argument("--max_concurrent_requests", type=int, default=None, help="同时进行的大模型请求数")
+    parser.add_argument("--db_pool_size", type=int, default=None, help="数据库连接池大小，默认与并发数相同")
+    parser.add_argument("--capture_logs", action="store_true", help="在结果中保留每个问题的运行日志")
+
+
+def run_batch_from_args(agent, args) -> dict:
+    summary = run_batch(
+        agent,
+        args.batch,
+        args.output,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        max_concurrent_requests=args.max_concurrent_requests,
+        db_pool_size=args.db_pool_size,
+        capture_logs=args.capture_logs
+    )
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return summary
@@ -0,0 +1,275 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from ..utils.serialization import DELIMITER
+
+BLOB_STORE_KEY = '_blob_store'
+# 运行结果为文本表格（第一行为字段名，字段之间以制表符分隔，见utils.serialization）的外部函数
+TABULAR_FUNCTIONS = {'sql_inter'}
+
+
+class BlobStore:
+    """
+    会话级的大结果存储：外部函数运行结果过长时，完整内容保存在这里，对话上下文中只保留预览和句柄。
+    1、结果默认保存在内存中，内存占用超过memory_limit后，将最早的结果写入磁盘（spill_dir）；
+    2、大模型可以通过fetch_blob工具，按行、列或字节范围读取需要的部分；
+    3、记录本会话中未进入上下文的字节数。
+    """
+    def __init__(self,
+                 inline_limit=2000,
+                 preview_chars=600,
+                 memory_limit=64 * 1024 * 1024,
+                 spill_dir=None):
+        """
+        :param inline_limit: 结果长度（字符数）不超过该值时直接放入上下文
+        :param preview_chars: 放入上下文的预览长度（字符数）
+        :param memory_limit: 内存中保存结果的最大字节数，超过后写入磁盘
+        :param spill_dir: 写入磁盘的目录，默认为临时目录
+        """
+        self.inline_limit = inline_limit
+        self.preview_chars = preview_chars
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+
+        # handle -> 内容（内存中）或文件路径（已写入磁盘）
+        self._memory = OrderedDict()
+        self._spilled = {}
+        # 内容为文本表格的句柄
+        self._tabular = set()
+        self._memory_bytes = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+        self.bytes_offloaded = 0
+        self.bytes_spilled = 0
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    def put(self, content:str, tabular:bool=False) -> str:
+        """
+        保存一段内容，返回句柄
+        :param tabular: 内容是否为文本表格（第一行为字段名）
+        """
+        with self._lock:
+            self._count += 1
+            handle = f"blob_{self._count}"
+            self._memory[handle] = content
+            if tabular:
+                self._tabular.add(handle)
+            self._memory_bytes += len(content.encode('utf-8'))
+            self._spill()
+        return handle
+
+    def get(self, handle:str) -> str:
+        """根据句柄读取完整内容"""
+        with self._lock:
+            if handle in self._memory:
+                return self._memory[handle]
+            if handle in self._spilled:
+                with open(self._spilled[handle], 'r', encoding='utf-8') as file:
+                    return file.read()
+        raise KeyError("Invalid blob handle: {}".format(handle))
+
+    def _spill(self):
+        while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+            handle, content = self._memory.popitem(last=False)
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix='dataflow_blobs_')
+            path = os.path.join(self.spill_dir, f"{handle}.txt")
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(content)
+            size = len(content.encode('utf-8'))
+            self._memory_bytes -= size
+            self.bytes_spilled += size
+            self._spilled[handle] = path
+
+    def offload(self, content:str, tabular:bool=False) -> str:
+        """
+        若内容过长，保存完整内容并返回预览和句柄，否则原样返回
+        :param tabular: 内容是否为文本表格（第一行为字段名），预览和按行、列读取时保留字段名行
+        """
+        if len(content) <= self.inline_limit:
+            return content
+
+        handle = self.put(content, tabular)
+        preview = make_preview(content, self.preview_chars, tabular)
+        if tabular:
+            usage = "按行（rows，从0开始，不含字段名行）、列（columns，字段名或序号）或字节范围（start、end）读取，" \
+                    "按行、列读取时总是附带字段名行"
+        else:
+            usage = "按行（rows）、列（columns）或字节范围（start、end）读取"
+        reference = f"\n...[结果过长，共{len(content)}个字符，完整结果已保存，句柄为{handle}。" \
+                    f"如需查看更多内容，请调用fetch_blob函数，{usage}]"
+        self.bytes_offloaded += len(content.encode('utf-8')) - len((preview + reference).encode('utf-8'))
+        return preview + reference
+
+    def slice(self, handle, rows=None, columns=None, start=None, end=None) -> str:
+        """
+        读取结果中的一部分
+        :param handle: 结果句柄
+        :param rows: 行范围，形如[起始行, 结束行]或"10:20"，文本表格中不含字段名行
+        :param columns: 列，文本表格和JSON结果中为列序号或字段名所组成的list
+        :param start: 起始字节
+        :param end: 结束字节
+        :raise ValueError: 文本表格中不存在指定的字段
+        """
+        content = self.get(handle)
+
+        if start is not None or end is not None:
+            data = content.encode('utf-8')[start:end]
+            return data.decode('utf-8', errors='ignore')
+
+        row_slice = _parse_range(rows)
+        if handle in self._tabular:
+            header, *lines = content.split('\n')
+            lines = lines[row_slice]
+            if columns:
+                indexes = _column_indexes(header.split(DELIMITER), columns)
+                header = _select_fields(header, indexes)
+                lines = [_select_fields(line, indexes) for line in lines]
+            return '\n'.join([header] + lines)
+        try:
+            data = json.loads(content)
+        except (ValueError, TypeError):
+            data = None
+
+        if isinstance(data, list):
+            data = data[row_slice]
+            if columns:
+                data = [_select_columns(row, columns) for row in data]
+            return json.dumps(data, ensure_ascii=False, default=str)
+
+        lines = content.splitlines()[row_slice]
+        return '\n'.join(lines)
+
+    def clear(self):
+        """释放全部结果，并删除写入磁盘的文件"""
+        with self._lock:
+            self._memory.clear()
+            self._spilled.clear()
+            self._memory_bytes = 0
+            if self.spill_dir is not None and os.path.isdir(self.spill_dir):
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __getstate__(self):
+        # 序列化时（会话检查点）读回已写入磁盘的结果，不保存锁和临时目录
+        with self._lock:
+            memory = OrderedDict()
+            for handle, path in self._spilled.items():
+                with open(path, 'r', encoding='utf-8') as file:
+                    memory[handle] = file.read()
+            memory.update(self._memory)
+            state = {key: value for key, value in self.__dict__.items()
+                     if key not in ('_lock', '_memory', '_spilled', 'spill_dir')}
+            state['_tabular'] = set(self._tabular)
+        state['_memory'] = memory
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_tabular', set())
+        self._spilled = {}
+        self.spill_dir = None
+        self._lock = threading.Lock()
+        self._memory_bytes = sum(len(content.encode('utf-8')) for content in self._memory.values())
+        with self._lock:
+            self._spill()
+
+    def get_stats(self) -> dict:
+        return {
+            'blobs': len(self),
+            'bytes_offloaded': self.bytes_offloaded,
+            'bytes_in_memory': self._memory_bytes,
+            'bytes_spilled': self.bytes_spilled,
+        }
+
+
+def make_preview(content:str, preview_chars:int, tabular:bool=False) -> str:
+    """生成结果预览：文本表格保留字段名行和前几行，JSON数组保留前几行，其余内容截取开头部分"""
+    if tabular:
+        header, *lines = content.split('\n')
+        rows = []
+        length = len(header)
+        for line in lines:
+            if rows and length + len(line) > preview_chars:
+                break
+            rows.append(line)
+            length += len(line)
+        return f"[共{len(lines)}行，前{len(rows)}行如下]\n" + '\n'.join([header] + rows)
+
+    try:
+        data = json.loads(content)
+    except (ValueError, TypeError):
+        data = None
+
+    if isinstance(data, list) and data:
+        rows = []
+        length = 0
+        for row in data:
+            row_str = json.dumps(row, ensure_ascii=False, default=str)
+            if rows and length + len(row_str) > preview_chars:
+                break
+            rows.append(row_str)
+            length += len(row_str)
+        return f"[共{len(data)}行，前{len(rows)}行如下]\n[" + ',\n'.join(rows) + ']'
+
+    return content[:preview_chars]
+
+
+def _parse_range(rows):
+    if rows is None:
+        return slice(None)
+    if isinstance(rows, str):
+        parts = [int(p) if p.strip() else None for p in rows.split(':')]
+        if len(parts) == 1:
+            return slice(parts[0], parts[0] + 1)
+        return slice(parts[0], parts[1])
+    if isinstance(rows, int):
+        return slice(rows, rows + 1)
+    return slice(*rows[:2])
+
+
+def _column_indexes(header:list, columns) -> list:
+    """将字段名或序号转换为文本表格中的列序号，字段名先按原样匹配，再忽略大小写匹配"""
+    if isinstance(columns, (str, int)):
+        columns = [columns] if isinstance(columns, int) else [c.strip() for c in columns.split(',')]
+    lowered = {name.lower(): i for i, name in reversed(list(enumerate(header)))}
+    indexes = []
+    for column in columns:
+        name = str(column)
+        if name in header:
+            indexes.append(header.index(name))
+        elif name.lower() in lowered:
+            indexes.append(lowered[name.lower()])
+        elif name.lstrip('-').isdigit() and -len(header) <= int(name) < len(header):
+            indexes.append(int(name) % len(header))
+        else:
+            raise ValueError(f"结果中不存在字段{name}，现有字段：{', '.join(header[:30])}")
+    return indexes
+
+
+def _select_fields(line:str, indexes:list) -> str:
+    fields = line.split(DELIMITER)
+    return DELIMITER.join(fields[i] for i in indexes)
+
+
+def _select_columns(row, columns):
+    if isinstance(row, dict):
+        return {c: row.get(c) for c in columns}
+    if isinstance(row, (list, tuple)):
+        indexes = [int(c) for c in columns if str(c).lstrip('-').isdigit()]
+        return [row[i] for i in indexes if -len(row) <= i < len(row)]
+    return row
+
+
+def get_blob_store(g:dict) -> BlobStore:
+    """获取分析环境中的结果存储，不存在时创建"""
+    store = g.get(BLOB_STORE_KEY)
+    if store is None:
+        store = g[BLOB_STORE_KEY] = BlobStore()
+    return store
@@ -1,5 +1,6 @@
 import json
-from pprint import pprint
+import time
+from collections import deque
 
 from .messages import (
     ChatMessages,
@@ -8,18 +9,24 @@ from .messages import (
 )
 
 from ..api import LlmBox
+from .parallel_debug import ParallelDebugger
+from .watchdog import get_watchdog, CellCancelled
 from ..utils.helpers import (
     modify_prompt,
     add_task_decomposition_prompt,
-    function_to_call
+    function_to_call,
+    default_namespace
 )
+from ..utils.tracing import span, start_span, finish_span, propagate
 
 def get_deepseek_response(
         llm_api:LlmBox,
         messages:ChatMessages,
         available_functions=None,
         is_developer_mode=False,
-        is_enhanced_mode=False) -> MessageType:
+        is_enhanced_mode=False,
+        route='main',
+        on_token=None) -> MessageType:
     """
     负责调用Chat模型并获得模型回答函数，并且当在调用GPT模型时遇到Rate limit时可以选择暂时休眠1分钟后再运行。\
     同时对于意图不清的问题，会提示用户修改输入的prompt，以获得更好的模型运行结果。
@@ -32,6 +39,8 @@ def get_deepseek_response(
     开启开发者模式时，会自动添加提示词模板，并且会在每次执行代码前、以及返回结果之后询问用户意见，并会根据用户意见进行修改。
     :param is_enhanced_mode: 可选参数，表示是否开启增强模式，默认为False。\
     开启增强模式时，会自动启动复杂任务拆解流程，并且在进行代码debug时会自动执行deep debug。
+    :param route: 可选参数，表示本次调用的位置，用于选择对应的模型档案，默认为main。
+    :param on_token: 可选参数，传入后使用流式输出，每收到一段文本调用一次on_token(text)。
     :return: 返回模型返回的response message
     """
 
@@ -43,13 +52,21 @@ def get_deepseek_response(
     # if is_enhanced_mode:
     #     messages = add_task_decomposition_prompt(messages)
 
+    # 若使用数据字典检索，则根据当前问题和最近的函数调用更新注入的数据字典片段
+    messages.refresh_retrieved_context()
+
+    # 仅在需要流式输出时传入on_token
+    stream_kwargs = {'on_token': on_token} if on_token is not None else {}
+
     # 若不存在外部函数
     if available_functions is None:
-        response = llm_api.chat(messages=messages.messages)
+        response = llm_api.chat(messages=messages.messages, route=route, **stream_kwargs)
     else:
         response = llm_api.chat(
         messages=messages.messages,
-        tools=available_functions.functions)
+        tools=available_functions.functions,
+        route=route,
+        **stream_kwargs)
 
     # print("@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@")
     # print(messages.messages[-3:])
@@ -62,154 +79,310 @@ def get_deepseek_response(
     return response
 
 
-def check_get_final_function_response(
-        llm_api:LlmBox,
-        messages:ChatMessages,
-        function_call_message:MessageType,
-        function_response_message:MessageDict,
-        available_functions=None,
-        is_developer_mode=False,
-        is_enhanced_mode=False,
-        delete_some_messages=True
-):
-    '''负责执行外部函数运行结果审查工作。若外部函数运行结果消息function_response_message并不存在报错信息，\
-    则将其拼接入message中，并将其带入get_chat_response函数并获取下一轮对话结果。而如果function_response_message中存在报错信息，\
-    则开启自动debug模式。本函数将借助类似Autogen的模式，复制多个Agent，并通过彼此对话的方式来完成debug。
-    '''
-    # 获取外部函数运行的结果内容
-    fun_res_content = function_response_message['content']
 
-    # 如果包含报错信息，就调用debug功能
-    if "报错" in fun_res_content:
-        print(f'报错信息：{fun_res_content}')
-        # 根据是否开启增强模式，选择执行开启高效debug还是深度debug
-        if not is_enhanced_mode:
-            # 执行高效debug
-            debug_info = "**即将执行高效debug，正在实例化Efficient Debug Agent...**"
-            debug_prompt_list = ['你编写的代码报错了，请根据报错信息修改代码并重新执行。']
-        else:
-            debug_info = "**即将执行深度debug，该debug过程将自动执行多轮对话，请耐心等待。正在实例化Deep Debug Agent...**"
-            debug_prompt_list = [
-                "之前执行的代码报错了，你觉得代码哪里编写错了？",
-                "好的。那么根据你的分析，为了解决这个错误，从理论上来说，应该如何操作呢？",
-                "非常好，接下来请按照你的逻辑编写相应代码并运行。"
-            ]
-
-        print(debug_info)
-
-        msg_debug = messages.copy()
-        # 追加function_call_message和包含报错信息的function_call_message
-        msg_debug.messages_append(function_call_message)
-        msg_debug.messages_append(function_response_message)
-
-        # 依次输入debug的prompt来引导大模型进行debug
-        for debug_prompt in debug_prompt_list:
-            msg_debug.messages_append({'role':'user','content':debug_prompt})
-
-            print(f"**From Debug Agent:**\n{debug_prompt}")
-            print("**From MateGen:**")
-            msg_debug = get_chat_response(
-                llm_api=llm_api,
-                messages=msg_debug,
-                available_functions=available_functions,
-                is_developer_mode=is_developer_mode,
-                is_enhanced_mode=False,
-                delete_some_messages=delete_some_messages
-            )
-        messages = msg_debug.copy()
-
-    # 如果不包含报错信息，直接将结果传给大模型
-    else:
-        print(">>> 外部函数已执行完毕，正在解析运行结果...", function_call_message)
-        messages.messages_append(function_call_message)
-        messages.messages_append(function_response_message)
-        messages = get_chat_response(
-            llm_api=llm_api,
+class TurnBudget:
+    """
+    单轮对话的预算，任意一项达到上限时提前结束本轮对话，None表示不限制
+    :param max_steps: 最大步数，每次大模型调用、每次外部函数运行各计为一步
+    :param max_seconds: 最大耗时（秒）
+    :param max_tokens: 最大token消耗（输入与输出的估算值之和）
+    """
+    def __init__(self, max_steps=50, max_seconds=None, max_tokens=None):
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+
+    def exceeded(self, state) -> str:
+        """返回超出的预算项名称，未超出时返回空字符串"""
+        if self.max_steps is not None and state.steps >= self.max_steps:
+            return 'max_steps'
+        if self.max_seconds is not None and state.elapsed >= self.max_seconds:
+            return 'max_seconds'
+        if self.max_tokens is not None and state.tokens >= self.max_tokens:
+            return 'max_tokens'
+        return ''
+
+
+class TurnState:
+    """
+    单轮对话的运行状态，每一步执行前会传给step_hook，可用于统计指标或取消对话
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        # 已执行的步数、大模型调用次数、外部函数运行次数、token消耗估算
+        self.steps = 0
+        self.llm_calls = 0
+        self.tool_calls = 0
+        self.tokens = 0
+        # 即将执行的动作及其使用的messages
+        self.action = None
+        self.messages = None
+        # 当前嵌套的debug层数
+        self.debug_depth = 0
+        # 提前结束的原因：cancelled或超出的预算项
+        self.stop_reason = None
+        # 外部函数调用记录：函数名、参数、耗时、是否报错以及结果长度
+        self.tool_trace = []
+        # 是否直接使用了缓存的回答（此时tool_trace为产生该回答的调用记录）
+        self.cached = False
+
+    def record_tool(self, function_call_message, function_response_message, latency, **extra):
+        function = function_call_message.tool_calls[0].function
+        content = function_response_message['content']
+        self.tool_trace.append(dict(
+            name=function.name,
+            arguments=function.arguments,
+            latency=latency,
+            error="报错" in content,
+            result_chars=len(content),
+            **extra
+        ))
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+
+class ChatTurn:
+    """
+    单轮对话的执行引擎：以显式的状态机代替函数之间的相互递归，调用栈深度与工具调用轮数无关。
+    每个动作（chat、text、code、check）执行后返回下一个动作，run方法循环执行直到finish。
+    深度debug时的多轮引导对话通过debug栈（堆上的数据）记录剩余的debug提示词，子对话结束后继续下一条提示词。
+    每一步执行前检查预算，并调用step_hook，step_hook返回False或调用cancel()时提前结束本轮对话。
+    """
+    def __init__(self,
+                 llm_api:LlmBox,
+                 available_functions=None,
+                 is_developer_mode=False,
+                 budget:TurnBudget=None,
+                 step_hook=None,
+                 debugger:ParallelDebugger=None,
+                 namespace:dict=None,
+                 on_event=None,
+                 tool_executor=None):
+        """
+        :param llm_api: 必要参数，实例化后的大模型调用接口
+        :param available_functions: 可选参数，AvailableFunctions类型对象，用于表示开启对话时外部函数基本情况。
+        :param is_developer_mode: 表示是否开启开发者模式，默认为False。
+        :param budget: 可选参数，TurnBudget对象，表示本轮对话的预算，默认为TurnBudget()
+        :param step_hook: 可选参数，每一步执行前调用的函数step_hook(state)，返回False时取消本轮对话
+        :param debugger: 可选参数，ParallelDebugger对象，增强模式下代码报错时先并行尝试多个候选修改方案，均失败时再进行深度debug
+        :param namespace: 可选参数，外部函数运行时使用的变量空间，默认为utils.helpers模块的全局变量
+        :param on_event: 可选参数，接收运行事件的函数on_event(event)，传入后大模型使用流式输出，
+        事件包括step（即将执行的步骤）、token（流式输出的文本）、tool_start和tool_end（外部函数开始和结束运行）
+        :param tool_executor: 可选参数，运行外部函数的线程池，用于限制多个会话同时运行SQL和pandas代码的数量
+        """
+        self.llm_api = llm_api
+        self.available_functions = available_functions
+        self.is_developer_mode = is_developer_mode
+        self.debugger = debugger
+        self.namespace = namespace if namespace is not None else default_namespace()
+        self.on_event = on_event
+        self.tool_executor = tool_executor
+        self.budget = budget if budget is not None else TurnBudget()
+        self.step_hook = step_hook
+        self.state = TurnState()
+        self._debug_stack = []
+        self._cancelled = False
+
+    def cancel(self):
+        """取消本轮对话，当前步骤执行完后生效"""
+        self._cancelled = True
+
+    def run(self,
+            messages:ChatMessages,
+            is_enhanced_mode=False,
+            is_task_decomposition=False,
+            delete_some_messages=False,
+            route='main') -> ChatMessages:
+        """
+        执行一轮对话，返回拼接本次问答最终结果的messages
+        """
+        with span('turn', 'turn', route=route, enhanced=is_enhanced_mode) as turn_span:
+            try:
+                return self._run(messages, is_enhanced_mode, is_task_decomposition, delete_some_messages, route)
+            finally:
+                # 提前结束时关闭尚未完成的debug区间
+                for frame in self._debug_stack:
+                    finish_span(frame['span'], stopped=True)
+                turn_span.set(steps=self.state.steps, llm_calls=self.state.llm_calls,
+                              tool_calls=self.state.tool_calls, tokens=self.state.tokens,
+                              stop_reason=self.state.stop_reason)
+
+    def _run(self, messages, is_enhanced_mode, is_task_decomposition, delete_some_messages, route):
+        action = ('chat', dict(
             messages=messages,
-            available_functions=available_functions,
-            is_developer_mode=is_developer_mode,
             is_enhanced_mode=is_enhanced_mode,
-            delete_some_messages=delete_some_messages
+            is_task_decomposition=is_task_decomposition,
+            delete_some_messages=delete_some_messages,
+            route=route
+        ))
+
+        while True:
+            name, kwargs = action
+            messages = kwargs['messages']
+
+            # 子对话结束：若处于debug中，继续下一条debug提示词，否则结束本轮对话
+            if name == 'finish':
+                if not self._debug_stack:
+                    return messages
+                action = self._resume_debug(messages)
+                continue
+
+            self.state.action = name
+            self.state.messages = messages
+            self.state.debug_depth = len(self._debug_stack)
+
+            if self.step_hook is not None and self.step_hook(self.state) is False:
+                self._cancelled = True
+            if self._cancelled:
+                self.state.stop_reason = 'cancelled'
+                print(">>> 本轮对话已取消")
+                return messages
+            exceeded = self.budget.exceeded(self.state)
+            if exceeded:
+                self.state.stop_reason = exceeded
+                print(f">>> 本轮对话已达到预算上限（{exceeded}），提前结束")
+                return messages
+
+            if self.on_event is not None:
+                self.on_event({'type': 'step', 'action': name, 'step': self.state.steps})
+            action = getattr(self, name)(**kwargs)
+
+    def _llm(self, messages, is_enhanced_mode=False, route='main') -> MessageType:
+        """调用大模型，并记录步数和token消耗"""
+        on_token = None
+        if self.on_event is not None:
+            on_token = lambda text: self.on_event({'type': 'token', 'route': route, 'text': text})
+        response = get_deepseek_response(
+            llm_api=self.llm_api,
+            messages=messages,
+            available_functions=self.available_functions,
+            is_developer_mode=self.is_developer_mode,
+            is_enhanced_mode=is_enhanced_mode,
+            route=route,
+            on_token=on_token
         )
-    return messages
-
-
-def is_text_response_valid(
-        llm_api:LlmBox,
-        messages:ChatMessages,
-        text_answer_message:MessageType,
-        available_functions=None,
-        is_developer_mode=False,
-        is_enhanced_mode=False,
-        delete_some_messages=False,
-        is_task_decomposition=False
-):
-
-    """
-    负责执行文本内容创建审查工作。运行模式可分为快速模式和人工审查模式。在快速模式下，模型将迅速创建文本并保存至msg对象中，\
-    而如果是人工审查模式，则需要先经过人工确认，函数才会保存大模型创建的文本内容，并且在这个过程中，\
-    也可以选择让模型根据用户输入的修改意见重新修改文本。
-    :param llm_api: 必要参数，实例化后的大模型调用接口
-    :param messages: 必要参数，ChatMessages类型对象，用于存储对话消息
-    :param text_answer_message: 必要参数，用于表示上层函数创建的一条包含文本内容的message
-    :param available_functions: 可选参数，AvailableFunctions类型对象，用于表示开启对话时外部函数基本情况。\
-    默认为None，表示没有外部函数
-    :param is_developer_mode: 表示是否开启开发者模式，默认为False。\
-    开启开发者模式时，会自动添加提示词模板，并且会在每次执行代码前、以及返回结果之后询问用户意见，并会根据用户意见进行修改。
-    :param is_enhanced_mode: 可选参数，表示是否开启增强模式，默认为False。\
-    开启增强模式时，会自动启动复杂任务拆解流程，并且在进行代码debug时会自动执行deep debug。
-    :param delete_some_messages: 可选参数，表示在拼接messages时是否删除中间若干条消息，默认为Fasle。
-    :param is_task_decomposition: 可选参数，是否是当前执行任务是否是审查任务拆解结果，默认为False。
-    :return: message，拼接了最新大模型回答结果的message
-    """
-   # 从text_answer_message中获取模型回答结果并打印
-    answer_content = text_answer_message.content
-
-    print("🤖: Mate Response：\n")
-    print(answer_content)
-
-    # 创建指示变量user_input，用于记录用户修改意见，默认为None
-    user_input = None
-
-    # 若是开发者模式，或者是增强模式下任务拆解结果，则引导用户对其进行审查
-    # 若是开发者模式而非任务拆解
-    if not is_task_decomposition and is_developer_mode:
-        user_input = input("对话模式：你好，请问是否记录回答结果，记录结果请输入1；\
-        对当前结果提出修改意见请输入2；\
-        重新进行提问请输入3，\
-        直接退出对话请输入4")
-        if user_input == '1':
-            # 若记录回答结果，则将其添加入msg对象中
-            messages.messages_append(text_answer_message)
-            print(">>> 本次对话结果已保存")
-
-    # 若是任务拆解
-    elif is_task_decomposition:
-        user_input = input("【进行任务拆解】请问是否按照该流程执行任务（1），\
-        或者对当前执行流程提出修改意见（2），\
-        或者重新进行提问（3），\
-        或者直接退出对话（4）")
-        if user_input == '1':
-            # 任务拆解中，如果选择执行该流程
+        self.state.steps += 1
+        self.state.llm_calls += 1
+        self.state.tokens += messages.tokens_count + messages.count_tokens(response)
+        return response
+
+    def chat(self,
+             messages:ChatMessages,
+             is_enhanced_mode=False,
+             is_task_decomposition=False,
+             delete_some_messages=False,
+             route='main'):
+        '''
+        单轮对话任务主步骤，负责两种路径的调度：1、文本对话任务；2、function call任务
+        要求输入的messages中最后一条消息必须是能正常发起对话的消息。
+        该步骤通过调用get_deepseek_response来获取模型输出结果，并且会根据返回结果的不同，例如是文本结果还是代码结果，进入不同的后处理步骤。
+        :param messages: 必要参数，ChatMessages类型对象，用于存储对话消息
+        :param is_enhanced_mode: 可选参数，表示是否开启增强模式，默认为False。
+        :param is_task_decomposition: 可选参数，是否是当前执行任务是否是审查任务拆解结果，默认为False。
+        :param delete_some_messages: 可选参数，表示在拼接messages时是否删除中间若干条消息，默认为Fasle。这里更多的是在进行返修时，将用户第一次回答、以及用户的返回建议进行删除（此时已经生成返修后的回答，不需要第一次回答和返修建议message）
+        :param route: 可选参数，表示本步骤首次大模型调用的位置，用于选择对应的模型档案，默认为main。
+        :return: 下一个动作
+        '''
+        # 当围绕复杂任务拆解结果进行修改时，才会出现is_task_decomposition=True的情况
+        # 当is_task_decomposition=True时，不再重新创建response_message
+        if not is_task_decomposition:
+            # 先后去单次大模型调用结果
+            response_message = self._llm(messages, is_enhanced_mode, route)
+
+        # 任务拆解情况：1、is_task_composition=True;2、开启增强模式下的function call调用
+        if is_task_decomposition or (is_enhanced_mode and response_message.tool_calls):
+            # 将is_task_decomposition修改为True,表示当前执行任务俄日复杂任务拆解，拆解成：第一步xxx，第二步xxx：
+            is_task_decomposition = True
+            task_decomp_few_shot = add_task_decomposition_prompt(messages=messages)
+            print(">>> 正在进行任务分解.....")
+            # 更新response_message,其中，更新完的resopnse_message就是任务拆解之后的response
+            with span('task_decomposition', 'agent') as decomposition_span:
+                response_message = self._llm(task_decomp_few_shot, is_enhanced_mode, 'task_decomposition')
+                decomposition_span.set(direct_tool_call=bool(response_message.tool_calls))
+            if response_message.tool_calls:
+                print("当前任务无需拆解，可以直接运行。")
+
+        # 若本次调用是由修改对话需求产生的，则按照参数设置删除原始message中的若干条消息
+        # 注意：删除中间若干条消息，必须在创建完新的response_message之后在执行
+        if delete_some_messages and isinstance(delete_some_messages, int):
+            for i in range(delete_some_messages):
+                messages.messages_pop(manual=True, index=-1)
+
+        # 到此为止，产生了一个response_message,接下来根据不同类型，调用不同的路径（文本\code）
+        kwargs = dict(
+            messages=messages,
+            is_enhanced_mode=is_enhanced_mode,
+            delete_some_messages=delete_some_messages,
+            is_task_decomposition=is_task_decomposition
+        )
+        if not response_message.tool_calls:
+            # 若是文本响应类任务（包括普通文本响应和和复杂任务拆解审查两种情况，都可以使用相同代码）
+            return 'text', dict(kwargs, text_answer_message=response_message)
+        # 如果是调用function call模式，此时输入的response_message是一个包含SQL或者python代码的JSON对象，输入给代码审查&执行的步骤
+        return 'code', dict(kwargs, function_call_message=response_message)
+
+    def text(self,
+             messages:ChatMessages,
+             text_answer_message:MessageType,
+             is_enhanced_mode=False,
+             delete_some_messages=False,
+             is_task_decomposition=False):
+        """
+        负责执行文本内容创建审查工作。运行模式可分为快速模式和人工审查模式。在快速模式下，模型将迅速创建文本并保存至msg对象中，\
+        而如果是人工审查模式，则需要先经过人工确认，才会保存大模型创建的文本内容，并且在这个过程中，\
+        也可以选择让模型根据用户输入的修改意见重新修改文本。
+        :param messages: 必要参数，ChatMessages类型对象，用于存储对话消息
+        :param text_answer_message: 必要参数，用于表示上一步创建的一条包含文本内容的message
+        :param is_enhanced_mode: 可选参数，表示是否开启增强模式，默认为False。
+        :param delete_some_messages: 可选参数，表示在拼接messages时是否删除中间若干条消息，默认为Fasle。
+        :param is_task_decomposition: 可选参数，是否是当前执行任务是否是审查任务拆解结果，默认为False。
+        :return: 下一个动作
+        """
+        # 从text_answer_message中获取模型回答结果并打印
+        answer_content = text_answer_message.content
+
+        print("🤖: Mate Response：\n")
+        print(answer_content)
+
+        # 若不是开发者模式，也不是任务拆解，则直接记录返回消息
+        if not is_task_decomposition and not self.is_developer_mode:
             messages.messages_append(text_answer_message)
-            print(">>> 好的，即将逐步执行上述流程")
-            messages.messages_append({"role": "user", "content": "非常好，请按照该流程逐步执行。"})
-            is_task_decomposition = False
-            is_enhanced_mode = False
-            messages = get_chat_response(
-                llm_api=llm_api,
-                messages=messages,
-                available_functions=available_functions,
-                is_developer_mode=is_developer_mode,
-                is_enhanced_mode=is_enhanced_mode,
-                delete_some_messages=delete_some_messages,
-                is_task_decomposition=is_task_decomposition)
-
-
-    if user_input is not None:
-        if user_input == '1':
-            pass
-        elif user_input == '2':
+            return 'finish', dict(messages=messages)
+
+        # 若是开发者模式，或者是增强模式下任务拆解结果，则引导用户对其进行审查
+        # 若是开发者模式而非任务拆解
+        if not is_task_decomposition:
+            user_input = input("对话模式：你好，请问是否记录回答结果，记录结果请输入1；\
+            对当前结果提出修改意见请输入2；\
+            重新进行提问请输入3，\
+            直接退出对话请输入4")
+            if user_input == '1':
+                # 若记录回答结果，则将其添加入msg对象中
+                messages.messages_append(text_answer_message)
+                print(">>> 本次对话结果已保存")
+                return 'finish', dict(messages=messages)
+
+        # 若是任务拆解
+        else:
+            user_input = input("【进行任务拆解】请问是否按照该流程执行任务（1），\
+            或者对当前执行流程提出修改意见（2），\
+            或者重新进行提问（3），\
+            或者直接退出对话（4）")
+            if user_input == '1':
+                # 任务拆解中，如果选择执行该流程
+                messages.messages_append(text_answer_message)
+                print(">>> 好的，即将逐步执行上述流程")
+                messages.messages_append({"role": "user", "content": "非常好，请按照该流程逐步执行。"})
+                return 'chat', dict(
+                    messages=messages,
+                    is_enhanced_mode=False,
+                    is_task_decomposition=False,
+                    delete_some_messages=delete_some_messages
+                )
+
+        if user_input == '2':
             new_user_content = input("好的，输入对模型结果的修改意见：")
             print(">>> 好的，正在进行修改。")
             # 在messages中暂时记录上一轮回答的内容
@@ -217,161 +390,256 @@ def is_text_response_valid(
             # 记录用户提出的修改意见
             messages.messages_append({"role": "user", "content": new_user_content})
 
-            # 再次调用主函数进行回答，为了节省token，可以删除用户修改意见和第一版模型回答结果
+            # 再次进行回答，为了节省token，可以删除用户修改意见和第一版模型回答结果
             # 因此这里可以设置delete_some_messages=2
             # 此外，这里需要设置is_task_decomposition=is_task_decomposition
             # 当需要修改复杂任务拆解结果时，会自动带入is_task_decomposition=True
-            messages = get_chat_response(
-                llm_api=llm_api,
+            return 'chat', dict(
                 messages=messages,
-                available_functions=available_functions,
-                is_developer_mode=is_developer_mode,
                 is_enhanced_mode=is_enhanced_mode,
                 delete_some_messages=2,
-                is_task_decomposition=is_task_decomposition)
+                is_task_decomposition=is_task_decomposition
+            )
 
-        elif user_input == '3':
+        if user_input == '3':
             new_user_content = input("好的，请重新提出问题：")
             # 修改问题
-            messages.messages[-1]["content"] = new_user_content
-            # 再次调用主函数进行回答
-            messages = get_chat_response(
-                llm_api=llm_api,
+            messages.update_content(-1, new_user_content)
+            # 再次进行回答
+            return 'chat', dict(
                 messages=messages,
-                available_functions=available_functions,
-                is_developer_mode=is_developer_mode,
                 is_enhanced_mode=is_enhanced_mode,
                 delete_some_messages=delete_some_messages,
-                is_task_decomposition=is_task_decomposition)
-
-        else:
-            messages.messages_append(text_answer_message)
-            print(">>> 好的，已退出当前对话")
+                is_task_decomposition=is_task_decomposition
+            )
 
-    # 若不是开发者模式
-    else:
-        # 记录返回消息
         messages.messages_append(text_answer_message)
+        print(">>> 好的，已退出当前对话")
+        return 'finish', dict(messages=messages)
+
+    def code(self,
+             messages:ChatMessages,
+             function_call_message:MessageType,
+             is_enhanced_mode=False,
+             delete_some_messages=False,
+             is_task_decomposition=False):
+        """
+        负责完整执行一次外部函数调用，要求上一步的模型输出是包含function call的消息。\
+        该步骤将function call的消息中的代码带入外部函数并完成代码运行，并且支持交互式代码编写或自动代码编写运行不同模式。\
+        得到一条包含外部函数运行结果的function message之后，会进入check步骤，
+        用于最终将function message转化为assistant message，并完成本次对话。
+        :param messages: 必要参数，ChatMessages类型对象，用于存储对话消息
+        :param function_call_message: 必要参数，用于表示上一步创建的一条包含function call消息的message
+        :param is_enhanced_mode: 可选参数，表示是否开启增强模式，默认为False。
+        :param delete_some_messages: 可选参数，表示在拼接messages时是否删除中间若干条消息，默认为Fasle。
+        :return: 下一个动作
+        """
+        code_json_str = function_call_message.tool_calls[0].function.arguments
+
+        def display_code():
+            '''给用户展示即将运行的代码，如果是开发模式，就让用户看看需不需要修改'''
+
+            code_dict = json.loads(code_json_str)
+            print(">>> 即将执行以下代码：")
+
+            if code_dict.get('sql_query'):
+                code = code_dict.get('sql_query')
+                md_code = f"```sql\n{code}\n```"
+            elif code_dict.get('py_code'):
+                code = code_dict.get('py_code')
+                md_code = f"```python\n{code}\n```"
+            else:
+                md_code = code_dict
+
+            print(md_code)
+
+        try:
+            display_code()
+        except Exception as e:
+            print(f">>> 代码展示错误:{e}")
+            return 'chat', dict(
+                messages=messages,
+                is_enhanced_mode=is_enhanced_mode,
+                delete_some_messages=delete_some_messages
+            )
 
-    return messages
-
-
-def is_code_response_valid(
-        llm_api:LlmBox,
-        messages:ChatMessages,
-        function_call_message:MessageType,
-        available_functions=None,
-        is_developer_mode=False,
-        is_enhanced_mode=False,
-        delete_some_messages=False,
-        **kwargs
-):
-    """
-    负责完整执行一次外部函数调用的最高层函数，要求输入的msg最后一条消息必须是包含function call的消息。\
-    函数的最终任务是将function call的消息中的代码带入外部函数并完成代码运行，并且支持交互式代码编写或自动代码编写运行不同模式。\
-    当函数运行得到一条包含外部函数运行结果的function message之后，会继续将其带入check_get_final_function_response函数，\
-    用于最终将function message转化为assistant message，并完成本次对话。
-    :param llm_api: 必要参数，实例化后的大模型调用接口
-    :param model: 必要参数，表示调用的大模型名称
-    :param messages: 必要参数，ChatMessages类型对象，用于存储对话消息
-    :param function_call_message: 必要参数，用于表示上层函数创建的一条包含function call消息的message
-    :param available_functions: 可选参数，AvailableFunctions类型对象，用于表示开启对话时外部函数基本情况。\
-    默认为None，表示没有外部函数
-    :param is_developer_mode: 表示是否开启开发者模式，默认为False。\
-    开启开发者模式时，会自动添加提示词模板，并且会在每次执行代码前、以及返回结果之后询问用户意见，并会根据用户意见进行修改。
-    :param is_enhanced_mode: 可选参数，表示是否开启增强模式，默认为False。\
-    开启增强模式时，会自动启动复杂任务拆解流程，并且在进行代码debug时会自动执行deep debug。
-    :param delete_some_messages: 可选参数，表示在拼接messages时是否删除中间若干条消息，默认为Fasle。
-    :return: message，拼接了最新大模型回答结果的message
-    """
-
-    '''
-    TUDO: 有递归调用的风险
-    '''
-    code_json_str = function_call_message.tool_calls[0].function.arguments
-
-    def display_code():
-        '''给用户展示即将运行的代码，如果是开发模式，就让用户看看需不需要修改'''
-
-        code_dict = json.loads(code_json_str)
-        print(">>> 即将执行以下代码：")
-
-        if code_dict.get('sql_query'):
-            code = code_dict.get('sql_query')
-            md_code = f"```sql\n{code}\n```"
-        elif code_dict.get('py_code'):
-            code = code_dict.get('py_code')
-            md_code = f"```python\n{code}\n```"
-        else:
-            md_code = code_dict
-
-        print(md_code)
-
-    try:
-        display_code()
-    except Exception as e:
-        print(f">>> 代码展示错误:{e}")
-
-        messages = get_chat_response(
-            llm_api=llm_api,
+        # 如果时开发者模式，提示用户对代码进行审然后再运行
+        if self.is_developer_mode:
+            user_input = input("如果想直接运行代码，就输入1, 如果想反馈修改意见就让模型对代码进行修改后再运行,输入2。")
+            if user_input == "1":
+                print("💻：好的，正在运行代码，请稍等...")
+            else:
+                modify_input = input("好的，请输入修改意见：")
+                # 记录模型当前创建的代码和修改意见，等模型获取到意见再生成新代码后，再把这两条删掉
+                """
+                这里有个bug：就是模型返回tool_calls消息后，后面需要紧跟着一条tool_calls运行后的结果
+                这里的解决方法是：不把tool_calls添加进messages中，而是提取出它的内容到messages中，
+                变成普通的文本响应，这样后面就不需要跟tool_calls运行的结果
+                """
+                tool_calls_to_text = {'role': 'assistant', 'content': code_json_str}
+                fix_suggestion = {'role': 'user', 'content': modify_input}
+                messages.messages_append(tool_calls_to_text) # tool_calls变成文本
+                messages.messages_append(fix_suggestion)
+
+                # 调用大模型重新返回结果
+                return 'chat', dict(
+                    messages=messages,
+                    is_enhanced_mode=is_enhanced_mode,
+                    delete_some_messages=2
+                )
+
+        # 如果是非开发者模式，或者开发者模式下用户不进行代码修改，直接调用运行函数，运行代码获得结果
+        function = function_call_message.tool_calls[0].function
+        if self.on_event is not None:
+            self.on_event({'type': 'tool_start', 'name': function.name, 'arguments': function.arguments})
+        start = time.perf_counter()
+        call_kwargs = dict(
+            available_functions=self.available_functions,
+            function_call_message=function_call_message,
+            namespace=self.namespace
+        )
+        try:
+            function_response_message = self._call_tool(call_kwargs, function_call_message.tool_calls[0].id)
+        except (KeyboardInterrupt, CellCancelled):
+            # Ctrl-C只中断当前的外部函数并结束本轮对话，会话（对话历史和变量空间）保留
+            print(">>> 已中断当前外部函数的运行")
+            function_response_message = {
+                "role": "tool",
+                "content": "外部函数的运行已被用户中断（Ctrl-C），变量空间中可能只保留了部分运行结果",
+                'tool_call_id': function_call_message.tool_calls[0].id,
+            }
+            self.cancel()
+        self.state.record_tool(function_call_message, function_response_message, time.perf_counter() - start)
+        if self.on_event is not None:
+            trace = self.state.tool_trace[-1]
+            self.on_event({'type': 'tool_end', 'name': function.name, 'latency': trace['latency'],
+                           'error': trace['error'], 'preview': function_response_message['content'][:200]})
+        self.state.steps += 1
+        self.state.tool_calls += 1
+        print(f"💻: 代码运行结果：{function_response_message}")
+        # 将代码运行结果带入到审查步骤中
+        return 'check', dict(
             messages=messages,
-            available_functions=available_functions,
-            is_developer_mode=is_developer_mode,
+            function_call_message=function_call_message,
+            function_response_message=function_response_message,
             is_enhanced_mode=is_enhanced_mode,
-            delete_some_messages=delete_some_messages,
+            delete_some_messages=delete_some_messages
         )
-        return messages
 
-
-    # 如果时开发者模式，提示用户对代码进行审然后再运行
-    if is_developer_mode:
-        user_input = input("如果想直接运行代码，就输入1, 如果想反馈修改意见就让模型对代码进行修改后再运行,输入2。")
-        if user_input == "1":
-            print("💻：好的，正在运行代码，请稍等...")
-        else:
-            modify_input = input("好的，请输入修改意见：")
-            # 记录模型当前创建的代码和修改意见，等模型获取到意见再生成新代码后，再把这两条删掉
-            """
-            这里有个bug：就是模型返回tool_calls消息后，后面需要紧跟着一条tool_calls运行后的结果
-            这里的解决方法是：不把tool_calls添加进messages中，而是提取出它的内容到messages中，
-            变成普通的文本响应，这样后面就不需要跟tool_calls运行的结果
-            """
-            # messages.messages_append(function_call_message)
-            tool_calls_to_text = {'role': 'assistant', 'content': code_json_str}
-            fix_suggestion = {'role': 'user', 'content': modify_input}
-            messages.messages_append(tool_calls_to_text) # tool_calls变成文本
-            messages.messages_append(fix_suggestion)
-
-            # 调用大模型重新返回结果
-            messages = get_chat_response(
-                llm_api=llm_api,
+    def _call_tool(self, call_kwargs, call_id):
+        if self.tool_executor is None:
+            return function_to_call(**call_kwargs)
+        future = self.tool_executor.submit(propagate(function_to_call), **call_kwargs)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            # 外部函数在线程池中运行时，Ctrl-C由主线程接收，通过看门狗中断正在运行的代码单元，
+            # 并等待外部函数退出（SQL查询等不可中断的操作会运行完毕）
+            get_watchdog().cancel(call_id)
+            future.result()
+            raise
+
+    def check(self,
+              messages:ChatMessages,
+              function_call_message:MessageType,
+              function_response_message:MessageDict,
+              is_enhanced_mode=False,
+              delete_some_messages=False):
+        '''负责执行外部函数运行结果审查工作。若外部函数运行结果消息function_response_message并不存在报错信息，\
+        则将其拼接入message中，并进入chat步骤获取下一轮对话结果。而如果function_response_message中存在报错信息，\
+        则开启自动debug模式：复制一份messages作为debug子对话，依次输入debug提示词，通过多轮对话的方式来完成debug。
+        '''
+        # 获取外部函数运行的结果内容
+        fun_res_content = function_response_message['content']
+
+        # 如果不包含报错信息，直接将结果传给大模型
+        if "报错" not in fun_res_content:
+            print(">>> 外部函数已执行完毕，正在解析运行结果...", function_call_message)
+            messages.messages_append(function_call_message)
+            messages.messages_append(function_response_message)
+            return 'chat', dict(
                 messages=messages,
-                available_functions=available_functions,
-                is_developer_mode=is_developer_mode,
                 is_enhanced_mode=is_enhanced_mode,
-                delete_some_messages=2
+                delete_some_messages=delete_some_messages
             )
-            # print("is_code_response_valid：", messages.messages[-3:])
-            return messages
 
-    # 如果是非开发者模式，或者开发者模式下用户不进行代码修改，直接调用运行函数，运行代码获得结果
-    function_response_message = function_to_call(
-        available_functions=available_functions,
-        function_call_message=function_call_message
-    )
-    print(f"💻: 代码运行结果：{function_response_message}")
-    # 将代码运行结果带入到审查函数中
-    messages = check_get_final_function_response(
-        llm_api=llm_api,
-        messages=messages,
-        function_call_message=function_call_message,
-        function_response_message=function_response_message,
-        available_functions=available_functions,
-        is_developer_mode=is_developer_mode,
-        is_enhanced_mode=is_enhanced_mode,
-        delete_some_messages=delete_some_messages
-    )
-    return messages
+        # 如果包含报错信息，就调用debug功能
+        print(f'报错信息：{fun_res_content}')
+
+        msg_debug = messages.copy()
+        # 追加function_call_message和包含报错信息的function_call_message
+        msg_debug.messages_append(function_call_message)
+        msg_debug.messages_append(function_response_message)
+
+        # 增强模式下先进行并行debug，若有候选方案运行成功，直接将其运行结果交给大模型解析
+        if is_enhanced_mode and self.debugger is not None:
+            print(f"**即将执行并行debug，同时尝试{self.debugger.n_candidates}个候选修改方案...**")
+            with span('parallel_debug', 'debug', candidates=self.debugger.n_candidates) as debug_span:
+                result = self.debugger.run(msg_debug, self.namespace)
+                debug_span.set(success=result.success, llm_calls=result.llm_calls,
+                               winner=result.winner.index if result.success else None)
+            self.state.steps += 1
+            self.state.llm_calls += result.llm_calls
+            self.state.tool_calls += sum(candidate.response_message is not None for candidate in result.candidates)
+            self.state.tokens += msg_debug.tokens_count * result.llm_calls
+            if result.success:
+                winner = result.winner
+                self.state.record_tool(winner.call_message, winner.response_message, winner.latency,
+                                       debug_candidate=winner.index)
+                print(f">>> 候选方案{winner.index + 1}运行成功，耗时{winner.latency:.2f}s，其余方案已取消")
+                print(f"💻: 代码运行结果：{winner.response_message}")
+                msg_debug.messages_append({'role': 'user', 'content': winner.prompt})
+                msg_debug.messages_append(winner.call_message)
+                msg_debug.messages_append(winner.response_message)
+                return 'chat', dict(
+                    messages=msg_debug,
+                    is_enhanced_mode=False,
+                    delete_some_messages=delete_some_messages
+                )
+            print(">>> 全部候选方案均运行失败，改为执行深度debug")
+        # 根据是否开启增强模式，选择执行开启高效debug还是深度debug
+        if not is_enhanced_mode:
+            # 执行高效debug
+            debug_info = "**即将执行高效debug，正在实例化Efficient Debug Agent...**"
+            debug_prompt_list = ['你编写的代码报错了，请根据报错信息修改代码并重新执行。']
+        else:
+            debug_info = "**即将执行深度debug，该debug过程将自动执行多轮对话，请耐心等待。正在实例化Deep Debug Agent...**"
+            debug_prompt_list = [
+                "之前执行的代码报错了，你觉得代码哪里编写错了？",
+                "好的。那么根据你的分析，为了解决这个错误，从理论上来说，应该如何操作呢？",
+                "非常好，接下来请按照你的逻辑编写相应代码并运行。"
+            ]
+
+        print(debug_info)
+
+        # 将debug提示词压入debug栈，依次输入debug的prompt来引导大模型进行debug
+        self._debug_stack.append({
+            'prompts': deque(debug_prompt_list),
+            'delete_some_messages': delete_some_messages,
+            # 逐步debug跨越多个步骤，结束时在_resume_debug中关闭
+            'span': start_span('debug', 'debug', mode='deep' if is_enhanced_mode else 'efficient',
+                               depth=len(self._debug_stack) + 1, prompts=len(debug_prompt_list)),
+        })
+        return self._resume_debug(msg_debug)
+
+    def _resume_debug(self, msg_debug:ChatMessages):
+        """输入下一条debug提示词；全部提示词执行完毕后，debug子对话的结果即为外层对话的结果"""
+        frame = self._debug_stack[-1]
+        if not frame['prompts']:
+            self._debug_stack.pop()
+            finish_span(frame['span'])
+            return 'finish', dict(messages=msg_debug)
+
+        debug_prompt = frame['prompts'].popleft()
+        msg_debug.messages_append({'role': 'user', 'content': debug_prompt})
+        print(f"**From Debug Agent:**\n{debug_prompt}")
+        print("**From MateGen:**")
+        return 'chat', dict(
+            messages=msg_debug,
+            is_enhanced_mode=False,
+            delete_some_messages=frame['delete_some_messages'],
+            route='debug'
+        )
 
 
 def get_chat_response(
@@ -381,76 +649,47 @@ def get_chat_response(
         is_developer_mode=False,
         is_enhanced_mode=False,
         is_task_decomposition=False,
-        delete_some_messages=False
+        delete_some_messages=False,
+        route='main',
+        budget:TurnBudget=None,
+        step_hook=None,
+        debugger:ParallelDebugger=None,
+        namespace:dict=None,
+        on_event=None
 ):
     '''
-    单轮对话任务主函数，负责两种路径的调度：1、文本对话任务；2、function call任务
-    负责完整执行一次对话的最高层函数，需要注意的是，一次对话中可能会多次调用大模型，而本函数则是完成一次对话的主函数。
+    单轮对话任务主函数，负责完整执行一次对话。需要注意的是，一次对话中可能会多次调用大模型和外部函数，
+    具体的调度由ChatTurn状态机循环完成，调用栈深度与工具调用轮数无关。
     要求输入的messages中最后一条消息必须是能正常发起对话的消息。
-    该函数通过调用get_gpt_response来获取模型输出结果，并且会根据返回结果的不同，例如是文本结果还是代码结果，灵活调用不同函数对模型输出结果进行后处理。
     :param llm_api: 必要参数，实例化后的大模型调用接口
     :param messages: 必要参数，ChatMessages类型对象，用于存储对话消息
     :param available_functions: 可选参数，AvailableFunctions类型对象，用于表示开启对话时外部函数基本情况。
     :param is_developer_mode: 表示是否开启开发者模式，默认为False。
     :param is_enhanced_mode: 可选参数，表示是否开启增强模式，默认为False。
     :param is_task_decomposition: 可选参数，是否是当前执行任务是否是审查任务拆解结果，默认为False。
-    :param delete_some_messages: 可选参数，表示在拼接messages时是否删除中间若干条消息，默认为Fasle。这里更多的是在进行返修时，将用户第一次回答、以及用户的返回建议进行删除（此时已经生成返修后的回答，不需要第一次回答和返修建议message）
+    :param delete_some_messages: 可选参数，表示在拼接messages时是否删除中间若干条消息，默认为Fasle。
+    :param route: 可选参数，表示本轮首次大模型调用的位置，用于选择对应的模型档案，默认为main。
+    :param budget: 可选参数，TurnBudget对象，表示本轮对话的步数、耗时和token预算。
+    :param step_hook: 可选参数，每一步执行前调用的函数step_hook(state)，返回False时取消本轮对话。
+    :param debugger: 可选参数，ParallelDebugger对象，增强模式下代码报错时先进行并行debug。
+    :param namespace: 可选参数，外部函数运行时使用的变量空间。
+    :param on_event: 可选参数，接收运行事件（步骤、流式文本、外部函数进度）的函数。
     :return: 拼接本次问答最终结果的messages
     '''
-    # 当围绕复杂任务拆解结果进行修改时，才会出现is_task_decomposition=True的情况
-    # 当is_task_decomposition=True时，不再重新创建response_message
-
-    # print("chat_response:")
-    # for m in messages.messages[-2:]:
-    #     print(m)
-
-    if not is_task_decomposition:
-        # 先后去单次大模型调用结果
-        response_message = get_deepseek_response(
-            llm_api=llm_api,
-            messages=messages,
-            available_functions=available_functions,
-            is_developer_mode=is_developer_mode,
-            is_enhanced_mode=is_enhanced_mode,
-        )
-    # 任务拆解情况：1、is_task_composition=True;2、开启增强模式下的function call调用
-    if is_task_decomposition or (is_enhanced_mode and response_message.tool_calls):
-        # 将is_task_decomposition修改为True,表示当前执行任务俄日复杂任务拆解，拆解成：第一步xxx，第二步xxx：
-        is_task_decomposition = True
-        task_decomp_few_shot = add_task_decomposition_prompt(messages=messages)
-        print(">>> 正在进行任务分解.....")
-        # 更新response_message,其中，更新完的resopnse_message就是任务拆解之后的response
-        response_message = get_deepseek_response(
-            messages=task_decomp_few_shot,
-            available_functions=available_functions,
-            is_developer_mode=is_developer_mode,
-            is_enhanced_mode=is_enhanced_mode
-        )
-        if response_message.tool_calls:
-            print("当前任务无需拆解，可以直接运行。")
-
-    # 若本次调用是由修改对话需求产生的，则按照参数设置删除原始message中的若干条消息
-    # 注意：删除中间若干条消息，必须在创建完新的response_message之后在执行
-    if delete_some_messages and isinstance(delete_some_messages, int):
-        for i in range(delete_some_messages):
-            messages.messages_pop(manual=True, index=-1)
-
-    # 到此为止，产生了一个response_message,接下来根据不同类型，调用不同的路径（文本\code）
-    if not response_message.tool_calls:
-        # 若是文本响应类任务（包括普通文本响应和和复杂任务拆解审查两种情况，都可以使用相同代码）
-        func_mode = is_text_response_valid
-    else:
-        # 如果是调用function call模式，此时输入的response_message是一个包含SQL或者python代码的JSON对象，输入给代码审查&执行的函数，输出为外部函数运行后的结果
-        func_mode = is_code_response_valid
-
-    messages = func_mode(
-        llm_api,
-        messages,
-        response_message,
-        available_functions,
-        is_developer_mode,
-        is_enhanced_mode,
-        delete_some_messages,
-        is_task_decomposition=is_task_decomposition
+    turn = ChatTurn(
+        llm_api=llm_api,
+        available_functions=available_functions,
+        is_developer_mode=is_developer_mode,
+        budget=budget,
+        step_hook=step_hook,
+        debugger=debugger,
+        namespace=namespace,
+        on_event=on_event
+    )
+    return turn.run(
+        messages=messages,
+        is_enhanced_mode=is_enhanced_mode,
+        is_task_decomposition=is_task_decomposition,
+        delete_some_messages=delete_some_messages,
+        route=route
     )
-    return messages
\ No newline at end of file
@@ -0,0 +1,278 @@
+"""
+会话检查点：保存并恢复一个会话的对话历史（ChatMessages）和变量空间。
+1、DataFrame按列保存，数值、布尔和日期时间列保存为NPY文件，恢复时以内存映射（copy-on-write）方式打开，
+   数据在访问时才从磁盘读入，恢复耗时与数据大小基本无关；字符串、分类等列保存为取值编号（NPY）和不重复的取值，
+   恢复时解码，无法编码的列以pickle保存；
+2、ndarray同样保存为NPY文件，其他变量以pickle保存，无法序列化的变量（模块、连接等）跳过并记录在清单中；
+3、每个文件以内容哈希命名，保存检查点时只写入哈希发生变化的列和变量，未变化的内容直接复用，
+   写入新的清单后删除不再被引用的文件。
+"""
+import os
+import json
+import time
+import pickle
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from .blob_store import BLOB_STORE_KEY
+from .session_store import message_to_dict
+
+CHECKPOINT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+# 可以直接保存为NPY并以内存映射方式读取的dtype类别：布尔、整数、无符号整数、浮点、复数、时间间隔、日期时间
+_NPY_KINDS = 'biufcmM'
+
+
+def _is_npy_array(values) -> bool:
+    return isinstance(values, np.ndarray) and values.dtype.kind in _NPY_KINDS
+
+
+def _hash_array(array:np.ndarray) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+
+def _hash_bytes(data:bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class _Writer:
+    """按内容哈希写入文件，已存在的文件直接复用"""
+    def __init__(self, blob_dir):
+        self.blob_dir = blob_dir
+        self.referenced = set()
+        self.written = 0
+        self.reused = 0
+        self.bytes_written = 0
+
+    def _write(self, name, write):
+        self.referenced.add(name)
+        path = os.path.join(self.blob_dir, name)
+        if os.path.exists(path):
+            self.reused += 1
+            return name
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            write(file)
+        self.bytes_written += os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        self.written += 1
+        return name
+
+    def array(self, array:np.ndarray) -> str:
+        return self._write(f"{_hash_array(array)}.npy", lambda file: np.save(file, array, allow_pickle=False))
+
+    def pickled(self, value) -> str:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        return self._write(f"{_hash_bytes(data)}.pkl", lambda file: file.write(data))
+
+
+def _column_values(frame:pd.DataFrame, i:int):
+    values = frame.iloc[:, i].array
+    # NumpyExtensionArray包装的numpy数组取出原数组，避免pickle
+    if isinstance(values, pd.arrays.NumpyExtensionArray):
+        return values.to_numpy()
+    return values
+
+
+def _factorize(values):
+    """
+    字符串、分类等列编码为(取值编号, 不重复的取值)，编号保存为NPY，比整列pickle的保存和读取都快得多；
+    含有缺失值（None和NaN在编码后无法区分）或者取值无法哈希时返回None
+    """
+    try:
+        if pd.isna(values).any():
+            return None
+        codes, uniques = pd.factorize(values)
+    except TypeError:
+        return None
+    return codes.astype(np.min_scalar_type(max(len(uniques) - 1, 0))), uniques
+
+
+def _save_frame(writer:_Writer, frame:pd.DataFrame) -> dict:
+    columns = []
+    for i in range(frame.shape[1]):
+        values = _column_values(frame, i)
+        if _is_npy_array(values):
+            columns.append({'format': 'npy', 'file': writer.array(values)})
+            continue
+        encoded = _factorize(values)
+        if encoded is not None:
+            codes, uniques = encoded
+            columns.append({'format': 'codes', 'file': writer.array(codes), 'uniques': writer.pickled(uniques)})
+        else:
+            columns.append({'format': 'pkl', 'file': writer.pickled(values)})
+    index = frame.index
+    labels = {
+        'columns': frame.columns,
+        'index': None if isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1 else index,
+        'attrs': frame.attrs,
+        'length': len(frame),
+    }
+    return {'columns': columns, 'labels': writer.pickled(labels)}
+
+
+def _save_variable(writer:_Writer, value):
+    """保存一个变量，返回清单中的条目；无法保存时抛出异常"""
+    if isinstance(value, pd.DataFrame) and not isinstance(value.columns, pd.MultiIndex):
+        return {'kind': 'frame', **_save_frame(writer, value)}
+    if isinstance(value, pd.Series):
+        entry = _save_frame(writer, value.to_frame(name=0))
+        return {'kind': 'series', 'name': writer.pickled(value.name), **entry}
+    if _is_npy_array(value):
+        return {'kind': 'array', 'file': writer.array(value)}
+    return {'kind': 'pickle', 'file': writer.pickled(value)}
+
+
+class _Reader:
+    def __init__(self, blob_dir, mmap=True):
+        self.blob_dir = blob_dir
+        self.mmap = mmap
+
+    def array(self, name):
+        # copy-on-write映射：可以原地修改，修改不会写回检查点文件；
+        # 以ndarray视图的形式返回，避免np.memmap子类出现在分析代码的运算结果中
+        array = np.load(os.path.join(self.blob_dir, name), mmap_mode='c' if self.mmap else None,
+                        allow_pickle=False)
+        return array.view(np.ndarray)
+
+    def pickled(self, name):
+        with open(os.path.join(self.blob_dir, name), 'rb') as file:
+            return pickle.load(file)
+
+    def load(self, column):
+        if column['format'] == 'npy':
+            return self.array(column['file'])
+        if column['format'] == 'codes':
+            return self.pickled(column['uniques']).take(self.array(column['file']))
+        return self.pickled(column['file'])
+
+
+def _load_frame(reader:_Reader, entry:dict) -> pd.DataFrame:
+    labels = reader.pickled(entry['labels'])
+    arrays = {i: reader.load(column) for i, column in enumerate(entry['columns'])}
+    # copy=False时各列直接使用内存映射的数组，不合并为二维的块，也就不会读入数据
+    frame = pd.DataFrame(arrays, copy=False) if arrays else pd.DataFrame(index=pd.RangeIndex(labels['length']))
+    frame.columns = labels['columns']
+    if labels['index'] is not None:
+        frame.index = labels['index']
+    frame.attrs = labels['attrs']
+    return frame
+
+
+def _load_variable(reader:_Reader, entry:dict):
+    kind = entry['kind']
+    if kind == 'frame':
+        return _load_frame(reader, entry)
+    if kind == 'series':
+        series = _load_frame(reader, entry).iloc[:, 0]
+        series.name = reader.pickled(entry['name'])
+        return series
+    if kind == 'array':
+        return reader.array(entry['file'])
+    return reader.pickled(entry['file'])
+
+
+def _checkpoint_variables(namespace:dict) -> dict:
+    """需要保存的变量：分析过程中产生的变量以及结果存储，不包括内置函数、模块和内部对象"""
+    variables = {
+        name: value for name, value in namespace.items()
+        if not name.startswith('_') and type(value).__name__ != 'module'
+    }
+    if namespace.get(BLOB_STORE_KEY) is not None:
+        variables[BLOB_STORE_KEY] = namespace[BLOB_STORE_KEY]
+    return variables
+
+
+class SessionCheckpoint:
+    """
+    一个会话的检查点目录：
+        manifest.json  清单（对话历史、会话状态摘要、各变量对应的文件）
+        blobs/         以内容哈希命名的NPY和pickle文件
+    example:
+        >>> checkpoint = SessionCheckpoint('./project/checkpoints/session_id')
+        >>> checkpoint.save(agent.messages, agent.namespace)
+        >>> state = checkpoint.load()
+    """
+    def __init__(self, path):
+        """
+        :param path: 检查点目录
+        """
+        self.path = path
+        self.blob_dir = os.path.join(path, 'blobs')
+        self.manifest_path = os.path.join(path, MANIFEST_NAME)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def save(self, messages, namespace:dict) -> dict:
+        """
+        保存检查点，只写入发生变化的列和变量
+        :param messages: ChatMessages对象
+        :param namespace: 变量空间
+        :return: 统计信息：变量数量、写入和复用的文件数量、写入字节数、跳过的变量、耗时（秒）
+        """
+        start = time.perf_counter()
+        os.makedirs(self.blob_dir, exist_ok=True)
+        writer = _Writer(self.blob_dir)
+
+        variables, skipped = {}, {}
+        for name, value in _checkpoint_variables(namespace).items():
+            try:
+                variables[name] = _save_variable(writer, value)
+            except Exception as e:
+                skipped[name] = f"{type(e).__name__}: {e}"
+
+        session_state = messages.session_state
+        manifest = {
+            'version': CHECKPOINT_VERSION,
+            'created': time.time(),
+            'messages': [message_to_dict(message) for message in messages.history_messages],
+            'session_state': session_state['content'] if session_state is not None else None,
+            'variables': variables,
+            'skipped': skipped,
+        }
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, ensure_ascii=False, default=str)
+        os.replace(tmp_path, self.manifest_path)
+
+        # 删除不再被清单引用的文件；已经映射到内存中的文件删除后映射仍然有效
+        for name in os.listdir(self.blob_dir):
+            if name not in writer.referenced:
+                try:
+                    os.remove(os.path.join(self.blob_dir, name))
+                except OSError:
+                    pass
+
+        return {
+            'variables': len(variables),
+            'written': writer.written,
+            'reused': writer.reused,
+            'bytes_written': writer.bytes_written,
+            'skipped': skipped,
+            'seconds': time.perf_counter() - start,
+        }
+
+    def load(self, mmap=True) -> dict:
+        """
+        读取检查点
+        :param mmap: 是否以内存映射方式打开NPY文件，默认为True；为False时全部读入内存
+        :return: 字典，包括messages（字典形式的消息）、session_state和variables
+        """
+        with open(self.manifest_path, encoding='utf-8') as file:
+            manifest = json.load(file)
+        if manifest.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"不支持的检查点版本：{manifest.get('version')}")
+        reader = _Reader(self.blob_dir, mmap=mmap)
+        variables = {name: _load_variable(reader, entry) for name, entry in manifest['variables'].items()}
+        return {
+            'messages': manifest['messages'],
+            'session_state': manifest['session_state'],
+            'variables': variables,
+            'skipped': manifest.get('skipped', {}),
+        }
@@ -0,0 +1,206 @@
+import time
+import weakref
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .tokens import message_text
+from ..utils.tracing import span, propagate
+
+SESSION_STATE_PREFIX = "【会话状态摘要】以下是本次分析会话中较早对话的压缩摘要，请在后续回答中沿用其中的信息：\n"
+
+COMPACTION_PROMPT = """你是一名数据分析助手，需要将一段较早的数据分析对话压缩为简洁的会话状态，供后续对话继续使用。
+请按照以下格式输出，每一项尽量精简，不要遗漏表名、变量名、字段名和关键数值：
+1、已加载的数据表：读取过哪些数据表，保存为哪些变量；
+2、当前环境中的变量：变量名、类型及含义；
+3、目前为止的分析结论：已经得到的关键发现和数值；
+4、未完成的任务：用户提出但尚未完成的需求。
+{previous_state}
+当前Python环境中的变量如下：
+{namespace_summary}
+
+需要压缩的对话如下：
+{conversation}"""
+
+
+def _get_role(message):
+    if isinstance(message, dict):
+        return message.get('role')
+    return getattr(message, 'role', None)
+
+
+def summarize_namespace(namespace) -> str:
+    """
+    生成分析环境中变量的简要说明（变量名、类型、DataFrame的形状和字段）
+    :param namespace: 字典形式的变量空间
+    """
+    if not namespace:
+        return '无'
+    lines = []
+    for name, value in namespace.items():
+        if name.startswith('_') or callable(value) or type(value).__name__ == 'module':
+            continue
+        shape = getattr(value, 'shape', None)
+        if shape is not None and hasattr(value, 'columns'):
+            columns = ', '.join(str(c) for c in list(value.columns)[:20])
+            lines.append(f"{name}: DataFrame{tuple(shape)}，字段：{columns}")
+        elif shape is not None:
+            lines.append(f"{name}: {type(value).__name__}{tuple(shape)}")
+        else:
+            lines.append(f"{name}: {type(value).__name__}")
+    return '\n'.join(lines) or '无'
+
+
+class CompactionJob:
+    """
+    一次压缩任务：记录被压缩的消息对象，以及后台执行的摘要调用。
+    任务属于发起它的ChatMessages，只会应用到该对象上
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.future = None
+        self.summary = None
+        self.latency = 0.0
+
+
+class SessionCompactor:
+    """
+    会话压缩器：当ChatMessages的token数量超过高水位线时，将最早的若干轮对话交给大模型总结为一条"会话状态"系统消息，
+    最近的keep_turns轮对话保持原样。
+    1、默认在后台线程中调用大模型，不阻塞当前对话，摘要完成后在下一次append时替换原消息；
+    2、进行中的任务按所属的ChatMessages分别记录，copy得到的对话历史共享压缩器时，不会应用彼此的任务；
+    3、记录压缩次数、节省的token数量、摘要调用耗时以及阻塞对话的耗时。
+    """
+    def __init__(self,
+                 llm_api,
+                 high_water=0.8,
+                 keep_turns=4,
+                 background=True,
+                 namespace=None,
+                 route='compaction'):
+        """
+        :param llm_api: 大模型调用接口，需要提供chat(messages=..., route=...)方法
+        :param high_water: 高水位线，token数量达到tokens_thr * high_water时触发压缩
+        :param keep_turns: 保持原样的最近对话轮数
+        :param background: 是否在后台线程中执行摘要调用
+        :param namespace: 可选参数，分析环境的变量空间，用于在摘要中记录当前变量
+        :param route: 摘要调用所使用的模型路由
+        """
+        self.llm_api = llm_api
+        self.high_water = high_water
+        self.keep_turns = keep_turns
+        self.background = background
+        self.namespace = namespace
+        self.route = route
+
+        self._executor = ThreadPoolExecutor(max_workers=1) if background else None
+        # 所属的ChatMessages -> 进行中的压缩任务，对话历史被回收后对应的任务随之丢弃
+        self._pending = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+        self.metrics = {
+            'compactions': 0,
+            'tokens_saved': 0,
+            'summary_latency': 0.0,
+            'blocking_latency': 0.0,
+        }
+
+    def select(self, messages):
+        """
+        选取需要压缩的消息：当前轮和最近keep_turns轮之前的全部历史消息
+        :return: (message, tokens)所组成的list，不足一轮可压缩时返回空list
+        """
+        entries = list(messages._history)
+        turn_starts = [i for i, (message, _) in enumerate(entries) if _get_role(message) == 'user']
+        if len(turn_starts) <= self.keep_turns + 1:
+            return []
+        end = turn_starts[-(self.keep_turns + 1)]
+        return entries[:end]
+
+    def summarize(self, entries, previous_state=None) -> str:
+        conversation = '\n'.join(
+            f"[{_get_role(message)}] {message_text(message)}" for message, _ in entries
+        )
+        prompt = COMPACTION_PROMPT.format(
+            previous_state=f"此前的会话状态如下，请在其基础上更新：\n{previous_state}\n" if previous_state else '',
+            namespace_summary=summarize_namespace(self.namespace),
+            conversation=conversation
+        )
+        response = self.llm_api.chat(messages=[{"role": "user", "content": prompt}], route=self.route)
+        return response.content
+
+    def _run(self, job, previous_state):
+        start = time.perf_counter()
+        with span('compaction', 'compaction', messages=len(job.entries), background=self.background):
+            job.summary = self.summarize(job.entries, previous_state)
+        job.latency = time.perf_counter() - start
+        return job
+
+    def maybe_compact(self, messages):
+        """
+        在ChatMessages每次append后调用：先应用已经完成的压缩任务，再根据高水位线决定是否发起新的压缩
+        """
+        start = time.perf_counter()
+
+        with self._lock:
+            job = self._pending.get(messages)
+            if job is not None and job.future.done():
+                del self._pending[messages]
+            else:
+                job = None
+        if job is not None:
+            try:
+                self.apply(messages, job.future.result())
+            except Exception as e:
+                print(f">>> 会话压缩失败：{e}")
+
+        if (messages not in self._pending
+                and messages.tokens_thr is not None
+                and messages.tokens_count >= messages.tokens_thr * self.high_water):
+            entries = self.select(messages)
+            if entries:
+                job = CompactionJob(entries)
+                previous_state = messages.session_state['content'] if messages.session_state else None
+                if self._executor is not None:
+                    job.future = self._executor.submit(propagate(self._run), job, previous_state)
+                    with self._lock:
+                        self._pending[messages] = job
+                else:
+                    try:
+                        self.apply(messages, self._run(job, previous_state))
+                    except Exception as e:
+                        print(f">>> 会话压缩失败：{e}")
+
+        self.metrics['blocking_latency'] += time.perf_counter() - start
+
+    def wait(self, messages):
+        """等待messages的后台压缩任务完成并应用，主要用于测试和会话结束前"""
+        job = self._pending.get(messages)
+        if job is not None:
+            job.future.result()
+            self.maybe_compact(messages)
+
+    def apply(self, messages, job):
+        """
+        用摘要替换被压缩的消息。若部分消息已被淘汰，只删除仍位于历史头部的被压缩消息；
+        被压缩的消息已全部不在历史中时不做任何修改，也不计入压缩次数。
+        """
+        tokens_before = messages.tokens_count
+        compacted = {id(message) for message, _ in job.entries}
+        evicted_before = messages._evicted
+        while len(messages._history) and id(messages._history[0][0]) in compacted:
+            if not messages._evict_oldest():
+                break
+        removed = messages._evicted - evicted_before
+        if not removed:
+            return
+
+        messages.set_session_state(SESSION_STATE_PREFIX + job.summary)
+        tokens_saved = tokens_before - messages.tokens_count
+
+        self.metrics['compactions'] += 1
+        self.metrics['summary_latency'] += job.latency
+        self.metrics['tokens_saved'] += tokens_saved
+        print(f">>> 已将{removed}条较早的对话压缩为会话状态，节省约{tokens_saved}个tokens")
+
+    def get_metrics(self) -> dict:
+        return dict(self.metrics)
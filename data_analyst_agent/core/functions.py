@@ -1,7 +1,12 @@
+import os
+import re
+import copy
 import json
+import types
+import typing
+import hashlib
 import inspect
-import numpy as np
-import pandas as pd
+import tempfile
 
 DefaultToolsDescMap = {
     'sql_inter':
@@ -42,99 +47,284 @@ DefaultToolsDescMap = {
                                             'required': ['py_code', 'fname'],
                                             'type': 'object'}},
     'type': 'function'},
+    'fetch_blob':
+        {'function':
+             {'description': '用于读取此前过长的外部函数运行结果中的一部分。过长的结果只在对话中保留预览和句柄（例如blob_1），需要查看更多内容时，按行、列或字节范围读取。SQL查询结果为文本表格（第一行为字段名，字段之间以制表符分隔），按行或列读取时总是附带字段名行',
+              'name': 'fetch_blob',
+              'parameters': {'properties': {'handle': {'description': '结果句柄，例如blob_1', 'type': 'string'},
+                                            'rows': {'description': '需要读取的行范围，例如"10:20"表示第10行到第19行，SQL查询结果中从0开始计数且不含字段名行', 'type': 'string'},
+                                            'columns': {'description': '需要读取的列，SQL查询结果和JSON数组结果中为字段名或列序号（从0开始）', 'type': 'array', 'items': {'type': 'string'}},
+                                            'start': {'description': '按字节读取时的起始位置', 'type': 'integer'},
+                                            'end': {'description': '按字节读取时的结束位置', 'type': 'integer'},
+                                            'g': {'description': '环境变量，无需设置，保持默认参数即可', 'type': 'string'}},
+                             'required': ['handle'],
+                             'type': 'object'}},
+         'type': 'function'},
 }
 
 
-def auto_functions(functions_list:list):
+# 生成规则变化时修改版本号，使旧的缓存失效
+SCHEMA_VERSION = 1
+
+# 由外部函数运行环境注入的参数，不出现在函数描述中
+INJECTED_PARAMS = {'g'}
+
+_JSON_TYPES = {
+    str: 'string',
+    int: 'integer',
+    float: 'number',
+    bool: 'boolean',
+    list: 'array',
+    tuple: 'array',
+    set: 'array',
+    dict: 'object',
+}
+
+
+def _json_type(annotation, default=inspect.Parameter.empty) -> dict:
+    """根据类型注解（或默认值的类型）推断JSON Schema类型，无法推断时为string"""
+    if annotation is inspect.Parameter.empty:
+        if default is inspect.Parameter.empty or default is None:
+            return {'type': 'string'}
+        annotation = type(default)
+    if isinstance(annotation, str):
+        annotation = {'str': str, 'int': int, 'float': float, 'bool': bool, 'list': list, 'dict': dict}.get(
+            annotation.split('[')[0], str)
+
+    origin = typing.get_origin(annotation)
+    args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+    if origin is typing.Union or (hasattr(types, 'UnionType') and origin is types.UnionType):
+        # Optional[X]取X，多种类型时取第一种
+        return _json_type(args[0]) if args else {'type': 'string'}
+    if origin is typing.Literal:
+        values = list(typing.get_args(annotation))
+        schema = _json_type(type(values[0])) if values else {'type': 'string'}
+        schema['enum'] = values
+        return schema
+    if origin in (list, tuple, set):
+        schema = {'type': 'array'}
+        if args and args[0] is not Ellipsis:
+            schema['items'] = _json_type(args[0])
+        return schema
+    if origin is dict:
+        return {'type': 'object'}
+    for python_type in (bool, int, float, str, list, tuple, set, dict):
+        if annotation is python_type or (isinstance(annotation, type) and issubclass(annotation, python_type)):
+            return {'type': _JSON_TYPES[python_type]}
+    return {'type': 'string'}
+
+
+_PARAM_PATTERN = re.compile(r'^\s*:param\s+(\w+)\s*[:：]\s*(.*)$')
+_SECTION_PATTERN = re.compile(r'^\s*(:return|:raises?|:rtype|example|>>>)', re.IGNORECASE)
+_GOOGLE_ARG_PATTERN = re.compile(r'^\s+(\w+)\s*(?:\([^)]*\))?\s*[:：]\s*(.*)$')
+
+
+def _clean_text(text:str) -> str:
+    """合并多余的空白（包括续行产生的缩进），并去掉两个中文字符之间的空格"""
+    text = re.sub(r'\s+', ' ', text).strip()
+    return re.sub(r'(?<=[^\x00-\x7f]) (?=[^\x00-\x7f])', '', text)
+
+
+def parse_docstring(doc:str) -> tuple:
+    """
+    解析函数说明，返回(功能说明, {参数名: 参数说明})
+    支持本项目使用的`:param x: 说明`格式，以及Google风格的`Args:`段落
+    """
+    if not doc:
+        return '', {}
+    summary, params = [], {}
+    current = None
+    in_args = False
+    for line in doc.splitlines():
+        match = _PARAM_PATTERN.match(line)
+        if match:
+            current = match.group(1)
+            params[current] = match.group(2).strip()
+            continue
+        stripped = line.strip()
+        if stripped in ('Args:', 'Arguments:', 'Parameters:', '参数:', '参数：'):
+            in_args, current = True, None
+            continue
+        if in_args:
+            match = _GOOGLE_ARG_PATTERN.match(line)
+            if match:
+                current = match.group(1)
+                params[current] = match.group(2).strip()
+                continue
+            if stripped and not line.startswith((' ', '\t')):
+                in_args = False
+        if _SECTION_PATTERN.match(line) or stripped in ('Returns:', 'Raises:', 'Example:', 'Examples:'):
+            current, in_args = None, False
+            continue
+        if current is not None and stripped:
+            # 参数说明跨越多行
+            params[current] = params[current] + ' ' + stripped
+        elif current is None and not in_args and not params:
+            summary.append(stripped)
+    return _clean_text(' '.join(line.rstrip('\\') for line in summary if line)), \
+        {name: _clean_text(text) for name, text in params.items()}
+
+
+def function_schema(function) -> dict:
+    """
+    根据函数签名、类型注解和函数说明中的参数段落生成函数描述（Chat模型tools参数的一项），不调用大模型
+    1、没有默认值的参数为必填参数；
+    2、参数类型来自类型注解，没有注解时根据默认值推断，否则为string；
+    3、外部函数运行环境注入的参数（g）以及*args、**kwargs不出现在描述中。
+    """
+    description, param_docs = parse_docstring(inspect.getdoc(function) or '')
+    properties, required = {}, []
+    for name, parameter in inspect.signature(function).parameters.items():
+        if name in INJECTED_PARAMS or parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+            continue
+        schema = _json_type(parameter.annotation, parameter.default)
+        if name in param_docs:
+            schema['description'] = param_docs[name]
+        if parameter.default is inspect.Parameter.empty:
+            required.append(name)
+        elif parameter.default is not None and isinstance(parameter.default, (str, int, float, bool)):
+            schema['default'] = parameter.default
+        properties[name] = schema
+    return {
+        'type': 'function',
+        'function': {
+            'name': function.__name__,
+            'description': description or function.__name__,
+            'parameters': {'type': 'object', 'properties': properties, 'required': required},
+        }
+    }
+
+
+def source_hash(function) -> str:
+    """函数源码的哈希值，源码不可获取时使用字节码和常量"""
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        code = getattr(function, '__code__', None)
+        source = repr((code.co_code, code.co_consts, code.co_varnames)) if code is not None else repr(function)
+    doc = inspect.getdoc(function) or ''
+    return hashlib.sha256(f"{SCHEMA_VERSION}\n{source}\n{doc}".encode('utf-8')).hexdigest()
+
+
+class SchemaCache:
+    """
+    函数描述的磁盘缓存：以函数名和源码哈希作为键，每个函数描述保存为一个JSON文件，
+    函数源码不变时，再次启动无需重新生成（也无需调用大模型）
+    """
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: 缓存目录，默认为环境变量TOOL_SCHEMA_CACHE，未设置时为~/.cache/dataflow_agent/tool_schemas
+        """
+        self.cache_dir = cache_dir or os.getenv('TOOL_SCHEMA_CACHE') or os.path.join(
+            os.path.expanduser('~'), '.cache', 'dataflow_agent', 'tool_schemas')
+        self.metrics = {'hits': 0, 'misses': 0}
+
+    def _path(self, function, enriched) -> str:
+        key = source_hash(function)[:32]
+        suffix = '.enriched' if enriched else ''
+        return os.path.join(self.cache_dir, f"{function.__name__}-{key}{suffix}.json")
+
+    def get(self, function, enriched=False):
+        try:
+            with open(self._path(function, enriched), 'r', encoding='utf-8') as file:
+                schema = json.load(file)
+        except (OSError, ValueError):
+            self.metrics['misses'] += 1
+            return None
+        self.metrics['hits'] += 1
+        return schema
+
+    def put(self, function, schema:dict, enriched=False):
+        path = self._path(function, enriched)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # 先写入临时文件再替换，避免并发启动时读到写了一半的文件
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(schema, file, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f">>> 函数描述缓存写入失败：{e}")
+
+
+_default_schema_cache = None
+
+
+def get_default_schema_cache() -> SchemaCache:
+    global _default_schema_cache
+    if _default_schema_cache is None:
+        _default_schema_cache = SchemaCache()
+    return _default_schema_cache
+
+
+ENRICH_PROMPT = """以下是根据函数签名和函数说明自动生成的函数描述（JSON格式），以及该函数的函数说明。
+请完善其中的description字段（函数的功能说明以及每个参数的说明），使大模型能够准确理解何时以及如何调用该函数。
+不要修改name、type、required以及参数名称，只输出修改后的JSON字典，前后不需要任何修饰或说明。
+函数描述：
+{schema}
+函数说明：
+{doc}"""
+
+
+def enrich_schema(schema:dict, function, llm_api) -> dict:
+    """
+    借助大模型（schema路由）完善函数描述中的文字说明；大模型输出不合法时返回原始描述
+    """
+    prompt = ENRICH_PROMPT.format(schema=json.dumps(schema['function'], ensure_ascii=False, indent=2),
+                                  doc=inspect.getdoc(function) or '无')
+    try:
+        response = llm_api.chat(messages=[{"role": "user", "content": prompt}], route='schema')
+        content = response.content.strip()
+        if content.startswith('```'):
+            content = content.strip('`').split('\n', 1)[-1]
+        enriched = json.loads(content)
+    except Exception as e:
+        print(f">>> 函数{schema['function']['name']}的描述完善失败，使用自动生成的描述：{e}")
+        return schema
+
+    result = copy.deepcopy(schema)
+    if isinstance(enriched.get('description'), str) and enriched['description'].strip():
+        result['function']['description'] = enriched['description'].strip()
+    enriched_properties = (enriched.get('parameters') or {}).get('properties') or {}
+    for name, prop in result['function']['parameters']['properties'].items():
+        description = (enriched_properties.get(name) or {}).get('description')
+        if isinstance(description, str) and description.strip():
+            prop['description'] = description.strip()
+    return result
+
+
+def auto_functions(functions_list:list, llm_api=None, enrich=False, cache=None):
     """
     Chat模型的functions参数编写函数
+    1、DefaultToolsDescMap中的函数直接使用预置的描述；
+    2、其他函数根据函数签名、类型注解和函数说明生成描述，不需要调用大模型；
+    3、enrich=True且传入llm_api时，借助大模型完善描述中的文字说明；
+    4、生成的描述按函数源码的哈希值缓存到磁盘，源码不变时直接读取缓存。
     :param functions_list: 包含一个或者多个函数对象的列表；
+    :param llm_api: 可选参数，大模型调用接口，仅在enrich=True时使用；
+    :param enrich: 可选参数，是否借助大模型完善函数描述，默认为False；
+    :param cache: 可选参数，SchemaCache对象，默认使用~/.cache/dataflow_agent/tool_schemas，设置为False时不使用缓存；
     :return：满足Chat模型functions参数要求的functions对象
     """
-    def functions_generate(functions_list):
-        # 创建空列表，用于保存每个函数的描述字典
-        functions = []
-
-        def chen_ming_algorithm(data):
-            """
-            陈明算法函数，该函数定义了一种特殊的数据集计算过程
-            :param data: 必要参数，表示带入计算的数据表，用字符串进行表示
-            :return：陈明函数计算后的结果，返回结果为表示为JSON格式的Dataframe类型对象
-            """
-            df_new = pd.read_json(data)
-            res = np.sum(df_new, axis=1) - 1
-            return res.to_json(orient='records')
-
-        chen_ming_function_description = inspect.getdoc(chen_ming_algorithm)
-
-        chen_ming_function_name = chen_ming_algorithm.__name__
-
-        chen_ming_function = {"name": "chen_ming_algorithm",
-                              "description": "用于执行陈明算法的函数，定义了一种特殊的数据集计算过程",
-                              "parameters": {"type": "object",
-                                             "properties": {"data": {"type": "string",
-                                                                     "description": "执行陈明算法的数据集"},
-                                                           },
-                                             "required": ["data"],
-                                            },
-                             }
-
-
-        # 对每个外部函数进行循环
-        for function in functions_list:
-            function_name = function.__name__
-            if function_name in DefaultToolsDescMap:
-                functions.append(DefaultToolsDescMap[function_name])
-                continue
-            # 读取函数对象的函数说明
-            function_description = inspect.getdoc(function)
-            # 读取函数的函数名字符串
-            user_message1 = '以下是某的函数说明：%s。' % chen_ming_function_description +\
-                            '根据这个函数的函数说明，请帮我创建一个function对象，用于描述这个函数的基本情况。这个function对象是一个JSON格式的字典，\
-                            这个字典有如下5点要求：\
-                            1.字典总共有三个键值对；\
-                            2.第一个键值对的Key是字符串name，value是该函数的名字：%s，也是字符串；\
-                            3.第二个键值对的Key是字符串description，value是该函数的函数的功能说明，也是字符串；\
-                            4.第三个键值对的Key是字符串parameters，value是一个JSON Schema对象，用于说明该函数的参数输入规范。\
-                            5.输出结果必须是一个JSON格式的字典，只输出这个字典即可，前后不需要任何前后修饰或说明的语句' % chen_ming_function_name
-
-
-            assistant_message1 = json.dumps(chen_ming_function)
-
-            user_prompt = '现在有另一个函数，函数名为：%s；函数说明为：%s；\
-                          请帮我仿造类似的格式为当前函数创建一个function对象。' % (function_name, function_description)
-
-            '''TUDO:用llm_api注入的方式'''
-            response = client.chat.completions.create(
-                              model=model_name,
-                              messages=[
-                                {"role": "user", "name":"example_user", "content": user_message1},
-                                {"role": "assistant", "name":"example_assistant", "content": assistant_message1},
-                                {"role": "user", "name":"example_user", "content": user_prompt}]
-                            )
-            one_function = {
-                'type': 'function',
-                'function': json.loads(response.choices[0].message.content)
-            }
-            functions.append(one_function)
-        return functions
-
-    max_attempts = 3
-    attempts = 0
-
-    while attempts < max_attempts:
-        try:
-            functions = functions_generate(functions_list)
-            break  # 如果代码成功执行，跳出循环
-        except Exception as e:
-            attempts += 1  # 增加尝试次数
-            print(">>> 发生错误：", e)
-            print(">>> 由于模型limit rate导致报错，即将暂停1分钟，1分钟后重新尝试调用模型")
-            if attempts == max_attempts:
-                print(">>> 已达到最大尝试次数，程序终止。")
-                raise  # 重新引发最后一个异常
-            else:
-                print(">>> 正在重新运行...")
+    if cache is None:
+        cache = get_default_schema_cache()
+    enrich = bool(enrich and llm_api is not None)
+
+    functions = []
+    for function in functions_list:
+        function_name = function.__name__
+        if function_name in DefaultToolsDescMap:
+            functions.append(DefaultToolsDescMap[function_name])
+            continue
+
+        schema = cache.get(function, enrich) if cache else None
+        if schema is None:
+            schema = function_schema(function)
+            if enrich:
+                schema = enrich_schema(schema, function, llm_api)
+            if cache:
+                cache.put(function, schema, enrich)
+        functions.append(schema)
     return functions
 
 
@@ -142,25 +332,38 @@ class AvailableFunctions:
     """
     外部函数类，主要负责承接外部函数调用时相关功能支持。类属性包括外部函数列表、外部函数参数说明列表、以及调用方式说明三项。
     """
-    def __init__(self, functions_list=[], functions=[], function_call="auto"):
+    def __init__(self, functions_list=[], functions=[], function_call="auto", llm_api=None,
+                 enrich_schemas=False, schema_cache=None):
+        """
+        :param functions_list: 外部函数列表
+        :param functions: 外部函数描述列表，为空时根据functions_list自动生成
+        :param function_call: 外部函数调用规则
+        :param llm_api: 可选参数，大模型调用接口，仅在enrich_schemas=True时用于完善函数描述
+        :param enrich_schemas: 可选参数，是否借助大模型完善自动生成的函数描述，默认为False
+        :param schema_cache: 可选参数，SchemaCache对象，默认使用磁盘上的共享缓存，设置为False时不使用缓存
+        """
         self.functions_list = functions_list
         self.functions = functions
         self.functions_dic = None
         self.function_call = None
+        self.llm_api = llm_api
+        self.enrich_schemas = enrich_schemas
+        self.schema_cache = schema_cache
         # 当外部函数列表不为空、且外部函数参数解释为空时，调用auto_functions创建外部函数解释列表
         if functions_list and isinstance(functions_list, list):
             self.functions_dic = {func.__name__: func for func in functions_list}
             self.function_call = function_call
             if not functions:
-                self.functions = auto_functions(functions_list)
+                self.functions = auto_functions(functions_list, self.llm_api, self.enrich_schemas, self.schema_cache)
 
     # 增加外部函数方法，并且同时可以更换外部函数调用规则
     def add_function(self, new_function, function_description=None, function_call_update=None):
         self.functions_list.append(new_function)
         self.functions_dic[new_function.__name__] = new_function
         if function_description is None:
-            new_function_description = auto_functions([new_function])
-            self.functions.append(new_function_description)
+            new_function_description = auto_functions([new_function], self.llm_api, self.enrich_schemas,
+                                                      self.schema_cache)
+            self.functions.extend(new_function_description)
         else:
             self.functions.append(function_description)
         if function_call_update:
@@ -1,12 +1,127 @@
-import copy
+import json
+from collections import deque
 from openai.types.chat import chat_completion
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
 
+from .tokens import get_token_counter, message_text
+
 MessageDict = dict
 MessageType = ChatCompletionMessage
 ChatMessageTypeList = [chat_completion, MessageType, MessageDict]
 
 
+class MessageHistory:
+    """
+    结构共享（写时复制）的历史消息序列，元素为(message, tokens)。
+    1、fork时将自身尾部冻结为不可变的段（tuple），新旧对象共享全部已冻结的段，复制开销与消息数量和内容大小无关；
+    2、每个对象只记录自己追加的尾部，以及自己在各个共享段上的起止位置，
+       头部淘汰、尾部删除只移动起止位置，不会修改共享段；
+    3、段的数量超过max_segments时合并为一个段，保证遍历和fork的开销有界。
+    """
+    max_segments = 32
+
+    def __init__(self, entries=()):
+        # 共享段：[segment, lo, hi]，segment为tuple，本对象只使用segment[lo:hi]
+        self._segments = deque()
+        self._segments_len = 0
+        # 本对象自己追加的尾部
+        self._tail = deque(entries)
+
+    def __len__(self):
+        return self._segments_len + len(self._tail)
+
+    def __iter__(self):
+        for segment, lo, hi in self._segments:
+            for i in range(lo, hi):
+                yield segment[i]
+        yield from self._tail
+
+    def __getitem__(self, index):
+        index = self._normalize(index)
+        if index >= self._segments_len:
+            return self._tail[index - self._segments_len]
+        for segment, lo, hi in self._segments:
+            if index < hi - lo:
+                return segment[lo + index]
+            index -= hi - lo
+
+    def __setitem__(self, index, entry):
+        index = self._normalize(index)
+        if index == len(self) - 1:
+            self.pop()
+            self.append(entry)
+            return
+        if index < self._segments_len:
+            self._materialize()
+        self._tail[index - self._segments_len] = entry
+
+    def __delitem__(self, index):
+        index = self._normalize(index)
+        if index == len(self) - 1:
+            self.pop()
+            return
+        if index < self._segments_len:
+            self._materialize()
+        del self._tail[index - self._segments_len]
+
+    def _normalize(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return index
+
+    # 将共享段全部展开为本对象自己的尾部，仅在修改历史中间位置时使用
+    def _materialize(self):
+        self._tail = deque(self)
+        self._segments = deque()
+        self._segments_len = 0
+
+    def append(self, entry):
+        self._tail.append(entry)
+
+    def pop(self):
+        if self._tail:
+            return self._tail.pop()
+        if not self._segments:
+            raise IndexError("pop from empty history")
+        last = self._segments[-1]
+        last[2] -= 1
+        self._segments_len -= 1
+        if last[1] == last[2]:
+            self._segments.pop()
+        return last[0][last[2]]
+
+    def popleft(self):
+        if not self._segments:
+            return self._tail.popleft()
+        first = self._segments[0]
+        entry = first[0][first[1]]
+        first[1] += 1
+        self._segments_len -= 1
+        if first[1] == first[2]:
+            self._segments.popleft()
+        return entry
+
+    def fork(self):
+        """
+        复制当前序列：冻结尾部后，新对象与当前对象共享全部段，各自记录之后的修改
+        """
+        if self._tail:
+            segment = tuple(self._tail)
+            self._segments.append([segment, 0, len(segment)])
+            self._segments_len += len(segment)
+            self._tail = deque()
+        if len(self._segments) > self.max_segments:
+            segment = tuple(self)
+            self._segments = deque([[segment, 0, len(segment)]])
+
+        new_obj = MessageHistory()
+        new_obj._segments = deque([list(bounds) for bounds in self._segments])
+        new_obj._segments_len = self._segments_len
+        return new_obj
+
+
 class ChatMessages:
     """
     ChatMessages类，用于创建Chat模型能够接收和解读的messages对象。
@@ -14,39 +129,46 @@ class ChatMessages:
     2、ChatMessages类对象将字典类型的list作为其属性之一，
     3、同时还能能区分系统消息和历史对话消息，并且能够自行计算当前对话的token量，
     4、能够在append的同时删减最早对话消息，从而能够更加顺畅的输入大模型并完成多轮对话需求。
+    5、copy时与原对象结构共享历史消息（写时复制），debug等场景频繁复制时无需深复制全部消息。
     """
 
     def __init__(self,
                  system_content_list=[],
                  question='你好。',
                  tokens_thr=None,
-                 project=None):
+                 project=None,
+                 tokenizer='auto',
+                 compactor=None,
+                 retriever=None):
 
         # 最大token数量阈值
         self.tokens_thr = tokens_thr
-        # token数计算编码方式
-        # self.encoding = AutoTokenizer.from_pretrained("./Qwen2.5-3B-Instruct").encode
-
-        self.encoding = lambda x: x # 需要进一步优化
+        # token计数器：支持'auto'、'tiktoken'、'heuristic'，或传入编码函数（例如transformers tokenizer的encode）
+        # 计数器带有按消息缓存，append、pop、copy时无需重复编码
+        self.token_counter = get_token_counter(tokenizer)
 
         # message挂靠的项目
         self.project = project
+        # 会话压缩器：token数量超过高水位线时，将较早的对话总结为会话状态
+        self.compactor = compactor
+        # 会话状态摘要消息，位于系统消息之后、历史消息之前
+        self.session_state = None
+        self.session_state_tokens = 0
+        # 数据字典检索索引：设置后，只将与当前问题相关的数据字典片段作为系统消息注入
+        self.retriever = retriever
+        self.retrieved_context = None
+        self.retrieved_context_tokens = 0
+        self._retrieval_query = None
 
         self.system_content_list = system_content_list
         # 系统消息文档列表，相当于外部输入文档列表
         system_messages = []
         # 除系统消息外历史对话消息
         history_messages = []
-        # 用于保存全部消息的list
-        messages_all = []
-        # 系统消息字符串
-        system_content = ''
-        # 历史消息字符串，此时为用户输入信息
-        history_content = question
-        # 系统消息+历史消息字符串
-        content_all = ''
         # 输入到messages中系统消息个数，初始情况为0
         num_of_system_messages = 0
+        # 系统消息的token数量
+        system_tokens_count = 0
         # 全部信息的token数量
         all_tokens_count = 0
 
@@ -54,15 +176,10 @@ class ChatMessages:
         # 将外部输入文档列表依次保存为系统消息
         if system_content_list and isinstance(system_content_list, list):
             for content in system_content_list:
-                system_messages.append(
-                    {"role": "system", "content": content})
-                # 同时进行全文档拼接
-                system_content += content
-
-            # 计算系统消息token
-            system_tokens_count = len(self.encoding(system_content))
-            # 拼接系统消息
-            messages_all += system_messages
+                system_message = {"role": "system", "content": content}
+                system_messages.append(system_message)
+                # 计算系统消息token
+                system_tokens_count += self.count_tokens(system_message)
             # 计算系统消息个数
             num_of_system_messages = len(system_content_list)
 
@@ -73,7 +190,6 @@ class ChatMessages:
                     print(">>> system_messages的tokens数量超出限制，当前系统消息将不会被输入模型，若有必要，请重新调整外部文档数量。")
                     # 删除系统消息
                     system_messages = []
-                    messages_all = []
                     # 系统消息个数清零
                     num_of_system_messages = 0
                     # 系统消息token数清零
@@ -83,11 +199,9 @@ class ChatMessages:
 
         # 创建首次对话消息
         history_messages = [{"role": "user", "content": question}]
-        # 创建全部消息列表
-        messages_all += history_messages
 
         # 计算用户问题token
-        user_tokens_count = len(self.encoding(question))
+        user_tokens_count = self.count_tokens(history_messages[0])
 
         # 计算总token数
         all_tokens_count += user_tokens_count
@@ -100,79 +214,197 @@ class ChatMessages:
                 # 同时清空系统消息和用户消息
                 history_messages = []
                 system_messages = []
-                messages_all = []
                 num_of_system_messages = 0
+                system_tokens_count = 0
                 all_tokens_count = 0
 
-        # 全部messages信息
-        self.messages = messages_all
         # system_messages信息
         self.system_messages = system_messages
-        # user_messages信息
-        self.history_messages = history_messages
-        # messages信息中全部content的token数量
-        self.tokens_count = all_tokens_count
+        # 系统消息的token数量
+        self.system_tokens_count = system_tokens_count
         # 系统信息数量
         self.num_of_system_messages = num_of_system_messages
 
+        # 历史对话消息窗口：结构共享的序列中保存(message, tokens)，并维护历史消息的token总数
+        self._history = MessageHistory()
+        self._history_tokens = 0
+        # 已从窗口头部淘汰的消息数量，用于换算消息的绝对位置
+        self._evicted = 0
+        # 当前轮对话（最后一条用户消息）的绝对位置，当前轮对话不会被自动淘汰
+        self._turn_start = 0
+        for message in history_messages:
+            self._push(message)
+
+
+    # messages信息中全部content的token数量
+    @property
+    def tokens_count(self):
+        return self.system_tokens_count + self.retrieved_context_tokens + self.session_state_tokens \
+            + self._history_tokens
+
+    # user_messages信息
+    @property
+    def history_messages(self):
+        return [message for message, _ in self._history]
+
+    # 全部messages信息
+    @property
+    def messages(self):
+        context_messages = [message for message in (self.retrieved_context, self.session_state) if message is not None]
+        return self.system_messages + context_messages + self.history_messages
+
+    # 计算单条消息的token数量（带缓存）
+    def count_tokens(self, message):
+        return self.token_counter.count_message(message)
+
+    # 设置会话状态摘要，content为None时清除
+    def set_session_state(self, content):
+        if content is None:
+            self.session_state = None
+            self.session_state_tokens = 0
+        else:
+            self.session_state = {"role": "system", "content": content}
+            self.session_state_tokens = self.count_tokens(self.session_state)
+
+    # 根据当前轮的用户问题和最近recent次函数调用的参数（SQL、数据表名等），重新检索需要注入的数据字典片段
+    def refresh_retrieved_context(self, recent=3):
+        if self.retriever is None:
+            return
+
+        # 当前轮的用户问题不会被淘汰，本轮函数调用再多也始终作为查询的一部分
+        start = max(self._turn_start - self._evicted, 0)
+        query_parts = []
+        if start < len(self._history) and _get_role(self._history[start][0]) == 'user':
+            query_parts.append(message_text(self._history[start][0]))
+        arguments = []
+        for i in range(len(self._history) - 1, start, -1):
+            if len(arguments) >= recent:
+                break
+            arguments.extend(reversed(_tool_call_arguments(self._history[i][0])))
+        query_parts.extend(reversed(arguments[:recent]))
+        query = '\n'.join(query_parts)
+
+        # 查询没有变化时沿用上一次的检索结果
+        if query == self._retrieval_query:
+            return
+        self._retrieval_query = query
+
+        content = self.retriever.build_context(query, count_tokens=self.token_counter.count_text)
+        if content:
+            self.retrieved_context = {"role": "system", "content": content}
+            self.retrieved_context_tokens = self.count_tokens(self.retrieved_context)
+        else:
+            self.retrieved_context = None
+            self.retrieved_context_tokens = 0
+
+    # 在窗口尾部追加一条历史消息
+    def _push(self, message):
+        tokens = self.count_tokens(message)
+        if _get_role(message) == 'user':
+            self._turn_start = self._evicted + len(self._history)
+        self._history.append((message, tokens))
+        self._history_tokens += tokens
+
+    # 从窗口头部淘汰最早的一组消息，返回是否淘汰成功
+    def _evict_oldest(self):
+        # 系统消息不在窗口中；当前轮对话不淘汰
+        if not self._history or self._evicted >= self._turn_start:
+            return False
+
+        message, tokens = self._history.popleft()
+        self._evicted += 1
+        self._history_tokens -= tokens
+
+        # 带有tool_calls的assistant消息需要和其后的tool消息一起淘汰，否则接口会拒绝孤立的tool消息
+        if _get_tool_calls(message):
+            while self._history and _get_role(self._history[0][0]) == 'tool':
+                _, tokens = self._history.popleft()
+                self._evicted += 1
+                self._history_tokens -= tokens
+        return True
 
     # 删除部分对话信息
     def messages_pop(self, manual=False, index=None):
-        def reduce_tokens(idx):
-            drop_message = self.history_messages.pop(idx)
-            self.tokens_count -= len(self.encoding(str(drop_message)))
-
+        # 超出token限制时，从最早的历史消息开始淘汰
         if self.tokens_thr is not None:
             while self.tokens_count >= self.tokens_thr:
-                reduce_tokens(-1)
+                if not self._evict_oldest():
+                    print(">>> 当前轮对话的tokens数量超出限制，已无可淘汰的历史消息。")
+                    break
 
         if manual:
-            if index is None:
-                reduce_tokens(-1)
-            elif 0 <= index < len(self.history_messages) or index == -1:
-                reduce_tokens(index)
-            else:
+            if index is None or index == -1:
+                index = len(self._history) - 1
+            elif not 0 <= index < len(self._history):
                 raise ValueError("Invalid index value: {}".format(index))
-
-        # 更新messages
-        self.messages = self.system_messages + self.history_messages
+            if index < 0:
+                raise IndexError("pop from empty history")
+
+            _, tokens = self._history[index]
+            del self._history[index]
+            self._history_tokens -= tokens
+
+            # 若删除了当前轮对话的用户消息，则重新定位当前轮对话的起点
+            position = self._evicted + index
+            if position < self._turn_start:
+                self._turn_start -= 1
+            elif position == self._turn_start:
+                self._turn_start = self._evicted
+                for i in range(len(self._history) - 1, -1, -1):
+                    if _get_role(self._history[i][0]) == 'user':
+                        self._turn_start = self._evicted + i
+                        break
 
     # 增加部分对话信息
     def messages_append(self, new_messages):
 
         # 若是单独一个字典，或JSON格式字典
         if type(new_messages) in ChatMessageTypeList:
-            self.messages.append(new_messages)
-            self.tokens_count += len(self.encoding(str(new_messages)))
+            self._push(new_messages)
 
         # 若新消息也是ChatMessages对象
         elif isinstance(new_messages, ChatMessages):
-            self.messages += new_messages.messages
-            self.tokens_count += new_messages.tokens_count
+            for message in new_messages.messages:
+                self._push(message)
 
-        # 重新更新history_messages
-        self.history_messages = self.messages[self.num_of_system_messages: ]
+        # 若是字典所构成的list
+        elif isinstance(new_messages, list):
+            for message in new_messages:
+                self._push(message)
+
+        # 若设置了压缩器，先尝试将较早的对话压缩为会话状态
+        if self.compactor is not None:
+            self.compactor.maybe_compact(self)
 
         # 再执行pop，若有需要，则会删除部分历史消息
         self.messages_pop()
 
     # 复制信息
     def copy(self):
-        # 创建一个新的 ChatMessages 对象，复制所有重要的属性
-        system_content_str_list = [message['content'] for message in self.system_messages]
-        new_obj = ChatMessages(
-            system_content_list=copy.deepcopy(system_content_str_list),  # 使用深复制来复制系统消息
-            question=self.history_messages[0]['content'] if self.history_messages else '',
-            tokens_thr=self.tokens_thr
-        )
-        # 复制任何其他需要复制的属性
-        new_obj.history_messages = copy.deepcopy(self.history_messages)  # 使用深复制来复制历史消息
-        new_obj.messages = copy.deepcopy(self.messages)  # 使用深复制来复制所有消息
-        new_obj.tokens_count = self.tokens_count
-        new_obj.num_of_system_messages = self.num_of_system_messages
+        """
+        复制当前对象：新旧对象共享已有的消息（结构共享，不做深复制），之后各自的追加、删除互不影响。
+        修改已有消息的内容请使用update_content，不要直接修改消息字典。
+        """
+        new_obj = ChatMessages.__new__(ChatMessages)
+        new_obj.__dict__.update(self.__dict__)
+        new_obj.system_content_list = list(self.system_content_list)
+        new_obj.system_messages = list(self.system_messages)
+        new_obj._history = self._history.fork()
 
         return new_obj
 
+    # 修改某条历史消息的内容：写时复制，生成新的消息对象，不影响共享该消息的其他对象
+    def update_content(self, index, content):
+        message, tokens = self._history[index]
+        if isinstance(message, dict):
+            new_message = dict(message)
+            new_message['content'] = content
+        else:
+            new_message = message.model_copy(update={'content': content})
+        new_tokens = self.count_tokens(new_message)
+        self._history[index] = (new_message, new_tokens)
+        self._history_tokens += new_tokens - tokens
+
     # 增加系统消息
     def add_system_messages(self, new_system_content):
         system_content_list = self.system_content_list
@@ -181,18 +413,13 @@ class ChatMessages:
         if type(new_system_content) == str:
             new_system_content = [new_system_content]
 
-        system_content_list.extend(new_system_content)
-        new_system_content_str = ''
-        for content in new_system_content:
-            new_system_content_str += content
-        new_token_count = len(self.encoding(str(new_system_content_str)))
-        self.tokens_count += new_token_count
+        system_content_list = system_content_list + list(new_system_content)
         self.system_content_list = system_content_list
         for message in system_content_list:
             system_messages.append({"role": "system", "content": message})
         self.system_messages = system_messages
+        self.system_tokens_count = sum(self.count_tokens(message) for message in system_messages)
         self.num_of_system_messages = len(system_content_list)
-        self.messages = system_messages + self.history_messages
 
         # 再执行pop，若有需要，则会删除部分历史消息
         self.messages_pop()
@@ -202,15 +429,10 @@ class ChatMessages:
     def delete_system_messages(self):
         system_content_list = self.system_content_list
         if system_content_list:
-            system_content_str = ''
-            for content in system_content_list:
-                system_content_str += content
-            delete_token_count = len(self.encoding(str(system_content_str)))
-            self.tokens_count -= delete_token_count
+            self.system_tokens_count = 0
             self.num_of_system_messages = 0
             self.system_content_list = []
             self.system_messages = []
-            self.messages = self.history_messages
 
     # 清除对话消息中的function消息
     def delete_function_messages(self):
@@ -222,3 +444,31 @@ class ChatMessages:
             if type(message) in [MessageType, ChatMessages] and (message.tool_calls or message.role == "tools"):
                 self.messages_pop(manual=True, index=index)
 
+
+def _get_role(message):
+    if isinstance(message, dict):
+        return message.get('role')
+    return getattr(message, 'role', None)
+
+
+def _get_tool_calls(message):
+    if isinstance(message, dict):
+        return message.get('tool_calls')
+    return getattr(message, 'tool_calls', None)
+
+
+def _tool_call_arguments(message) -> list:
+    """一条消息中各次函数调用的参数值（SQL、代码、变量名等）所拼接的文本，不包括环境变量g"""
+    texts = []
+    for tool_call in _get_tool_calls(message) or []:
+        function = tool_call.get('function', {}) if isinstance(tool_call, dict) else tool_call.function
+        arguments = function.get('arguments', '') if isinstance(function, dict) else function.arguments
+        try:
+            values = json.loads(arguments or '{}')
+        except ValueError:
+            texts.append(arguments)
+            continue
+        if isinstance(values, dict):
+            texts.append('\n'.join(str(value) for key, value in values.items() if key != 'g'))
+    return texts
+
@@ -0,0 +1,107 @@
+import gc
+import os
+import sys
+import builtins
+
+from .blob_store import BLOB_STORE_KEY
+from .validation import VALIDATOR_KEY
+from .artifact_store import ARTIFACT_STORE_KEY, SESSION_ID_KEY
+from .watchdog import CELL_TIMEOUT_KEY
+
+# 释放变量空间时保留的条目：内置函数、静态检查器（只包含数据库结构缓存的引用，不占用数据内存）、
+# 项目的产物存储、会话id以及代码单元的最长运行时间
+_KEEP_KEYS = ('__builtins__', VALIDATOR_KEY, ARTIFACT_STORE_KEY, SESSION_ID_KEY, CELL_TIMEOUT_KEY)
+
+
+def object_size(value) -> int:
+    """
+    估算一个变量占用的内存（字节）：DataFrame和Series统计包括对象列在内的实际占用，ndarray统计数据缓冲区，
+    其他对象使用sys.getsizeof（容器只统计自身，不递归统计元素）
+    """
+    memory_usage = getattr(value, 'memory_usage', None)
+    if callable(memory_usage) and hasattr(value, 'dtypes'):
+        try:
+            usage = memory_usage(deep=True)
+            return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+        except TypeError:
+            pass
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    try:
+        return sys.getsizeof(value)
+    except TypeError:
+        return 0
+
+
+def current_rss():
+    """当前进程的常驻内存（字节），无法获取时返回None"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+class SessionNamespace(dict):
+    """
+    会话级的变量空间：外部函数（python_inter、extract_data、fig_inter等）在其中读写变量。
+    每个DataFlowAgent会话拥有自己的变量空间，同一进程中的多个会话互不干扰；
+    release()清空其中的变量和结果存储，使DataFrame等对象占用的内存得以回收。
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 预先放入__builtins__，避免exec将其作为新变量写入变量空间
+        self.setdefault('__builtins__', builtins)
+
+    def user_variables(self) -> dict:
+        """分析过程中产生的变量（不包括内置函数、模块和内部对象）"""
+        return {
+            name: value for name, value in self.items()
+            if not name.startswith('_') and type(value).__name__ != 'module'
+        }
+
+    def memory_usage(self) -> dict:
+        """
+        各变量占用的内存（字节），按占用从大到小排列；结果存储中保存在内存里的内容记为'_blob_store'
+        """
+        usage = {name: object_size(value) for name, value in self.user_variables().items()}
+        store = self.get(BLOB_STORE_KEY)
+        if store is not None:
+            usage[BLOB_STORE_KEY] = store.get_stats()['bytes_in_memory']
+        return dict(sorted(usage.items(), key=lambda item: item[1], reverse=True))
+
+    def total_memory(self) -> int:
+        return sum(self.memory_usage().values())
+
+    def release(self) -> int:
+        """
+        清空变量和结果存储，返回释放前估算的内存占用（字节）
+        """
+        return release_namespace(self)
+
+
+def release_namespace(namespace:dict) -> int:
+    """
+    清空变量空间中的变量和结果存储（保留内置函数和静态检查器），并进行一次垃圾回收，
+    返回释放前估算的内存占用（字节）
+    :param namespace: 字典形式的变量空间
+    """
+    if isinstance(namespace, SessionNamespace):
+        released = namespace.total_memory()
+    else:
+        released = sum(object_size(value) for name, value in namespace.items() if not name.startswith('_'))
+    store = namespace.get(BLOB_STORE_KEY)
+    if store is not None:
+        store.clear()
+    for name in list(namespace):
+        if name not in _KEEP_KEYS:
+            del namespace[name]
+    # DataFrame之间可能存在循环引用（例如通过attrs或闭包），回收后内存才会归还
+    gc.collect()
+    return released
@@ -0,0 +1,251 @@
+import re
+import json
+import time
+import types
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .blob_store import BlobStore
+from .watchdog import get_watchdog
+from ..utils.tracing import span, propagate
+
+PARALLEL_DEBUG_PROMPT = "之前执行的代码报错了，请分析报错原因，并直接编写修改后的完整代码，调用相应函数运行。"
+
+# 不同候选方案使用的补充提示，引导大模型给出不同思路的修改
+CANDIDATE_HINTS = [
+    "",
+    "请尝试与最直接的修改方式不同的思路。",
+    "请先检查变量名、字段名和数据类型是否正确，再给出修改后的代码。",
+    "请尽量使用最简单、最稳妥的写法重写这段代码。",
+]
+
+
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+def referenced_names(call_message) -> set:
+    """
+    函数调用消息的参数中出现的全部标识符（代码、SQL中的变量名等），用于判断候选方案可能修改哪些变量
+    """
+    names = set()
+    for tool_call in call_message.tool_calls or []:
+        try:
+            arguments = json.loads(tool_call.function.arguments)
+        except (TypeError, ValueError):
+            arguments = tool_call.function.arguments
+        values = arguments.values() if isinstance(arguments, dict) else [arguments]
+        for value in values:
+            names.update(_IDENTIFIER.findall(str(value)))
+    return names
+
+
+def snapshot_namespace(namespace:dict, names=None) -> dict:
+    """
+    创建变量空间的隔离快照：DataFrame、ndarray、list、dict、set等可变容器会被复制，
+    模块、函数以及结果存储等对象在快照之间共享。
+    :param names: 可选参数，只复制其中的变量，其余变量在快照之间共享，默认复制全部可变容器
+    """
+    snapshot = {}
+    for name, value in namespace.items():
+        if (name.startswith('__')
+                or (names is not None and name not in names)
+                or isinstance(value, (types.ModuleType, BlobStore))
+                or callable(value)):
+            snapshot[name] = value
+        elif isinstance(value, (list, dict, set)) or (hasattr(value, 'shape') and hasattr(value, 'copy')):
+            try:
+                snapshot[name] = value.copy()
+            except Exception:
+                snapshot[name] = value
+        else:
+            snapshot[name] = value
+    return snapshot
+
+
+def merge_namespace(namespace:dict, snapshot:dict):
+    """将胜出候选方案的快照写回变量空间：新增或重新赋值的变量写回，被删除的变量同步删除"""
+    for name in [name for name in namespace if name not in snapshot]:
+        del namespace[name]
+    for name, value in snapshot.items():
+        if namespace.get(name) is not value:
+            namespace[name] = value
+
+
+class Candidate:
+    """
+    一个候选修改方案：大模型给出的函数调用消息，及其在隔离快照上的运行结果
+    """
+    def __init__(self, index, prompt):
+        self.index = index
+        self.prompt = prompt
+        self.call_message = None
+        self.response_message = None
+        self.namespace = None
+        self.success = False
+        self.cancelled = False
+        self.latency = 0.0
+
+
+class DebugResult:
+    """
+    一次并行debug的结果
+    :param winner: 第一个运行成功的候选方案，全部失败时为None
+    """
+    def __init__(self, winner, candidates, latency, llm_calls):
+        self.winner = winner
+        self.candidates = candidates
+        self.latency = latency
+        self.llm_calls = llm_calls
+
+    @property
+    def success(self):
+        return self.winner is not None
+
+
+class ParallelDebugger:
+    """
+    并行debug：外部函数运行报错时，同时请求n个候选修改方案，每个方案在变量空间的隔离快照上运行
+    （只复制候选代码中引用到的变量），采用第一个运行成功的方案，尚未运行的方案直接取消，
+    正在运行的代码单元通过看门狗中断，胜出方案的快照写回变量空间。
+    不再使用时调用close关闭候选方案的线程池。
+    相比逐条输入三条debug提示词的深度debug，只需要一次（并行的）大模型调用即可得到可运行的修改。
+    """
+    def __init__(self,
+                 llm_api,
+                 available_functions,
+                 n_candidates=3,
+                 use_n=False,
+                 route='debug'):
+        """
+        :param llm_api: 大模型调用接口
+        :param available_functions: AvailableFunctions对象，候选方案可以调用的外部函数
+        :param n_candidates: 候选方案数量
+        :param use_n: 是否通过一次请求的n参数生成全部候选方案（需要服务端支持），默认为并行发送n个请求
+        :param route: 候选方案生成所使用的模型路由
+        """
+        self.llm_api = llm_api
+        self.available_functions = available_functions
+        self.n_candidates = n_candidates
+        self.use_n = use_n
+        self.route = route
+        self._executor = ThreadPoolExecutor(max_workers=n_candidates, thread_name_prefix='debug')
+
+        self.metrics = {
+            'rounds': 0,
+            'fixed': 0,
+            'candidates': 0,
+            'cancelled': 0,
+            'latency_to_fix': 0.0,
+        }
+
+    def _prompt(self, index):
+        hint = CANDIDATE_HINTS[index % len(CANDIDATE_HINTS)]
+        return PARALLEL_DEBUG_PROMPT + hint
+
+    def _request(self, messages, candidate):
+        messages = messages + [{"role": "user", "content": candidate.prompt}]
+        return self.llm_api.chat(
+            messages=messages,
+            tools=self.available_functions.functions,
+            route=self.route
+        )
+
+    def _attempt(self, candidate, call_message, namespace, cancel_event, start):
+        """在隔离快照上运行一个候选方案"""
+        # 延迟导入，避免与utils.helpers循环引用
+        from ..utils.helpers import function_to_call
+
+        if cancel_event.is_set() or call_message is None or not call_message.tool_calls:
+            candidate.cancelled = cancel_event.is_set()
+            return candidate
+        candidate.call_message = call_message
+        candidate.namespace = snapshot_namespace(namespace, referenced_names(call_message))
+        candidate.response_message = function_to_call(
+            available_functions=self.available_functions,
+            function_call_message=call_message,
+            namespace=candidate.namespace
+        )
+        candidate.success = "报错" not in candidate.response_message['content']
+        candidate.latency = time.perf_counter() - start
+        return candidate
+
+    def _run_candidate(self, messages, candidate, namespace, cancel_event, start):
+        if cancel_event.is_set():
+            candidate.cancelled = True
+            return candidate
+        with span(f"candidate_{candidate.index + 1}", 'debug') as candidate_span:
+            call_message = self._request(messages, candidate)
+            self._attempt(candidate, call_message, namespace, cancel_event, start)
+            candidate_span.set(success=candidate.success, cancelled=candidate.cancelled)
+        return candidate
+
+    def run(self, msg_debug, namespace:dict) -> DebugResult:
+        """
+        执行一次并行debug
+        :param msg_debug: ChatMessages对象，最后两条消息为报错的函数调用消息和包含报错信息的运行结果
+        :param namespace: 外部函数使用的变量空间，胜出方案的运行结果会写回其中
+        """
+        start = time.perf_counter()
+        msg_debug.refresh_retrieved_context()
+        messages = msg_debug.messages
+        candidates = [Candidate(i, self._prompt(i)) for i in range(self.n_candidates)]
+        cancel_event = threading.Event()
+
+        if self.use_n:
+            # 一次请求生成全部候选方案，随后并行运行
+            for candidate in candidates:
+                candidate.prompt = PARALLEL_DEBUG_PROMPT
+            call_messages = self.llm_api.chat_n(
+                messages=messages + [{"role": "user", "content": PARALLEL_DEBUG_PROMPT}],
+                n=self.n_candidates,
+                tools=self.available_functions.functions,
+                route=self.route
+            )
+            llm_calls = 1
+            futures = [self._executor.submit(propagate(self._attempt), candidate, message, namespace, cancel_event, start)
+                       for candidate, message in zip(candidates, call_messages)]
+        else:
+            llm_calls = self.n_candidates
+            futures = [self._executor.submit(propagate(self._run_candidate), messages, candidate, namespace,
+                                             cancel_event, start)
+                       for candidate in candidates]
+
+        winner = None
+        for future in as_completed(futures):
+            try:
+                candidate = future.result()
+            except Exception as e:
+                print(f">>> 候选方案运行失败：{e}")
+                continue
+            if candidate.success:
+                winner = candidate
+                break
+
+        # 取消其余候选方案：尚未开始的直接取消，正在请求大模型的不再运行代码，正在运行的代码单元由看门狗中断
+        cancel_event.set()
+        for future, candidate in zip(futures, candidates):
+            if candidate is not winner and (future.cancel() or not future.done()):
+                candidate.cancelled = True
+                if candidate.call_message is not None:
+                    get_watchdog().cancel(candidate.call_message.tool_calls[0].id)
+
+        latency = time.perf_counter() - start
+        self.metrics['rounds'] += 1
+        self.metrics['candidates'] += len(candidates)
+        self.metrics['cancelled'] += sum(candidate.cancelled for candidate in candidates)
+        if winner is not None:
+            merge_namespace(namespace, winner.namespace)
+            self.metrics['fixed'] += 1
+            self.metrics['latency_to_fix'] += winner.latency
+
+        return DebugResult(winner, candidates, latency, llm_calls)
+
+    def close(self, wait=False):
+        """关闭候选方案的线程池，尚未开始的候选方案不再运行"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def get_metrics(self) -> dict:
+        metrics = dict(self.metrics)
+        metrics['fix_rate'] = metrics['fixed'] / metrics['rounds'] if metrics['rounds'] else 0.0
+        metrics['avg_latency_to_fix'] = metrics['latency_to_fix'] / metrics['fixed'] if metrics['fixed'] else 0.0
+        return metrics
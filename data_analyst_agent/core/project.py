@@ -2,6 +2,9 @@ import os
 import json
 import shutil
 
+from .session_store import SessionStore
+from .artifact_store import ArtifactStore
+
 
 def create_or_get_folder(folder_name):
     """
@@ -107,17 +110,28 @@ class InterProject:
     每个代码解释器必须说明所属项目，若无所属项目，则在代码解释器运行时会自动创建一个项目。\
     需要注意的是，项目不仅起到了说明和标注当前分析任务的作用，更关键的是，项目提供了每个分析任务的“长期记忆”，\
     即每个项目都有对应的谷歌云盘和谷歌云文档，用于保存在分析和建模工作过程中多轮对话内容，\
-    此外，也可以选择借助本地文档进行存储。
+    此外，也可以选择借助本地文档进行存储。\
+    对话消息保存在项目文件夹内的会话存储（sessions.db）中，按会话和轮次追加，可以快速读取某个会话最近几轮的消息；\
+    图片和导出的数据表保存在项目文件夹内的产物存储（artifacts目录）中。
     """
     def __init__(self,
                  project_name,
                  doc_name,
                  folder_id=None,
                  doc_id=None,
-                 doc_content=None
+                 doc_content=None,
+                 session_store=None,
+                 artifact_quota=None
     ):
+        """
+        :param session_store: 可选参数，SessionStore对象，默认为None，表示首次保存对话时在项目文件夹内创建sessions.db
+        :param artifact_quota: 可选参数，产物存储（图片、导出的数据表等）的容量上限（字节），默认为None，表示不限制
+        """
         self.project_name = project_name
         self.doc_name = doc_name
+        self._session_store = session_store
+        self.artifact_quota = artifact_quota
+        self._artifact_store = None
 
         if folder_id is None:
             folder_id = create_or_get_folder(project_name)
@@ -150,6 +164,40 @@ class InterProject:
 
         append_content_in_doc(self.doc_id, content)
 
+    @property
+    def session_store(self) -> SessionStore:
+        """项目的会话存储，首次访问时创建"""
+        if self._session_store is None:
+            self._session_store = SessionStore(os.path.join(self.folder_id, 'sessions.db'))
+        return self._session_store
+
+    @property
+    def artifact_store(self) -> ArtifactStore:
+        """项目的产物存储（项目文件夹内的artifacts目录），首次访问时创建"""
+        if self._artifact_store is None:
+            self._artifact_store = ArtifactStore(os.path.join(self.folder_id, 'artifacts'),
+                                                 quota_bytes=self.artifact_quota)
+        return self._artifact_store
+
+    def append_turn(self, session_id, messages):
+        """
+        将一轮对话新增的消息追加到会话存储中
+        :return: 本轮的轮次编号
+        """
+        return self.session_store.append_turn(session_id, messages, project=self.project_name)
+
+    def load_last_turns(self, session_id, n=None):
+        """
+        读取某个会话最近n轮的消息，n为None时读取全部
+        """
+        return self.session_store.load_last_turns(session_id, n)
+
+    def list_sessions(self):
+        """
+        列出当前项目的全部会话，按最近更新时间倒序排列
+        """
+        return self.session_store.list_sessions(project=self.project_name)
+
     def clear_doc_content(self):
         """
         清空某文件内的全部内容
@@ -160,6 +208,13 @@ class InterProject:
         """
         删除当前项目文件夹内的全部文件
         """
+        # 先关闭会话存储，再删除sessions.db
+        if self._session_store is not None:
+            self._session_store.close()
+            self._session_store = None
+        if self._artifact_store is not None:
+            self._artifact_store.close()
+            self._artifact_store = None
         delete_all_files_in_folder(self.folder_id)
 
     def update_doc_list(self):
@@ -0,0 +1,202 @@
+import re
+import math
+from collections import defaultdict
+
+import numpy as np
+
+_HEADING_RE = re.compile(r'^(#{1,6})\s+(.*)$')
+_WORD_RE = re.compile(r'[a-z0-9_]+')
+_CJK_RUN_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff]+')
+
+RETRIEVED_CONTEXT_PREFIX = "以下是数据字典中与当前问题相关的部分：\n"
+
+
+def tokenize(text:str) -> list:
+    """
+    检索用分词：英文按单词切分（下划线连接的字段名同时保留整体和各部分），中文按单字和相邻两字切分
+    """
+    text = text.lower()
+    terms = []
+    for word in _WORD_RE.findall(text):
+        terms.append(word)
+        if '_' in word:
+            terms.extend(part for part in word.split('_') if part)
+    for run in _CJK_RUN_RE.findall(text):
+        terms.extend(run)
+        terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+class Section:
+    """
+    数据字典中的一个片段：一张表的说明（kind='table'），或者表中某个字段的说明（kind='column'）
+    """
+    def __init__(self, table, text, kind='table', header=''):
+        self.table = table
+        self.text = text
+        self.kind = kind
+        # 字段片段所属表格的表头，拼接上下文时使用
+        self.header = header
+
+    def __repr__(self):
+        return f"Section(table={self.table!r}, kind={self.kind!r}, text={self.text[:30]!r})"
+
+
+def split_sections(document:str) -> list:
+    """
+    将markdown格式的数据字典按标题切分为表级片段，并将表格中的每一行切分为字段级片段
+    :param document: 数据字典文档
+    :return: Section对象所组成的list
+    """
+    sections = []
+    title = ''
+    lines = []
+
+    def flush():
+        if not title and not any(line.strip() for line in lines):
+            return
+        description = []
+        header = []
+        columns = []
+        for line in lines:
+            stripped = line.strip()
+            if stripped.startswith('|'):
+                # 表头和分隔行
+                if not header or set(stripped) <= set('|-: '):
+                    header.append(stripped)
+                else:
+                    columns.append(stripped)
+            elif stripped:
+                description.append(stripped)
+        table = title or (description[0] if description else '')
+        header_text = '\n'.join(header)
+        sections.append(Section(table, '\n'.join([title] + description + header), 'table', header_text))
+        for column in columns:
+            sections.append(Section(table, column, 'column', header_text))
+
+    for line in document.splitlines():
+        match = _HEADING_RE.match(line.strip())
+        if match:
+            flush()
+            title = match.group(2).strip()
+            lines = []
+        else:
+            lines.append(line)
+    flush()
+    return sections
+
+
+def is_dictionary(document:str) -> bool:
+    """文档是否为数据字典：包含以markdown表格逐行说明的字段。其余系统消息（指令等）不建立检索索引"""
+    return any(section.kind == 'column' for section in split_sections(document))
+
+
+class DictionaryIndex:
+    """
+    数据字典检索索引：基于BM25的词法检索，纯Python + NumPy实现。
+    1、建立索引时将文档切分为表级和字段级片段，构建倒排表；
+    2、检索时只累加查询词对应的倒排表，返回得分最高的片段；
+    3、build_context在token预算内拼接检索结果，并按表格分组输出。
+    """
+    def __init__(self, documents, top_k=10, token_budget=2000, k1=1.5, b=0.75):
+        """
+        :param documents: 数据字典文档，字符串或字符串所组成的list
+        :param top_k: 默认检索的片段数量
+        :param token_budget: 默认注入上下文的token预算
+        :param k1: BM25参数，控制词频饱和速度
+        :param b: BM25参数，控制文档长度归一化程度
+        """
+        if isinstance(documents, str):
+            documents = [documents]
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.k1 = k1
+        self.b = b
+
+        self.sections = []
+        for document in documents:
+            self.sections.extend(split_sections(document))
+
+        # 倒排表：term -> (片段序号数组, 词频数组)
+        postings = defaultdict(lambda: ([], []))
+        lengths = np.zeros(len(self.sections), dtype=np.float64)
+        for i, section in enumerate(self.sections):
+            terms = tokenize(section.text if section.kind == 'table' else section.table + ' ' + section.text)
+            lengths[i] = len(terms)
+            counts = defaultdict(int)
+            for term in terms:
+                counts[term] += 1
+            for term, count in counts.items():
+                ids, tfs = postings[term]
+                ids.append(i)
+                tfs.append(count)
+
+        n = max(len(self.sections), 1)
+        avg_length = lengths.mean() if len(self.sections) else 1.0
+        # 预先计算每个片段的长度归一化系数
+        self._norm = k1 * (1 - b + b * lengths / max(avg_length, 1e-9))
+        self._postings = {}
+        for term, (ids, tfs) in postings.items():
+            df = len(ids)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            self._postings[term] = (np.asarray(ids, dtype=np.int64), np.asarray(tfs, dtype=np.float64), idf)
+
+    def __len__(self):
+        return len(self.sections)
+
+    def search(self, query:str, top_k=None) -> list:
+        """
+        检索与查询最相关的片段
+        :return: (score, Section)所组成的list，按得分从高到低排序
+        """
+        if top_k is None:
+            top_k = self.top_k
+        scores = np.zeros(len(self.sections), dtype=np.float64)
+        for term in set(tokenize(query)):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs, idf = posting
+            scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + self._norm[ids])
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k)[:top_k]]
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(float(scores[i]), self.sections[i]) for i in order]
+
+    def build_context(self, query:str, top_k=None, token_budget=None, count_tokens=None) -> str:
+        """
+        在token预算内拼接与查询相关的数据字典片段，同一张表的字段放在该表的表头下
+        :param count_tokens: 计算文本token数量的函数，默认按字符数估算
+        """
+        if token_budget is None:
+            token_budget = self.token_budget
+        if count_tokens is None:
+            count_tokens = len
+
+        tables = {}
+        used = count_tokens(RETRIEVED_CONTEXT_PREFIX)
+        for _, section in self.search(query, top_k):
+            block = tables.get(section.table)
+            if block is None:
+                # 首次出现的表格需要加上表名和表头
+                head = f"## {section.text}" if section.kind == 'table' else f"## {section.table}\n{section.header}"
+                cost = count_tokens(head) + (count_tokens(section.text) if section.kind == 'column' else 0)
+                if used + cost > token_budget:
+                    continue
+                block = tables[section.table] = [head]
+                if section.kind == 'column':
+                    block.append(section.text)
+                used += cost
+            elif section.kind == 'column' and section.text not in block:
+                cost = count_tokens(section.text)
+                if used + cost > token_budget:
+                    continue
+                block.append(section.text)
+                used += cost
+
+        if not tables:
+            return ''
+        return RETRIEVED_CONTEXT_PREFIX + '\n\n'.join('\n'.join(block) for block in tables.values())
+
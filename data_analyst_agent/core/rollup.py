@@ -0,0 +1,906 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import datetime
+import threading
+import unicodedata
+from decimal import Decimal, localcontext, ROUND_HALF_UP
+
+_COMMENT_RE = re.compile(r'--[^\n]*|#[^\n]*|/\*.*?\*/', re.S)
+_TOKEN_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|`[^`]*`|[A-Za-z_][\w$]*|\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|<=|>=|<>|!=|\S")
+_NUMBER_RE = re.compile(r'\d+(?:\.\d+)?(?:[eE][-+]?\d+)?$')
+
+AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')
+_COMPARISONS = ('=', '!=', '<>', '<', '<=', '>', '>=')
+# 出现这些关键字时不尝试改写（多表、子查询、窗口函数、HAVING等）
+_UNSUPPORTED = {'join', 'union', 'having', 'with', 'over', 'select', 'into', 'distinct', 'rollup', 'intersect',
+                'except', 'window'}
+_CLAUSES = ('from', 'where', 'group', 'order', 'limit')
+_NOT_ALIAS = {'end', 'null', 'true', 'false'}
+_BEFORE_VALUE = {'not', 'is', 'and', 'or', 'case', 'when', 'then', 'else', 'interval'}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS query_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    shape TEXT NOT NULL,
+    source TEXT NOT NULL,
+    rollup TEXT,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_query_log_shape_ts ON query_log (shape, ts);
+CREATE TABLE IF NOT EXISTS shapes (
+    shape TEXT PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    dims TEXT NOT NULL,
+    measures TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    name TEXT PRIMARY KEY,
+    shape TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    dims TEXT NOT NULL,
+    measures TEXT NOT NULL,
+    watermark TEXT,
+    watermark_value TEXT,
+    built REAL NOT NULL,
+    refreshed REAL NOT NULL,
+    rows INTEGER NOT NULL,
+    compacted_rows INTEGER NOT NULL
+);
+"""
+
+
+def _is_string(token:str) -> bool:
+    return token.startswith("'")
+
+
+def _is_literal(token:str) -> bool:
+    # 含反斜杠转义的字符串在MySQL和SQLite中含义不同，不作为可改写的常量
+    return bool(_NUMBER_RE.match(token)) or (_is_string(token) and '\\' not in token)
+
+
+def _column_name(tokens) -> str:
+    """未设置别名的SELECT项在结果中的字段名：原样拼接token，括号、逗号和点号两侧不加空格"""
+    name = ''
+    for token in tokens:
+        if name and name[-1] not in '(.,' and token not in ('(', ')', '.', ','):
+            name += ' '
+        name += token.strip('`')
+    return name
+
+
+def _closing(tokens, start:int) -> int:
+    """与tokens[start]处左括号匹配的右括号的位置，没有匹配时返回-1"""
+    depth = 0
+    for i in range(start, len(tokens)):
+        depth += (tokens[i] == '(') - (tokens[i] == ')')
+        if depth == 0:
+            return i
+    return -1
+
+
+def _split(tokens, separator=','):
+    """在括号外按分隔符切分token列表"""
+    parts, current, depth = [], [], 0
+    for token in tokens:
+        lowered = token.lower()
+        depth += (token == '(') - (token == ')')
+        if depth == 0 and lowered == separator:
+            parts.append(current)
+            current = []
+        else:
+            current.append(token)
+    parts.append(current)
+    return parts
+
+
+class Expression:
+    """SQL表达式：key为规范化文本（用于匹配，忽略大小写、空白和表名前缀），sql为可以执行的文本"""
+    def __init__(self, tokens, qualifiers=()):
+        cleaned = []
+        i = 0
+        while i < len(tokens):
+            # 去掉表名或别名前缀：p.Contract -> Contract
+            if i + 2 < len(tokens) and tokens[i + 1] == '.' and tokens[i].strip('`').lower() in qualifiers:
+                i += 2
+                continue
+            cleaned.append(tokens[i])
+            i += 1
+        self.tokens = cleaned
+        self.key = ' '.join(t if _is_string(t) else t.strip('`').lower() for t in cleaned)
+        self.sql = ' '.join(cleaned)
+
+
+class AggregateQuery:
+    """
+    可以由汇总表回答的单表聚合查询：SELECT 维度, 聚合函数(表达式) FROM 表 [WHERE 条件] GROUP BY 维度 [ORDER BY] [LIMIT]。
+    WHERE只支持AND连接的“表达式 比较运算 常量”、IN、LIKE、BETWEEN和IS NULL，条件中的表达式也作为汇总表的维度。
+    """
+    def __init__(self, table, items, group, where, order, limit):
+        self.table = table
+        self.items = items
+        self.group = group
+        self.where = where
+        self.order = order
+        self.limit = limit
+        # 结果的字段名
+        self.columns = [item['name'] for item in items]
+        dims = {}
+        for expression in group + [expression for expression, _ in where]:
+            dims.setdefault(expression.key, expression.sql)
+        self.dims = dims
+        # 汇总表需要的基础度量：AVG拆分为SUM和COUNT，COUNT(*)总是保留
+        measures = {('count', '*'): '*'}
+        for item in items:
+            if item['kind'] != 'agg':
+                continue
+            func, argument = item['func'], item['argument']
+            for base in (('sum', 'count') if func == 'avg' else (func,)):
+                measures[(base, argument.key if argument else '*')] = argument.sql if argument else '*'
+        self.measures = measures
+        self.shape = table + '|' + ','.join(sorted(dims))
+
+
+def parse_aggregate_query(sql:str):
+    """
+    解析单表GROUP BY聚合查询，不是可以由汇总表回答的形式时返回None
+    """
+    tokens = _TOKEN_RE.findall(_COMMENT_RE.sub(' ', sql).strip().rstrip(';'))
+    lowered = [t.lower() for t in tokens]
+    if not tokens or lowered[0] != 'select' or any(t in _UNSUPPORTED for t in lowered[1:]):
+        return None
+
+    # 括号外各子句的位置
+    positions, depth = {}, 0
+    for i, token in enumerate(lowered):
+        depth += (token == '(') - (token == ')')
+        if depth == 0 and token in _CLAUSES and token not in positions:
+            if token in ('group', 'order') and (i + 1 >= len(lowered) or lowered[i + 1] != 'by'):
+                return None
+            positions[token] = i
+    if 'from' not in positions or 'group' not in positions:
+        return None
+    order = [positions[c] for c in _CLAUSES if c in positions]
+    if order != sorted(order):
+        return None
+
+    def clause(name, skip=1):
+        if name not in positions:
+            return []
+        start = positions[name] + skip
+        ends = [p for p in positions.values() if p > positions[name]]
+        return tokens[start:min(ends) if ends else len(tokens)]
+
+    # FROM：表名 [AS] [别名]
+    source = clause('from')
+    if len(source) >= 3 and source[1] == '.':
+        source = [source[0] + '.' + source[2]] + source[3:]
+    if source and source[-1].lower() == 'as':
+        return None
+    source = [t for t in source if t.lower() != 'as']
+    if not 1 <= len(source) <= 2 or not re.match(r'[`A-Za-z_]', source[0]):
+        return None
+    table = source[0].strip('`')
+    qualifiers = {table.split('.')[-1].lower()} | ({source[1].strip('`').lower()} if len(source) == 2 else set())
+
+    # SELECT列表
+    items, aliases = [], {}
+    for part in _split(tokens[1:positions['from']]):
+        if not part:
+            return None
+        alias = None
+        if len(part) >= 3 and part[-2].lower() == 'as':
+            alias, part = part[-1].strip('`'), part[:-2]
+        elif len(part) >= 2 and re.match(r'[`A-Za-z_]', part[-1]) and part[-1].lower() not in _NOT_ALIAS \
+                and (part[-2] == ')' or re.match(r'[`A-Za-z_]', part[-2]) and part[-2].lower() not in _BEFORE_VALUE):
+            # 省略AS的别名：COUNT(*) n、CASE ... END bucket
+            alias, part = part[-1].strip('`'), part[:-1]
+        func = part[0].lower()
+        # 只有整个SELECT项就是一次聚合函数调用时才作为度量，SUM(a) / COUNT(*)、MAX(a) - MIN(a)等复合表达式不改写
+        if func in AGGREGATES and len(part) >= 3 and part[1] == '(' and _closing(part, 1) == len(part) - 1 \
+                and len(_split(part[2:-1])) == 1:
+            argument = part[2:-1]
+            if argument == ['*']:
+                if func != 'count':
+                    return None
+                argument = None
+            else:
+                argument = Expression(argument, qualifiers)
+            item = {'kind': 'agg', 'func': func, 'argument': argument,
+                    'key': func + ' ( ' + (argument.key if argument else '*') + ' )'}
+        else:
+            expression = Expression(part, qualifiers)
+            if any(t.lower() in AGGREGATES and i + 1 < len(part) and part[i + 1] == '('
+                   for i, t in enumerate(part)):
+                return None
+            item = {'kind': 'dim', 'expression': expression, 'key': expression.key}
+        item['alias'] = alias
+        item['name'] = alias or _column_name(item['expression'].tokens if item['kind'] == 'dim' else part)
+        if alias:
+            aliases[alias.lower()] = len(items)
+        items.append(item)
+
+    # GROUP BY：表达式、SELECT中的别名或序号
+    group = []
+    for part in _split(clause('group', 2)):
+        if len(part) == 1 and part[0].isdigit():
+            index = int(part[0]) - 1
+            if not 0 <= index < len(items) or items[index]['kind'] != 'dim':
+                return None
+            group.append(items[index]['expression'])
+        elif len(part) == 1 and part[0].strip('`').lower() in aliases \
+                and items[aliases[part[0].strip('`').lower()]]['kind'] == 'dim':
+            group.append(items[aliases[part[0].strip('`').lower()]]['expression'])
+        elif part:
+            group.append(Expression(part, qualifiers))
+        else:
+            return None
+    group_keys = {expression.key for expression in group}
+    if any(item['kind'] == 'dim' and item['key'] not in group_keys for item in items):
+        return None
+
+    # WHERE：AND连接的简单条件（BETWEEN中的AND不作为分隔）
+    where = []
+    conditions, current, depth = [], [], 0
+    for token in clause('where'):
+        depth += (token == '(') - (token == ')')
+        words = [t.lower() for t in current]
+        if depth == 0 and token.lower() == 'and' and not ('between' in words and 'and' not in words):
+            conditions.append(current)
+            current = []
+        else:
+            current.append(token)
+    if 'where' in positions:
+        conditions.append(current)
+    for condition in conditions:
+        parsed = _parse_condition(condition, qualifiers)
+        if parsed is None:
+            return None
+        where.append(parsed)
+
+    # ORDER BY：序号、别名、SELECT中的表达式或维度
+    order_by = []
+    for part in _split(clause('order', 2)) if 'order' in positions else []:
+        direction = ''
+        if part and part[-1].lower() in ('asc', 'desc'):
+            direction, part = part[-1].upper(), part[:-1]
+        if not part:
+            return None
+        key = Expression(part, qualifiers).key
+        if len(part) == 1 and part[0].isdigit():
+            reference = ('position', int(part[0]))
+        elif len(part) == 1 and part[0].strip('`').lower() in aliases:
+            reference = ('item', aliases[part[0].strip('`').lower()])
+        elif any(item['key'] == key for item in items):
+            reference = ('item', [item['key'] for item in items].index(key))
+        elif key in group_keys:
+            reference = ('dim', key)
+        else:
+            return None
+        order_by.append((reference, direction))
+
+    limit = ' '.join(clause('limit')) or None
+    if limit is not None and not re.match(r'\d+(\s*(,|offset)\s*\d+)?$', limit, re.I):
+        return None
+    return AggregateQuery(table, items, group, where, order_by, limit)
+
+
+def _parse_condition(tokens, qualifiers):
+    """解析一个条件：返回(表达式, 表达式之后的SQL文本)，不支持时返回None"""
+    depth = 0
+    for i, token in enumerate(tokens):
+        depth += (token == '(') - (token == ')')
+        lowered = token.lower()
+        if depth or i == 0 or not (token in _COMPARISONS or lowered in ('in', 'like', 'between', 'is', 'not')):
+            continue
+        rest = tokens[i:]
+        words = [t.lower() for t in rest]
+        if words[0] == 'not':
+            words, rest = words[1:], rest[1:]
+            if not words or words[0] not in ('in', 'like', 'between'):
+                return None
+        if words[0] in _COMPARISONS or words[0] == 'like':
+            literal = rest[1:]
+            if literal[:1] == ['-']:
+                literal = ['-' + ''.join(literal[1:])] if len(literal) == 2 else []
+            valid = len(literal) == 1 and _is_literal(literal[0].lstrip('-'))
+        elif words[0] == 'in':
+            valid = len(rest) >= 4 and rest[1] == '(' and rest[-1] == ')' and \
+                all(len(p) == 1 and _is_literal(p[0]) for p in _split(rest[2:-1]))
+        elif words[0] == 'between':
+            valid = len(rest) == 4 and words[2] == 'and' and _is_literal(rest[1]) and _is_literal(rest[3])
+        else:
+            valid = words in (['is', 'null'], ['is', 'not', 'null'])
+        if not valid:
+            return None
+        return Expression(tokens[:i], qualifiers), ' '.join(tokens[i:])
+    return None
+
+
+# 源数据库返回值的类型 -> 汇总表中字段的类型，用于还原结果的类型以及判断改写后的语义是否与源数据库一致
+_KINDS = {bool: 'int', int: 'int', float: 'float', Decimal: 'decimal', datetime.datetime: 'datetime',
+          datetime.date: 'date', datetime.time: 'time', datetime.timedelta: 'timedelta', str: 'text',
+          bytes: 'bytes', bytearray: 'bytes'}
+# 在SQLite中比较结果与MySQL一致的类型：数值、按ISO格式保存的日期时间、以秒数保存的TIME以及二进制值。
+# 字符串在MySQL中通常使用不区分大小写的排序规则，DECIMAL以文本保存，都不能在SQLite中直接比较和排序
+_ORDERED_KINDS = {None, 'int', 'float', 'decimal', 'datetime', 'date', 'time', 'timedelta', 'bytes'}
+_NUMERIC_KINDS = {None, 'int', 'float'}
+
+
+def _merge_kind(a, b):
+    """合并两批值的字段类型：整数与浮点数或DECIMAL混合时取后者，其余不同类型混合时为mixed"""
+    if a is None or b is None or a == b:
+        return b if a is None else a
+    pair = {a, b}
+    return 'float' if pair == {'int', 'float'} else 'decimal' if pair == {'int', 'decimal'} else 'mixed'
+
+
+def _column_kinds(rows, previous=None) -> list:
+    """
+    汇总结果各字段的类型（全为NULL时为None）
+    :param previous: 已有汇总表各字段的类型，增量刷新时与新增行的类型合并
+    """
+    kinds = list(previous) if previous else [None] * (len(rows[0]) if rows else 0)
+    for i, values in enumerate(zip(*rows)):
+        for t in set(map(type, values)) - {type(None)}:
+            kinds[i] = _merge_kind('text' if kinds[i] == 'ambiguous_text' else kinds[i], _KINDS.get(t, 'mixed'))
+    return kinds
+
+
+def _folded(text:str) -> str:
+    """近似MySQL中不区分大小写和重音、忽略末尾空格的排序规则下的比较键"""
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold().rstrip(' ')
+
+
+def _local_value(value):
+    """将源数据库返回的值转换为SQLite可以保存的类型，DECIMAL以文本保存以保持精确"""
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return value
+
+
+def _restore(value, kind):
+    """将汇总表中保存的值还原为源数据库返回的类型"""
+    if value is None:
+        return None
+    if kind == 'decimal':
+        return Decimal(str(value))
+    if kind == 'datetime':
+        return datetime.datetime.fromisoformat(value)
+    if kind == 'date':
+        return datetime.date.fromisoformat(value)
+    if kind == 'time':
+        return datetime.time.fromisoformat(value)
+    if kind == 'timedelta':
+        return datetime.timedelta(seconds=value)
+    return value
+
+
+class _DecimalAggregate:
+    """SQLite中对以文本保存的DECIMAL做精确聚合，结果同样以文本返回"""
+    def __init__(self):
+        self.value = None
+
+    def step(self, value):
+        if value is not None:
+            value = Decimal(str(value))
+            self.value = value if self.value is None else self.combine(self.value, value)
+
+    def finalize(self):
+        return None if self.value is None else str(self.value)
+
+
+class _DecimalSum(_DecimalAggregate):
+    @staticmethod
+    def combine(a, b):
+        with localcontext() as context:
+            context.prec = 80
+            return a + b
+
+
+class _DecimalMin(_DecimalAggregate):
+    combine = staticmethod(min)
+
+
+class _DecimalMax(_DecimalAggregate):
+    combine = staticmethod(max)
+
+
+class _DecimalAvg:
+    """由SUM和COUNT计算DECIMAL的平均值，与MySQL一致保留SUM的小数位数加4位（四舍五入）"""
+    def __init__(self):
+        self.total = Decimal(0)
+        self.count = 0
+        self.scale = 0
+
+    def step(self, total, count):
+        if total is not None:
+            total = Decimal(str(total))
+            self.scale = max(self.scale, -total.as_tuple().exponent)
+            with localcontext() as context:
+                context.prec = 80
+                self.total += total
+        self.count += count or 0
+
+    def finalize(self):
+        if not self.count:
+            return None
+        with localcontext() as context:
+            context.prec = 80
+            return str((self.total / self.count).quantize(Decimal(1).scaleb(-(self.scale + 4)), ROUND_HALF_UP))
+
+
+def _literal(value) -> str:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "'%s'" % str(_local_value(value)).replace("'", "''")
+
+
+def _measure_sql(func, argument):
+    return 'COUNT(*)' if argument == '*' else f'{func.upper()}({argument})'
+
+
+class RollupMaterializer:
+    """
+    由查询日志驱动的汇总表物化：
+    1、record记录经sql_inter执行的每条单表GROUP BY聚合查询（按数据表和维度归为同一形态，条件中的常量不同也属于同一形态）；
+    2、某个形态在window秒内出现min_hits次后，在后台线程中于源数据库上按该形态的全部维度聚合一次，结果保存为本地SQLite中的汇总表，
+       度量包括COUNT(*)以及各表达式的SUM、COUNT、MIN和MAX；
+    3、answer将维度和度量被某张汇总表覆盖的查询改写为对汇总表的再聚合，不再扫描源数据表。SQLite与MySQL语义不一致的情况不改写：
+       筛选条件作用于字符串、日期时间或DECIMAL维度（排序规则和类型转换不同），按字符串排序，对字符串取MIN、MAX，
+       以及按字符串维度分组而汇总表中存在只有大小写、重音或末尾空格不同的取值；
+    4、距上次刷新超过refresh_interval秒时先刷新：配置了水位字段（只追加的数据表中单调递增的字段，例如自增主键）的数据表
+       只聚合新增的行并追加到汇总表，否则在后台重新构建，重建完成前查询源数据库。
+    DECIMAL在汇总表中以文本保存，再聚合时使用精确的十进制运算，结果的类型与直接查询源数据库一致。
+    """
+    def __init__(self, path=':memory:', connect=None, min_hits=3, window=7 * 24 * 3600, refresh_interval=60.0,
+                 watermarks=None, max_rows=200000, background=True):
+        """
+        :param path: 本地数据库文件路径（保存查询日志和汇总表），默认为':memory:'，传入文件路径时跨进程复用
+        :param connect: 获取源数据库连接的上下文管理器函数，默认为run_sql.db_connection
+        :param min_hits: 某个形态出现该次数后建立汇总表
+        :param window: 统计出现次数的时间窗口（秒）
+        :param refresh_interval: 汇总表的最长刷新间隔（秒），设置为0时每次改写前都刷新
+        :param watermarks: 数据表名 -> 水位字段名，用于增量刷新，例如{'user_payments': 'id'}
+        :param max_rows: 汇总表的最大行数，超过时放弃该形态（维度基数过高，汇总表不比源数据表小多少）
+        :param background: 是否在后台线程中建立汇总表，默认为True，设置为False时在record中同步建立
+        """
+        self.path = path
+        self._connect = connect
+        self.min_hits = min_hits
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.watermarks = {table.lower(): column for table, column in (watermarks or {}).items()}
+        self.max_rows = max_rows
+        self.background = background
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+        for name, aggregate in (('DECIMAL_SUM', _DecimalSum), ('DECIMAL_MIN', _DecimalMin),
+                                ('DECIMAL_MAX', _DecimalMax)):
+            self._connection.create_aggregate(name, 1, aggregate)
+        self._connection.create_aggregate('DECIMAL_AVG', 2, _DecimalAvg)
+        self._lock = threading.RLock()
+        self._building = set()
+        self._threads = []
+        self._stats = {'queries': 0, 'hits': 0, 'misses': 0, 'seconds_saved': 0.0, 'rollup_seconds': 0.0,
+                       'builds': 0, 'refreshes': 0, 'refresh_seconds': 0.0, 'rollup_hits': {}}
+
+    def _source(self):
+        if self._connect is not None:
+            return self._connect()
+        from ..functions_lib.run_sql import db_connection
+        return db_connection()
+
+    def _source_rows(self, sql):
+        with self._source() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    def _rollups(self, table=None):
+        sql = "SELECT name, shape, table_name, dims, measures, watermark, watermark_value, refreshed, rows, " \
+              "compacted_rows FROM rollups"
+        with self._lock:
+            rows = self._connection.execute(sql + (" WHERE table_name = ?" if table else ""),
+                                            (table,) if table else ()).fetchall()
+        # 维度为[表达式, SQL, 类型]，度量为(函数, 表达式, SQL, 类型)，缺少类型的汇总表不用于改写
+        return [{
+            'name': row[0], 'shape': row[1], 'table': row[2],
+            'dims': [(d + ['mixed'])[:3] for d in json.loads(row[3])],
+            'measures': [tuple((m + ['mixed'])[:4]) for m in json.loads(row[4])], 'watermark': row[5],
+            'watermark_value': json.loads(row[6]) if row[6] is not None else None, 'refreshed': row[7],
+            'rows': row[8], 'compacted_rows': row[9],
+        } for row in rows]
+
+    def _match(self, query:AggregateQuery):
+        """维度和度量都被覆盖的汇总表中行数最少的一张"""
+        candidates = []
+        for rollup in self._rollups(query.table):
+            dims = {dim[0] for dim in rollup['dims']}
+            measures = {(func, key) for func, key, _, _ in rollup['measures']}
+            if set(query.dims) <= dims and set(query.measures) <= measures:
+                candidates.append(rollup)
+        return min(candidates, key=lambda r: r['rows']) if candidates else None
+
+    @staticmethod
+    def _item_kind(item, rollup) -> str:
+        """查询结果中某一项的类型"""
+        if item['kind'] == 'dim':
+            return next(dim[2] for dim in rollup['dims'] if dim[0] == item['key'])
+        measure_kind = {(func, key): kind for func, key, _, kind in rollup['measures']}
+        argument = item['argument'].key if item['argument'] else '*'
+        if item['func'] == 'count':
+            return 'int'
+        if item['func'] == 'avg':
+            return 'decimal' if measure_kind[('sum', argument)] == 'decimal' else 'float'
+        return measure_kind[(item['func'], argument)]
+
+    def _order_keys(self, query:AggregateQuery, rollup):
+        """
+        排序使用的结果列（序号, 是否降序），隐藏的排序维度位于查询结果各项之后；改写后排序与源数据库可能不一致时返回None
+        """
+        dim_kind = {dim[0]: dim[2] for dim in rollup['dims']}
+        keys, hidden = [], len(query.items)
+        for (kind, value), direction in query.order:
+            if kind == 'dim':
+                index, column_kind = hidden, dim_kind[value]
+                hidden += 1
+            else:
+                index = value - 1 if kind == 'position' else value
+                if not 0 <= index < len(query.items):
+                    return None
+                column_kind = self._item_kind(query.items[index], rollup)
+            if column_kind not in _ORDERED_KINDS:
+                return None
+            keys.append((index, direction == 'DESC'))
+        return keys
+
+    def _rewritable(self, query:AggregateQuery, rollup) -> bool:
+        """改写为对汇总表的再聚合后，结果是否与直接查询源数据库一致"""
+        dim_kind = {dim[0]: dim[2] for dim in rollup['dims']}
+        if any(kind == 'mixed' for kind in list(dim_kind.values()) + [m[3] for m in rollup['measures']]):
+            return False
+        # 筛选条件：IS NULL对任何类型都适用，其余条件只用于数值维度，并且不能与字符串常量比较
+        for expression, rest in query.where:
+            words = [t.lower() for t in _TOKEN_RE.findall(rest)]
+            if words in (['is', 'null'], ['is', 'not', 'null']):
+                continue
+            if dim_kind[expression.key] not in _NUMERIC_KINDS or 'like' in words or any(map(_is_string, words)):
+                return False
+        # 分组：字符串维度存在只有大小写、重音或末尾空格不同的取值时，SQLite分组的结果与MySQL不同
+        if any(dim_kind[expression.key] == 'ambiguous_text' for expression in query.group):
+            return False
+        # 对字符串取MIN、MAX时比较方式不同
+        if any(item['kind'] == 'agg' and item['func'] in ('min', 'max') and
+               self._item_kind(item, rollup) not in _ORDERED_KINDS for item in query.items):
+            return False
+        return self._order_keys(query, rollup) is not None
+
+    def rewrite(self, query:AggregateQuery, rollup:dict) -> str:
+        """
+        将聚合查询改写为对汇总表的再聚合。ORDER BY和LIMIT在还原结果的类型后由answer处理，
+        ORDER BY中不在查询结果中的维度作为额外的列放在最后
+        """
+        dim_column = {dim[0]: f'd{i}' for i, dim in enumerate(rollup['dims'])}
+        measure_column = {(func, key): f'm{i}' for i, (func, key, _, _) in enumerate(rollup['measures'])}
+        decimal = {(func, key) for func, key, _, kind in rollup['measures'] if kind == 'decimal'}
+
+        def aggregate(item):
+            argument = item['argument'].key if item['argument'] else '*'
+            func = item['func']
+            if func == 'avg':
+                total, count = measure_column[('sum', argument)], measure_column[('count', argument)]
+                if ('sum', argument) in decimal:
+                    return f"DECIMAL_AVG({total}, {count})"
+                return f"1.0 * SUM({total}) / NULLIF(SUM({count}), 0)"
+            outer = {'count': 'SUM', 'sum': 'SUM', 'min': 'MIN', 'max': 'MAX'}[func]
+            if (func, argument) in decimal:
+                outer = 'DECIMAL_' + outer
+            return f"{outer}({measure_column[(func, argument)]})"
+
+        select = [f"{dim_column[item['key']] if item['kind'] == 'dim' else aggregate(item)} AS c{i}"
+                  for i, item in enumerate(query.items)]
+        select += [dim_column[value] for (kind, value), _ in query.order if kind == 'dim']
+        sql = f"SELECT {', '.join(select)} FROM {rollup['name']}"
+        if query.where:
+            sql += " WHERE " + ' AND '.join(f"{dim_column[e.key]} {rest}" for e, rest in query.where)
+        sql += " GROUP BY " + ', '.join(dim_column[e.key] for e in query.group)
+        return sql
+
+    def _result_rows(self, query:AggregateQuery, rollup, rows) -> list:
+        """还原再聚合结果的类型，按ORDER BY排序（与MySQL一致，升序时NULL在前）并应用LIMIT"""
+        kinds = [self._item_kind(item, rollup) for item in query.items]
+        kinds += [dim[2] for (kind, value), _ in query.order if kind == 'dim' for dim in rollup['dims']
+                  if dim[0] == value]
+        rows = [[_restore(value, kind) for value, kind in zip(row, kinds)] for row in rows]
+        for index, descending in reversed(self._order_keys(query, rollup)):
+            rows.sort(key=lambda row: (row[index] is not None, row[index] if row[index] is not None else 0),
+                      reverse=descending)
+        if query.limit:
+            numbers = [int(n) for n in re.findall(r'\d+', query.limit)]
+            if len(numbers) == 1:
+                offset, count = 0, numbers[0]
+            elif ',' in query.limit:
+                offset, count = numbers
+            else:
+                count, offset = numbers
+            rows = rows[offset:offset + count]
+        return [tuple(row[:len(query.items)]) for row in rows]
+
+    def answer(self, sql:str):
+        """
+        查询可以由汇总表回答时返回(字段名列表, 结果元组列表)，否则返回None
+        """
+        query = parse_aggregate_query(sql)
+        with self._lock:
+            self._stats['queries'] += 1
+        if query is None:
+            return None
+        rollup = self._match(query)
+        if rollup is None:
+            return None
+        start = time.perf_counter()
+        if time.time() - rollup['refreshed'] >= self.refresh_interval:
+            if not rollup['watermark']:
+                # 没有水位字段时刷新即重建，在后台进行，重建完成前查询源数据库
+                self._schedule(rollup['shape'])
+                if self.background:
+                    return None
+            else:
+                try:
+                    self.refresh(rollup['name'])
+                except Exception as e:
+                    print(f">>> 汇总表{rollup['name']}刷新失败，改为查询源数据库：{e}")
+                    return None
+            # 刷新后字段类型可能变化，重建后也可能因行数超限而被放弃
+            rollup = self._match(query)
+            if rollup is None:
+                return None
+        if not self._rewritable(query, rollup):
+            return None
+        with self._lock:
+            rows = self._connection.execute(self.rewrite(query, rollup)).fetchall()
+        rows = self._result_rows(query, rollup, rows)
+        with self._lock:
+            seconds = time.perf_counter() - start
+            average = self._connection.execute(
+                "SELECT AVG(seconds) FROM query_log WHERE shape IN (?, ?) AND source = 'base'",
+                (query.shape, rollup['shape'])).fetchone()[0]
+            self._connection.execute("INSERT INTO query_log (ts, shape, source, rollup, seconds) VALUES (?, ?, ?, ?, ?)",
+                                     (time.time(), query.shape, 'rollup', rollup['name'], seconds))
+            self._stats['hits'] += 1
+            self._stats['rollup_seconds'] += seconds
+            self._stats['seconds_saved'] += max(0.0, (average or 0.0) - seconds)
+            self._stats['rollup_hits'][rollup['name']] = self._stats['rollup_hits'].get(rollup['name'], 0) + 1
+        return query.columns, rows
+
+    def record(self, sql:str, seconds:float):
+        """
+        记录一条在源数据库上执行的查询及耗时，聚合查询的形态达到min_hits次时建立汇总表
+        """
+        query = parse_aggregate_query(sql)
+        if query is None:
+            return
+        with self._lock:
+            self._stats['misses'] += 1
+            connection = self._connection
+            connection.execute("INSERT INTO query_log (ts, shape, source, rollup, seconds) VALUES (?, ?, ?, NULL, ?)",
+                               (time.time(), query.shape, 'base', seconds))
+            row = connection.execute("SELECT measures, status FROM shapes WHERE shape = ?", (query.shape,)).fetchone()
+            measures = {(func, key): argument for func, key, argument in json.loads(row[0])} if row else {}
+            grown = not set(query.measures) <= set(measures)
+            measures.update(query.measures)
+            status = row[1] if row and not grown else 'candidate'
+            connection.execute(
+                "INSERT OR REPLACE INTO shapes (shape, table_name, dims, measures, status) VALUES (?, ?, ?, ?, ?)",
+                (query.shape, query.table, json.dumps(sorted(query.dims.items())),
+                 json.dumps(sorted([func, key, argument] for (func, key), argument in measures.items())), status))
+            hits = connection.execute("SELECT COUNT(*) FROM query_log WHERE shape = ? AND ts >= ?",
+                                      (query.shape, time.time() - self.window)).fetchone()[0]
+            if status != 'candidate' or hits < self.min_hits:
+                return
+        self._schedule(query.shape)
+
+    def _schedule(self, shape:str):
+        """建立（或重建）某个形态的汇总表，background为True时在后台线程中进行，不占用查询本身的耗时"""
+        with self._lock:
+            if shape in self._building:
+                return
+            self._building.add(shape)
+            if self.background:
+                thread = threading.Thread(target=self._build, args=(shape,), name='rollup-build', daemon=True)
+                self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+                thread.start()
+                return
+        self._build(shape)
+
+    def _build(self, shape:str):
+        try:
+            self.materialize(shape)
+        except Exception as e:
+            print(f">>> 汇总表建立失败：{e}")
+        finally:
+            with self._lock:
+                self._building.discard(shape)
+
+    def wait(self, timeout:float=None):
+        """等待后台正在建立的汇总表完成"""
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(timeout)
+
+    def materialize(self, shape:str):
+        """按某个形态的全部维度和度量在源数据库上聚合，建立（或重建）汇总表"""
+        with self._lock:
+            row = self._connection.execute("SELECT table_name, dims, measures FROM shapes WHERE shape = ?",
+                                           (shape,)).fetchone()
+        if row is None:
+            raise KeyError(shape)
+        table, dims, measures = row[0], json.loads(row[1]), json.loads(row[2])
+        name = 'rollup_' + hashlib.blake2b(shape.encode('utf-8'), digest_size=6).hexdigest()
+        watermark = self.watermarks.get(table.lower())
+
+        start = time.perf_counter()
+        upper = self._source_rows(f"SELECT MAX({watermark}) FROM {table}")[0][0] if watermark else None
+        rows = self._aggregate(table, dims, measures, watermark, None, upper)
+        kinds = _column_kinds(rows, [None] * (len(dims) + len(measures)))
+        rows = [tuple(map(_local_value, row)) for row in rows]
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN")
+            connection.execute(f"DROP TABLE IF EXISTS {name}")
+            if len(rows) > self.max_rows:
+                connection.execute("UPDATE shapes SET status = 'rejected' WHERE shape = ?", (shape,))
+                connection.execute("DELETE FROM rollups WHERE name = ?", (name,))
+                connection.execute("COMMIT")
+                print(f">>> 形态{shape}的汇总表超过{self.max_rows}行，不再物化")
+                return None
+            columns = [f'd{i}' for i in range(len(dims))] + [f'm{i}' for i in range(len(measures))]
+            connection.execute(f"CREATE TABLE {name} ({', '.join(columns)})")
+            connection.executemany(f"INSERT INTO {name} VALUES ({', '.join('?' * len(columns))})", rows)
+            kinds = self._text_kinds(name, kinds, len(dims))
+            now = time.time()
+            connection.execute(
+                "INSERT OR REPLACE INTO rollups (name, shape, table_name, dims, measures, watermark, watermark_value, "
+                "built, refreshed, rows, compacted_rows) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, shape, table, json.dumps([dim[:2] + [kind] for dim, kind in zip(dims, kinds)]),
+                 json.dumps([measure[:3] + [kind] for measure, kind in zip(measures, kinds[len(dims):])]), watermark,
+                 json.dumps(_local_value(upper)) if watermark else None, now, now, len(rows), len(rows)))
+            connection.execute("UPDATE shapes SET status = 'materialized' WHERE shape = ?", (shape,))
+            connection.execute("COMMIT")
+            self._stats['builds'] += 1
+            self._stats['refresh_seconds'] += time.perf_counter() - start
+        print(f">>> 已建立汇总表{name}（{table}，维度：{', '.join(dim[1] for dim in dims)}，{len(rows)}行）")
+        return name
+
+    def _text_kinds(self, name, kinds, dims) -> list:
+        """字符串维度中存在只有大小写、重音或末尾空格不同的取值时标记为ambiguous_text"""
+        kinds = list(kinds)
+        for i in range(dims):
+            if kinds[i] in ('text', 'ambiguous_text'):
+                values = [row[0] for row in self._connection.execute(
+                    f"SELECT DISTINCT d{i} FROM {name} WHERE d{i} IS NOT NULL")]
+                kinds[i] = 'ambiguous_text' if len(set(map(_folded, values))) < len(values) else 'text'
+        return kinds
+
+    def _aggregate(self, table, dims, measures, watermark, lower, upper):
+        """在源数据库上聚合，返回源数据库原样返回的结果"""
+        select = [f"{dim[1]} AS d{i}" for i, dim in enumerate(dims)] + \
+                 [f"{_measure_sql(measure[0], measure[2])} AS m{i}" for i, measure in enumerate(measures)]
+        sql = f"SELECT {', '.join(select)} FROM {table}"
+        conditions = []
+        if watermark and lower is not None:
+            conditions.append(f"{watermark} > {_literal(lower)}")
+        if watermark and upper is not None:
+            conditions.append(f"{watermark} <= {_literal(upper)}")
+        if conditions:
+            sql += " WHERE " + ' AND '.join(conditions)
+        sql += " GROUP BY " + ', '.join(dim[1] for dim in dims)
+        return self._source_rows(sql)
+
+    def refresh(self, name:str):
+        """
+        刷新汇总表：有水位字段时只聚合新增的行并追加（行数超过上次整理时的2倍后合并为每组一行），否则重新构建
+        """
+        rollup = next((r for r in self._rollups() if r['name'] == name), None)
+        if rollup is None:
+            raise KeyError(name)
+        if not rollup['watermark']:
+            self.materialize(rollup['shape'])
+            with self._lock:
+                self._stats['refreshes'] += 1
+            return
+
+        start = time.perf_counter()
+        table, watermark, lower = rollup['table'], rollup['watermark'], rollup['watermark_value']
+        upper = self._source_rows(f"SELECT MAX({watermark}) FROM {table}")[0][0]
+        dims, measures = rollup['dims'], rollup['measures']
+        delta = []
+        if upper is not None and (lower is None or _local_value(upper) != lower):
+            delta = self._aggregate(table, dims, measures, watermark, lower, upper)
+        kinds = _column_kinds(delta, [dim[2] for dim in dims] + [measure[3] for measure in measures])
+        delta = [tuple(map(_local_value, row)) for row in delta]
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN")
+            if delta:
+                connection.executemany(f"INSERT INTO {name} VALUES ({', '.join('?' * len(kinds))})", delta)
+                kinds = self._text_kinds(name, kinds, len(dims))
+            rows = rollup['rows'] + len(delta)
+            compacted = rollup['compacted_rows']
+            if rows > 2 * max(compacted, 1):
+                rows = compacted = self._compact(name, len(dims), measures, kinds[len(dims):])
+            connection.execute(
+                "UPDATE rollups SET dims = ?, measures = ?, watermark_value = ?, refreshed = ?, rows = ?, "
+                "compacted_rows = ? WHERE name = ?",
+                (json.dumps([list(dim[:2]) + [kind] for dim, kind in zip(dims, kinds)]),
+                 json.dumps([list(measure[:3]) + [kind] for measure, kind in zip(measures, kinds[len(dims):])]),
+                 json.dumps(_local_value(upper)) if upper is not None else None, time.time(), rows, compacted, name))
+            connection.execute("COMMIT")
+            self._stats['refreshes'] += 1
+            self._stats['refresh_seconds'] += time.perf_counter() - start
+
+    def _compact(self, name, dims, measures, kinds) -> int:
+        """将增量追加的部分聚合行合并为每组一行"""
+        outer = {'count': 'SUM', 'sum': 'SUM', 'min': 'MIN', 'max': 'MAX'}
+        group = [f'd{i}' for i in range(dims)]
+        select = group + [f"{'DECIMAL_' if kind == 'decimal' and func != 'count' else ''}{outer[func]}(m{i}) AS m{i}"
+                          for i, ((func, _, _, _), kind) in enumerate(zip(measures, kinds))]
+        connection = self._connection
+        connection.execute(f"CREATE TABLE {name}_compact AS SELECT {', '.join(select)} FROM {name} "
+                           f"GROUP BY {', '.join(group)}")
+        connection.execute(f"DROP TABLE {name}")
+        connection.execute(f"ALTER TABLE {name}_compact RENAME TO {name}")
+        return connection.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+
+    def get_stats(self) -> dict:
+        """
+        改写命中率（由汇总表回答的聚合查询占全部聚合查询的比例）、估算节省的耗时（同形态查询在源数据库上的平均耗时减去改写后的耗时）
+        以及各汇总表的情况
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            aggregates = stats['hits'] + stats['misses']
+            stats['aggregate_queries'] = aggregates
+            stats['hit_rate'] = stats['hits'] / aggregates if aggregates else 0.0
+            hits = stats.pop('rollup_hits')
+            stats['rollups'] = [{
+                'name': rollup['name'], 'table': rollup['table'], 'dims': [dim[1] for dim in rollup['dims']],
+                'rows': rollup['rows'], 'hits': hits.get(rollup['name'], 0),
+            } for rollup in self._rollups()]
+        return stats
+
+    def report(self) -> str:
+        stats = self.get_stats()
+        lines = [f"聚合查询{stats['aggregate_queries']}次，由汇总表回答{stats['hits']}次（命中率{stats['hit_rate']:.1%}），"
+                 f"估算节省{stats['seconds_saved']:.3f}秒；建立汇总表{stats['builds']}次，刷新{stats['refreshes']}次，"
+                 f"建立和刷新共耗时{stats['refresh_seconds']:.3f}秒"]
+        for rollup in stats['rollups']:
+            lines.append(f"  {rollup['name']}：{rollup['table']}按{', '.join(rollup['dims'])}汇总，"
+                         f"{rollup['rows']}行，命中{rollup['hits']}次")
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
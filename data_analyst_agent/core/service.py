@@ -0,0 +1,536 @@
+import io
+import sys
+import json
+import time
+import uuid
+import base64
+import asyncio
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from http import HTTPStatus
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .batch import ThreadRoutedStream, routed_stdout
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_END = object()
+
+
+class HttpError(Exception):
+    def __init__(self, status, message='', headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message or HTTPStatus(status).phrase
+        self.headers = headers or {}
+
+
+class Request:
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> dict:
+        if not self.body:
+            return {}
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            raise HttpError(400, '请求体不是合法的JSON')
+
+
+async def read_request(reader:asyncio.StreamReader, max_body=1024 * 1024):
+    """读取一个HTTP/1.1请求，连接已关闭时返回None"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split(None, 2)
+    except ValueError:
+        raise HttpError(400, '无法解析请求行')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length') or 0)
+    if length > max_body:
+        raise HttpError(413)
+    body = await reader.readexactly(length) if length else b''
+    path, _, query_string = target.partition('?')
+    query = {k: v[-1] for k, v in urllib.parse.parse_qs(query_string).items()}
+    return Request(method.upper(), path, query, headers, body)
+
+
+def _head(status, headers) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+    lines += [f"{key}: {value}" for key, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def send_json(writer:asyncio.StreamWriter, status, data, headers=None):
+    body = json.dumps(data, ensure_ascii=False, default=str).encode('utf-8')
+    head = {'Content-Type': 'application/json; charset=utf-8', 'Content-Length': len(body), 'Connection': 'close'}
+    head.update(headers or {})
+    writer.write(_head(status, head) + body)
+    await writer.drain()
+
+
+class ChunkedResponse:
+    """分块传输的流式响应，每个事件为一行JSON（NDJSON）"""
+    def __init__(self, writer:asyncio.StreamWriter, content_type='application/x-ndjson; charset=utf-8'):
+        self.writer = writer
+        self.content_type = content_type
+
+    async def start(self, status=200):
+        self.writer.write(_head(status, {
+            'Content-Type': self.content_type,
+            'Transfer-Encoding': 'chunked',
+            'Cache-Control': 'no-cache',
+            'Connection': 'close',
+        }))
+        await self.writer.drain()
+
+    async def write(self, data:bytes):
+        self.writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+        # 客户端读取较慢时在这里等待，形成背压
+        await self.writer.drain()
+
+    async def send(self, event:dict):
+        await self.write((json.dumps(event, ensure_ascii=False, default=str) + '\n').encode('utf-8'))
+
+    async def close(self):
+        self.writer.write(b'0\r\n\r\n')
+        await self.writer.drain()
+
+
+def websocket_accept(key:str) -> str:
+    return base64.b64encode(hashlib.sha1((key + _WS_GUID).encode('latin-1')).digest()).decode('latin-1')
+
+
+def websocket_frame(payload:bytes, opcode=0x1, mask=False) -> bytes:
+    """构造一个WebSocket数据帧，服务端发送时不加掩码，客户端发送时需要加掩码"""
+    head = bytearray([0x80 | opcode])
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        head.append(mask_bit | length)
+    elif length < 1 << 16:
+        head.append(mask_bit | 126)
+        head += length.to_bytes(2, 'big')
+    else:
+        head.append(mask_bit | 127)
+        head += length.to_bytes(8, 'big')
+    if mask:
+        key = uuid.uuid4().bytes[:4]
+        head += key
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+    return bytes(head) + payload
+
+
+async def read_websocket_frame(reader:asyncio.StreamReader):
+    """读取一个WebSocket数据帧，返回(opcode, payload)"""
+    first, second = await reader.readexactly(2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), 'big')
+    key = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length) if length else b''
+    if key is not None:
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+class ServiceSession:
+    """服务中的一个会话：独立的DataFlowAgent会话（对话历史和变量空间），同一时间只回答一个问题"""
+    def __init__(self, session_id, agent):
+        self.session_id = session_id
+        self.agent = agent
+        self.created_at = time.time()
+        self.last_active = time.monotonic()
+        self.busy = False
+        self.turns = 0
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def close(self):
+        self.agent.reset()
+        if self.agent.debugger is not None:
+            self.agent.debugger.close()
+
+    def info(self) -> dict:
+        return {
+            'session_id': self.session_id,
+            'turns': self.turns,
+            'busy': self.busy,
+            'idle_seconds': round(time.monotonic() - self.last_active, 3),
+        }
+
+
+class AgentService:
+    """
+    基于asyncio的多会话HTTP/WebSocket服务：
+    1、每个会话由模板agent的new_session()创建，使用独立的对话历史和变量空间；
+    2、一轮对话在有界的线程池中运行，外部函数（SQL、pandas）在另一个有界线程池中运行；
+    3、运行事件（步骤、流式文本、外部函数进度）通过NDJSON分块响应或WebSocket推送给客户端，客户端读取慢时对话线程等待（背压）；
+    4、进行中和排队的对话超过上限时返回429，会话数量超过上限时淘汰最久未使用的空闲会话，空闲超时的会话定期清理。
+
+    接口：
+    POST /sessions                    创建会话
+    GET /sessions                     会话列表
+    DELETE /sessions/{id}             关闭会话
+    POST /sessions/{id}/chat          {"question": ...}，默认流式返回事件，?stream=0时只返回最终结果
+    GET /sessions/{id}/ws             WebSocket，发送{"question": ...}，接收事件
+    GET /health                       服务状态
+    """
+    def __init__(self,
+                 agent,
+                 max_sessions=100,
+                 idle_timeout=900,
+                 max_active_turns=8,
+                 max_pending_turns=16,
+                 tool_workers=4,
+                 event_queue_size=256):
+        """
+        :param agent: DataFlowAgent对象，作为各会话的模板
+        :param max_sessions: 最大会话数量
+        :param idle_timeout: 会话空闲超过该时间（秒）后被清理
+        :param max_active_turns: 同时运行的对话数量（对话线程池大小）
+        :param max_pending_turns: 排队等待运行的对话数量上限，超过后返回429
+        :param tool_workers: 同时运行外部函数的数量（外部函数线程池大小）
+        :param event_queue_size: 每轮对话的事件缓冲区大小，缓冲区满时对话线程等待客户端读取
+        """
+        self.agent = agent
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_active_turns = max_active_turns
+        self.max_pending_turns = max_pending_turns
+        self.event_queue_size = event_queue_size
+
+        self.turn_executor = ThreadPoolExecutor(max_workers=max_active_turns, thread_name_prefix='turn')
+        self.tool_executor = ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix='tool')
+        self.sessions = OrderedDict()
+        self._inflight = 0
+        self._server = None
+        self._evictor = None
+        self._stdout = None
+
+        self.metrics = {
+            'turns': 0,
+            'turn_errors': 0,
+            'rejected': 0,
+            'evicted': 0,
+            'cancelled': 0,
+        }
+
+    # ---------- 会话管理 ----------
+    def create_session(self) -> ServiceSession:
+        if len(self.sessions) >= self.max_sessions:
+            self._evict(force=True)
+        if len(self.sessions) >= self.max_sessions:
+            raise HttpError(503, '会话数量已达上限', {'Retry-After': '5'})
+        session = self.agent.new_session()
+        session.tool_executor = self.tool_executor
+        service_session = ServiceSession(uuid.uuid4().hex, session)
+        self.sessions[service_session.session_id] = service_session
+        return service_session
+
+    def get_session(self, session_id) -> ServiceSession:
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HttpError(404, f'会话{session_id}不存在')
+        self.sessions.move_to_end(session_id)
+        return session
+
+    def close_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+
+    def _evict(self, force=False) -> int:
+        """清理空闲超时的会话；force=True时至少淘汰一个最久未使用的空闲会话"""
+        now = time.monotonic()
+        evicted = 0
+        for session_id, session in list(self.sessions.items()):
+            if session.busy:
+                continue
+            if now - session.last_active > self.idle_timeout or (force and evicted == 0):
+                self.close_session(session_id)
+                evicted += 1
+        self.metrics['evicted'] += evicted
+        return evicted
+
+    async def _evict_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self._evict()
+
+    # ---------- 对话 ----------
+    async def run_turn(self, session:ServiceSession, question:str, send_event) -> dict:
+        """
+        在对话线程池中运行一轮对话，运行事件通过send_event推送，返回最终结果
+        """
+        if session.busy:
+            raise HttpError(409, '当前会话正在回答上一个问题')
+        if self._inflight >= self.max_active_turns + self.max_pending_turns:
+            self.metrics['rejected'] += 1
+            raise HttpError(429, '服务繁忙，请稍后重试', {'Retry-After': '1'})
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.event_queue_size)
+        cancelled = threading.Event()
+
+        def emit(event):
+            if not cancelled.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(event), loop).result()
+
+        def work():
+            if isinstance(sys.stdout, ThreadRoutedStream):
+                sys.stdout.set_stream(io.StringIO())
+            try:
+                return session.agent.ask(question, on_event=emit, step_hook=lambda state: not cancelled.is_set())
+            finally:
+                if isinstance(sys.stdout, ThreadRoutedStream):
+                    sys.stdout.set_stream(None)
+
+        session.busy = True
+        session.touch()
+        self._inflight += 1
+        start = time.perf_counter()
+        future = loop.run_in_executor(self.turn_executor, work)
+        future.add_done_callback(lambda _: asyncio.ensure_future(queue.put(_END)))
+        try:
+            while True:
+                event = await queue.get()
+                if event is _END:
+                    break
+                if cancelled.is_set():
+                    continue
+                try:
+                    await send_event(event)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # 客户端断开：取消本轮对话，继续取出剩余事件直到对话线程结束
+                    cancelled.set()
+                    self.metrics['cancelled'] += 1
+
+            state = session.agent.last_turn
+            result = {'type': 'done', 'latency': time.perf_counter() - start}
+            try:
+                result['answer'] = await future
+                result['status'] = 'stopped' if state is not None and state.stop_reason else 'ok'
+            except Exception as e:
+                self.metrics['turn_errors'] += 1
+                result['answer'] = None
+                result['status'] = 'error'
+                result['error'] = f"{type(e).__name__}: {e}"
+            if state is not None:
+                result.update(steps=state.steps, llm_calls=state.llm_calls, tokens=state.tokens,
+                              stop_reason=state.stop_reason)
+            self.metrics['turns'] += 1
+            session.turns += 1
+            return result
+        finally:
+            self._inflight -= 1
+            session.busy = False
+            session.touch()
+
+    # ---------- HTTP ----------
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            await self.dispatch(request, reader, writer)
+        except HttpError as e:
+            try:
+                await send_json(writer, e.status, {'error': e.message}, e.headers)
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def dispatch(self, request:Request, reader, writer):
+        parts = [part for part in request.path.split('/') if part]
+        method = request.method
+
+        if parts == ['health'] and method == 'GET':
+            await send_json(writer, 200, self.get_stats())
+        elif parts == ['sessions'] and method == 'POST':
+            session = self.create_session()
+            await send_json(writer, 201, session.info())
+        elif parts == ['sessions'] and method == 'GET':
+            await send_json(writer, 200, [session.info() for session in self.sessions.values()])
+        elif len(parts) == 2 and parts[0] == 'sessions' and method == 'DELETE':
+            self.get_session(parts[1])
+            self.close_session(parts[1])
+            await send_json(writer, 200, {'closed': parts[1]})
+        elif len(parts) == 3 and parts[0] == 'sessions' and parts[2] == 'chat' and method == 'POST':
+            session = self.get_session(parts[1])
+            question = request.json().get('question')
+            if not question:
+                raise HttpError(400, '缺少question字段')
+            await self._chat_http(session, question, writer, request.query.get('stream', '1') != '0')
+        elif len(parts) == 3 and parts[0] == 'sessions' and parts[2] == 'ws' and method == 'GET':
+            session = self.get_session(parts[1])
+            await self._chat_websocket(session, request, reader, writer)
+        else:
+            raise HttpError(404)
+
+    async def _chat_http(self, session, question, writer, stream=True):
+        if not stream:
+            async def ignore(event):
+                pass
+            result = await self.run_turn(session, question, ignore)
+            await send_json(writer, 200, result)
+            return
+
+        response = ChunkedResponse(writer)
+        started = False
+
+        async def send_event(event):
+            nonlocal started
+            if not started:
+                await response.start()
+                started = True
+            await response.send(event)
+
+        result = await self.run_turn(session, question, send_event)
+        try:
+            await send_event(result)
+            await response.close()
+        except ConnectionError:
+            pass
+
+    async def _chat_websocket(self, session, request, reader, writer):
+        key = request.headers.get('sec-websocket-key')
+        if request.headers.get('upgrade', '').lower() != 'websocket' or not key:
+            raise HttpError(400, '需要WebSocket升级请求')
+        writer.write(_head(101, {
+            'Upgrade': 'websocket',
+            'Connection': 'Upgrade',
+            'Sec-WebSocket-Accept': websocket_accept(key),
+        }))
+        await writer.drain()
+
+        async def send_event(event):
+            writer.write(websocket_frame(json.dumps(event, ensure_ascii=False, default=str).encode('utf-8')))
+            await writer.drain()
+
+        while True:
+            opcode, payload = await read_websocket_frame(reader)
+            if opcode == 0x8:
+                writer.write(websocket_frame(b'', opcode=0x8))
+                await writer.drain()
+                return
+            if opcode == 0x9:
+                writer.write(websocket_frame(payload, opcode=0xA))
+                await writer.drain()
+                continue
+            if opcode != 0x1:
+                continue
+            try:
+                question = json.loads(payload.decode('utf-8')).get('question')
+                if not question:
+                    raise HttpError(400, '缺少question字段')
+                result = await self.run_turn(session, question, send_event)
+            except (ValueError, AttributeError):
+                result = {'type': 'error', 'status': 400, 'error': '消息不是合法的JSON'}
+            except HttpError as e:
+                result = {'type': 'error', 'status': e.status, 'error': e.message}
+            await send_event(result)
+
+    # ---------- 启动与关闭 ----------
+    async def start(self, host='127.0.0.1', port=8000, evict_interval=30):
+        self._stdout = routed_stdout()
+        self._stdout.__enter__()
+        self._server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        self._evictor = asyncio.ensure_future(self._evict_loop(evict_interval))
+        return self._server
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._evictor is not None:
+            self._evictor.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for session_id in list(self.sessions):
+            self.close_session(session_id)
+        self.turn_executor.shutdown(wait=False)
+        self.tool_executor.shutdown(wait=False)
+        if self._stdout is not None:
+            self._stdout.__exit__(None, None, None)
+            self._stdout = None
+
+    def get_stats(self) -> dict:
+        stats = dict(self.metrics)
+        stats.update(
+            sessions=len(self.sessions),
+            busy_sessions=sum(session.busy for session in self.sessions.values()),
+            inflight_turns=self._inflight,
+            max_active_turns=self.max_active_turns,
+            max_pending_turns=self.max_pending_turns,
+        )
+        return stats
+
+
+def serve(agent, host='127.0.0.1', port=8000, **kwargs):
+    """启动服务并一直运行，直到按下Ctrl-C"""
+    service = AgentService(agent, **kwargs)
+
+    async def main():
+        await service.start(host, port)
+        print(f">>> 服务已启动：http://{host}:{service.port}", file=sys.__stdout__)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await service.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def add_service_arguments(parser:argparse.ArgumentParser):
+    parser.add_argument("--serve", action="store_true", help="以HTTP/WebSocket服务模式运行")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_sessions", type=int, default=100, help="最大会话数量")
+    parser.add_argument("--max_active_turns", type=int, default=8, help="同时运行的对话数量")
+    parser.add_argument("--max_pending_turns", type=int, default=16, help="排队等待的对话数量上限")
+    parser.add_argument("--tool_workers", type=int, default=4, help="同时运行外部函数的数量")
+    parser.add_argument("--idle_timeout", type=float, default=900, help="会话空闲超时（秒）")
+
+
+def serve_from_args(agent, args):
+    serve(
+        agent,
+        host=args.host,
+        port=args.port,
+        max_sessions=args.max_sessions,
+        max_active_turns=args.max_active_turns,
+        max_pending_turns=args.max_pending_turns,
+        tool_workers=args.tool_workers,
+        idle_timeout=args.idle_timeout
+    )
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import threading
+
+from openai.types.chat import ChatCompletionMessage
+
+# PRAGMA synchronous的取值：off不主动fsync；normal在WAL检查点时fsync（进程崩溃不丢数据，断电可能丢失最近的提交）；
+# full在每次提交时fsync
+SYNC_MODES = {'off': 'OFF', 'normal': 'NORMAL', 'full': 'FULL'}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project TEXT NOT NULL,
+    session TEXT NOT NULL,
+    turn INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    role TEXT,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session_turn ON messages (session, turn, seq);
+CREATE INDEX IF NOT EXISTS idx_messages_project_ts ON messages (project, ts);
+CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (ts);
+CREATE TABLE IF NOT EXISTS sessions (
+    session TEXT PRIMARY KEY,
+    project TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    turns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_project_updated ON sessions (project, updated);
+"""
+
+
+def message_to_dict(message) -> dict:
+    """将ChatCompletionMessage或字典形式的消息转换为可以JSON序列化的字典"""
+    if isinstance(message, dict):
+        return message
+    if hasattr(message, 'model_dump'):
+        return message.model_dump(exclude_none=True)
+    return {'role': getattr(message, 'role', None), 'content': getattr(message, 'content', None)}
+
+
+def message_from_dict(message:dict):
+    """恢复保存的消息：带有tool_calls的assistant消息恢复为ChatCompletionMessage，与模型返回的消息保持一致"""
+    if message.get('role') == 'assistant' and message.get('tool_calls'):
+        return ChatCompletionMessage.model_validate(message)
+    return message
+
+
+class SessionStore:
+    """
+    只追加的会话存储（SQLite，WAL模式）：
+    1、每条消息是一行记录，带有项目、会话、轮次、顺序号和时间戳，按(会话, 轮次)、(项目, 时间)和时间建立索引；
+    2、写入先进入内存缓冲区，达到batch_size条或距上次写入超过flush_interval秒时，在一个事务中批量写入；
+    3、sync控制fsync策略（off、normal、full）；
+    4、load_last_turns只读取某个会话最近N轮的消息，恢复会话的耗时与会话总长度无关。
+    """
+    def __init__(self, path, batch_size=64, flush_interval=1.0, sync='normal'):
+        """
+        :param path: 数据库文件路径
+        :param batch_size: 缓冲区中的消息达到该数量时写入数据库
+        :param flush_interval: 距上次写入超过该时间（秒）时，下一次追加会触发写入；设置为0时每次追加都立即写入
+        :param sync: fsync策略，off、normal或full，默认为normal
+        """
+        if sync not in SYNC_MODES:
+            raise ValueError(f"sync必须是{list(SYNC_MODES)}之一")
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sync = sync
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(f"PRAGMA synchronous={SYNC_MODES[sync]}")
+        self._connection.executescript(_SCHEMA)
+
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._session_updates = {}
+        self._turns = {}
+        self._last_flush = time.monotonic()
+        self._closed = False
+
+        self.metrics = {
+            'messages': 0,
+            'flushes': 0,
+            'bytes': 0,
+            'flush_time': 0.0,
+        }
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _next_turn(self, session) -> int:
+        turn = self._turns.get(session)
+        if turn is None:
+            row = self._connection.execute(
+                "SELECT turns FROM sessions WHERE session = ?", (session,)).fetchone()
+            turn = row[0] if row else 0
+        self._turns[session] = turn + 1
+        return turn + 1
+
+    def append_turn(self, session:str, messages:list, project:str='default') -> int:
+        """
+        追加一轮对话的消息
+        :param session: 会话id
+        :param messages: 本轮新增的消息（字典或ChatCompletionMessage）
+        :param project: 项目名称
+        :return: 本轮的轮次编号（从1开始）
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("SessionStore已关闭")
+            turn = self._next_turn(session)
+            now = time.time()
+            for seq, message in enumerate(messages):
+                data = message_to_dict(message)
+                text = json.dumps(data, ensure_ascii=False, default=str)
+                self._buffer.append((project, session, turn, seq, now, data.get('role'), text))
+                self.metrics['bytes'] += len(text)
+            self.metrics['messages'] += len(messages)
+            created = self._session_updates.get(session, (project, now, now, turn))[1]
+            self._session_updates[session] = (project, created, now, turn)
+
+            if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+            return turn
+
+    def flush(self):
+        """将缓冲区中的消息在一个事务中写入数据库"""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._buffer and not self._session_updates:
+                return
+            start = time.perf_counter()
+            buffer, self._buffer = self._buffer, []
+            updates, self._session_updates = self._session_updates, {}
+            connection = self._connection
+            connection.execute("BEGIN")
+            try:
+                connection.executemany(
+                    "INSERT INTO messages (project, session, turn, seq, ts, role, message) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", buffer)
+                connection.executemany(
+                    "INSERT INTO sessions (session, project, created, updated, turns) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(session) DO UPDATE SET updated = excluded.updated, turns = excluded.turns",
+                    [(session, project, created, updated, turns)
+                     for session, (project, created, updated, turns) in updates.items()])
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                # 写入失败时放回缓冲区，下次重试
+                self._buffer = buffer + self._buffer
+                for session, update in updates.items():
+                    self._session_updates.setdefault(session, update)
+                raise
+            self.metrics['flushes'] += 1
+            self.metrics['flush_time'] += time.perf_counter() - start
+
+    def load_last_turns(self, session:str, n:int=None) -> list:
+        """
+        读取某个会话最近n轮的消息（n为None时读取全部），按轮次和顺序排列
+        :return: 字典形式的消息组成的list
+        """
+        with self._lock:
+            self.flush()
+            if n is None:
+                rows = self._connection.execute(
+                    "SELECT message FROM messages WHERE session = ? ORDER BY turn, seq", (session,)).fetchall()
+            else:
+                row = self._connection.execute(
+                    "SELECT turns FROM sessions WHERE session = ?", (session,)).fetchone()
+                if row is None:
+                    return []
+                rows = self._connection.execute(
+                    "SELECT message FROM messages WHERE session = ? AND turn > ? ORDER BY turn, seq",
+                    (session, row[0] - n)).fetchall()
+        return [json.loads(message) for (message,) in rows]
+
+    def list_sessions(self, project:str=None, since:float=None, until:float=None) -> list:
+        """
+        列出会话及其创建时间、最近更新时间和轮次数量，按最近更新时间倒序排列
+        :param project: 可选参数，只列出该项目的会话
+        :param since: 可选参数，最近更新时间不早于该时间戳
+        :param until: 可选参数，最近更新时间不晚于该时间戳
+        """
+        conditions, params = [], []
+        if project is not None:
+            conditions.append("project = ?")
+            params.append(project)
+        if since is not None:
+            conditions.append("updated >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("updated <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(
+                f"SELECT session, project, created, updated, turns FROM sessions {where} ORDER BY updated DESC",
+                params).fetchall()
+        return [dict(zip(('session', 'project', 'created', 'updated', 'turns'), row)) for row in rows]
+
+    def query(self, project:str=None, since:float=None, until:float=None, role:str=None, limit:int=None) -> list:
+        """按项目、时间范围和角色查询消息，用于跨会话分析"""
+        conditions, params = [], []
+        for column, op, value in (('project', '=', project), ('ts', '>=', since), ('ts', '<=', until),
+                                  ('role', '=', role)):
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        sql = f"SELECT project, session, turn, seq, ts, message FROM messages {where} ORDER BY ts, id"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(sql, params).fetchall()
+        return [{'project': p, 'session': s, 'turn': t, 'seq': q, 'ts': ts, 'message': json.loads(m)}
+                for p, s, t, q, ts, m in rows]
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self.flush()
+            self._closed = True
+            self._connection.close()
+        atexit.unregister(self.close)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics['buffered'] = len(self._buffer)
+        return metrics
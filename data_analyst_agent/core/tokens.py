@@ -0,0 +1,162 @@
+import re
+import json
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 每条消息在对话格式中的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD = 4
+
+# 中日韩文字及全角标点，一个字符大致对应一个token
+_CJK_RE = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+class HeuristicTokenizer:
+    """
+    启发式token估算：中日韩字符按1个token计算，其余字符按4个字符1个token计算。
+    不依赖任何外部资源，作为tiktoken不可用时的兜底方案。
+    """
+    name = 'heuristic'
+
+    def count(self, text:str) -> int:
+        if not text:
+            return 0
+        cjk = len(_CJK_RE.findall(text))
+        return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class TiktokenTokenizer:
+    """
+    基于tiktoken的真实token计算，默认使用cl100k_base编码
+    """
+    name = 'tiktoken'
+
+    def __init__(self, encoding_name='cl100k_base'):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text:str) -> int:
+        if not text:
+            return 0
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+class CallableTokenizer:
+    """
+    将任意编码函数（例如transformers tokenizer的encode方法）包装为token计算后端
+    """
+    name = 'callable'
+
+    def __init__(self, encode):
+        self.encode = encode
+
+    def count(self, text:str) -> int:
+        if not text:
+            return 0
+        return len(self.encode(text))
+
+
+def message_text(message) -> str:
+    """
+    提取一条消息中需要计入token的文本：content以及tool_calls中的函数名和参数
+    :param message: 字典形式的消息，或者ChatCompletionMessage对象
+    """
+    if isinstance(message, dict):
+        content = message.get('content')
+        tool_calls = message.get('tool_calls')
+    else:
+        content = getattr(message, 'content', None)
+        tool_calls = getattr(message, 'tool_calls', None)
+
+    if content is not None and not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False, default=str)
+    text = content or ''
+
+    for tool_call in tool_calls or []:
+        if isinstance(tool_call, dict):
+            function = tool_call.get('function', {})
+            text += function.get('name', '') + function.get('arguments', '')
+        else:
+            text += tool_call.function.name + tool_call.function.arguments
+    return text
+
+
+class TokenCounter:
+    """
+    带缓存的token计数器：以文本内容的摘要为key缓存token数量，相同内容只编码一次，
+    消息按其需要计入token的文本计数，消息内容被修改后会自动重新计算。
+    1、缓存不持有文本和消息对象的引用，被淘汰的消息可以及时释放；
+    2、缓存按最近使用顺序淘汰（LRU），可以被多个线程（并发会话）共享。
+    """
+    def __init__(self, tokenizer, cache_size=8192):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def name(self):
+        return self.tokenizer.name
+
+    def count_text(self, text:str) -> int:
+        if not text:
+            return 0
+        key = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        with self._lock:
+            count = self._cache.get(key)
+            if count is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return count
+            self.misses += 1
+
+        # 编码在锁外进行，多个线程同时计算同一文本时结果相同
+        count = self.tokenizer.count(text)
+        with self._lock:
+            self._cache[key] = count
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return count
+
+    def count_message(self, message) -> int:
+        if isinstance(message, str):
+            return self.count_text(message)
+        return MESSAGE_OVERHEAD + self.count_text(message_text(message))
+
+
+_COUNTERS = {}
+_COUNTERS_LOCK = threading.Lock()
+
+
+def get_token_counter(backend='auto') -> TokenCounter:
+    """
+    获取token计数器，同一种后端在进程内共享一个计数器（及其缓存）
+    :param backend: 'auto'（优先tiktoken，不可用时退化为启发式估算）、'tiktoken'、'heuristic'，\
+    也可以直接传入一个编码函数或TokenCounter对象
+    :return: TokenCounter对象
+    """
+    if isinstance(backend, TokenCounter):
+        return backend
+    if callable(backend):
+        return TokenCounter(CallableTokenizer(backend))
+
+    with _COUNTERS_LOCK:
+        if backend not in _COUNTERS:
+            if backend == 'heuristic':
+                tokenizer = HeuristicTokenizer()
+            elif backend == 'tiktoken':
+                tokenizer = TiktokenTokenizer()
+            elif backend == 'auto':
+                try:
+                    tokenizer = TiktokenTokenizer()
+                except Exception as e:
+                    print(f">>> tiktoken不可用（{e.__class__.__name__}），使用启发式方法估算token数量")
+                    tokenizer = HeuristicTokenizer()
+            else:
+                raise ValueError("Invalid tokenizer backend: {}".format(backend))
+            _COUNTERS[backend] = TokenCounter(tokenizer)
+
+        return _COUNTERS[backend]
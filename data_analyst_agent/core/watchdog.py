@@ -0,0 +1,184 @@
+import time
+import ctypes
+import heapq
+import itertools
+import threading
+import traceback
+
+from .artifact_store import current_tool_call
+
+# 变量空间中保存单个代码单元最长运行时间（秒）的键，未设置时使用DEFAULT_CELL_TIMEOUT（不限制）
+CELL_TIMEOUT_KEY = '_cell_timeout'
+DEFAULT_CELL_TIMEOUT = None
+# 编译代码单元时使用的文件名，用于在调用栈中找到代码单元自身的行号
+CELL_FILENAME = '<cell>'
+
+
+class ToolInterrupt(BaseException):
+    """
+    由看门狗抛入代码单元所在线程的中断。继承BaseException，代码中的except Exception不会将其吞掉
+    """
+
+
+class CellTimeout(ToolInterrupt):
+    """代码单元运行超时"""
+    def __init__(self, seconds:float=None, lineno:int=None, line:str=None):
+        self.seconds = seconds
+        self.lineno = lineno
+        self.line = line
+        super().__init__(seconds, lineno, line)
+
+    def __str__(self):
+        where = f"，中断时正在执行第{self.lineno}行：{self.line}" if self.lineno else ''
+        return f"运行超过{self.seconds:g}秒被中断{where}"
+
+
+class CellCancelled(ToolInterrupt):
+    """代码单元被用户取消（Ctrl-C）"""
+
+
+def _raise_in_thread(thread_id:int, exception):
+    """向指定线程抛出异常（exception为None时清除尚未抛出的异常），线程执行下一条Python字节码时生效"""
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id),
+                                               ctypes.py_object(exception) if exception is not None else None)
+
+
+def cell_line(tb, source:str=None):
+    """调用栈中最内层的代码单元帧所在的行号及该行代码"""
+    lineno = None
+    for frame, frame_lineno in traceback.walk_tb(tb):
+        if frame.f_code.co_filename == CELL_FILENAME:
+            lineno = frame_lineno
+    if lineno is None:
+        return None, None
+    lines = (source or '').splitlines()
+    return lineno, lines[lineno - 1].strip() if 0 < lineno <= len(lines) else None
+
+
+class _Cell:
+    def __init__(self, thread_id, key, timeout):
+        self.thread_id = thread_id
+        self.key = key
+        self.timeout = timeout
+        self.start = time.perf_counter()
+        self.deadline = self.start + timeout if timeout else None
+        self.reason = None
+        self.finished = False
+
+
+class CellWatchdog:
+    """
+    代码单元的看门狗：在当前线程中运行代码单元，由一个后台线程统一检查各代码单元的运行时间，
+    超时或被取消时通过PyThreadState_SetAsyncExc向代码单元所在线程抛出中断，不需要单独的进程。
+    中断在线程执行下一条Python字节码时生效：Python层面的循环会立即停止，长时间运行的C扩展调用
+    （例如一次大的merge）需要等该调用返回；代码捕获了中断继续运行时，每隔grace秒重新抛出一次。
+    """
+    def __init__(self, grace:float=1.0):
+        """
+        :param grace: 中断未能使代码单元结束时，再次抛出中断的间隔（秒）
+        """
+        self.grace = grace
+        self._condition = threading.Condition()
+        self._cells = {}
+        self._deadlines = []
+        self._ids = itertools.count()
+        self._thread = None
+        self.metrics = {'cells': 0, 'timeouts': 0, 'cancelled': 0}
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name='cell-watchdog', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        with self._condition:
+            while True:
+                now = time.perf_counter()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, cell_id = heapq.heappop(self._deadlines)
+                    cell = self._cells.get(cell_id)
+                    if cell is None or cell.finished:
+                        continue
+                    if cell.reason is None:
+                        cell.reason = 'timeout'
+                        self.metrics['timeouts'] += 1
+                    _raise_in_thread(cell.thread_id, CellTimeout if cell.reason == 'timeout' else CellCancelled)
+                    heapq.heappush(self._deadlines, (now + self.grace, cell_id))
+                timeout = self._deadlines[0][0] - now if self._deadlines else None
+                self._condition.wait(timeout)
+
+    def _start(self, timeout, key):
+        cell = _Cell(threading.get_ident(), key, timeout)
+        with self._condition:
+            cell_id = next(self._ids)
+            self._cells[cell_id] = cell
+            self.metrics['cells'] += 1
+            if cell.deadline is not None:
+                heapq.heappush(self._deadlines, (cell.deadline, cell_id))
+                self._ensure_thread()
+                self._condition.notify()
+        return cell_id, cell
+
+    def _finish(self, cell_id, cell):
+        with self._condition:
+            if cell.finished:
+                return
+            cell.finished = True
+            self._cells.pop(cell_id, None)
+            # 已经发出但尚未生效的中断不能再抛到代码单元之外
+            if cell.reason is not None:
+                _raise_in_thread(cell.thread_id, None)
+
+    def run(self, function, timeout:float=None, key=None, source:str=None):
+        """
+        在当前线程中运行function()并返回其结果
+        :param timeout: 最长运行时间（秒），None或0表示不限制
+        :param key: 用于取消的标识，默认为当前外部函数调用的id
+        :param source: 代码单元的源代码，用于在超时信息中给出中断时所在的代码行
+        :raise CellTimeout: 运行超时，包含超时时间、中断时所在的行号和该行代码
+        :raise CellCancelled: 被cancel取消
+        """
+        key = key if key is not None else current_tool_call.get()
+        cell_id, cell = self._start(timeout, key)
+        try:
+            try:
+                return function()
+            finally:
+                self._finish(cell_id, cell)
+        except ToolInterrupt as e:
+            # 中断可能恰好在_finish之前生效，再次确认代码单元已结束
+            self._finish(cell_id, cell)
+            if cell.reason == 'timeout':
+                lineno, line = cell_line(e.__traceback__, source)
+                raise CellTimeout(timeout, lineno, line) from None
+            raise
+
+    def cancel(self, key) -> int:
+        """
+        取消标识为key的正在运行的代码单元，返回取消的数量
+        """
+        cancelled = 0
+        with self._condition:
+            for cell_id, cell in self._cells.items():
+                if cell.key == key and cell.reason is None:
+                    cell.reason = 'cancelled'
+                    heapq.heappush(self._deadlines, (time.perf_counter(), cell_id))
+                    cancelled += 1
+            if cancelled:
+                self.metrics['cancelled'] += cancelled
+                self._ensure_thread()
+                self._condition.notify()
+        return cancelled
+
+
+_WATCHDOG = CellWatchdog()
+
+
+def get_watchdog() -> CellWatchdog:
+    """进程内共享的看门狗"""
+    return _WATCHDOG
+
+
+def cell_timeout(g:dict):
+    """变量空间中设置的代码单元最长运行时间（秒），未设置时为None（不限制）"""
+    return g.get(CELL_TIMEOUT_KEY, DEFAULT_CELL_TIMEOUT) if isinstance(g, dict) else DEFAULT_CELL_TIMEOUT
@@ -1,2 +1,5 @@
-from .run_sql import sql_inter, extract_data
-from .run_code import python_inter, fig_inter
\ No newline at end of file
+from .run_sql import sql_inter, extract_data, extract_sample
+from .run_code import python_inter, fig_inter
+from .run_blob import fetch_blob
+from .run_artifact import export_data
+from .run_profile import profile_data
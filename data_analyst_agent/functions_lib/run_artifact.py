@@ -0,0 +1,24 @@
+from ..core.artifact_store import get_artifact_store, SESSION_ID_KEY, QuotaExceededError
+
+
+def export_data(df_name, file_format='csv', g='globals()'):
+    """
+    用于将本地Python环境中的某个DataFrame导出为文件，保存到项目的产物存储中，返回产物id，数据本身不会进入对话。
+    :param df_name: 需要导出的DataFrame变量名，以字符串形式表示
+    :param file_format: 导出的文件格式，csv或parquet，默认为csv
+    :param g: g，字符串形式变量，表示环境变量，无需设置，保持默认参数即可
+    :return：导出结果及产物id
+    """
+    store = get_artifact_store(g)
+    if store is None:
+        return "导出时报错：当前会话未设置项目，无法保存导出的文件"
+    if df_name not in g or not hasattr(g[df_name], 'to_csv'):
+        return f"导出时报错：不存在DataFrame变量{df_name}"
+
+    df = g[df_name]
+    try:
+        artifact_id = store.put_frame(df, file_format=file_format, session=g.get(SESSION_ID_KEY), name=df_name)
+    except (ValueError, QuotaExceededError) as e:
+        return f"导出时报错：{e}"
+    size = store.info(artifact_id)['size']
+    return f"已将{df_name}（{df.shape[0]}行，{df.shape[1]}列）导出为{file_format}文件（{size}字节），产物id为{artifact_id}"
@@ -0,0 +1,28 @@
+from ..core.blob_store import get_blob_store
+
+# fetch_blob单次返回的最大字符数，避免读取结果时再次撑满上下文
+FETCH_MAX_CHARS = 8000
+
+
+def fetch_blob(handle, rows=None, columns=None, start=None, end=None, g='globals()'):
+    """
+    用于读取此前过长的外部函数运行结果中的一部分，完整结果不会直接进入对话，只在对话中保留预览和句柄。
+    SQL查询结果为文本表格（第一行为字段名，字段之间以制表符分隔），按行或列读取时总是附带字段名行。
+    :param handle: 字符串形式的结果句柄，例如blob_1
+    :param rows: 需要读取的行范围，字符串形式，例如"10:20"表示第10行到第19行，SQL查询结果中从0开始计数且不含字段名行
+    :param columns: 需要读取的列，SQL查询结果和JSON数组结果中为字段名或列序号（从0开始）所组成的list
+    :param start: 按字节读取时的起始位置
+    :param end: 按字节读取时的结束位置
+    :param g: g，字符串形式变量，表示环境变量，无需设置，保持默认参数即可
+    :return：结果中对应部分的内容
+    """
+    try:
+        content = get_blob_store(g).slice(handle, rows=rows, columns=columns, start=start, end=end)
+    except KeyError:
+        return f"读取结果时报错：不存在句柄{handle}"
+    except ValueError as e:
+        return f"读取结果时报错：{e}"
+
+    if len(content) > FETCH_MAX_CHARS:
+        content = content[:FETCH_MAX_CHARS] + f"\n...[本次读取内容过长，仅返回前{FETCH_MAX_CHARS}个字符，请缩小读取范围]"
+    return content
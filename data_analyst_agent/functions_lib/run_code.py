@@ -1,3 +1,10 @@
+from ..core.artifact_store import get_artifact_store, SESSION_ID_KEY, QuotaExceededError
+from ..core.watchdog import get_watchdog, cell_timeout, CellTimeout, CELL_FILENAME
+
+
+def _timeout_message(e:CellTimeout) -> str:
+    return f"代码执行时报错CellTimeout：{e}。请改写为向量化的写法（避免Python层面的逐行循环、apply、iterrows等），" \
+           f"或先在数据的子集上运行"
 
 
 def python_inter(py_code, g:dict='globals()'):
@@ -7,10 +14,17 @@ def python_inter(py_code, g:dict='globals()'):
     :param g: g，字符串形式变量，表示环境变量，无需设置，保持默认参数即可
     :return：代码运行的最终结果
     """
+    # 超过最长运行时间时，由看门狗中断代码的运行
+    try:
+        return get_watchdog().run(lambda: _run_python(py_code, g), timeout=cell_timeout(g), source=py_code)
+    except CellTimeout as e:
+        return _timeout_message(e)
 
+
+def _run_python(py_code, g):
     global_vars_before = set(g.keys())
     try:
-        exec(py_code, g)
+        exec(compile(py_code, CELL_FILENAME, 'exec'), g)
     except Exception as e:
         return f"代码执行时报错{e}"
     global_vars_after = set(g.keys())
@@ -23,11 +37,11 @@ def python_inter(py_code, g:dict='globals()'):
     else:
         try:
             # 尝试如果是表达式，则返回表达式运行结果
-            return str(eval(py_code, g))
+            return str(eval(compile(py_code, CELL_FILENAME, 'eval'), g))
         # 若报错，则先测试是否是对相同变量重复赋值
         except Exception as e:
             try:
-                exec(py_code, g)
+                exec(compile(py_code, CELL_FILENAME, 'exec'), g)
                 return "已经顺利执行代码"
             except Exception as e:
                 pass
@@ -48,7 +62,11 @@ def fig_inter(py_code, fname, g='globals()'):
     current_backend = matplotlib.get_backend()
 
     # 设置为Agg后端
-    matplotlib.use('notebook')
+    try:
+        matplotlib.use('notebook')
+    except ImportError:
+        # 不在notebook环境中（命令行、服务模式、基准测试）时使用Agg后端
+        matplotlib.use('Agg')
     import matplotlib.pyplot as plt
     import pandas as pd
     import seaborn as sns
@@ -57,11 +75,24 @@ def fig_inter(py_code, fname, g='globals()'):
     local_vars = {"plt": plt, "pd": pd, "sns": sns}
 
     try:
-        exec(py_code, g, local_vars)
-        return "成功执行完代码。"
+        get_watchdog().run(lambda: exec(compile(py_code, CELL_FILENAME, 'exec'), g, local_vars),
+                           timeout=cell_timeout(g), source=py_code)
+    except CellTimeout as e:
+        return _timeout_message(e)
     except Exception as e:
         return f"代码执行时报错{e}"
 
+    # 设置了项目时，将图片保存到项目的产物存储中，结果中只返回产物id
+    store = get_artifact_store(g)
+    fig = local_vars.get(fname, g.get(fname))
+    if store is None or not hasattr(fig, 'savefig'):
+        return "成功执行完代码。"
+    try:
+        artifact_id = store.put_figure(fig, session=g.get(SESSION_ID_KEY), name=fname)
+    except QuotaExceededError as e:
+        return f"成功执行完代码，但图片未能保存：{e}"
+    return f"成功执行完代码，图片已保存，产物id为{artifact_id}。"
+
     # 回复默认后端
     # matplotlib.use(current_backend)
 
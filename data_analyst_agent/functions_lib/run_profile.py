@@ -0,0 +1,263 @@
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+from ..core.tokens import get_token_counter
+from ..utils.tracing import annotate
+
+# 行数超过该值时，分位数和相关系数基于随机样本计算，数值列的不重复值数量使用HyperLogLog估计
+PROFILE_SAMPLE_ROWS = 1000000
+# HyperLogLog的精度：2^14个寄存器，标准误差约为1.04/sqrt(2^14)≈0.8%
+HLL_PRECISION = 14
+QUANTILES = (0.01, 0.25, 0.5, 0.75, 0.99)
+CORRELATION_THRESHOLD = 0.3
+
+
+def _fmix64(values:np.ndarray) -> np.ndarray:
+    """MurmurHash3的64位finalizer，将数值的位模式打散为均匀分布的64位哈希"""
+    h = values.astype(np.uint64, copy=True)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xff51afd7ed558ccd)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xc4ceb9fe1a85ec53)
+    h ^= h >> np.uint64(33)
+    return h
+
+
+def _hash_values(values) -> np.ndarray:
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'iufmMb':
+        if values.dtype.itemsize == 8:
+            return _fmix64(values.view(np.uint64))
+        return _fmix64(values.astype(np.int64).view(np.uint64))
+    return pd.util.hash_pandas_object(pd.Series(values), index=False).to_numpy()
+
+
+def _bit_length(w:np.ndarray) -> np.ndarray:
+    """
+    64位无符号整数的有效位数（0的有效位数为0）：借助np.frexp读取浮点数的指数位，避免逐位比较；
+    转换为float64时接近2的幂的值可能向上进位，最多使结果大1，对HyperLogLog的估计没有影响
+    """
+    return np.frexp(w.astype(np.float64))[1]
+
+
+def hll_distinct(values, precision=HLL_PRECISION) -> int:
+    """
+    使用HyperLogLog估计不重复值数量（不包括缺失值），内存占用固定为2^precision个寄存器
+    :param values: ndarray或ExtensionArray
+    """
+    hashes = _hash_values(values)
+    m = 1 << precision
+    index = (hashes >> np.uint64(64 - precision)).astype(np.intp)
+    # 剩余64-precision位中第一个1出现的位置
+    rest = hashes & np.uint64((1 << (64 - precision)) - 1)
+    rank = np.minimum(64 - precision - _bit_length(rest), 64 - precision) + 1
+    # 每个寄存器取rank的最大值：np.maximum.at逐元素执行较慢，改为用bincount统计(寄存器, rank)组合是否出现
+    width = 64 - precision + 2
+    seen = np.bincount(index * width + rank, minlength=m * width).reshape(m, width) > 0
+    registers = (seen * np.arange(width)).max(axis=1)
+
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.exp2(-registers.astype(np.float64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    # 基数较小时使用线性计数修正
+    if estimate <= 2.5 * m and zeros > 0:
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+
+def _fmt(value) -> str:
+    """紧凑的数值格式：保留4位有效数字"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NaN'
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return str(pd.Timestamp(value))
+    if isinstance(value, (float, np.floating)):
+        if value != 0 and (abs(value) >= 1e6 or abs(value) < 1e-3):
+            return f"{value:.3e}"
+        return f"{value:.4g}"
+    return str(value)
+
+
+def _column_kind(series:pd.Series) -> str:
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'category'
+    if pd.api.types.is_numeric_dtype(dtype):
+        return 'numeric'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'datetime'
+    return 'category'
+
+
+def profile_frame(df:pd.DataFrame, sample_rows=PROFILE_SAMPLE_ROWS, top_k=5, seed=0) -> dict:
+    """
+    计算数据概况：各列的缺失率、不重复值数量、数值列的最小值、最大值、均值、标准差和分位数、
+    其他列的高频取值，以及数值列之间的相关系数。
+    缺失率、最小值、最大值、均值、标准差和高频取值基于全部数据；行数超过sample_rows时，
+    分位数和相关系数基于sample_rows行随机样本，数值和日期时间列的不重复值数量为HyperLogLog估计值。
+    :return: 字典形式的数据概况
+    """
+    start = time.perf_counter()
+    n = len(df)
+    sampled = n > sample_rows
+    if sampled:
+        rng = np.random.default_rng(seed)
+        sample = df.iloc[np.sort(rng.integers(0, n, sample_rows))]
+    else:
+        sample = df
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        series = df.iloc[:, i]
+        sample_series = sample.iloc[:, i]
+        kind = _column_kind(series)
+        if kind == 'datetime' and getattr(series.dtype, 'tz', None) is not None:
+            # 带时区的日期时间统一转换为UTC
+            series, sample_series = series.dt.tz_convert(None), sample_series.dt.tz_convert(None)
+        info = {'name': str(name), 'dtype': str(series.dtype), 'kind': kind}
+        if kind == 'category':
+            # 字符串等列只做一次factorize：缺失值、精确的不重复值数量和高频取值都基于全部数据，由编码直接得到
+            try:
+                codes, uniques = pd.factorize(series.array)
+            except TypeError:
+                # 列表、字典等不可哈希的取值转换为字符串后再编码
+                codes, uniques = pd.factorize(series.astype(str).where(series.notna()).array)
+            valid = codes[codes >= 0]
+            nulls = n - len(valid)
+            counts = np.bincount(valid, minlength=len(uniques))
+            order = np.argsort(-counts, kind='stable')[:top_k]
+            info['null_rate'] = nulls / n if n else 0.0
+            info['distinct'] = len(uniques)
+            info['top'] = [(str(uniques[j]), counts[j] / n) for j in order]
+            columns.append(info)
+            continue
+
+        if isinstance(series.dtype, np.dtype):
+            values = series.to_numpy()
+        else:
+            # 可空整数等扩展类型转换为浮点数，缺失值为NaN
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        null_mask = pd.isna(values)
+        nulls = int(null_mask.sum())
+        info['null_rate'] = nulls / n if n else 0.0
+        non_null = values[~null_mask] if nulls else values
+        if sampled:
+            info['distinct'] = hll_distinct(non_null) if len(non_null) else 0
+        else:
+            info['distinct'] = len(pd.unique(non_null))
+
+        if len(non_null):
+            sample_data = sample_series.dropna()
+            sample_data = sample_data.to_numpy() if kind == 'datetime' else sample_data.to_numpy(dtype=np.float64)
+            if kind == 'datetime':
+                info['min'], info['max'] = pd.Timestamp(non_null.min()), pd.Timestamp(non_null.max())
+                quantiles = np.quantile(sample_data.astype('datetime64[ns]').view(np.int64), QUANTILES) \
+                    if len(sample_data) else []
+                info['quantiles'] = [pd.Timestamp(int(q)) for q in quantiles]
+            else:
+                data = non_null.astype(np.float64, copy=False)
+                info['min'], info['max'] = float(data.min()), float(data.max())
+                info['mean'], info['std'] = float(data.mean()), float(data.std())
+                info['quantiles'] = [float(q) for q in np.quantile(sample_data, QUANTILES)] \
+                    if len(sample_data) else []
+        columns.append(info)
+
+    correlations = []
+    numeric = [i for i, c in enumerate(columns) if c['kind'] == 'numeric' and c['distinct'] > 1]
+    if len(numeric) > 1:
+        matrix = sample.iloc[:, numeric].astype(np.float64).corr().to_numpy()
+        for a in range(len(numeric)):
+            for b in range(a + 1, len(numeric)):
+                r = matrix[a, b]
+                if not np.isnan(r):
+                    correlations.append((columns[numeric[a]]['name'], columns[numeric[b]]['name'], float(r)))
+        correlations.sort(key=lambda item: abs(item[2]), reverse=True)
+
+    return {
+        'rows': n,
+        'columns': columns,
+        'correlations': correlations,
+        'sampled': sampled,
+        'sample_rows': len(sample),
+        'memory': int(df.memory_usage(deep=False).sum()),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def _column_line(info, level) -> str:
+    parts = [info['name'], info['dtype'], f"缺失{info['null_rate']:.1%}", f"不重复{info['distinct']}"]
+    if level < 2:
+        if 'quantiles' in info and info['quantiles']:
+            q = info['quantiles']
+            if level == 0:
+                stats = f"min {_fmt(info['min'])}, p1 {_fmt(q[0])}, p25 {_fmt(q[1])}, p50 {_fmt(q[2])}, " \
+                        f"p75 {_fmt(q[3])}, p99 {_fmt(q[4])}, max {_fmt(info['max'])}"
+            else:
+                stats = f"min {_fmt(info['min'])}, p50 {_fmt(q[2])}, max {_fmt(info['max'])}"
+            if 'mean' in info:
+                stats += f", mean {_fmt(info['mean'])}"
+                if level == 0:
+                    stats += f", std {_fmt(info['std'])}"
+            parts.append(stats)
+        elif info.get('top'):
+            top = info['top'] if level == 0 else info['top'][:3]
+            parts.append(', '.join(f"{value[:30]} {share:.1%}" for value, share in top))
+    return ' | '.join(parts)
+
+
+def render_profile(profile:dict, name:str='df', max_tokens:int=1500) -> str:
+    """
+    将数据概况渲染为紧凑的文本：从最详细的格式开始尝试，超出token预算时依次减少相关系数、分位数和高频取值，
+    仍然超出时省略末尾的列
+    """
+    counter = get_token_counter()
+    memory = profile['memory']
+    header = f"数据集{name}：{profile['rows']}行，{len(profile['columns'])}列，内存约{memory / 1024 ** 2:.1f} MB"
+    if profile['sampled']:
+        header += f"（分位数和相关系数基于{profile['sample_rows']}行随机样本，数值列的不重复值数量为HyperLogLog估计值）"
+    header += "\n列名 | 类型 | 缺失率 | 不重复值 | 统计"
+
+    strong = [c for c in profile['correlations'] if abs(c[2]) >= CORRELATION_THRESHOLD]
+    text = ''
+    for level, max_pairs in ((0, 10), (1, 5), (2, 0)):
+        lines = [header] + [_column_line(info, level) for info in profile['columns']]
+        if strong and max_pairs:
+            pairs = ', '.join(f"{a}~{b} {r:.2f}" for a, b, r in strong[:max_pairs])
+            lines.append(f"强相关字段（|r|≥{CORRELATION_THRESHOLD}）：{pairs}")
+        text = '\n'.join(lines)
+        if counter.count_text(text) <= max_tokens:
+            return text
+
+    # 最简格式仍然超出预算时，省略末尾的列
+    lines = text.split('\n')
+    while len(lines) > 2 and counter.count_text('\n'.join(lines)) > max_tokens:
+        lines.pop()
+    omitted = len(profile['columns']) - (len(lines) - 2)
+    return '\n'.join(lines) + f"\n...其余{omitted}列已省略，可通过columns参数指定需要分析的列"
+
+
+def profile_data(df_name, columns=None, max_tokens=1500, g='globals()'):
+    """
+    用于快速了解本地Python环境中某个DataFrame的数据概况：各列的缺失率、不重复值数量、数值列的分位数、均值和标准差、
+    其他列的高频取值，以及数值列之间的强相关关系。检查缺失值、分布和取值情况时应优先使用本函数，而不是编写python代码。
+    :param df_name: 需要分析的DataFrame变量名，以字符串形式表示，通常是extract_data创建的变量
+    :param columns: 需要分析的列名，多个列名用逗号分隔，默认为全部列
+    :param max_tokens: 返回的数据概况的最大token数量，默认为1500
+    :param g: g，字符串形式变量，表示环境变量，无需设置，保持默认参数即可
+    :return：文本形式的数据概况
+    """
+    if df_name not in g or not isinstance(g[df_name], pd.DataFrame):
+        return f"分析时报错：不存在DataFrame变量{df_name}，请先使用extract_data提取数据"
+    df = g[df_name]
+    if columns:
+        names = [c.strip() for c in columns.split(',')] if isinstance(columns, str) else list(columns)
+        missing = [c for c in names if c not in df.columns]
+        if missing:
+            return f"分析时报错：{df_name}中不存在字段{missing}"
+        df = df[names]
+
+    profile = profile_frame(df)
+    annotate(rows=profile['rows'], columns=len(profile['columns']), sampled=profile['sampled'])
+    return render_profile(profile, name=df_name, max_tokens=int(max_tokens))
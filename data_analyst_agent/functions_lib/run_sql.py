@@ -1,7 +1,16 @@
-import json
+import queue
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
 import pymysql
 import pandas as pd
 
+from ..utils.tracing import annotate
+from ..utils.sampling import SAMPLING_ATTR, MIN_STRATUM_ROWS
+from ..utils.serialization import encode_results
+
 
 SQL_CONFIG = {
     'host': 'localhost',
@@ -11,6 +20,134 @@ SQL_CONFIG = {
     'charset': 'utf8'  # 字符集选择utf8
 }
 
+# sql_inter返回结果的数值精度：浮点数的有效数字位数、DECIMAL字段的小数位数（None表示原样输出）以及二进制值最多输出的字节数
+RESULT_FORMAT = {
+    'float_digits': 10,
+    'decimal_places': None,
+    'max_bytes': 32
+}
+
+
+def get_connection():
+    """根据SQL_CONFIG创建数据库连接"""
+    return pymysql.connect(**SQL_CONFIG)
+
+
+class ConnectionPool:
+    """
+    数据库连接池：多个并发会话共享固定数量的连接，连接用完后归还而不是关闭。
+    """
+    def __init__(self, factory=None, size=4, timeout=30.0):
+        """
+        :param factory: 创建连接的函数，默认为get_connection
+        :param size: 最大连接数
+        :param timeout: 等待空闲连接的最长时间（秒），默认为30秒，None表示一直等待
+        """
+        self.factory = factory if factory is not None else get_connection
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self.factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("等待数据库连接超时")
+
+    def release(self, connection, broken=False):
+        """归还连接，出错的连接直接关闭"""
+        if broken:
+            try:
+                connection.close()
+            finally:
+                with self._lock:
+                    self._created -= 1
+            return
+        self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            # 包括看门狗的中断和KeyboardInterrupt：连接上可能还有未读完的结果，不能再归还
+            self.release(connection, broken=True)
+            raise
+        # 结束连接上的事务，与单独创建连接后直接关闭的行为一致，也避免下次使用时读到旧的快照
+        try:
+            connection.rollback()
+        except Exception:
+            self.release(connection, broken=True)
+        else:
+            self.release(connection)
+
+    def close(self):
+        """关闭全部空闲连接"""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+            with self._lock:
+                self._created -= 1
+
+
+# 并发会话共享的连接池，为None时每次调用单独创建连接
+_connection_pool = None
+
+
+def set_connection_pool(pool):
+    """设置共享的连接池，传入None时恢复为每次调用单独创建连接"""
+    global _connection_pool
+    _connection_pool = pool
+
+
+# 聚合查询的汇总表物化（RollupMaterializer），为None时sql_inter直接查询数据库
+_rollup_materializer = None
+
+
+def set_rollup_materializer(materializer):
+    """设置sql_inter使用的汇总表物化，传入None时关闭"""
+    global _rollup_materializer
+    _rollup_materializer = materializer
+
+
+@contextmanager
+def db_connection():
+    """获取数据库连接：存在共享连接池时从连接池中获取，否则单独创建，用完后关闭"""
+    pool = _connection_pool
+    if pool is not None:
+        with pool.connection() as connection:
+            yield connection
+        return
+    connection = get_connection()
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
 def extract_data(sql_query,df_name,g='globals()'):
     """
     借助pymysql将MySQL中的某张表读取并保存到本地Python环境中。
@@ -26,13 +163,105 @@ def extract_data(sql_query,df_name,g='globals()'):
     #         db='telco_db',  # 数据库名
     #         charset='utf8'  # 字符集选择utf8
     #     )
-    connection = pymysql.connect(**SQL_CONFIG)
+    with db_connection() as connection:
+        g[df_name] = pd.read_sql(sql_query, connection)
+    annotate(rows=len(g[df_name]), columns=len(g[df_name].columns))
 
-    g[df_name] = pd.read_sql(sql_query, connection)
+    return "已成功完成%s变量创建" % df_name
 
-    connection.close()
+def _random_expression(connection, seed=None) -> str:
+    """在数据库端为每行生成[0, 1)均匀分布随机数的表达式：MySQL使用RAND(seed)，SQLite的RANDOM()不支持种子"""
+    if isinstance(connection, sqlite3.Connection):
+        return "((RANDOM() & 1073741823) / 1073741824.0)"
+    return "RAND(%d)" % int(seed) if seed is not None else "RAND()"
 
-    return "已成功完成%s变量创建" % df_name
+
+def _sql_literal(connection, value) -> str:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    escape = getattr(connection, 'escape', None)
+    if escape is not None:
+        return escape(value)
+    return "'%s'" % str(value).replace("'", "''")
+
+
+def _query_rows(connection, sql):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def extract_sample(sql_query, df_name, fraction:float=None, size:int=None, strata:str=None, seed:int=None,
+                   g='globals()'):
+    """
+    借助数据库端的随机抽样，从MySQL的查询结果中抽取一部分行保存到本地Python环境中，用于对大表进行探索性分析。\
+    只需要近似结果（例如流失率、均值精确到小数点后两位）时应优先使用本函数，而不是extract_data提取全表。\
+    基于样本计算的统计量是近似值，需要置信区间时在python_inter中使用estimate_mean、estimate_proportion和estimate_total。
+    :param sql_query: 字符串形式的SQL查询语句，抽样在该查询的结果上进行
+    :param df_name: 将抽样结果进行本地保存时的变量名，以字符串形式表示
+    :param fraction: 抽样比例，例如0.01，与size二选一
+    :param size: 期望的样本行数，例如20000，与fraction二选一，均未设置时默认为20000
+    :param strata: 可选参数，分层字段名（例如Contract），按该字段分层抽样，每层按比例抽取且至少抽取30行
+    :param seed: 可选参数，随机数种子
+    :param g: g，字符串形式变量，表示环境变量，无需设置，保持默认参数即可
+    :return：抽样结果的说明
+    """
+    if fraction is None and size is None:
+        size = 20000
+    with db_connection() as connection:
+        source = "(%s) AS _source" % sql_query.strip().rstrip(';')
+        if strata:
+            counts = _query_rows(connection, "SELECT %s, COUNT(*) FROM %s GROUP BY %s" % (strata, source, strata))
+        else:
+            counts = _query_rows(connection, "SELECT COUNT(*) FROM %s" % source)
+            counts = [(None, counts[0][0])]
+        population = sum(count for _, count in counts)
+        if fraction is None:
+            fraction = size / population if population else 1.0
+        fraction = min(max(float(fraction), 0.0), 1.0)
+
+        # 各层的抽样比例：按比例分配，行数较少的层至少抽取MIN_STRATUM_ROWS行
+        rates = [min(1.0, max(fraction * count, min(MIN_STRATUM_ROWS, count) if strata else 0) / count)
+                 if count else 0.0 for _, count in counts]
+        random = _random_expression(connection, seed)
+        if strata:
+            cases = ' '.join(
+                "WHEN %s IS NULL THEN %r" % (strata, rate) if value is None else
+                "WHEN %s = %s THEN %r" % (strata, _sql_literal(connection, value), rate)
+                for (value, _), rate in zip(counts, rates)
+            )
+            predicate = "%s < CASE %s ELSE 0 END" % (random, cases)
+        else:
+            predicate = "%s < %r" % (random, rates[0])
+        df = pd.read_sql("SELECT * FROM %s WHERE %s" % (source, predicate), connection)
+
+    if strata:
+        sample_counts = df[strata].value_counts(dropna=False)
+        layers = [[value, int(count), int(sample_counts.get(value, 0) if value is not None
+                                           else df[strata].isna().sum())] for value, count in counts]
+    else:
+        layers = [[None, int(population), len(df)]]
+    df.attrs[SAMPLING_ATTR] = {
+        'method': 'stratified' if strata else 'bernoulli',
+        'query': sql_query,
+        'population': int(population),
+        'sample_rows': len(df),
+        'fraction': fraction,
+        'seed': seed,
+        'strata': strata or None,
+        'layers': layers,
+    }
+    g[df_name] = df
+    annotate(rows=len(df), columns=len(df.columns), population=int(population))
+
+    design = f"按{strata}分层" if strata else ""
+    return (f"已成功完成{df_name}变量创建：从{population}行查询结果中{design}随机抽取了{len(df)}行（抽样比例约{fraction:.2%}），"
+            f"抽样设计记录在{df_name}.attrs['{SAMPLING_ATTR}']中。基于该变量计算的统计量是近似值，回答时需要说明结果为抽样估计；"
+            f"需要置信区间时可使用from data_analyst_agent.utils.sampling import estimate_mean, estimate_proportion, "
+            f"estimate_total，例如estimate_proportion({df_name}, 'Churn', 'Yes', by='Contract')")
 
 def sql_inter(sql_query, **kargs):
     """
@@ -40,23 +269,39 @@ def sql_inter(sql_query, **kargs):
     核心功能是将输入的SQL代码传输至MySQL环境中进行运行，\
     并最终返回SQL代码运行结果。需要注意的是，本函数是借助pymysql来连接MySQL数据库。
     :param sql_query: 字符串形式的SQL查询语句，用于执行对MySQL中telco_db数据库中各张表进行查询，并获得各表中的各类相关信息
-    :return：sql_query在MySQL中的运行结果。
+    :return：sql_query在MySQL中的运行结果，第一行为字段名，之后每行一条记录，字段之间以制表符分隔，NULL写作\\N。
     """
-    connection = pymysql.connect(**SQL_CONFIG)
-
-    try:
-        with connection.cursor() as cursor:
+    materializer = _rollup_materializer
+    if materializer is not None:
+        # 可以由汇总表回答的聚合查询不再扫描源数据表
+        answer = materializer.answer(sql_query)
+        if answer is not None:
+            columns, results = answer
+            encoded = encode_results(columns, results, **RESULT_FORMAT)
+            annotate(rows=len(results), bytes=len(encoded), rollup=True)
+            return encoded
+    start = time.perf_counter()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
             # SQL查询语句
             sql = sql_query
             cursor.execute(sql)
 
             # 获取查询结果
             results = cursor.fetchall()
+            description = cursor.description
+            row_count = cursor.rowcount
+        finally:
+            cursor.close()
+    if materializer is not None:
+        materializer.record(sql_query, time.perf_counter() - start)
 
-    finally:
-        connection.close()
-
-
-    return json.dumps(results)
+    if description is None:
+        # 没有结果集的语句（SET、CREATE等）
+        return f"SQL语句执行成功，影响{max(row_count, 0)}行"
+    encoded = encode_results([column[0] for column in description], results, **RESULT_FORMAT)
+    annotate(rows=len(results), bytes=len(encoded))
+    return encoded
 
 
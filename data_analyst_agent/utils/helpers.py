@@ -2,32 +2,71 @@ import json
 
 from ..core.messages import ChatMessages, MessageDict
 from ..core.functions import AvailableFunctions
+from ..core.blob_store import get_blob_store, TABULAR_FUNCTIONS
+from ..core.artifact_store import current_tool_call
+from ..core.validation import get_validator
+from .tracing import span
+
+
+def default_namespace() -> dict:
+    """外部函数默认使用的变量空间，即本模块的全局变量"""
+    return globals()
 
 
 def function_to_call(available_functions:AvailableFunctions,
-                     function_call_message) -> MessageDict:
+                     function_call_message,
+                     namespace:dict=None) -> MessageDict:
     """
     根据一条函数调用消息function_call_message，返回一条函数运行结果消息function_response_messages。
     :param available_functions: 必要参数，要求输入一个AvailableFunctions对象，以说明当前外部函数基本情况
     :param function_call_message: 必要参数，要求输入一条外部函数调用的message
+    :param namespace: 可选参数，外部函数运行时使用的变量空间，默认为本模块的全局变量
     :return: function_response_messages，输出又外部函数运行结果所组成的message
     """
+    if namespace is None:
+        namespace = globals()
     function_name = function_call_message.tool_calls[0].function.name
     fuction_to_call = available_functions.functions_dic[function_name]
     function_args = json.loads(function_call_message.tool_calls[0].function.arguments)
 
-    # 将参数带入到外部函数中并运行
-    try:
-        # 将当前操作空间中的全局变量添加到外部函数中
-        function_args['g']=globals()
-
-        # 运行外部函数
-        function_response = fuction_to_call(**function_args)
-
-    # 若外部函数运行报错，则提取报错信息
-    except Exception as e:
-        function_response = "函数运行报错如下:" + str(e)
-        #print(function_response)
+    with span(function_name, 'tool', arguments_bytes=len(function_call_message.tool_calls[0].function.arguments)) \
+            as tool_span:
+        # 运行前先进行静态检查，未通过时直接返回报错信息，不执行代码、不访问数据库
+        with span('validate', 'validation'):
+            validation_error = get_validator(namespace).validate(function_name, function_args, namespace)
+
+        # 将参数带入到外部函数中并运行
+        try:
+            if validation_error is not None:
+                tool_span.set(rejected=True)
+                raise ValueError(validation_error)
+
+            # 将当前操作空间中的全局变量添加到外部函数中
+            function_args['g']=namespace
+
+            # 运行外部函数，期间产生的产物记录当前的外部函数调用id
+            token = current_tool_call.set(function_call_message.tool_calls[0].id)
+            try:
+                function_response = fuction_to_call(**function_args)
+            finally:
+                current_tool_call.reset(token)
+            tabular = function_name in TABULAR_FUNCTIONS and isinstance(function_response, str)
+
+        # 若外部函数运行报错，则提取报错信息
+        except Exception as e:
+            function_response = "函数运行报错如下:" + str(e)
+            tabular = False
+            tool_span.set(error=str(e)[:200])
+            #print(function_response)
+
+        # 过长的运行结果保存到结果存储中，上下文中只保留预览和句柄（fetch_blob自身的结果不再转存）
+        if not isinstance(function_response, str):
+            function_response = str(function_response)
+        result_chars = len(function_response)
+        if function_name != 'fetch_blob':
+            function_response = get_blob_store(namespace).offload(function_response, tabular)
+        tool_span.set(result_chars=result_chars, context_chars=len(function_response),
+                      failed="报错" in function_response)
 
     # 创建function_response_messages
     # 该message包含外部函数顺利运行或报错信息
@@ -73,7 +112,7 @@ def add_task_decomposition_prompt(messages:ChatMessages) -> ChatMessages:
     若无需拆分执行步骤，请直接回答原始问题。" % user_question3
     assistant_message3_content = '为了检查user_payments数据集是否存在缺失值，我们将执行如下步骤：\
     \n\n步骤1：使用`extract_data`函数将user_payments数据表读取到当前的Python环境中。\
-    \n\n步骤2：使用`python_inter`函数执行Python代码检查数据集的缺失值。'
+    \n\n步骤2：使用`profile_data`函数查看数据集各字段的缺失率，无需编写Python代码。'
 
     # 第四个提示示例
     user_question4 =  '我想寻找合适的缺失值填补方法，来填补user_payments数据集中的缺失值。'
@@ -127,24 +166,25 @@ def modify_prompt(
     md_prompt = "\n任何回答都请以markdown格式进行输出。"
 
     last_content = messages.history_messages[-1]["content"]
+    new_content = last_content
     # 如果是添加提示词
     if action == 'add':
         if enable_COT and cot_prompt not in last_content:
-            # messages.messages[-1]["content"] += cot_prompt
-            messages.history_messages[-1]["content"] += cot_prompt
+            new_content += cot_prompt
 
         if enable_md_output and md_prompt not in last_content:
-            # messages.messages[-1]["content"] += md_prompt
-            messages.history_messages[-1]["content"] += md_prompt
+            new_content += md_prompt
 
     # 如果是将指定提示词删除
     elif action == 'remove':
         if enable_md_output:
-            # messages.messages[-1]["content"] = messages.messages[-1]["content"].replace(md_prompt, "")
-            messages.history_messages[-1]["content"] = messages.history_messages[-1]["content"].replace(md_prompt, "")
+            new_content = new_content.replace(md_prompt, "")
 
         if enable_COT:
-            # messages.messages[-1]["content"] = messages.messages[-1]["content"].replace(cot_prompt, "")
-            messages.history_messages[-1]["content"] = messages.history_messages[-1]["content"].replace(cot_prompt, "")
+            new_content = new_content.replace(cot_prompt, "")
+
+    # 通过update_content写时复制，避免修改与其他ChatMessages对象共享的消息
+    if new_content != last_content:
+        messages.update_content(-1, new_content)
 
     return messages
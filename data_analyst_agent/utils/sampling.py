@@ -0,0 +1,133 @@
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+# 抽样设计保存在DataFrame.attrs中的键
+SAMPLING_ATTR = 'sampling'
+# 分层抽样时每层至少抽取的行数（该层行数不足时全部抽取），保证小的层也能得到估计值
+MIN_STRATUM_ROWS = 30
+
+
+def sampling_design(df:pd.DataFrame):
+    """
+    读取DataFrame上记录的抽样设计，不是抽样数据时返回None。抽样设计为字典：
+    method（bernoulli或stratified）、query、population（总体行数）、sample_rows、fraction、seed、
+    strata（分层字段，简单随机抽样时为None）以及layers（各层的[取值, 总体行数, 样本行数]）
+    """
+    design = df.attrs.get(SAMPLING_ATTR)
+    return design if isinstance(design, dict) else None
+
+
+def is_approximate(df:pd.DataFrame) -> bool:
+    return sampling_design(df) is not None
+
+
+def _layer_codes(df, design):
+    """
+    每行所属的层（layers中的序号）以及各层的总体行数和样本行数。
+    样本行数使用抽样时记录的值，因此对抽样结果筛选行之后，被筛掉的行在方差估计中按0计入，估计仍然无偏
+    """
+    if design is None:
+        return np.zeros(len(df), dtype=np.intp), np.array([len(df)], dtype=np.float64), \
+            np.array([len(df)], dtype=np.float64)
+    layers = design['layers']
+    population = np.array([layer[1] for layer in layers], dtype=np.float64)
+    sample_rows = np.array([layer[2] for layer in layers], dtype=np.float64)
+    if design.get('strata') is None:
+        return np.zeros(len(df), dtype=np.intp), population, sample_rows
+    if design['strata'] not in df.columns:
+        raise ValueError(f"分层抽样的数据中缺少分层字段{design['strata']}，无法计算置信区间")
+    codes = pd.Index([layer[0] for layer in layers]).get_indexer(df[design['strata']])
+    if (codes < 0).any():
+        raise ValueError(f"分层字段{design['strata']}中存在抽样时没有出现的取值")
+    return codes, population, sample_rows
+
+
+def _total_variance(u, codes, population, sample_rows):
+    """
+    分层简单随机抽样下总量估计的方差：Σ N_h²(1 - n_h/N_h)s_h²/n_h，
+    s_h²为u在第h层n_h个样本上的方差（不在当前DataFrame中的样本行按0计入）
+    """
+    k = len(population)
+    sums = np.bincount(codes, weights=u, minlength=k)
+    squares = np.bincount(codes, weights=u * u, minlength=k)
+    n = np.maximum(sample_rows, 1)
+    s2 = np.where(sample_rows > 1, (squares - sums ** 2 / n) / np.maximum(sample_rows - 1, 1), 0.0)
+    fpc = np.where(population > 0, 1 - sample_rows / np.maximum(population, 1), 0.0)
+    return float(np.sum(population ** 2 * np.clip(fpc, 0, 1) * np.maximum(s2, 0) / n))
+
+
+def _interval(estimate, variance, rows, confidence):
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    stderr = float(np.sqrt(variance))
+    return {'estimate': estimate, 'stderr': stderr, 'ci_low': estimate - z * stderr,
+            'ci_high': estimate + z * stderr, 'sample_rows': int(rows)}
+
+
+def _estimate(df, values, statistic, by, confidence):
+    codes, population, sample_rows = _layer_codes(df, sampling_design(df))
+    weights = (population / np.maximum(sample_rows, 1))[codes]
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0.0)
+
+    def estimate(domain):
+        domain = domain & valid
+        count = float(np.sum(weights * domain))
+        total = float(np.sum(weights * domain * values))
+        if statistic == 'total':
+            u = domain * values
+            result = total
+        elif statistic == 'count':
+            u = domain.astype(np.float64)
+            result = count
+        else:
+            # 均值为比率估计量Σwy/Σw，方差使用线性化方法
+            result = total / count if count else float('nan')
+            u = domain * (values - result) / count if count else np.zeros(len(values))
+        return _interval(result, _total_variance(u, codes, population, sample_rows), domain.sum(), confidence)
+
+    if by is None:
+        return pd.Series(estimate(np.ones(len(df), dtype=bool)))
+    keys = df[by]
+    groups = keys.dropna().unique()
+    try:
+        groups = sorted(groups)
+    except TypeError:
+        pass
+    rows = {group: estimate((keys == group).to_numpy()) for group in groups}
+    return pd.DataFrame.from_dict(rows, orient='index').rename_axis(by)
+
+
+def estimate_mean(df:pd.DataFrame, column, by=None, confidence=0.95):
+    """
+    根据抽样数据估计某列的均值及置信区间（分层抽样时按各层的总体行数加权），缺失值不参与计算。
+    对抽样结果筛选行之后仍然可以使用（按子总体估计），不是抽样数据时标准误为0。
+    :param df: extract_sample提取的DataFrame
+    :param column: 数值字段名
+    :param by: 可选参数，分组字段名，按组分别估计
+    :param confidence: 置信水平，默认为0.95
+    :return: by为None时返回Series（estimate、stderr、ci_low、ci_high、sample_rows），否则返回每组一行的DataFrame
+    """
+    return _estimate(df, df[column].to_numpy(dtype=np.float64, na_value=np.nan), 'mean', by, confidence)
+
+
+def estimate_proportion(df:pd.DataFrame, column, value=True, by=None, confidence=0.95):
+    """
+    根据抽样数据估计某列取值为value的比例及置信区间，例如estimate_proportion(df, 'Churn', 'Yes')
+    :param value: 需要统计比例的取值，默认为True
+    :return: 与estimate_mean相同
+    """
+    series = df[column]
+    indicator = (series == value).astype(np.float64).where(series.notna())
+    return _estimate(df, indicator.to_numpy(dtype=np.float64, na_value=np.nan), 'mean', by, confidence)
+
+
+def estimate_total(df:pd.DataFrame, column=None, by=None, confidence=0.95):
+    """
+    根据抽样数据估计总体中某列的合计值及置信区间，column为None时估计总体行数
+    :return: 与estimate_mean相同
+    """
+    if column is None:
+        return _estimate(df, np.ones(len(df)), 'count', by, confidence)
+    return _estimate(df, df[column].to_numpy(dtype=np.float64, na_value=np.nan), 'total', by, confidence)
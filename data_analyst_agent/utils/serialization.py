@@ -0,0 +1,173 @@
+import re
+import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+import numpy as np
+
+# 查询结果的文本格式：第一行为字段名，之后每行一条记录，字段之间以制表符分隔，
+# NULL写作\N，字段值中的反斜杠、制表符和换行符转义（与MySQL导出的文本文件一致）
+DELIMITER = '\t'
+NULL = '\\N'
+
+_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+_UNESCAPES = {v[1]: k for k, v in _ESCAPES.items()}
+_ESCAPE_RE = re.compile(r'[\\\t\n\r]')
+_UNESCAPE_RE = re.compile(r'\\(.)')
+_INT_RE = re.compile(r'-?(0|[1-9]\d*)$')
+_FLOAT_RE = re.compile(r'-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$|-?inf$|nan$')
+
+
+def _escape(text:str) -> str:
+    return _ESCAPE_RE.sub(lambda m: _ESCAPES[m.group()], text)
+
+
+def _format_timedelta(value:datetime.timedelta) -> str:
+    """MySQL的TIME字段（pymysql返回timedelta）：[-]HH:MM:SS[.ffffff]，小时数可以超过24"""
+    micros = (value.days * 86400 + value.seconds) * 1000000 + value.microseconds
+    sign = '-' if micros < 0 else ''
+    seconds, micros = divmod(abs(micros), 1000000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    text = f"{sign}{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return f"{text}.{micros:06d}" if micros else text
+
+
+def _format_bytes(value, max_bytes:int) -> str:
+    """二进制值：可以按UTF-8解码的可打印文本原样输出，其余输出为十六进制，超过max_bytes的部分省略"""
+    value = bytes(value)
+    try:
+        text = value.decode('utf-8')
+    except UnicodeDecodeError:
+        text = None
+    if text is not None and text.isprintable():
+        return _escape(text)
+    if max_bytes is not None and len(value) > max_bytes:
+        return f"0x{value[:max_bytes].hex()}...({len(value)} bytes)"
+    return '0x' + value.hex()
+
+
+def _format_decimal(value:Decimal, decimal_places:int) -> str:
+    if decimal_places is not None and value.is_finite():
+        try:
+            value = value.quantize(Decimal(1).scaleb(-decimal_places), rounding=ROUND_HALF_UP)
+        except InvalidOperation:
+            pass
+    # 使用定点格式，避免str(Decimal)在部分取值上输出科学计数法
+    return format(value, 'f')
+
+
+def format_value(value, float_digits:int=None, decimal_places:int=None, max_bytes:int=32) -> str:
+    """
+    将数据库返回的单个值转换为文本，支持MySQL常见的全部类型
+    :param float_digits: 浮点数保留的有效数字位数，None表示使用能还原该浮点数的最短表示
+    :param decimal_places: DECIMAL字段保留的小数位数（四舍五入），None表示原样输出
+    :param max_bytes: 二进制值最多输出的字节数
+    """
+    if value is None:
+        return NULL
+    if isinstance(value, str):
+        return _escape(value)
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value) if float_digits is None else format(value, f'.{float_digits}g')
+    if isinstance(value, Decimal):
+        return _format_decimal(value, decimal_places)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return _format_timedelta(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return _format_bytes(value, max_bytes)
+    if isinstance(value, (set, frozenset)):
+        # MySQL的SET字段
+        return _escape(','.join(sorted(map(str, value))))
+    if isinstance(value, np.generic):
+        return format_value(value.item(), float_digits, decimal_places, max_bytes)
+    return _escape(str(value))
+
+
+def _decimal_text(value:Decimal) -> str:
+    text = str(value)
+    return format(value, 'f') if 'E' in text else text
+
+
+def _column_formatter(kind, float_digits, decimal_places):
+    """整列（除NULL外）为同一种类型时使用的转换函数，没有对应的批量转换时返回None"""
+    if kind is int:
+        return str
+    if kind is float:
+        return repr if float_digits is None else f'{{:.{float_digits}g}}'.format
+    if kind is Decimal:
+        return _decimal_text if decimal_places is None else lambda value: _format_decimal(value, decimal_places)
+    if kind in (datetime.datetime, datetime.date, datetime.time):
+        # str与isoformat(sep=' ')的结果一致
+        return str
+    if kind is datetime.timedelta:
+        return _format_timedelta
+    return None
+
+
+def _format_column(values:tuple, float_digits, decimal_places, max_bytes) -> list:
+    """
+    按列转换：整列（除NULL外）为同一种常见类型时批量转换，避免逐个值判断类型
+    """
+    types = set(map(type, values))
+    if types == {str}:
+        if _ESCAPE_RE.search(''.join(values)) is None:
+            return list(values)
+        return [_escape(value) for value in values]
+    has_null = type(None) in types
+    kinds = types - {type(None)}
+    formatter = _column_formatter(next(iter(kinds)), float_digits, decimal_places) if len(kinds) == 1 else None
+    if formatter is None:
+        return [format_value(value, float_digits, decimal_places, max_bytes) for value in values]
+    if has_null:
+        return [NULL if value is None else formatter(value) for value in values]
+    return list(map(formatter, values))
+
+
+def encode_results(columns, rows, float_digits:int=10, decimal_places:int=None, max_bytes:int=32) -> str:
+    """
+    将查询结果编码为紧凑的文本表格：只有一行字段名，之后每行一条记录，字段之间以制表符分隔，NULL写作\\N。
+    与json.dumps相比，可以处理Decimal、日期时间和二进制值，保留字段名，并且每行不再重复括号、引号和逗号。
+    :param columns: 字段名列表（cursor.description中的名称）
+    :param rows: 查询结果，元组构成的列表或元组
+    :param float_digits: 浮点数保留的有效数字位数，默认为10，None表示使用能还原该浮点数的最短表示
+    :param decimal_places: DECIMAL字段保留的小数位数，默认为None，表示按字段定义的精度原样输出
+    :param max_bytes: 二进制值最多输出的字节数，默认为32
+    """
+    lines = [DELIMITER.join(_escape(str(column)) for column in columns)]
+    if rows:
+        formatted = [_format_column(values, float_digits, decimal_places, max_bytes) for values in zip(*rows)]
+        lines.extend(map(DELIMITER.join, zip(*formatted)))
+    return '\n'.join(lines)
+
+
+def _parse_value(text:str, parse_numbers:bool):
+    if text == NULL:
+        return None
+    if '\\' in text:
+        return _UNESCAPE_RE.sub(lambda m: _UNESCAPES.get(m.group(1), m.group(1)), text)
+    if parse_numbers:
+        if _INT_RE.match(text):
+            return int(text)
+        if _FLOAT_RE.match(text):
+            return float(text)
+    return text
+
+
+def decode_results(text:str, parse_numbers:bool=True):
+    """
+    解析encode_results编码的文本表格
+    :param parse_numbers: 是否将数字形式的字段值转换为int或float，默认为True，其余值（包括日期时间）保留为字符串
+    :return: (字段名列表, 元组构成的记录列表)
+    """
+    lines = text.split('\n')
+    columns = [_parse_value(column, False) for column in lines[0].split(DELIMITER)]
+    rows = [tuple(_parse_value(value, parse_numbers) for value in line.split(DELIMITER)) for line in lines[1:]]
+    return columns, rows
@@ -0,0 +1,284 @@
+"""
+轻量的运行追踪：在一轮对话的主要阶段（大模型调用、外部函数分发与运行、debug、任务拆解、会话压缩）记录嵌套的span，
+每个span带有tokens、行数、字节数、报错等属性，可以导出为Chrome trace（chrome://tracing、Perfetto）或逐行的JSONL。
+未开启追踪时，span()返回共享的空对象，开销只有一次全局变量判断。
+
+example:
+    >>> from data_analyst_agent.utils.tracing import tracing
+    >>> with tracing(chrome_path='trace.json', jsonl_path='spans.jsonl') as tracer:
+            agent.ask('统计各合同类型的流失率')
+    >>> tracer.summary()
+"""
+import os
+import json
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+
+
+class Span:
+    """一个已开始的追踪区间"""
+    __slots__ = ('tracer', 'name', 'category', 'span_id', 'parent_id', 'thread_id', 'thread_name',
+                 'start', 'end', 'attributes')
+
+    def __init__(self, tracer, name, category, span_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.span_id = span_id
+        self.parent_id = parent_id
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end = None
+
+    def set(self, **attributes):
+        """添加或更新属性"""
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.attributes['error'] = f"{exc_type.__name__}: {exc_val}"
+        self.tracer.finish(self)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'category': self.category,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'thread': self.thread_name,
+            'start': self.start - self.tracer.origin,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+
+
+class _NoopSpan:
+    """未开启追踪时使用的空span"""
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """
+    追踪记录器：每个线程维护自己的span栈，子span的父span为同一线程中最近开始且尚未结束的span；
+    在线程池中运行的任务可以通过wrap()继承提交时所在的span。
+    """
+    def __init__(self, max_spans=200000):
+        """
+        :param max_spans: 最多保存的span数量，超过后不再记录新的span（dropped计数）
+        """
+        self.max_spans = max_spans
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def start(self, name, category='agent', **attributes) -> Span:
+        """开始一个span，需要调用finish()结束，或者作为上下文管理器使用"""
+        stack = self._stack()
+        parent = stack[-1] if stack else getattr(self._local, 'parent', None)
+        span = Span(self, name, category, next(self._ids), parent.span_id if parent is not None else None, attributes)
+        stack.append(span)
+        return span
+
+    span = start
+
+    def finish(self, span:Span):
+        span.end = time.perf_counter()
+        stack = self._stack()
+        # span不一定位于栈顶（例如跨越多个步骤的debug），从栈中移除即可
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] is span:
+                del stack[i]
+                break
+        with self._lock:
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def wrap(self, func):
+        """返回在其他线程中运行时以当前span为父span的函数"""
+        parent = self.current()
+
+        def wrapped(*args, **kwargs):
+            previous = getattr(self._local, 'parent', None)
+            self._local.parent = parent
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.parent = previous
+        return wrapped
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+            self.dropped = 0
+
+    # ---------- 导出 ----------
+    def to_chrome_trace(self) -> dict:
+        """Chrome trace-event格式：每个span为一个完整事件（ph=X），时间单位为微秒"""
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        threads = {}
+        for span in spans:
+            threads.setdefault(span.thread_id, span.thread_name)
+            args = dict(span.attributes)
+            args['span_id'] = span.span_id
+            if span.parent_id is not None:
+                args['parent_id'] = span.parent_id
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': (span.start - self.origin) * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': args,
+            })
+        for thread_id, thread_name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id,
+                           'args': {'name': thread_name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.to_chrome_trace(), file, ensure_ascii=False, default=str)
+
+    def export_jsonl(self, path):
+        """每行一个span：名称、类别、id、父span id、线程、相对开始时间（秒）、耗时（秒）和属性"""
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, 'w', encoding='utf-8') as file:
+            for span in sorted(spans, key=lambda s: s.start):
+                file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n')
+
+    def summary(self) -> dict:
+        """按类别汇总span数量和总耗时（秒），嵌套的span会分别计入各自的类别"""
+        result = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            item = result.setdefault(span.category, {'count': 0, 'duration': 0.0, 'errors': 0})
+            item['count'] += 1
+            item['duration'] += span.duration
+            item['errors'] += 'error' in span.attributes
+        return result
+
+
+# 当前进程的追踪记录器，为None时不进行追踪
+_tracer = None
+
+
+def get_tracer():
+    return _tracer
+
+
+def set_tracer(tracer):
+    """设置进程级的追踪记录器，传入None时关闭追踪"""
+    global _tracer
+    _tracer = tracer
+
+
+def span(name, category='agent', **attributes):
+    """
+    创建一个span上下文：with span('sql_inter', 'tool') as s: ...; s.set(rows=10)
+    未开启追踪时返回空对象
+    """
+    tracer = _tracer
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.start(name, category, **attributes)
+
+
+def start_span(name, category='agent', **attributes):
+    """开始一个跨越多个步骤的span，返回值需要传给finish_span"""
+    tracer = _tracer
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.start(name, category, **attributes)
+
+
+def finish_span(span, **attributes):
+    if span is NOOP_SPAN or span is None:
+        return
+    span.attributes.update(attributes)
+    span.tracer.finish(span)
+
+
+def annotate(**attributes):
+    """为当前线程中最近的span添加属性（例如外部函数内部记录行数、字节数）"""
+    tracer = _tracer
+    if tracer is None:
+        return
+    current = tracer.current()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def propagate(func):
+    """提交到线程池的函数继承当前span，未开启追踪时原样返回"""
+    tracer = _tracer
+    if tracer is None:
+        return func
+    return tracer.wrap(func)
+
+
+@contextmanager
+def tracing(chrome_path=None, jsonl_path=None, tracer=None):
+    """
+    在上下文中开启追踪，退出时按需导出
+    :param chrome_path: 可选参数，Chrome trace文件路径
+    :param jsonl_path: 可选参数，JSONL文件路径
+    :param tracer: 可选参数，使用已有的Tracer对象
+    """
+    tracer = tracer if tracer is not None else Tracer()
+    previous = _tracer
+    set_tracer(tracer)
+    try:
+        yield tracer
+    finally:
+        set_tracer(previous)
+        if chrome_path:
+            tracer.export_chrome_trace(chrome_path)
+        if jsonl_path:
+            tracer.export_jsonl(jsonl_path)
@@ -1,5 +1,10 @@
+import os
 import argparse
+import contextlib
 from data_analyst_agent import create_agent
+from data_analyst_agent.core.batch import add_batch_arguments, run_batch_from_args
+from data_analyst_agent.core.service import add_service_arguments, serve_from_args
+from data_analyst_agent.utils.tracing import tracing
 
 def main():
     parser = argparse.ArgumentParser(description="Data Analyst Agent")
@@ -8,6 +13,10 @@ def main():
     parser.add_argument("--env_path", type=str, default="./.env", help="环境文件路径")
     parser.add_argument("--is_enhanced_mode", default=False, help="是否开启增强模式")
     parser.add_argument("--is_developer_mode", default=False, help="当前对话是否开启开发者模式")
+    add_batch_arguments(parser)
+    add_service_arguments(parser)
+    parser.add_argument("--trace", type=str, default=None,
+                        help="记录运行追踪并在退出时导出为Chrome trace文件，同时导出同名的.jsonl文件")
 
     args = parser.parse_args()
 
@@ -17,7 +26,20 @@ def main():
         is_enhanced_mode=args.is_enhanced_mode,
         is_developer_mode=args.is_developer_mode
     )
-    agent.run()
+    trace = contextlib.nullcontext()
+    if args.trace:
+        # 在chrome://tracing或Perfetto中打开导出的文件
+        trace = tracing(chrome_path=args.trace, jsonl_path=os.path.splitext(args.trace)[0] + '.jsonl')
+
+    with trace:
+        if args.batch:
+            # 批量问答：python run.py --batch questions.jsonl --output results.jsonl --concurrency 4
+            run_batch_from_args(agent, args)
+        elif args.serve:
+            # 服务模式：python run.py --serve --port 8000
+            serve_from_args(agent, args)
+        else:
+            agent.run()
 
 
 if __name__ == "__main__":
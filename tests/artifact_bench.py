@@ -0,0 +1,75 @@
+"""
+产物存储的基准测试：统计大量小图片（PNG）和少量大数据表（parquet，未安装pyarrow/fastparquet时使用csv）的写入吞吐量，
+重复写入相同内容（去重）的吞吐量，以及释放引用后gc的耗时。
+图片内容为随机字节（带PNG文件头），只测试存储本身，不包括绘图耗时。
+
+运行方式：python tests/artifact_bench.py [--pngs 2000] [--png_kb 30] [--frames 3] [--rows 1000000]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.core.artifact_store import ArtifactStore
+
+
+def frame_format():
+    try:
+        pd.DataFrame({'a': [1]}).to_parquet()
+        return 'parquet'
+    except ImportError:
+        return 'csv'
+
+
+def report(name, count, size, elapsed):
+    print(f"{name:<24}{count / elapsed:>12.1f} 个/s{size / elapsed / 1024 ** 2:>12.1f} MB/s  ({elapsed:.3f} s)")
+
+
+def main(args):
+    store = ArtifactStore(os.path.join(tempfile.mkdtemp(prefix='dataflow_artifact_bench_'), 'artifacts'))
+    rng = np.random.default_rng(0)
+    pngs = [b'\x89PNG\r\n\x1a\n' + rng.bytes(args.png_kb * 1024) for _ in range(args.pngs)]
+    size = sum(len(png) for png in pngs)
+
+    start = time.perf_counter()
+    for i, png in enumerate(pngs):
+        store.put_bytes(png, ext='.png', kind='figure', session='bench', name=f'fig{i}')
+    report('小图片写入', len(pngs), size, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i, png in enumerate(pngs):
+        store.put_bytes(png, ext='.png', kind='figure', session='bench-repeat', name=f'fig{i}')
+    report('小图片重复写入（去重）', len(pngs), size, time.perf_counter() - start)
+
+    file_format = frame_format()
+    frames = [pd.DataFrame({'customerID': np.arange(args.rows) + i, 'MonthlyCharges': rng.random(args.rows) * 100,
+                            'tenure': rng.integers(0, 72, args.rows)}) for i in range(args.frames)]
+    start = time.perf_counter()
+    for i, df in enumerate(frames):
+        store.put_frame(df, file_format=file_format, session='bench', name=f'df{i}')
+    elapsed = time.perf_counter() - start
+    frame_size = sum(a['size'] for a in store.list(kind='frame'))
+    report(f'大数据表写入（{file_format}）', len(frames), frame_size, elapsed)
+
+    store.release(session='bench')
+    store.release(session='bench-repeat')
+    start = time.perf_counter()
+    result = store.gc()
+    print(f"gc：删除{result['removed']}个产物，释放{result['bytes_freed'] / 1024 ** 2:.1f} MB，"
+          f"耗时{time.perf_counter() - start:.3f} s")
+    store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pngs', type=int, default=2000)
+    parser.add_argument('--png_kb', type=int, default=30, help='每张图片的大小（KB）')
+    parser.add_argument('--frames', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=1000000)
+    main(parser.parse_args())
@@ -0,0 +1,314 @@
+"""
+热点路径的组件基准测试：不访问网络，使用大模型替身和SQLite版的telco_db，覆盖
+ChatMessages的messages_append/messages_pop/copy（不同历史长度）、function_to_call的分发开销、
+python_inter的执行与结果渲染、sql_inter的结果编码、extract_data的吞吐量、fig_inter的绘图耗时以及追踪span的开销。
+
+运行并保存结果：python tests/benchmark.py run --output bench.json [--filter messages] [--quick]
+对比两次结果：python tests/benchmark.py compare base.json bench.json [--threshold 0.1]
+对比时，中位数耗时变慢超过阈值的项目记为性能退化，存在退化时以状态码1退出。
+"""
+import os
+import sys
+import gc
+import io
+import json
+import time
+import sqlite3
+import platform
+import argparse
+import tempfile
+import contextlib
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import create_telco_db, tool_call_message
+
+from data_analyst_agent.core.messages import ChatMessages
+from data_analyst_agent.core.functions import AvailableFunctions
+from data_analyst_agent.core.namespace import SessionNamespace
+from data_analyst_agent.core.validation import get_validator
+from data_analyst_agent.functions_lib import run_sql, python_inter, sql_inter, extract_data, fig_inter
+from data_analyst_agent.utils.helpers import function_to_call
+from data_analyst_agent.utils.serialization import encode_results
+
+HISTORY_SIZES = [10, 100, 1000]
+SQL_ROWS = [100, 5000]
+
+
+def measure(func, setup=None, repeat=7, number=None, min_time=0.05):
+    """
+    多次运行func并统计单次耗时（秒）：每轮运行前调用setup()得到func的参数（不计入耗时），
+    number为每轮的运行次数，未指定时自动选择使每轮耗时不少于min_time的次数
+    """
+    def run_round(n):
+        args = [setup() if setup is not None else () for _ in range(n)]
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for arg in args:
+                func(*arg)
+            return time.perf_counter() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    if number is None:
+        number = 1
+        while True:
+            elapsed = run_round(number)
+            if elapsed >= min_time or number >= 10000:
+                break
+            number = min(10000, number * max(2, int(min_time / max(elapsed, 1e-9))))
+    times = [run_round(number) / number for _ in range(repeat)]
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def _history(n):
+    messages = ChatMessages(question='请统计各性别的用户数量', tokens_thr=10 ** 9, tokenizer='heuristic')
+    for i in range(n):
+        role = 'assistant' if i % 2 == 0 else 'user'
+        messages.messages_append({'role': role, 'content': f'第{i}条消息：' + '用户数据分析' * 20})
+    return messages
+
+
+def bench_messages(quick):
+    results = {}
+    message = {'role': 'user', 'content': '请按合同类型统计流失率' * 5}
+    for n in HISTORY_SIZES[:2] if quick else HISTORY_SIZES:
+        base = _history(n)
+        results[f'messages.append[{n}]'] = measure(
+            lambda m: m.messages_append(message), setup=lambda: (base.copy(),))
+        results[f'messages.pop[{n}]'] = measure(
+            lambda m: m.messages_pop(), setup=lambda: (base.copy(),))
+        results[f'messages.copy[{n}]'] = measure(base.copy)
+    return results
+
+
+def bench_dispatch(quick):
+    af = AvailableFunctions(functions_list=[python_inter])
+    call = tool_call_message('python_inter', {'py_code': '1 + 1'})
+    namespace = SessionNamespace()
+    get_validator(namespace).enabled = False
+    direct = measure(lambda: python_inter('1 + 1', g=namespace))
+    dispatched = measure(lambda: function_to_call(af, call, namespace=namespace))
+    validated_namespace = SessionNamespace()
+    validated = measure(lambda: function_to_call(af, call, namespace=validated_namespace))
+    return {
+        'python_inter.direct': direct,
+        'dispatch.function_to_call': dispatched,
+        'dispatch.function_to_call+validation': validated,
+    }
+
+
+def bench_python_inter(quick, db_path):
+    import pandas as pd
+    with contextlib.closing(sqlite3.connect(db_path)) as connection:
+        df = pd.read_sql('SELECT * FROM user_payments', connection)
+    results = {}
+    for rows in [10, 1000] if quick else [10, 1000, len(df)]:
+        namespace = SessionNamespace(df=df)
+        # 每次运行都产生新变量，结果为该变量的字符串渲染
+        code = f"sub = df.head({rows})\nstats = sub.groupby('Contract')['MonthlyCharges'].mean()"
+
+        def run(namespace=namespace, code=code):
+            namespace.pop('sub', None)
+            namespace.pop('stats', None)
+            python_inter(code, g=namespace)
+        results[f'python_inter.render[{rows}]'] = measure(run)
+    return results
+
+
+def bench_sql(quick, db_path):
+    results = {}
+    for rows in SQL_ROWS:
+        query = f'SELECT * FROM user_payments LIMIT {rows}'
+        results[f'sql_inter.query+encode[{rows}]'] = measure(lambda: sql_inter(query))
+        with contextlib.closing(sqlite3.connect(db_path)) as connection:
+            cursor = connection.execute(query)
+            columns = [column[0] for column in cursor.description]
+            data = cursor.fetchall()
+        results[f'sql_inter.encode[{rows}]'] = measure(lambda: encode_results(columns, data))
+    return results
+
+
+def bench_extract_data(quick, db_path):
+    results = {}
+    with contextlib.closing(sqlite3.connect(db_path)) as connection:
+        total = connection.execute('SELECT COUNT(*) FROM user_payments').fetchone()[0]
+    namespace = SessionNamespace()
+    result = measure(lambda: extract_data('SELECT * FROM user_payments', 'df', g=namespace), repeat=5)
+    result['rows_per_second'] = total / result['median']
+    results[f'extract_data[{total}]'] = result
+    join = ('SELECT d.*, p.MonthlyCharges, c.Churn FROM user_demographics d '
+            'JOIN user_payments p ON d.customerID = p.customerID JOIN user_churn c ON d.customerID = c.customerID')
+    result = measure(lambda: extract_data(join, 'df', g=namespace), repeat=5)
+    result['rows_per_second'] = total / result['median']
+    results[f'extract_data.join[{total}]'] = result
+    return results
+
+
+def bench_fig_inter(quick, db_path):
+    import pandas as pd
+    with contextlib.closing(sqlite3.connect(db_path)) as connection:
+        df = pd.read_sql('SELECT * FROM user_payments', connection)
+    namespace = SessionNamespace(df=df)
+    code = ("fig, ax = plt.subplots(figsize=(6, 4))\n"
+            "df.groupby('Contract')['MonthlyCharges'].mean().plot.bar(ax=ax)\n"
+            "fig.canvas.draw()\n"
+            "plt.close(fig)")
+    # 首次调用会导入并初始化matplotlib，先预热一次
+    fig_inter(code, 'fig', g=namespace)
+    return {'fig_inter.bar': measure(lambda: fig_inter(code, 'fig', g=namespace), repeat=3 if quick else 5)}
+
+
+def bench_tracing(quick):
+    from data_analyst_agent.utils.tracing import span, tracing
+
+    def traced():
+        with span('tool', 'tool', rows=10) as s:
+            s.set(bytes=100)
+
+    results = {'tracing.span_disabled': measure(traced)}
+    with tracing() as tracer:
+        results['tracing.span_enabled'] = measure(traced)
+        tracer.clear()
+    return results
+
+
+SUITES = {
+    'messages': bench_messages,
+    'dispatch': bench_dispatch,
+    'python_inter': bench_python_inter,
+    'sql': bench_sql,
+    'extract_data': bench_extract_data,
+    'fig_inter': bench_fig_inter,
+    'tracing': bench_tracing,
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='dataflow_bench_')
+    db_path = create_telco_db(os.path.join(workdir, 'telco.db'), rows=args.rows)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(db_path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+
+    results = {}
+    try:
+        for name, suite in SUITES.items():
+            if args.filter and args.filter not in name:
+                continue
+            kwargs = {} if name in ('messages', 'dispatch', 'tracing') else {'db_path': db_path}
+            # 屏蔽被测函数的打印内容
+            with contextlib.redirect_stdout(io.StringIO()):
+                suite_results = suite(args.quick, **kwargs)
+            for case, result in suite_results.items():
+                print(f"{case:<45}{result['median'] * 1e6:>14.1f} us  (min {result['min'] * 1e6:.1f} us, "
+                      f"x{result['number']})")
+            results.update(suite_results)
+    finally:
+        run_sql.set_connection_pool(None)
+        pool.close()
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'rows': args.rows,
+            'quick': args.quick,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f">>> 结果已保存至{args.output}")
+    return report
+
+
+def compare_reports(base:dict, new:dict, threshold=0.1) -> list:
+    """
+    对比两次基准测试结果，返回[(项目, 基准中位数, 新中位数, 变化比例, 状态)]，
+    状态为regression（变慢超过阈值）、improvement（变快超过阈值）、ok、new或missing
+    """
+    rows = []
+    base_results, new_results = base['results'], new['results']
+    for case in sorted(set(base_results) | set(new_results)):
+        if case not in new_results:
+            rows.append((case, base_results[case]['median'], None, None, 'missing'))
+            continue
+        if case not in base_results:
+            rows.append((case, None, new_results[case]['median'], None, 'new'))
+            continue
+        before, after = base_results[case]['median'], new_results[case]['median']
+        change = after / before - 1 if before > 0 else 0.0
+        status = 'regression' if change > threshold else 'improvement' if change < -threshold else 'ok'
+        rows.append((case, before, after, change, status))
+    return rows
+
+
+def compare(args):
+    with open(args.base, encoding='utf-8') as file:
+        base = json.load(file)
+    with open(args.new, encoding='utf-8') as file:
+        new = json.load(file)
+    rows = compare_reports(base, new, args.threshold)
+
+    def fmt(value):
+        return f"{value * 1e6:.1f}" if value is not None else '-'
+
+    print(f"{'项目':<43}{'基准(us)':>12}{'当前(us)':>12}{'变化':>9}  状态")
+    for case, before, after, change, status in rows:
+        change_text = f"{change:+.1%}" if change is not None else '-'
+        print(f"{case:<45}{fmt(before):>12}{fmt(after):>12}{change_text:>9}  {status}")
+    regressions = [row for row in rows if row[-1] == 'regression']
+    if regressions:
+        print(f">>> {len(regressions)}个项目的耗时增加超过{args.threshold:.0%}")
+        return 1
+    print(">>> 未发现性能退化")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DataFlowAgent组件基准测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='运行基准测试')
+    run_parser.add_argument('--output', default=None, help='结果JSON文件路径')
+    run_parser.add_argument('--filter', default=None, help='只运行名称包含该字符串的测试组')
+    run_parser.add_argument('--rows', type=int, default=5000, help='telco_db各表的行数')
+    run_parser.add_argument('--quick', action='store_true', help='减少测试规模，用于快速检查')
+
+    compare_parser = subparsers.add_parser('compare', help='对比两次结果')
+    compare_parser.add_argument('base', help='基准结果JSON文件')
+    compare_parser.add_argument('new', help='当前结果JSON文件')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='判定为退化的耗时增加比例')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+会话检查点的基准测试：变量空间中放入一个大的DataFrame（数值列为主，另有一个字符串列），统计
+首次保存、修改一列后的增量保存、恢复（内存映射）以及恢复后首次完整读取数据的耗时，并与整体pickle的方式对比。
+
+运行方式：python tests/checkpoint_bench.py [--rows 5000000] [--columns 8]
+"""
+import os
+import io
+import sys
+import time
+import pickle
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.core.checkpoint import SessionCheckpoint
+from data_analyst_agent.core.messages import ChatMessages
+from data_analyst_agent.core.namespace import SessionNamespace
+
+
+def make_namespace(rows, columns):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({f'x{i}': rng.random(rows) for i in range(columns)})
+    df['tenure'] = rng.integers(0, 72, rows)
+    df['Contract'] = rng.choice(['Month-to-month', 'One year', 'Two year'], rows)
+    return SessionNamespace(df=df, stats=df.describe())
+
+
+def pickle_variables(namespace):
+    return {name: value for name, value in namespace.items() if not name.startswith('_')}
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='dataflow_ckpt_bench_')
+    namespace = make_namespace(args.rows, args.columns)
+    size = namespace['df'].memory_usage(deep=True).sum()
+    with contextlib.redirect_stdout(io.StringIO()):
+        messages = ChatMessages(question='请统计各合同类型的平均月费', tokenizer='heuristic')
+    print(f">>> DataFrame {args.rows}行 x {args.columns + 2}列，内存占用{size / 1024 ** 2:.0f} MB")
+
+    checkpoint = SessionCheckpoint(os.path.join(workdir, 'ckpt'))
+    elapsed, stats = timed(lambda: checkpoint.save(messages, namespace))
+    print(f"{'首次保存':<14}{elapsed:>10.3f} s  写入{stats['bytes_written'] / 1024 ** 2:.0f} MB")
+
+    namespace['df']['x0'] = namespace['df']['x0'] * 2
+    elapsed, stats = timed(lambda: checkpoint.save(messages, namespace))
+    print(f"{'修改一列后保存':<12}{elapsed:>10.3f} s  写入{stats['written']}个文件"
+          f"（{stats['bytes_written'] / 1024 ** 2:.0f} MB），复用{stats['reused']}个")
+
+    elapsed, state = timed(checkpoint.load)
+    print(f"{'恢复（内存映射）':<11}{elapsed:>10.3f} s")
+    numeric = state['variables']['df'].select_dtypes('number')
+    elapsed, _ = timed(lambda: numeric.sum())
+    print(f"{'恢复后首次完整读取':<10}{elapsed:>10.3f} s")
+
+    path = os.path.join(workdir, 'namespace.pkl')
+
+    def dump():
+        with open(path, 'wb') as file:
+            pickle.dump(pickle_variables(namespace), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load():
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    elapsed, _ = timed(dump)
+    print(f"{'pickle保存':<14}{elapsed:>10.3f} s")
+    elapsed, _ = timed(load)
+    print(f"{'pickle恢复':<14}{elapsed:>10.3f} s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--columns', type=int, default=8, help='数值列数量')
+    main(parser.parse_args())
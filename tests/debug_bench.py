@@ -0,0 +1,124 @@
+"""
+并行debug与逐步深度debug的对比基准：在记录的报错代码语料（debug_corpus.jsonl）上，
+分别统计两种策略得到可运行修改的成功率和耗时。
+每条语料记录了报错代码以及大模型先后给出的候选修改（部分候选仍然报错），大模型替身按固定延迟返回这些记录。
+
+运行方式：python tests/debug_bench.py [--latency 0.2] [--candidates 3]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import StubLlm, tool_call_message
+
+from data_analyst_agent.core.messages import ChatMessages
+from data_analyst_agent.core.functions import AvailableFunctions
+from data_analyst_agent.core.chat_engine import get_chat_response, TurnBudget
+from data_analyst_agent.core.parallel_debug import ParallelDebugger, PARALLEL_DEBUG_PROMPT, CANDIDATE_HINTS
+from data_analyst_agent.functions_lib import python_inter
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debug_corpus.jsonl')
+
+
+def _role(message):
+    return message['role'] if isinstance(message, dict) else message.role
+
+
+def _content(message):
+    return (message['content'] if isinstance(message, dict) else message.content) or ''
+
+
+def _candidate_index(prompt):
+    for i, hint in enumerate(CANDIDATE_HINTS):
+        if hint and prompt.endswith(hint):
+            return i
+    return 0
+
+
+def make_responder(cell, latency, rng):
+    """按记录回放大模型输出：首次给出报错代码，debug时依次给出记录的候选修改"""
+    candidates = cell['candidates']
+
+    def code(py_code):
+        return tool_call_message('python_inter', {'py_code': py_code})
+
+    def responder(messages, route):
+        time.sleep(latency * rng.uniform(0.7, 1.3))
+        last = messages[-1]
+        if _role(last) == 'tool':
+            return '分析完成' if '报错' not in _content(last) else '代码运行报错。'
+        prompt = _content(last)
+        if prompt.startswith(PARALLEL_DEBUG_PROMPT):
+            return code(candidates[_candidate_index(prompt) % len(candidates)])
+        if route != 'debug':
+            return code(cell['failing_code'])
+        if prompt.startswith(("之前执行的代码报错了，你觉得", "好的。那么根据你的分析")):
+            return '报错原因是字段名或数据类型使用错误，应当检查后修改代码。'
+        # 逐步debug中要求编写代码的提示词：按已经报错的次数依次回放候选修改
+        errors = sum(1 for m in messages if _role(m) == 'tool' and '报错' in _content(m))
+        if errors - 1 < len(candidates):
+            return code(candidates[errors - 1])
+        return '抱歉，暂时无法修复该错误。'
+
+    return responder
+
+
+def run_cell(cell, parallel, latency, n_candidates, seed):
+    namespace = {}
+    exec(cell['setup'], namespace)
+    llm = StubLlm(make_responder(cell, latency, random.Random(seed)))
+    af = AvailableFunctions(functions_list=[python_inter])
+    debugger = ParallelDebugger(llm, af, n_candidates=n_candidates) if parallel else None
+    messages = ChatMessages(question='请完成分析', tokenizer='heuristic')
+
+    start = time.perf_counter()
+    result = get_chat_response(llm, messages, available_functions=af, is_enhanced_mode=True,
+                               budget=TurnBudget(max_steps=40), debugger=debugger, namespace=namespace)
+    elapsed = time.perf_counter() - start
+
+    tools = [m for m in result.history_messages if _role(m) == 'tool']
+    fixed = bool(tools) and '报错' not in _content(tools[-1])
+    return {'fixed': fixed, 'latency': elapsed, 'llm_calls': len(llm.calls)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.2, help='模拟的单次大模型调用延迟（秒）')
+    parser.add_argument('--candidates', type=int, default=3)
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding='utf-8') as file:
+        corpus = [json.loads(line) for line in file if line.strip()]
+
+    import contextlib
+    import io
+    summary = {}
+    for name, parallel in [('serial', False), ('parallel', True)]:
+        rows = []
+        for i, cell in enumerate(corpus):
+            with contextlib.redirect_stdout(io.StringIO()):
+                rows.append(run_cell(cell, parallel, args.latency, args.candidates, seed=i))
+        fixed = [row for row in rows if row['fixed']]
+        summary[name] = {
+            'cells': len(rows),
+            'fix_rate': len(fixed) / len(rows),
+            'avg_latency_to_fix': sum(row['latency'] for row in fixed) / max(len(fixed), 1),
+            'avg_llm_calls': sum(row['llm_calls'] for row in rows) / len(rows),
+        }
+
+    for name, metrics in summary.items():
+        print(f"{name:>8}: 修复率 {metrics['fix_rate']:.0%}，修复耗时均值 {metrics['avg_latency_to_fix']:.2f}s，"
+              f"平均大模型调用 {metrics['avg_llm_calls']:.1f} 次")
+    speedup = summary['serial']['avg_latency_to_fix'] / max(summary['parallel']['avg_latency_to_fix'], 1e-9)
+    print(f"并行debug的修复耗时为逐步debug的 1/{speedup:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+测试与基准测试共用的离线组件：不访问网络的大模型替身、SQLite版的telco_db数据库
+"""
+import json
+import random
+import sqlite3
+
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+
+def text_message(content):
+    """构造一条文本回答消息"""
+    return ChatCompletionMessage(role='assistant', content=content)
+
+
+def tool_call_message(function_name, arguments, call_id='call_0'):
+    """构造一条包含tool_calls的消息"""
+    return ChatCompletionMessage.model_validate({
+        'role': 'assistant',
+        'content': None,
+        'tool_calls': [{
+            'id': call_id,
+            'type': 'function',
+            'function': {'name': function_name, 'arguments': json.dumps(arguments, ensure_ascii=False)},
+        }],
+    })
+
+
+class StubLlm:
+    """
+    大模型替身，与LlmBox的chat接口一致。
+    :param responder: 可以是固定的回答字符串、回答消息的list（依次返回），或者是函数responder(messages, route)
+    """
+    def __init__(self, responder='好的。'):
+        self.responder = responder
+        self.calls = []
+
+    def chat(self, prompt='你好。', system_pt=None, messages=None, tools=None, tool_choice='auto', route='main',
+             on_token=None):
+        if messages is None:
+            messages = [{"role": "user", "content": prompt}]
+        self.calls.append({'messages': messages, 'tools': tools, 'route': route})
+
+        if callable(self.responder):
+            response = self.responder(messages, route)
+        elif isinstance(self.responder, list):
+            response = self.responder[min(len(self.calls), len(self.responder)) - 1]
+        else:
+            response = self.responder
+        if isinstance(response, str):
+            response = text_message(response)
+        if on_token is not None and response.content:
+            for i in range(0, len(response.content), 4):
+                on_token(response.content[i:i + 4])
+        return response
+
+    def share(self):
+        """与LlmBox.share一致：返回使用相同回答方式、单独记录调用的副本"""
+        return StubLlm(self.responder)
+
+    def get_metrics(self):
+        routes = {}
+        for call in self.calls:
+            metrics = routes.setdefault(call['route'], {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0})
+            metrics['calls'] += 1
+        return routes
+
+
+def create_telco_db(path, rows=5000, seed=0):
+    """
+    创建SQLite版的telco_db：user_demographics、user_services、user_payments、user_churn四张表，
+    每张表rows行，以customerID关联，数据由固定的随机种子生成
+    """
+    rng = random.Random(seed)
+    yes_no = ['Yes', 'No']
+    ids = [f"{i:04d}-{''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(5))}" for i in range(rows)]
+    tables = {
+        'user_demographics': (
+            "customerID TEXT PRIMARY KEY, gender TEXT, SeniorCitizen INTEGER, Partner TEXT, Dependents TEXT",
+            lambda cid: (cid, rng.choice(['Male', 'Female']), rng.randint(0, 1), rng.choice(yes_no),
+                         rng.choice(yes_no))
+        ),
+        'user_services': (
+            "customerID TEXT PRIMARY KEY, PhoneService TEXT, MultipleLines TEXT, InternetService TEXT, "
+            "OnlineSecurity TEXT, OnlineBackup TEXT, StreamingTV TEXT",
+            lambda cid: (cid, rng.choice(yes_no), rng.choice(yes_no + ['No phone service']),
+                         rng.choice(['DSL', 'Fiber optic', 'No']), rng.choice(yes_no), rng.choice(yes_no),
+                         rng.choice(yes_no))
+        ),
+        'user_payments': (
+            "customerID TEXT PRIMARY KEY, tenure INTEGER, Contract TEXT, PaperlessBilling TEXT, PaymentMethod TEXT, "
+            "MonthlyCharges REAL, TotalCharges REAL",
+            lambda cid: (cid, rng.randint(0, 72), rng.choice(['Month-to-month', 'One year', 'Two year']),
+                         rng.choice(yes_no),
+                         rng.choice(['Electronic check', 'Mailed check', 'Bank transfer', 'Credit card']),
+                         round(rng.uniform(18, 120), 2), round(rng.uniform(18, 8700), 2))
+        ),
+        'user_churn': (
+            "customerID TEXT PRIMARY KEY, Churn TEXT",
+            lambda cid: (cid, rng.choice(yes_no))
+        ),
+    }
+    connection = sqlite3.connect(path)
+    for table, (columns, make_row) in tables.items():
+        connection.execute(f"CREATE TABLE {table} ({columns})")
+        rows_data = [make_row(cid) for cid in ids]
+        placeholders = ', '.join('?' * len(rows_data[0]))
+        connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows_data)
+    connection.commit()
+    connection.close()
+    return path
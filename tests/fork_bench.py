@@ -0,0 +1,54 @@
+"""
+ChatMessages复制（fork）的基准测试：在不同长度的历史消息上，对比原先的深复制实现与结构共享（写时复制）的copy，
+报告单次fork并追加一条消息的耗时，以及20次fork的峰值内存。
+
+运行方式：python tests/fork_bench.py [--sizes 50 200 800] [--forks 20]
+"""
+import os
+import sys
+import copy
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.core.messages import ChatMessages, MessageHistory
+from token_bench import make_data_dictionary, make_session
+
+
+def deepcopy_fork(msgs):
+    new_obj = ChatMessages.__new__(ChatMessages)
+    new_obj.__dict__.update(msgs.__dict__)
+    new_obj.system_messages = copy.deepcopy(msgs.system_messages)
+    new_obj._history = MessageHistory(copy.deepcopy(list(msgs._history)))
+    return new_obj
+
+
+def main(args):
+    big_dictionary = make_data_dictionary() * 20
+    session = make_session()
+    for history_size in args.sizes:
+        msgs = ChatMessages(system_content_list=[big_dictionary], tokenizer='heuristic')
+        for i in range(history_size):
+            msgs.messages_append(session[i % len(session)].copy())
+
+        for name, fork in [('deepcopy', deepcopy_fork), ('cow', ChatMessages.copy)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            forks = [fork(msgs) for _ in range(args.forks)]
+            for f in forks:
+                f.messages_append({"role": "user", "content": "之前执行的代码报错了，你觉得代码哪里编写错了？"})
+            elapsed = (time.perf_counter() - start) / len(forks)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del forks
+            print(f"[fork] {history_size}条历史消息，{name}：单次 {elapsed * 1000:.3f} ms，"
+                  f"{args.forks}次fork峰值内存 {peak / 1024 / 1024:.2f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 800])
+    parser.add_argument('--forks', type=int, default=20)
+    main(parser.parse_args())
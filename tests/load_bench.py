@@ -0,0 +1,227 @@
+"""
+多会话服务的负载测试：在本地启动兼容OpenAI接口的大模型替身服务和SQLite版的telco_db，
+通过AgentService的HTTP接口并发提问，统计不同并发数下的对话延迟（p50/p95/p99）、首个token延迟、吞吐量和被拒绝的请求数。
+大模型替身第一次回答返回sql_inter调用，收到外部函数结果后流式返回文本回答。
+
+运行方式：python tests/load_bench.py [--latency 0.2] [--levels 1,4,16,32] [--turns 2]
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import io
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import create_telco_db
+
+from data_analyst_agent.api.llms import LlmBox
+from data_analyst_agent.core.agent import DataFlowAgent
+from data_analyst_agent.core.functions import AvailableFunctions
+from data_analyst_agent.core.service import AgentService, ChunkedResponse, read_request, send_json
+from data_analyst_agent.functions_lib import run_sql
+from data_analyst_agent.functions_lib.run_sql import sql_inter
+
+
+def _sse(chunk) -> bytes:
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+def _chunk(delta=None, finish_reason=None, usage=None):
+    return {
+        'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'stub',
+        'choices': [] if delta is None else [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+        'usage': usage,
+    }
+
+
+class StubOpenAIServer:
+    """兼容/v1/chat/completions流式接口的大模型替身，每次请求等待latency秒（上下浮动30%）"""
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.requests = 0
+        self.rng = random.Random(0)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await read_request(reader, max_body=16 * 1024 * 1024)
+            if request is None:
+                return
+            body = request.json()
+            self.requests += 1
+            await asyncio.sleep(self.latency * self.rng.uniform(0.7, 1.3))
+
+            last = body['messages'][-1]
+            if last['role'] == 'tool':
+                text = f"用户表中共有{len(last.get('content') or '')}个字符的统计结果，男女比例基本均衡。"
+                deltas = [{'role': 'assistant', 'content': ''}]
+                deltas += [{'content': text[i:i + 4]} for i in range(0, len(text), 4)]
+                finish = 'stop'
+            else:
+                arguments = json.dumps({'sql_query': 'SELECT gender, COUNT(*) FROM user_demographics GROUP BY gender'})
+                deltas = [{'role': 'assistant', 'content': None, 'tool_calls': [{
+                    'index': 0, 'id': 'call_0', 'type': 'function',
+                    'function': {'name': 'sql_inter', 'arguments': arguments},
+                }]}]
+                finish = 'tool_calls'
+
+            if not body.get('stream'):
+                message = {'role': 'assistant', 'content': ''.join(d.get('content') or '' for d in deltas) or None}
+                if finish == 'tool_calls':
+                    message['tool_calls'] = [{k: v for k, v in call.items() if k != 'index'}
+                                             for call in deltas[0]['tool_calls']]
+                await send_json(writer, 200, {
+                    'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': 0, 'model': 'stub',
+                    'choices': [{'index': 0, 'message': message, 'finish_reason': finish}],
+                    'usage': {'prompt_tokens': 100, 'completion_tokens': 20, 'total_tokens': 120},
+                })
+                return
+
+            response = ChunkedResponse(writer, content_type='text/event-stream')
+            await response.start()
+            for delta in deltas:
+                await response.write(_sse(_chunk(delta)))
+            await response.write(_sse(_chunk({}, finish_reason=finish)))
+            await response.write(_sse(_chunk(usage={'prompt_tokens': 100, 'completion_tokens': 20,
+                                                    'total_tokens': 120})))
+            await response.write(b"data: [DONE]\n\n")
+            await response.close()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def http_request(port, method, path, data=None):
+    """发送一个HTTP请求，返回(status, 按行解析的JSON事件, 首个token的延迟)"""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(data or {}).encode('utf-8')
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    events, first_token = [], None
+    if headers.get('transfer-encoding') == 'chunked':
+        buffer = b''
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            if size == 0:
+                break
+            buffer += await reader.readexactly(size)
+            await reader.readexactly(2)
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                event = json.loads(line)
+                if event['type'] == 'token' and first_token is None:
+                    first_token = time.perf_counter() - start
+                events.append(event)
+    else:
+        events.append(json.loads(await reader.readexactly(int(headers.get('content-length', 0)))))
+    writer.close()
+    return status, events, first_token
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def run_level(port, concurrency, turns):
+    """concurrency个客户端各自创建会话并连续提问turns次"""
+    latencies, first_tokens, statuses = [], [], []
+
+    async def client(i):
+        status, events, _ = await http_request(port, 'POST', '/sessions')
+        session_id = events[0]['session_id']
+        for turn in range(turns):
+            start = time.perf_counter()
+            status, events, first_token = await http_request(
+                port, 'POST', f'/sessions/{session_id}/chat', {'question': f'客户{i}的第{turn}个问题：统计性别分布'})
+            statuses.append(status)
+            if status == 200 and events and events[-1].get('status') == 'ok':
+                latencies.append(time.perf_counter() - start)
+                if first_token is not None:
+                    first_tokens.append(first_token)
+        await http_request(port, 'DELETE', f'/sessions/{session_id}')
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    wall = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'turns': len(statuses),
+        'ok': len(latencies),
+        'rejected': sum(status == 429 for status in statuses),
+        'p50': _percentile(latencies, 0.5),
+        'p95': _percentile(latencies, 0.95),
+        'p99': _percentile(latencies, 0.99),
+        'ttft_p50': _percentile(first_tokens, 0.5),
+        'throughput': len(latencies) / wall,
+    }
+
+
+async def main(args):
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'telco.db')
+    create_telco_db(db_path)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(db_path, check_same_thread=False),
+                                  size=args.tool_workers)
+    run_sql.set_connection_pool(pool)
+
+    stub = StubOpenAIServer(latency=args.latency)
+    stub_server = await asyncio.start_server(stub.handle, '127.0.0.1', 0, backlog=1024)
+    stub_port = stub_server.sockets[0].getsockname()[1]
+    env_path = os.path.join(workdir, '.env')
+    with open(env_path, 'w') as file:
+        file.write(f"DS_API_KEY=stub\nDS_API_URL=http://127.0.0.1:{stub_port}/v1\n")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent = DataFlowAgent(llm_api=LlmBox(env_path=env_path), namespace={}, compact_history=False,
+                              available_functions=AvailableFunctions(functions_list=[sql_inter]))
+    service = AgentService(agent, max_active_turns=args.max_active_turns, max_pending_turns=args.max_pending_turns,
+                           tool_workers=args.tool_workers, max_sessions=max(args.levels) * 2)
+    await service.start('127.0.0.1', 0)
+
+    print(f"{'并发':>6}{'对话数':>8}{'成功':>6}{'拒绝':>6}{'p50':>8}{'p95':>8}{'p99':>8}{'首token':>9}{'吞吐(轮/s)':>12}")
+    try:
+        for level in args.levels:
+            row = await run_level(service.port, level, args.turns)
+            print(f"{row['concurrency']:>6}{row['turns']:>8}{row['ok']:>6}{row['rejected']:>6}"
+                  f"{row['p50']:>8.3f}{row['p95']:>8.3f}{row['p99']:>8.3f}{row['ttft_p50']:>9.3f}"
+                  f"{row['throughput']:>12.2f}")
+    finally:
+        await service.close()
+        stub_server.close()
+        run_sql.set_connection_pool(None)
+        pool.close()
+    print(json.dumps(service.get_stats(), ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.2, help='模拟的单次大模型调用延迟（秒）')
+    parser.add_argument('--levels', type=lambda s: [int(x) for x in s.split(',')], default=[1, 4, 16, 32])
+    parser.add_argument('--turns', type=int, default=2, help='每个客户端连续提问的次数')
+    parser.add_argument('--max_active_turns', type=int, default=16)
+    parser.add_argument('--max_pending_turns', type=int, default=32)
+    parser.add_argument('--tool_workers', type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,1448 @@
+from fixtures import StubLlm
+
+from data_analyst_agent.core.messages import ChatMessages
+from data_analyst_agent.core.compaction import SessionCompactor, CompactionJob, SESSION_STATE_PREFIX
+
+
+def test_llm_fallback_only_on_timeouts_before_the_first_token(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    import httpx
+    import openai
+    import pytest
+    from openai.types.chat.chat_completion_message import ChatCompletionMessage
+    from data_analyst_agent.api import llms
+
+    class FakeClient:
+        max_retries = 2
+
+        def __init__(self, outcomes):
+            self.outcomes = outcomes
+            self.calls = []
+            self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+        def with_options(self, max_retries):
+            return self
+
+        def create(self, **kwargs):
+            self.calls.append(kwargs)
+            outcome = self.outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            if kwargs.get('stream'):
+                return iter(outcome)
+            choices = [SimpleNamespace(message=ChatCompletionMessage(role='assistant', content=outcome))] \
+                * kwargs.get('n', 1)
+            return SimpleNamespace(choices=choices, usage=None)
+
+    def chunk(text):
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text,
+                                                                                        tool_calls=None))])
+
+    def broken_stream(*texts):
+        yield from (chunk(text) for text in texts)
+        raise httpx.ReadTimeout('read timeout')
+
+    request = httpx.Request('POST', 'http://llm/chat/completions')
+    server_error = openai.InternalServerError('busy', response=httpx.Response(500, request=request), body=None)
+    (tmp_path / '.env').write_text('DS_API_KEY=test\nDS_API_URL=http://llm\n', encoding='utf-8')
+    monkeypatch.setattr(llms, 'RETRY_BACKOFF', 0)
+
+    def make_box(strong, fallback):
+        profiles = {'strong': llms.ModelProfile('strong-model', fallback='fallback'),
+                    'fallback': llms.ModelProfile('fallback-model')}
+        box = llms.LlmBox(env_path=str(tmp_path / '.env'), profiles=profiles)
+        clients = {'strong-model': FakeClient(strong), 'fallback-model': FakeClient(fallback)}
+        box.get_client = lambda profile: clients[profile.model_name]
+        return box, clients['strong-model'], clients['fallback-model']
+
+    # 超时以外的可重试错误仍然重试，不切换备用模型
+    box, strong, fallback = make_box([server_error, '主模型回答'], [])
+    assert box.chat('你好').content == '主模型回答'
+    assert len(strong.calls) == 2 and not fallback.calls
+
+    # 超时立即切换，chat_n使用同样的路由
+    box, strong, fallback = make_box([openai.APITimeoutError(request=request)], ['备用回答'])
+    assert [m.content for m in box.chat_n([{'role': 'user', 'content': '你好'}], n=2)] == ['备用回答'] * 2
+    assert fallback.calls[0]['n'] == 2 and box.get_metrics()['main']['fallbacks'] == 1
+
+    # 流式输出在第一段文本之前超时时切换，之后超时则直接报错，不重复输出
+    tokens = []
+    box, strong, fallback = make_box([broken_stream()], [[chunk('备用'), chunk('回答')]])
+    assert box.chat('你好', on_token=tokens.append).content == '备用回答'
+    box, strong, fallback = make_box([broken_stream('主模型'), [chunk('不应输出')]], [[chunk('不应输出')]])
+    with pytest.raises(openai.APITimeoutError):
+        box.chat('你好', on_token=tokens.append)
+    assert tokens == ['备用', '回答', '主模型'] and len(strong.calls) == 1 and not fallback.calls
+
+
+def test_token_counter_counts_and_memoizes_by_content():
+    import gc
+    import weakref
+    import threading
+    from data_analyst_agent.core.tokens import TokenCounter, HeuristicTokenizer, MESSAGE_OVERHEAD
+
+    class Message:
+        def __init__(self, role, content):
+            self.role = role
+            self.content = content
+            self.tool_calls = None
+
+    counter = TokenCounter(HeuristicTokenizer(), cache_size=2)
+    # 中文字符按1个token计算，其余字符按4个字符1个token计算
+    assert counter.count_text('流失率churn') == 3 + 2
+    message = Message('user', '流失率churn')
+    assert counter.count_message(message) == MESSAGE_OVERHEAD + 5
+    assert (counter.hits, counter.misses) == (1, 1)
+    # 内容相同的新消息命中缓存，内容被修改后重新计算
+    assert counter.count_message({'role': 'user', 'content': '流失率churn'}) == MESSAGE_OVERHEAD + 5
+    message.content = '在网时长'
+    assert counter.count_message(message) == MESSAGE_OVERHEAD + 4
+    assert (counter.hits, counter.misses) == (2, 2)
+
+    # 缓存不持有消息的引用
+    reference = weakref.ref(message)
+    del message
+    gc.collect()
+    assert reference() is None
+
+    # 命中的内容移到最近使用的位置，淘汰最久未使用的内容
+    counter.count_text('合约类型')
+    counter.count_text('在网时长')
+    counter.count_text('流失率churn')
+    counter.count_text('在网时长')
+    assert (counter.hits, counter.misses) == (4, 4)
+
+    # 多个线程共享同一个计数器
+    texts = [f'第{i}个问题' for i in range(50)]
+    threads = [threading.Thread(target=lambda: [counter.count_text(t) for t in texts]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(counter._cache) == 2 and counter.hits + counter.misses == 8 + 8 * 50
+
+
+def test_eviction_keeps_tool_call_pairs_together_and_never_evicts_the_current_turn():
+    from fixtures import tool_call_message
+
+    messages = ChatMessages(question='第一个问题', tokenizer='heuristic')
+    messages.messages_append(tool_call_message('python_inter', {'py_code': 'res = 1'}))
+    messages.messages_append({"role": "tool", "content": '结果' * 50, "tool_call_id": 'call_0'})
+    messages.messages_append({"role": "assistant", "content": '回答'})
+    messages.messages_append({"role": "user", "content": '第二个问题'})
+    messages.messages_append({"role": "assistant", "content": '第二个回答'})
+    roles = lambda: [m['role'] if isinstance(m, dict) else m.role for m in messages.history_messages]
+
+    # 预算的边界落在函数调用与其结果之间：只淘汰函数调用消息即可满足预算，但结果必须一起淘汰
+    user_tokens = messages.count_tokens(messages.history_messages[0])
+    call_tokens = messages.count_tokens(messages.history_messages[1])
+    messages.tokens_thr = messages.tokens_count - user_tokens - call_tokens + 1
+    messages.messages_pop()
+    assert roles() == ['assistant', 'user', 'assistant']
+    assert messages.tokens_count == sum(messages.count_tokens(m) for m in messages.history_messages)
+
+    # 当前轮对话超出预算时也不会被淘汰
+    messages.tokens_thr = 1
+    messages.messages_pop()
+    assert roles() == ['user', 'assistant']
+    assert messages.history_messages[0]['content'] == '第二个问题'
+    messages.messages_append(tool_call_message('python_inter', {'py_code': 'res = 2'}, call_id='call_1'))
+    messages.messages_append({"role": "tool", "content": '结果', "tool_call_id": 'call_1'})
+    assert roles() == ['user', 'assistant', 'assistant', 'tool']
+
+
+def test_forked_messages_are_isolated_in_both_directions():
+    parent = ChatMessages(system_content_list=['数据字典'], question='第一个问题', tokenizer='heuristic')
+    for i in range(5):
+        parent.messages_append({"role": "assistant", "content": f"回答{i}"})
+        parent.messages_append({"role": "user", "content": f"问题{i}"})
+    before = [dict(m) for m in parent.messages]
+    tokens = parent.tokens_count
+
+    child = parent.copy()
+    # 子对象的追加、删除、修改和淘汰不影响父对象
+    child.messages_append({"role": "assistant", "content": "子对象的回答"})
+    child.messages_pop(manual=True, index=3)
+    child.update_content(0, '修改后的问题')
+    child.add_system_messages('补充的数据字典')
+    child.tokens_thr = child.tokens_count - 10
+    child.messages_pop()
+    assert child.history_messages[0]['content'] != '修改后的问题'
+    assert parent.messages == before and parent.tokens_count == tokens
+    assert child.history_messages[-1]['content'] == "子对象的回答"
+
+    # 父对象的修改不影响子对象
+    snapshot = [dict(m) for m in child.messages]
+    child_tokens = child.tokens_count
+    grandchild = child.copy()
+    parent.messages_append({"role": "assistant", "content": "父对象的回答"})
+    parent.update_content(1, '父对象修改的回答')
+    parent.messages_pop(manual=True)
+    parent.messages_pop(manual=True)
+    assert child.messages == snapshot and child.tokens_count == child_tokens
+    assert grandchild.messages == snapshot
+    assert parent.history_messages[1]['content'] == '父对象修改的回答'
+    assert parent.tokens_count == sum(parent.count_tokens(m) for m in parent.messages)
+
+
+def _long_session(compactor, turns=12):
+    messages = ChatMessages(system_content_list=['数据字典'], question='第0个问题',
+                            tokens_thr=600, tokenizer='heuristic', compactor=compactor)
+    messages.messages_append({"role": "assistant", "content": "回答" * 20})
+    for i in range(1, turns):
+        messages.messages_append({"role": "user", "content": f"第{i}个问题"})
+        messages.messages_append({"role": "assistant", "content": "回答" * 20})
+    return messages
+
+
+def test_compaction_replaces_oldest_turns_with_session_state():
+    llm = StubLlm('1、已加载的数据表：user_demographics -> df')
+    compactor = SessionCompactor(llm, high_water=0.5, keep_turns=2, background=False)
+    messages = _long_session(compactor)
+
+    assert messages.session_state['content'].startswith(SESSION_STATE_PREFIX)
+    assert all(call['route'] == 'compaction' for call in llm.calls)
+    assert messages.history_messages[-1]['content'] == "回答" * 20
+    assert compactor.metrics['tokens_saved'] > 0
+    assert messages.tokens_count < 600
+    # 会话状态位于系统消息之后、历史消息之前
+    assert messages.messages[1] is messages.session_state
+
+
+def test_background_compaction_applies_on_next_append():
+    llm = StubLlm('摘要')
+    compactor = SessionCompactor(llm, high_water=0.5, keep_turns=2, background=True)
+    messages = _long_session(compactor)
+    compactor.wait(messages)
+
+    assert compactor.metrics['compactions'] >= 1
+    assert messages.session_state is not None
+    roles = [m['role'] for m in messages.history_messages]
+    assert roles[0] == 'user'
+
+
+def test_pending_compaction_belongs_to_its_history_and_skips_no_op_applies():
+    import threading
+    release = threading.Event()
+
+    def responder(messages, route):
+        release.wait(5)
+        return '摘要'
+
+    compactor = SessionCompactor(StubLlm(responder), high_water=0.5, keep_turns=2, background=True)
+    parent = _long_session(compactor)
+    assert parent in compactor._pending
+    child = parent.copy()
+    release.set()
+    compactor._pending[parent].future.result()
+
+    # copy得到的对话历史共享压缩器，但不会应用父对象的压缩任务
+    child.messages_append({"role": "user", "content": "子会话的问题"})
+    assert child.session_state is None
+    compactor.wait(parent)
+    assert parent.session_state is not None
+    assert compactor.metrics['compactions'] == 1
+
+    # 被压缩的消息已不在历史中时，应用任务不做任何修改
+    saved = compactor.metrics['tokens_saved']
+    tokens = parent.tokens_count
+    compactor.apply(parent, compactor._run(CompactionJob(list(child._history)[:2]), None))
+    assert (compactor.metrics['compactions'], compactor.metrics['tokens_saved']) == (1, saved)
+    assert parent.tokens_count == tokens and saved > 0
+
+
+def test_blob_store_offloads_past_the_threshold_and_slices_rows_columns_and_bytes(tmp_path):
+    import json
+    from data_analyst_agent.core.blob_store import BlobStore
+
+    store = BlobStore(inline_limit=100, preview_chars=60, memory_limit=10 ** 6)
+    # 不超过阈值的结果原样返回
+    assert store.offload('x' * 100) == 'x' * 100 and len(store) == 0
+
+    rows = [{'id': i, 'name': f'用户{i}', 'charge': i * 1.5} for i in range(20)]
+    content = json.dumps(rows, ensure_ascii=False)
+    result = store.offload(content)
+    assert len(store) == 1 and store.get('blob_1') == content
+    preview, reference = result.split('\n...')
+    assert preview.startswith('[共20行，前') and json.loads(preview.split('\n', 1)[1])[0] == rows[0]
+    assert 'blob_1' in reference and 'fetch_blob' in reference
+    assert store.bytes_offloaded == len(content.encode('utf-8')) - len(result.encode('utf-8'))
+
+    # JSON结果按行、列读取
+    assert json.loads(store.slice('blob_1', rows='3:5')) == rows[3:5]
+    assert json.loads(store.slice('blob_1', rows=[18, 30])) == rows[18:]
+    assert json.loads(store.slice('blob_1', rows=7, columns=['name'])) == [{'name': '用户7'}]
+    table = json.dumps([[r['id'], r['name']] for r in rows], ensure_ascii=False)
+    store.offload(table)
+    assert json.loads(store.slice('blob_2', rows='1:3', columns=[1])) == [['用户1'], ['用户2']]
+
+    # 普通文本按行读取，按字节范围读取时不会输出截断的多字节字符
+    text = '\n'.join(f'第{i}行日志' for i in range(50))
+    store.offload(text)
+    assert store.slice('blob_3', rows='10:12') == '第10行日志\n第11行日志'
+    assert store.slice('blob_3', start=0, end=5) == '第0'
+    assert store.slice('blob_3', start=1, end=6) == '0'
+    assert store.slice('blob_3', start=len('第0行日志\n'.encode('utf-8'))).startswith('第1行日志')
+
+    # 超出内存上限后写入磁盘，读取结果不变
+    spilled = BlobStore(inline_limit=10, memory_limit=len(content.encode('utf-8')), spill_dir=str(tmp_path))
+    spilled.offload(content)
+    spilled.offload(text)
+    assert spilled.bytes_spilled > 0 and spilled.get('blob_1') == content
+    assert json.loads(spilled.slice('blob_1', rows='0:1')) == rows[:1]
+
+
+def _echo(text, g='globals()'):
+    return f"已记录：{text}"
+
+
+_ECHO_DESC = [{"type": "function", "function": {"name": "_echo", "description": "记录文本",
+                                                "parameters": {"type": "object", "properties": {"text": {"type": "string"}}}}}]
+
+
+TELCO_DICTIONARY = """## user_demographics
+用户人口统计信息表
+| 字段名 | 说明 | 类型 |
+|---|---|---|
+| gender | 性别 | VARCHAR |
+| SeniorCitizen | 是否为老年用户 | INT |
+## user_payments
+用户账单信息表
+| 字段名 | 说明 | 类型 |
+|---|---|---|
+| tenure | 在网时长（月） | INT |
+| MonthlyCharges | 月费用 | DOUBLE |
+## user_services
+用户订阅服务信息表
+| 字段名 | 说明 | 类型 |
+|---|---|---|
+| InternetService | 网络服务类型 | VARCHAR |
+"""
+
+
+def test_retrieval_query_keeps_the_turn_question_and_recent_tool_arguments():
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.retrieval import DictionaryIndex
+
+    messages = ChatMessages(question='老年用户的占比是多少？', tokenizer='heuristic',
+                            retriever=DictionaryIndex([TELCO_DICTIONARY], top_k=4, token_budget=1000))
+    # 没有函数调用的回答不参与检索
+    messages.messages_append({"role": "assistant", "content": "我会先查看InternetService字段"})
+    for i in range(8):
+        messages.messages_append(tool_call_message('sql_inter', {'sql_query': f"SELECT tenure FROM user_payments "
+                                                                              f"LIMIT {i}"}, call_id=f'call_{i}'))
+        messages.messages_append({"role": "tool", "content": "tenure\n1", "tool_call_id": f'call_{i}'})
+    messages.refresh_retrieved_context()
+
+    query = messages._retrieval_query
+    assert query.startswith('老年用户的占比是多少？') and query.count('SELECT tenure') == 3
+    assert 'InternetService' not in query and 'sql_inter' not in query
+    context = messages.retrieved_context['content']
+    assert 'SeniorCitizen' in context and 'tenure' in context and 'InternetService' not in context
+
+
+def test_agent_indexes_only_dictionary_documents():
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.retrieval import is_dictionary
+
+    instructions = '回答时请先给出结论，再给出计算过程。'
+    agent = DataFlowAgent(llm_api=StubLlm('好的'), namespace={}, compact_history=False,
+                          system_content_list=[instructions, TELCO_DICTIONARY], dictionary_token_budget=50)
+    assert is_dictionary(TELCO_DICTIONARY) and not is_dictionary(instructions)
+    assert agent.retriever is not None
+    assert all(instructions not in section.text for section in agent.retriever.sections)
+    # 指令仍然整体作为系统消息，数据字典只注入检索到的片段
+    assert [m['content'] for m in agent.messages.system_messages] == [instructions]
+
+
+def test_chat_turn_runs_long_tool_chain_with_constant_stack_depth():
+    import sys
+    import inspect
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.chat_engine import get_chat_response, TurnBudget
+
+    rounds = sys.getrecursionlimit() + 100
+    depths = []
+
+    def responder(messages, route):
+        depths.append(len(inspect.stack(0)))
+        if len(depths) > rounds:
+            return '分析完成'
+        return tool_call_message('_echo', {'text': str(len(depths))}, call_id=f'call_{len(depths)}')
+
+    af = AvailableFunctions(functions_list=[_echo], functions=_ECHO_DESC)
+    messages = ChatMessages(question='开始', tokenizer='heuristic')
+    result = get_chat_response(StubLlm(responder), messages, available_functions=af,
+                               budget=TurnBudget(max_steps=None))
+
+    assert result.history_messages[-1].content == '分析完成'
+    assert max(depths) == min(depths)
+
+
+def test_chat_turn_budget_and_step_hook_stop_the_turn():
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.chat_engine import get_chat_response, TurnBudget
+
+    af = AvailableFunctions(functions_list=[_echo], functions=_ECHO_DESC)
+    llm = StubLlm(lambda messages, route: tool_call_message('_echo', {'text': 'x'}))
+
+    get_chat_response(llm, ChatMessages(question='开始', tokenizer='heuristic'), available_functions=af,
+                      budget=TurnBudget(max_steps=7))
+    # 大模型调用与函数运行交替进行，第7步之前共调用4次大模型
+    assert len(llm.calls) == 4
+
+    actions = []
+
+    def hook(state):
+        actions.append(state.action)
+        return state.tool_calls < 2
+
+    llm.calls.clear()
+    get_chat_response(llm, ChatMessages(question='开始', tokenizer='heuristic'), available_functions=af,
+                      step_hook=hook)
+    assert len(llm.calls) == 2
+    assert actions[:4] == ['chat', 'code', 'check', 'chat']
+
+
+def test_parallel_debugger_commits_only_the_winning_candidate():
+    import pandas as pd
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.parallel_debug import ParallelDebugger, CANDIDATE_HINTS
+    from data_analyst_agent.functions_lib import python_inter
+
+    codes = ["df['x'] = 0\nres = df['missing']", "df['y'] = df['a'] * 2\nres = df['y'].sum()", "res = undefined"]
+
+    def responder(messages, route):
+        prompt = messages[-1]['content']
+        index = next((i for i, hint in enumerate(CANDIDATE_HINTS) if hint and prompt.endswith(hint)), 0)
+        return tool_call_message('python_inter', {'py_code': codes[index]})
+
+    namespace = {'df': pd.DataFrame({'a': [1, 2, 3]})}
+    original = namespace['df']
+    af = AvailableFunctions(functions_list=[python_inter])
+    debugger = ParallelDebugger(StubLlm(responder), af, n_candidates=3)
+    messages = ChatMessages(question='计算a的两倍之和', tokenizer='heuristic')
+    result = debugger.run(messages, namespace)
+
+    assert result.success and result.winner.index == 1
+    assert namespace['res'] == 12
+    assert list(namespace['df'].columns) == ['a', 'y']
+    # 候选方案在快照上运行，原始DataFrame不受影响
+    assert list(original.columns) == ['a']
+    assert debugger.get_metrics()['fix_rate'] == 1.0
+
+
+def test_parallel_debugger_interrupts_running_losers_and_copies_only_referenced_frames():
+    import time
+    import pandas as pd
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.parallel_debug import ParallelDebugger, CANDIDATE_HINTS, snapshot_namespace, \
+        referenced_names
+    from data_analyst_agent.functions_lib import python_inter
+
+    codes = ["import time\ntime.sleep(0.3)\nres = len(df)", "import time\nfor i in range(1000):\n    time.sleep(0.01)"]
+
+    def responder(messages, route):
+        prompt = messages[-1]['content']
+        index = next((i for i, hint in enumerate(CANDIDATE_HINTS) if hint and prompt.endswith(hint)), 0)
+        return tool_call_message('python_inter', {'py_code': codes[index]}, call_id=f'call_{index}')
+
+    namespace = {'df': pd.DataFrame({'a': [1, 2, 3]}), 'other': pd.DataFrame({'b': [1]})}
+    call = tool_call_message('python_inter', {'py_code': codes[0]})
+    snapshot = snapshot_namespace(namespace, referenced_names(call))
+    assert snapshot['df'] is not namespace['df'] and snapshot['other'] is namespace['other']
+
+    debugger = ParallelDebugger(StubLlm(responder), AvailableFunctions(functions_list=[python_inter]), n_candidates=2)
+    result = debugger.run(ChatMessages(question='统计行数', tokenizer='heuristic'), namespace)
+    assert result.winner.index == 0 and namespace['res'] == 3
+    assert result.candidates[1].cancelled
+
+    # 正在运行的落选方案被看门狗中断，关闭线程池时无需等待其运行完毕（约10秒）
+    start = time.perf_counter()
+    debugger.close(wait=True)
+    assert time.perf_counter() - start < 5
+    assert 'i' not in namespace
+
+
+def test_static_validation_rejects_before_execution():
+    import sqlite3
+    import pandas as pd
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.validation import StaticValidator, SchemaCatalog, load_schema, VALIDATOR_KEY
+    from data_analyst_agent.utils.helpers import function_to_call
+
+    executed = []
+
+    def run_query(sql_query, g='globals()'):
+        executed.append(sql_query)
+        return 'ok'
+
+    def run_code(py_code, g='globals()'):
+        executed.append(py_code)
+        return 'ok'
+
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE user_payments (customerID TEXT, MonthlyCharges REAL)')
+    catalog = SchemaCatalog(loader=lambda: load_schema(connection))
+    namespace = {'df': pd.DataFrame({'gender': ['Male']}), VALIDATOR_KEY: StaticValidator(catalog)}
+    af = AvailableFunctions(functions_list=[run_query, run_code], functions=[{}])
+
+    calls = [
+        ('run_code', {'py_code': "res = df['Gender'].value_counts()"}),
+        ('run_code', {'py_code': "res = undefined_df.head()"}),
+        ('run_code', {'py_code': "res = df['gender'].value_counts("}),
+        ('run_query', {'sql_query': "SELECT * FROM user_payment"}),
+        ('run_query', {'sql_query': "SELECT p.MonthlyCharge FROM user_payments p"}),
+        ('run_query', {'sql_query': "SELECT p.MonthlyCharges FROM user_payments AS p"}),
+        # 通过loc赋值或运行时才能确定的字段名新增字段，之后读取这些字段不报错
+        ('run_code', {'py_code': "df.loc[:, 'b'] = 1\nres = df['b']"}),
+        ('run_code', {'py_code': "for c in ['x']:\n    df[c + '_z'] = 1\nres = df['x_z']"}),
+    ]
+    responses = [function_to_call(af, tool_call_message(name, args), namespace=namespace)['content']
+                 for name, args in calls]
+
+    assert all('报错' in content and '代码未执行' in content for content in responses[:5])
+    assert "可能是：gender" in responses[0] and "可能是：user_payments" in responses[3]
+    assert responses[5:] == ['ok'] * 3 and executed == ["SELECT p.MonthlyCharges FROM user_payments AS p",
+                                                         calls[6][1]['py_code'], calls[7][1]['py_code']]
+    metrics = namespace[VALIDATOR_KEY].get_metrics()
+    assert metrics['round_trips_avoided'] == 5
+    assert metrics['rejected_by_kind'] == {'column': 2, 'name': 1, 'syntax': 1, 'table': 1}
+    assert catalog.loads == 1
+
+
+def test_validate_sql_skips_system_schemas_dual_and_other_databases():
+    import sqlite3
+    import pytest
+    from data_analyst_agent.core.validation import SchemaCatalog, ValidationError, load_schema, validate_sql
+
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE user_payments (customerID TEXT, MonthlyCharges REAL)')
+    catalog = SchemaCatalog(loader=lambda: ('telco', load_schema(connection)))
+    tables = catalog.get()
+    assert catalog.database == 'telco'
+
+    for sql in ["SELECT 1 FROM dual",
+                "SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = 'telco'",
+                "SELECT * FROM performance_schema.events_statements_summary_by_digest",
+                "SELECT user FROM mysql.user",
+                # 其他数据库中的表（包括与当前数据库同名的表）不检查
+                "SELECT o.amount FROM sales.orders o",
+                "SELECT p.MonthlyCharges, sales.user_payments.anything FROM user_payments p "
+                "JOIN sales.user_payments ON p.customerID = sales.user_payments.customerID",
+                "SELECT p.MonthlyCharges FROM telco.user_payments p",
+                # 字符串中的#、--、/*不是注释
+                "SELECT * FROM user_payments WHERE customerID = '#abc'",
+                "SELECT COUNT(*) FROM user_payments WHERE customerID LIKE '%--%' /* 'x */ -- it's"]:
+        validate_sql(sql, tables, catalog.database)
+
+    # 当前数据库中的表和字段仍然检查
+    with pytest.raises(ValidationError) as error:
+        validate_sql("SELECT * FROM telco.user_payment", tables, catalog.database)
+    assert error.value.kind == 'table'
+    with pytest.raises(ValidationError) as error:
+        validate_sql("SELECT p.MonthlyCharge FROM telco.user_payments p", tables, catalog.database)
+    assert error.value.kind == 'column'
+    # 不知道当前数据库名时不检查带数据库名前缀的表
+    validate_sql("SELECT * FROM telco.user_payment", tables)
+    with pytest.raises(ValidationError, match="引号'未闭合"):
+        validate_sql("SELECT * FROM user_payments WHERE customerID = '#abc", tables)
+
+
+def test_batch_runner_isolates_sessions_and_runs_concurrently(tmp_path):
+    import json
+    import time
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.batch import run_batch
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.functions_lib import python_inter
+
+    def responder(messages, route):
+        time.sleep(0.2)
+        last = messages[-1]
+        if isinstance(last, dict) and last['role'] == 'tool':
+            return f"结果：{last['content']}"
+        question = messages[-1]['content']
+        # 每个会话先检查变量空间中没有其他问题留下的变量，再创建自己的变量
+        code = f"assert 'value' not in globals()\nvalue = {len(question)}\nres = value * 2"
+        return tool_call_message('python_inter', {'py_code': code})
+
+    agent = DataFlowAgent(llm_api=StubLlm(responder), namespace={}, compact_history=False,
+                          available_functions=AvailableFunctions(functions_list=[python_inter]))
+    questions = tmp_path / 'questions.jsonl'
+    questions.write_text('\n'.join(json.dumps({'id': f'q{i}', 'question': '问' * i}) for i in range(1, 7)),
+                         encoding='utf-8')
+    output = tmp_path / 'results.jsonl'
+
+    summary = run_batch(agent, questions, output, concurrency=6, db_pool_size=0)
+    records = {r['id']: r for r in map(json.loads, output.read_text(encoding='utf-8').splitlines())}
+
+    assert summary['ok'] == 6
+    # 6个问题各需要2次0.2秒的大模型调用，并发运行时总耗时远小于串行的2.4秒
+    assert summary['wall_time'] < 1.5
+    assert "'value': 3" in records['q3']['answer']
+    assert [t['name'] for t in records['q5']['tool_trace']] == ['python_inter']
+    assert records['q5']['tool_trace'][0]['error'] is False
+    assert records['q5']['llm_calls'] == 2 and records['q5']['latency'] > 0.4
+    assert 'value' not in agent.namespace
+
+
+def test_connection_pool_drops_interrupted_connections_and_batch_restores_rate_limiter():
+    import sqlite3
+    import pytest
+    from data_analyst_agent.api.rate_limiter import RateLimiter
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.batch import BatchRunner
+    from data_analyst_agent.functions_lib import run_sql
+
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(':memory:', check_same_thread=False), size=1,
+                                  timeout=0.1)
+    assert run_sql.ConnectionPool().timeout is not None
+    with pytest.raises(KeyboardInterrupt):
+        with pool.connection() as connection:
+            raise KeyboardInterrupt
+    # 被中断的连接直接关闭，不会归还给下一个会话
+    with pytest.raises(sqlite3.ProgrammingError):
+        connection.execute('SELECT 1')
+    assert pool._created == 0
+    with pool.connection() as first:
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+    pool.close()
+
+    llm = StubLlm('好的')
+    llm.rate_limiter = original = RateLimiter(600)
+    agent = DataFlowAgent(llm_api=llm, namespace={}, compact_history=False)
+    runner = BatchRunner(agent, concurrency=1, requests_per_minute=60, db_pool_size=0)
+    assert llm.rate_limiter is original
+    runner.run([{'id': 1, 'question': '你好'}])
+    assert llm.rate_limiter is original
+
+
+def test_service_streams_events_and_applies_backpressure():
+    import json
+    import time
+    import asyncio
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.service import AgentService
+
+    def responder(messages, route):
+        time.sleep(0.3)
+        return '性别分布基本均衡。'
+
+    agent = DataFlowAgent(llm_api=StubLlm(responder), namespace={}, compact_history=False)
+    service = AgentService(agent, max_active_turns=1, max_pending_turns=1)
+
+    async def request(method, path, data=None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', service.port)
+        body = json.dumps(data or {}).encode('utf-8')
+        writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        raw = await reader.read()
+        writer.close()
+        head, _, payload = raw.partition(b'\r\n\r\n')
+        return int(head.split()[1]), head, payload
+
+    async def main():
+        await service.start('127.0.0.1', 0)
+        try:
+            ids = [json.loads((await request('POST', '/sessions'))[2])['session_id'] for _ in range(3)]
+            results = await asyncio.gather(*(request('POST', f'/sessions/{i}/chat', {'question': '性别分布'})
+                                             for i in ids))
+            return results, service.get_stats()
+        finally:
+            await service.close()
+
+    results, stats = asyncio.run(main())
+    statuses = sorted(status for status, _, _ in results)
+    # 1个运行 + 1个排队，第3个对话被拒绝
+    assert statuses == [200, 200, 429]
+    status, head, payload = next(r for r in results if r[0] == 200)
+    assert b'Transfer-Encoding: chunked' in head
+    events = [json.loads(line) for line in payload.split(b'\r\n') if line.startswith(b'{')]
+    assert ''.join(e['text'] for e in events if e['type'] == 'token') == '性别分布基本均衡。'
+    assert events[-1]['type'] == 'done' and events[-1]['answer'] == '性别分布基本均衡。'
+    assert stats['rejected'] == 1 and stats['turns'] == 2
+
+
+def test_session_namespaces_are_isolated_and_reset_returns_memory():
+    import pytest
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.namespace import SessionNamespace, current_rss
+    from data_analyst_agent.functions_lib import python_inter
+
+    if current_rss() is None:
+        pytest.skip('无法获取进程的常驻内存')
+
+    def responder(messages, route):
+        last = messages[-1]
+        if isinstance(last, dict) and last['role'] == 'tool':
+            return '完成'
+        # 约160MB的DataFrame
+        code = "import numpy as np\nimport pandas as pd\ndf = pd.DataFrame(np.ones((4_000_000, 5)))"
+        return tool_call_message('python_inter', {'py_code': code})
+
+    af = AvailableFunctions(functions_list=[python_inter])
+    first = DataFlowAgent(llm_api=StubLlm(responder), available_functions=af, compact_history=False)
+    second = DataFlowAgent(llm_api=StubLlm(responder), available_functions=af, compact_history=False)
+    # 变量空间在首次使用时才创建
+    assert first._namespace is None and first.get_memory_usage() == {}
+
+    first.ask('加载数据')
+    assert isinstance(first.namespace, SessionNamespace)
+    assert 'df' in first.namespace and 'df' not in second.namespace
+    assert first.get_memory_usage()['df'] >= 160_000_000
+
+    before = current_rss()
+    released = first.reset()
+    after = current_rss()
+    assert released >= 160_000_000
+    assert 'df' not in first.namespace
+    assert before - after > 100_000_000
+
+
+def test_benchmark_compare_flags_regressions_beyond_threshold():
+    from benchmark import compare_reports
+
+    base = {'results': {'messages.copy[100]': {'median': 1e-6}, 'sql_inter.encode[100]': {'median': 1e-4},
+                        'fig_inter.bar': {'median': 0.05}}}
+    new = {'results': {'messages.copy[100]': {'median': 1.05e-6}, 'sql_inter.encode[100]': {'median': 1.5e-4},
+                       'extract_data[5000]': {'median': 0.01}}}
+    status = {row[0]: row[-1] for row in compare_reports(base, new, threshold=0.1)}
+    assert status == {'messages.copy[100]': 'ok', 'sql_inter.encode[100]': 'regression',
+                      'fig_inter.bar': 'missing', 'extract_data[5000]': 'new'}
+
+
+def test_tracing_records_nested_spans_and_exports(tmp_path):
+    import json
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.functions_lib import python_inter
+    from data_analyst_agent.utils.tracing import tracing, span, get_tracer, NOOP_SPAN
+
+    def responder(messages, route):
+        last = messages[-1]
+        if isinstance(last, dict) and last['role'] == 'tool' and '报错' not in last['content']:
+            return '完成'
+        if route == 'debug':
+            return tool_call_message('python_inter', {'py_code': 'res = 1 + 1'})
+        return tool_call_message('python_inter', {'py_code': 'res = 1 / 0'})
+
+    agent = DataFlowAgent(llm_api=StubLlm(responder), compact_history=False,
+                          available_functions=AvailableFunctions(functions_list=[python_inter]))
+    chrome_path, jsonl_path = tmp_path / 'trace.json', tmp_path / 'spans.jsonl'
+    with tracing(chrome_path=chrome_path, jsonl_path=jsonl_path) as tracer:
+        agent.ask('计算')
+
+    # 关闭追踪后不再记录
+    assert get_tracer() is None and span('x') is NOOP_SPAN
+    spans = [json.loads(line) for line in jsonl_path.read_text(encoding='utf-8').splitlines()]
+    by_name = {}
+    for item in spans:
+        by_name.setdefault(item['name'], []).append(item)
+    turn = by_name['turn'][0]
+    assert turn['parent_id'] is None and turn['attributes']['tool_calls'] == 2
+    first_tool, fixed_tool = by_name['python_inter']
+    debug = by_name['debug'][0]
+    assert first_tool['parent_id'] == turn['span_id'] and first_tool['attributes']['failed'] is True
+    assert debug['parent_id'] == turn['span_id'] and debug['attributes']['mode'] == 'efficient'
+    assert fixed_tool['parent_id'] == debug['span_id'] and fixed_tool['attributes']['failed'] is False
+    assert tracer.summary()['tool']['count'] == 2
+
+    events = json.loads(chrome_path.read_text(encoding='utf-8'))['traceEvents']
+    complete = [e for e in events if e['ph'] == 'X']
+    assert len(complete) == len(spans) and all(e['dur'] >= 0 for e in complete)
+
+
+def test_tool_schema_from_introspection_is_cached_by_source_hash(tmp_path):
+    import json
+    from typing import Optional, List
+    from data_analyst_agent.core.functions import AvailableFunctions, SchemaCache
+
+    def churn_rate(table:str, group_by:Optional[List[str]]=None, threshold:float=0.5, g='globals()'):
+        """
+        按分组统计流失率，返回JSON格式的结果
+        :param table: 数据表名称，例如user_churn
+        :param group_by: 分组字段
+        :return: JSON格式的统计结果
+        """
+
+    cache = SchemaCache(tmp_path)
+    llm = StubLlm(json.dumps({'description': '按任意字段分组统计用户流失率',
+                              'parameters': {'properties': {'table': {'description': '流失标记所在的数据表'}}}},
+                             ensure_ascii=False))
+
+    af = AvailableFunctions(functions_list=[churn_rate], llm_api=llm, schema_cache=cache)
+    schema = af.functions[0]['function']
+    assert llm.calls == [] and cache.metrics == {'hits': 0, 'misses': 1}
+    assert schema['description'] == '按分组统计流失率，返回JSON格式的结果'
+    assert schema['parameters']['required'] == ['table']
+    assert schema['parameters']['properties']['group_by'] == {
+        'type': 'array', 'items': {'type': 'string'}, 'description': '分组字段'}
+    assert schema['parameters']['properties']['threshold']['type'] == 'number'
+    assert 'g' not in schema['parameters']['properties']
+
+    # 再次启动：直接读取磁盘缓存
+    warm = AvailableFunctions(functions_list=[churn_rate], schema_cache=SchemaCache(tmp_path))
+    assert warm.functions == af.functions and warm.schema_cache.metrics['hits'] == 1
+
+    # 可选的大模型完善：只替换文字说明，结果同样被缓存
+    enriched = AvailableFunctions(functions_list=[churn_rate], llm_api=llm, enrich_schemas=True,
+                                  schema_cache=SchemaCache(tmp_path)).functions[0]['function']
+    assert len(llm.calls) == 1 and llm.calls[0]['route'] == 'schema'
+    assert enriched['description'] == '按任意字段分组统计用户流失率'
+    assert enriched['parameters']['properties']['table']['description'] == '流失标记所在的数据表'
+    assert enriched['parameters']['required'] == ['table']
+    AvailableFunctions(functions_list=[churn_rate], llm_api=llm, enrich_schemas=True, schema_cache=SchemaCache(tmp_path))
+    assert len(llm.calls) == 1
+
+
+def test_default_functions_include_export_data(tmp_path):
+    from data_analyst_agent import DEFAULT_FUNCTIONS, export_data
+    from data_analyst_agent.core.functions import AvailableFunctions, SchemaCache
+
+    af = AvailableFunctions(functions_list=list(DEFAULT_FUNCTIONS), schema_cache=SchemaCache(tmp_path))
+    schemas = {schema['function']['name']: schema['function'] for schema in af.functions}
+    assert 'export_data' in schemas and af.functions_dic['export_data'] is export_data
+    assert schemas['export_data']['parameters']['required'] == ['df_name']
+    assert set(schemas['export_data']['parameters']['properties']) == {'df_name', 'file_format'}
+    # 未设置项目时给出明确的提示
+    assert export_data('df', g={}).startswith('导出时报错')
+
+
+def test_session_store_appends_turns_and_resumes_last_turns(tmp_path):
+    from fixtures import tool_call_message
+    from openai.types.chat import ChatCompletionMessage
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.project import InterProject
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.functions_lib import python_inter
+
+    def responder(messages, route):
+        last = messages[-1]
+        if isinstance(last, dict) and last['role'] == 'tool':
+            return f"结果：{last['content']}"
+        return tool_call_message('python_inter', {'py_code': f"{len(last['content'])} * 2"})
+
+    def make_agent():
+        project = InterProject(project_name=str(tmp_path / 'project'), doc_name='messages')
+        return DataFlowAgent(llm_api=StubLlm(responder), namespace={}, compact_history=False, project=project,
+                             available_functions=AvailableFunctions(functions_list=[python_inter]))
+
+    agent = make_agent()
+    agent.ask('问')
+    agent.ask('问题')
+    assert agent.upload_messages() == agent.session_id
+    store = agent.project.session_store
+    # 每轮只追加本轮新增的消息：问题、tool_calls、外部函数结果和回答（第一轮还有ChatMessages默认的问题）
+    assert store.get_metrics()['messages'] == 9
+    assert store.list_sessions()[0]['turns'] == 2
+    store.close()
+
+    resumed = make_agent().resume(agent.session_id, last_turns=1)
+    history = resumed.messages.history_messages
+    assert [m['content'] for m in history if isinstance(m, dict) and m['role'] == 'user'] == ['问题']
+    assert isinstance(history[1], ChatCompletionMessage) and history[1].tool_calls[0].id == 'call_0'
+    assert history[-1]['content'] == '结果：4'
+
+    resumed.ask('第三个问题')
+    resumed.upload_messages()
+    assert resumed.project.list_sessions()[0]['turns'] == 3
+    assert len(resumed.project.load_last_turns(agent.session_id)) == 13
+    resumed.project.session_store.close()
+
+
+def test_checkpoint_restores_memory_mapped_namespace_and_writes_only_changes(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.blob_store import get_blob_store
+
+    agent = DataFlowAgent(llm_api=StubLlm(), namespace={}, compact_history=False)
+    agent.messages.messages_append({'role': 'assistant', 'content': '已完成数据提取。'})
+    df = pd.DataFrame({
+        'tenure': np.arange(1000),
+        'MonthlyCharges': np.linspace(20, 120, 1000),
+        'Contract': ['Month-to-month', 'One year'] * 500,
+        'signup': pd.date_range('2020-01-01', periods=1000, freq='D'),
+    }, index=pd.RangeIndex(1000, 2000))
+    df.attrs['source'] = 'user_payments'
+    namespace = agent.namespace
+    namespace.update(df=df, arr=np.ones((10, 3)), total=42, note='备注', fn=lambda x: x, np=np)
+    handle = get_blob_store(namespace).put('完整结果')
+
+    stats = agent.checkpoint(str(tmp_path / 'ckpt'))
+    assert stats['variables'] == 5 and set(stats['skipped']) == {'fn'}
+
+    restored = DataFlowAgent(llm_api=StubLlm(), namespace={}, compact_history=False)
+    restored.restore(path=str(tmp_path / 'ckpt'))
+    restored_df = restored.namespace['df']
+    pd.testing.assert_frame_equal(restored_df, df)
+    assert restored_df.attrs == {'source': 'user_payments'}
+    # 数值列直接使用内存映射的数组
+    base = restored_df['MonthlyCharges'].to_numpy()
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert isinstance(base, np.memmap)
+    assert restored.namespace['total'] == 42 and restored.namespace['arr'].shape == (10, 3)
+    assert restored.namespace['_blob_store'].get(handle) == '完整结果'
+    assert restored.messages.history_messages[-1]['content'] == '已完成数据提取。'
+
+    # 只修改一列后再次保存，只写入该列
+    restored_df.loc[restored_df['tenure'] < 10, 'MonthlyCharges'] = 0.0
+    stats = restored.checkpoint(str(tmp_path / 'ckpt'))
+    assert stats['written'] == 1
+    assert stats['reused'] > 1
+    again = DataFlowAgent(llm_api=StubLlm(), namespace={}, compact_history=False).restore(path=str(tmp_path / 'ckpt'))
+    assert again.namespace['df']['MonthlyCharges'].iloc[:10].eq(0).all()
+
+
+def test_artifact_store_deduplicates_figures_and_collects_unreferenced(tmp_path):
+    import pandas as pd
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.project import InterProject
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.artifact_store import ArtifactStore, QuotaExceededError
+    from data_analyst_agent.functions_lib import fig_inter, export_data
+    from data_analyst_agent.utils.helpers import function_to_call
+
+    project = InterProject(project_name=str(tmp_path / 'project'), doc_name='messages')
+    agent = DataFlowAgent(llm_api=StubLlm(), namespace={}, compact_history=False, project=project)
+    af = AvailableFunctions(functions_list=[fig_inter, export_data])
+    agent.namespace['df'] = pd.DataFrame({'Contract': ['Month-to-month', 'One year'], 'churn': [0.43, 0.11]})
+    code = "fig, ax = plt.subplots(figsize=(3, 2))\ndf.plot.bar(x='Contract', y='churn', ax=ax)"
+
+    results = [function_to_call(af, tool_call_message('fig_inter', {'py_code': code, 'fname': 'fig'},
+                                                      call_id=f'call_{i}'), namespace=agent.namespace)
+               for i in range(2)]
+    ids = [result['content'].rsplit('产物id为', 1)[1].rstrip('。') for result in results]
+    store = project.artifact_store
+    # 相同的图片只保存一份，两次调用各记录一次引用
+    assert ids[0] == ids[1]
+    info = store.info(ids[0])
+    assert info['kind'] == 'figure' and info['size'] > 0
+    assert [(ref['session'], ref['tool_call']) for ref in info['refs']] == \
+        [(agent.session_id, 'call_0'), (agent.session_id, 'call_1')]
+    with open(store.path(ids[0]), 'rb') as file:
+        assert file.read(4) == b'\x89PNG'
+
+    result = function_to_call(af, tool_call_message('export_data', {'df_name': 'df'}), namespace=agent.namespace)
+    csv_id = result['content'].rsplit('产物id为', 1)[1]
+    assert store.read_bytes(csv_id).decode('utf-8').startswith('Contract,churn')
+    assert {a['kind'] for a in store.list(session=agent.session_id)} == {'figure', 'frame'}
+
+    store.release(artifact_id=ids[0])
+    assert store.gc()['removed'] == 1
+    assert [a['id'] for a in store.list()] == [csv_id]
+
+    small = ArtifactStore(str(tmp_path / 'small'), quota_bytes=10)
+    small.put_bytes(b'x' * 6, ext='.bin')
+    try:
+        small.put_bytes(b'y' * 6, ext='.bin')
+        raise AssertionError('超出容量上限时应拒绝写入')
+    except QuotaExceededError:
+        pass
+
+
+def test_profile_data_reports_nulls_distincts_and_respects_token_budget():
+    import numpy as np
+    import pandas as pd
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.tokens import get_token_counter
+    from data_analyst_agent.functions_lib import profile_data
+    from data_analyst_agent.functions_lib.run_profile import profile_frame
+    from data_analyst_agent.utils.helpers import function_to_call
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'customerID': np.arange(20000),
+        'tenure': rng.integers(0, 73, 20000),
+        'TotalCharges': np.where(rng.random(20000) < 0.1, np.nan, rng.random(20000) * 8000),
+        'Contract': pd.array(rng.choice(['Month-to-month', 'One year', None], 20000), dtype='string'),
+    })
+    profile = {c['name']: c for c in profile_frame(df)['columns']}
+    assert profile['customerID']['distinct'] == 20000 and profile['tenure']['distinct'] == 73
+    assert abs(profile['TotalCharges']['null_rate'] - df['TotalCharges'].isna().mean()) < 1e-12
+    assert profile['Contract']['distinct'] == 2
+    assert abs(profile['Contract']['null_rate'] - df['Contract'].isna().mean()) < 1e-12
+
+    # 超过sample_rows时不重复值数量为HyperLogLog估计值
+    sampled = profile_frame(df, sample_rows=5000)
+    assert sampled['sampled'] and sampled['sample_rows'] == 5000
+    assert abs(sampled['columns'][0]['distinct'] / 20000 - 1) < 0.05
+    assert sampled['columns'][1]['distinct'] == 73
+
+    af = AvailableFunctions(functions_list=[profile_data])
+    namespace = {'df': df}
+    report = function_to_call(af, tool_call_message('profile_data', {'df_name': 'df'}), namespace=namespace)['content']
+    assert report.startswith('数据集df：20000行，4列') and 'Month-to-month' in report
+    short = function_to_call(af, tool_call_message('profile_data', {'df_name': 'df', 'max_tokens': 60}),
+                             namespace=namespace)['content']
+    assert get_token_counter().count_text(short) < get_token_counter().count_text(report)
+    assert 'Month-to-month' not in short
+    missing = function_to_call(af, tool_call_message('profile_data', {'df_name': 'df', 'columns': 'tenure,gender'}),
+                               namespace=namespace)['content']
+    assert 'gender' in missing
+
+
+def test_extract_sample_records_design_and_estimates_cover_truth(tmp_path):
+    import sqlite3
+    import pandas as pd
+    from fixtures import create_telco_db
+    from data_analyst_agent.functions_lib import run_sql
+    from data_analyst_agent.functions_lib.run_sql import extract_sample
+    from data_analyst_agent.utils.sampling import estimate_mean, estimate_proportion, estimate_total
+
+    db_path = create_telco_db(str(tmp_path / 'telco.db'), rows=5000)
+    full = pd.read_sql('SELECT * FROM user_payments', sqlite3.connect(db_path))
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(db_path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+    g = {}
+    try:
+        result = extract_sample('SELECT * FROM user_payments', 'df', size=1000, g=g)
+        df = g['df']
+        design = df.attrs['sampling']
+        assert '近似' in result and design['method'] == 'bernoulli' and design['population'] == 5000
+        assert 700 < len(df) < 1300 and design['layers'] == [[None, 5000, len(df)]]
+        mean = estimate_mean(df, 'MonthlyCharges')
+        # SQLite的RANDOM()不支持种子，按4倍标准误检查，避免偶然失败
+        assert abs(mean['estimate'] - full['MonthlyCharges'].mean()) < 4 * mean['stderr']
+        assert round(estimate_total(df)['estimate']) == 5000
+
+        extract_sample('SELECT * FROM user_payments', 'df', fraction=0.1, strata='Contract', g=g)
+        df = g['df']
+        layers = {value: (population, rows) for value, population, rows in df.attrs['sampling']['layers']}
+        assert layers.keys() == set(full['Contract'])
+        assert all(population == (full['Contract'] == value).sum() for value, (population, _) in layers.items())
+        share = estimate_proportion(df, 'PaymentMethod', 'Mailed check', by='Contract')
+        truth = full.groupby('Contract')['PaymentMethod'].apply(lambda s: (s == 'Mailed check').mean())
+        assert ((share['estimate'] - truth).abs() < 4 * share['stderr']).all()
+        # 筛选行之后按子总体估计
+        count = estimate_total(df[df['tenure'] > 36])
+        assert abs(count['estimate'] - (full['tenure'] > 36).sum()) < 4 * count['stderr']
+        # 全表数据的标准误为0
+        assert estimate_mean(full, 'MonthlyCharges')['stderr'] == 0
+    finally:
+        run_sql.set_connection_pool(None)
+        pool.close()
+
+
+def test_rollup_materializer_answers_hot_group_by_queries_from_rollups(tmp_path):
+    import json
+    import math
+    import sqlite3
+    from fixtures import create_telco_db
+    from data_analyst_agent.core.rollup import RollupMaterializer, parse_aggregate_query
+    from data_analyst_agent.functions_lib import run_sql
+    from data_analyst_agent.functions_lib.run_sql import sql_inter
+    from data_analyst_agent.utils.serialization import decode_results
+
+    db_path = create_telco_db(str(tmp_path / 'telco.db'), rows=2000)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(db_path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+    materializer = RollupMaterializer(str(tmp_path / 'rollups.db'), min_hits=2, refresh_interval=0,
+                                      watermarks={'user_payments': 'rowid'})
+    run_sql.set_rollup_materializer(materializer)
+
+    def direct(query):
+        with sqlite3.connect(db_path) as connection:
+            return json.loads(json.dumps(connection.execute(query).fetchall()))
+
+    def same(a, b):
+        return len(a) == len(b) and all(
+            all(math.isclose(u, v, rel_tol=1e-9) if isinstance(v, float) else u == v for u, v in zip(x, y))
+            for x, y in zip(a, b))
+
+    # 合成的查询日志：同一形态的查询筛选常量、排序不同
+    log = [
+        "SELECT Contract, AVG(MonthlyCharges) AS avg_charge, COUNT(*) n FROM user_payments GROUP BY Contract "
+        "ORDER BY n DESC",
+        "SELECT p.Contract, COUNT(*) FROM user_payments p WHERE p.tenure >= 12 GROUP BY p.Contract",
+        "SELECT Contract, AVG(MonthlyCharges) AS avg_charge, COUNT(*) n FROM user_payments GROUP BY Contract "
+        "ORDER BY n DESC",
+        "SELECT Contract, COUNT(*) FROM user_payments WHERE tenure < 6 GROUP BY Contract",
+        "SELECT contract, count(*) AS n, avg(MonthlyCharges) FROM user_payments GROUP BY contract ORDER BY 3",
+        "SELECT tenure, COUNT(*) FROM user_payments WHERE tenure BETWEEN 1 AND 12 "
+        "GROUP BY tenure ORDER BY 2 DESC, 1 LIMIT 1, 3",
+    ]
+    try:
+        for query in log:
+            assert same(decode_results(sql_inter(query))[1], direct(query))
+            # 汇总表在后台建立
+            materializer.wait()
+        stats = materializer.get_stats()
+        # 两种形态各自第二次出现时建立汇总表，之后的两条由汇总表回答（最后一条使用两个维度的汇总表）
+        assert stats['builds'] == 2 and stats['hits'] == 2 and stats['aggregate_queries'] == 6
+        assert stats['hit_rate'] == 2 / 6 and stats['seconds_saved'] >= 0
+
+        # 字符串维度上的筛选和排序在SQLite与MySQL中的排序规则不同，不改写，但结果仍然正确
+        for query in ["SELECT Contract, COUNT(*) FROM user_payments WHERE Contract = 'one year' GROUP BY Contract",
+                      "SELECT Contract, COUNT(*) FROM user_payments GROUP BY Contract ORDER BY Contract"]:
+            assert parse_aggregate_query(query) is not None
+            assert same(decode_results(sql_inter(query))[1], direct(query))
+        assert materializer.get_stats()['hits'] == 2
+
+        # 源数据表新增的行通过水位字段增量刷新
+        with sqlite3.connect(db_path) as connection:
+            connection.execute("INSERT INTO user_payments VALUES ('new-1', 3, 'Two year', 'No', 'Mailed check', "
+                               "99.5, 120.0)")
+        query = log[0]
+        assert same(decode_results(sql_inter(query))[1], direct(query))
+        assert materializer.get_stats()['hits'] == 3
+
+        # 多表、DISTINCT、OR条件等不改写
+        assert parse_aggregate_query("SELECT Contract, COUNT(DISTINCT customerID) FROM user_payments "
+                                     "GROUP BY Contract") is None
+        assert parse_aggregate_query("SELECT a.Contract, COUNT(*) FROM user_payments a JOIN user_churn c "
+                                     "ON a.customerID = c.customerID GROUP BY a.Contract") is None
+        assert parse_aggregate_query("SELECT Contract, COUNT(*) FROM user_payments WHERE tenure > 10 OR tenure < 2 "
+                                     "GROUP BY Contract") is None
+        assert '命中率' in materializer.report()
+    finally:
+        run_sql.set_rollup_materializer(None)
+        run_sql.set_connection_pool(None)
+        pool.close()
+        materializer.close()
+
+
+def test_rollup_materializer_keeps_decimal_results_exact():
+    import contextlib
+    import datetime
+    from decimal import Decimal
+    from data_analyst_agent.core.rollup import RollupMaterializer
+
+    class Source:
+        """按MySQL的返回类型给出汇总结果：SUM为DECIMAL，COUNT为整数，日期为date"""
+        def cursor(self):
+            return self
+
+        def execute(self, sql):
+            self.sql = sql
+
+        def fetchall(self):
+            # 维度contract、day、region，度量COUNT(*)、COUNT(amount)、MAX(day)、SUM(amount)
+            return [('a', datetime.date(2024, 1, 1), 'x', 1, 1, datetime.date(2024, 1, 1), Decimal('0.10')),
+                    ('a', datetime.date(2024, 1, 2), 'y', 2, 2, datetime.date(2024, 1, 2), Decimal('0.20')),
+                    ('b', datetime.date(2024, 1, 1), 'x', 1, 1, datetime.date(2024, 1, 1), Decimal('1.05'))]
+
+        def close(self):
+            pass
+
+    materializer = RollupMaterializer(connect=lambda: contextlib.nullcontext(Source()), min_hits=1,
+                                      refresh_interval=3600, background=False)
+    materializer.record("SELECT contract, day, region, SUM(amount), AVG(amount), MAX(day) FROM orders "
+                        "GROUP BY contract, day, region", 1.0)
+    try:
+        columns, rows = materializer.answer("SELECT contract, SUM(amount), AVG(amount) AS avg_amount, MAX(day) "
+                                            "FROM orders GROUP BY contract ORDER BY 2 DESC")
+        assert columns == ['contract', 'SUM(amount)', 'avg_amount', 'MAX(day)']
+        # 0.10 + 0.20在浮点数中为0.30000000000000004；AVG与MySQL一致保留SUM的小数位数加4位
+        assert rows == [('b', Decimal('1.05'), Decimal('1.050000'), datetime.date(2024, 1, 1)),
+                        ('a', Decimal('0.30'), Decimal('0.100000'), datetime.date(2024, 1, 2))]
+        assert materializer.answer("SELECT day, COUNT(*) FROM orders GROUP BY day ORDER BY day DESC")[1] == \
+            [(datetime.date(2024, 1, 2), 2), (datetime.date(2024, 1, 1), 2)]
+        # 日期维度上的筛选不改写（MySQL与SQLite的类型转换不同）
+        assert materializer.answer("SELECT contract, COUNT(*) FROM orders WHERE day >= '2024-01-02' "
+                                   "GROUP BY contract") is None
+    finally:
+        materializer.close()
+
+
+def test_rollup_materializer_does_not_rewrite_compound_aggregate_items(tmp_path):
+    import json
+    import math
+    import sqlite3
+    from fixtures import create_telco_db
+    from data_analyst_agent.core.rollup import RollupMaterializer, parse_aggregate_query
+    from data_analyst_agent.functions_lib import run_sql
+    from data_analyst_agent.functions_lib.run_sql import sql_inter
+    from data_analyst_agent.utils.serialization import decode_results
+
+    # SELECT项以聚合函数开头、以右括号结尾，但不是一次完整的聚合函数调用
+    compound = [
+        "SELECT Contract, SUM(MonthlyCharges)/COUNT(*) FROM user_payments GROUP BY Contract",
+        "SELECT Contract, MAX(tenure) - MIN(tenure) AS spread FROM user_payments GROUP BY Contract",
+        "SELECT Contract, MAX(tenure) - (MIN(tenure)) FROM user_payments GROUP BY Contract",
+    ]
+    assert all(parse_aggregate_query(query) is None for query in compound)
+    assert parse_aggregate_query("SELECT Contract, SUM((MonthlyCharges)) FROM user_payments GROUP BY Contract")
+
+    db_path = create_telco_db(str(tmp_path / 'telco.db'), rows=1000)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(db_path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+    materializer = RollupMaterializer(min_hits=1, refresh_interval=0, watermarks={'user_payments': 'rowid'})
+    run_sql.set_rollup_materializer(materializer)
+
+    def direct(query):
+        with sqlite3.connect(db_path) as connection:
+            return json.loads(json.dumps(connection.execute(query).fetchall()))
+
+    try:
+        # 同一维度上的简单聚合查询建立汇总表，之后源数据表新增行并增量刷新
+        sql_inter("SELECT Contract, SUM(MonthlyCharges), COUNT(*), MAX(tenure), MIN(tenure) FROM user_payments "
+                  "GROUP BY Contract")
+        materializer.wait()
+        with sqlite3.connect(db_path) as connection:
+            connection.execute("INSERT INTO user_payments VALUES ('new-1', 90, 'Two year', 'No', 'Mailed check', "
+                               "500.0, 500.0)")
+        for query in compound:
+            rows = decode_results(sql_inter(query))[1]
+            assert all(math.isclose(u, v, rel_tol=1e-9) if isinstance(v, float) else u == v
+                       for x, y in zip(rows, direct(query)) for u, v in zip(x, y))
+        assert materializer.get_stats()['hits'] == 0
+    finally:
+        run_sql.set_rollup_materializer(None)
+        run_sql.set_connection_pool(None)
+        pool.close()
+        materializer.close()
+
+
+def test_answer_cache_reuses_answers_until_referenced_tables_change(tmp_path):
+    import sqlite3
+    from fixtures import create_telco_db, tool_call_message
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.answer_cache import AnswerCache, normalize_question
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.functions_lib import run_sql
+    from data_analyst_agent.functions_lib.run_sql import sql_inter
+
+    db_path = create_telco_db(str(tmp_path / 'telco.db'), rows=500)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(db_path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+    query = ("SELECT COUNT(*) FROM user_payments p JOIN user_churn c ON p.customerID = c.customerID "
+             "WHERE c.Churn = 'Yes'")
+
+    def responder(messages, route):
+        last = messages[-1]
+        if isinstance(last, dict) and last['role'] == 'tool':
+            return f"流失用户数：{last['content']}"
+        return tool_call_message('sql_inter', {'sql_query': query})
+
+    llm = StubLlm(responder)
+    cache = AnswerCache(str(tmp_path / 'answers.db'))
+    agent = DataFlowAgent(llm_api=llm, namespace={}, compact_history=False, answer_cache=cache,
+                          available_functions=AvailableFunctions(functions_list=[sql_inter]))
+    try:
+        first = agent.ask('一共有多少流失用户？')
+        assert len(llm.calls) == 2 and not agent.last_turn.cached
+
+        # 新会话中规范化后相同的问题直接使用缓存的回答，不调用大模型，调用记录与原先一致
+        session = agent.new_session()
+        assert normalize_question('  一共有多少流失用户?') == normalize_question('一共有多少流失用户？')
+        assert session.ask('  一共有多少流失用户?') == first
+        assert session.llm_api.calls == [] and session.last_turn.cached
+        assert [call['name'] for call in session.last_turn.tool_trace] == ['sql_inter']
+        assert session.messages.history_messages[-1]['content'] == first
+
+        # 已有回答的对话中不使用缓存，数据字典变化时指纹不同
+        assert agent.ask('一共有多少流失用户？') == first and len(llm.calls) == 4
+        other = DataFlowAgent(llm_api=StubLlm(responder), namespace={}, compact_history=False, answer_cache=cache,
+                              system_content_list=['新的数据字典'], dictionary_token_budget=None,
+                              available_functions=AvailableFunctions(functions_list=[sql_inter]))
+        assert other.context_fingerprint() != agent.context_fingerprint()
+
+        # 依赖的数据表新增数据后缓存失效，重新分析并保存新的回答
+        with sqlite3.connect(db_path) as connection:
+            connection.execute("INSERT INTO user_churn VALUES ('new-1', 'Yes')")
+            connection.execute("INSERT INTO user_payments VALUES ('new-1', 3, 'Two year', 'No', 'Mailed check', "
+                               "99.5, 120.0)")
+        session = agent.new_session()
+        updated = session.ask('一共有多少流失用户？')
+        assert updated != first and len(session.llm_api.calls) == 2
+        assert agent.new_session().ask('一共有多少流失用户？') == updated
+
+        stats = cache.get_stats()
+        assert stats['lookups'] == 4 and stats['hits'] == 2 and stats['invalidated'] == 1
+        assert stats['hit_rate'] == 0.5 and stats['seconds_saved'] >= 0 and stats['entries'] == 1
+        assert '命中率' in cache.report()
+    finally:
+        run_sql.set_connection_pool(None)
+        pool.close()
+        cache.close()
+
+
+def test_answer_cache_refuses_answers_whose_sql_tables_cannot_be_resolved(tmp_path):
+    import json
+    import sqlite3
+    from contextlib import closing, contextmanager
+    from fixtures import create_telco_db
+    from data_analyst_agent.core.answer_cache import AnswerCache, trace_tables
+
+    db_path = create_telco_db(str(tmp_path / 'telco.db'), rows=200)
+
+    @contextmanager
+    def connect():
+        with closing(sqlite3.connect(db_path)) as connection:
+            yield connection
+
+    def trace(*queries):
+        return [{'name': 'sql_inter', 'arguments': json.dumps({'sql_query': q}, ensure_ascii=False)} for q in queries]
+
+    resolved = "SELECT COUNT(*) FROM user_payments WHERE PaymentMethod LIKE '%--%'"
+    unresolved = "SELECT COUNT(*) FROM (user_payments)"
+    assert trace_tables(trace(resolved)) == ['user_payments']
+    assert trace_tables(trace(resolved, unresolved)) is None
+
+    cache = AnswerCache(connect=connect)
+    try:
+        assert cache.put('问题一', 'fp', '回答一', trace(resolved), 1.0)
+        # 任一条SQL无法解析出数据表时不缓存，数据变化后也不会返回旧的回答
+        assert not cache.put('问题二', 'fp', '回答二', trace(resolved, unresolved), 1.0)
+        assert len(cache) == 1
+        with closing(sqlite3.connect(db_path)) as connection, connection:
+            connection.execute("DELETE FROM user_payments WHERE rowid % 2 = 0")
+        assert cache.get('问题一', 'fp') is None and cache.get('问题二', 'fp') is None
+        assert cache.get_stats()['invalidated'] == 1 and len(cache) == 0
+    finally:
+        cache.close()
+
+
+def test_encode_results_handles_mysql_types_with_one_header_row(tmp_path):
+    import sqlite3
+    import datetime
+    from decimal import Decimal
+    from fixtures import create_telco_db
+    from data_analyst_agent.functions_lib import run_sql
+    from data_analyst_agent.functions_lib.run_sql import sql_inter
+    from data_analyst_agent.utils.serialization import encode_results, decode_results
+
+    columns = ['id', 'amount', 'ratio', 'created', 'day', 'duration', 'flag', 'payload', 'note']
+    rows = [
+        (1, Decimal('1234.50'), 2 / 3, datetime.datetime(2024, 1, 2, 3, 4, 5), datetime.date(2024, 1, 2),
+         datetime.timedelta(hours=30, minutes=5, seconds=1), b'\x01', b'\x00\xff' * 40, 'a\tb\nc'),
+        (2, None, float('nan'), None, None, -datetime.timedelta(seconds=90), b'\x00', b'text', '\\N'),
+    ]
+    text = encode_results(columns, rows, float_digits=4, decimal_places=1)
+    lines = text.split('\n')
+    assert lines[0] == '\t'.join(columns) and len(lines) == 3
+    assert lines[1].split('\t')[:8] == ['1', '1234.5', '0.6667', '2024-01-02 03:04:05', '2024-01-02', '30:05:01',
+                                        '0x01', '0x' + '00ff' * 16 + '...(80 bytes)']
+    assert lines[2].split('\t')[1:7] == ['\\N', 'nan', '\\N', '\\N', '-00:01:30', '0x00']
+    # 原样还原字符串中的制表符、换行符，区分NULL和字面量\N
+    decoded_columns, decoded = decode_results(text)
+    assert decoded_columns == columns
+    assert decoded[0][8] == 'a\tb\nc' and decoded[1][8] == '\\N' and decoded[1][1] is None
+    assert decoded[0][:3] == (1, 1234.5, 0.6667) and decoded[1][7] == 'text'
+    assert encode_results(['x'], []) == 'x'
+
+    db_path = create_telco_db(str(tmp_path / 'telco.db'), rows=50)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(db_path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+    try:
+        result = sql_inter("SELECT Contract, COUNT(*) AS n, AVG(MonthlyCharges) FROM user_payments "
+                           "GROUP BY Contract ORDER BY Contract")
+        header, *body = result.split('\n')
+        assert header == 'Contract\tn\tAVG(MonthlyCharges)' and len(body) == 3
+        assert sum(row[1] for row in decode_results(result)[1]) == 50
+        assert sql_inter("CREATE TABLE t (x INTEGER)").startswith('SQL语句执行成功')
+    finally:
+        run_sql.set_connection_pool(None)
+        pool.close()
+
+
+def test_large_sql_results_are_offloaded_with_header_and_fetched_by_column_name(tmp_path):
+    import re
+    import sqlite3
+    from fixtures import create_telco_db, tool_call_message
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.functions_lib import run_sql, sql_inter, fetch_blob
+    from data_analyst_agent.utils.helpers import function_to_call
+
+    db_path = create_telco_db(str(tmp_path / 'telco.db'), rows=300)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(db_path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+    af = AvailableFunctions(functions_list=[sql_inter, fetch_blob])
+    namespace = {}
+    query = "SELECT customerID, tenure, Contract, MonthlyCharges FROM user_payments ORDER BY customerID"
+    try:
+        with sqlite3.connect(db_path) as connection:
+            expected = connection.execute(query).fetchall()
+        preview = function_to_call(af, tool_call_message('sql_inter', {'sql_query': query}), namespace=namespace)
+        content = preview['content']
+        # 预览：行数不含字段名行，字段名行之后是前几行数据
+        assert content.startswith('[共300行，前')
+        lines = content.split('\n')
+        assert lines[1] == 'customerID\ttenure\tContract\tMonthlyCharges'
+        assert lines[2].split('\t')[0] == expected[0][0]
+        handle = re.search(r'句柄为(blob_\d+)', content).group(1)
+
+        def fetch(**arguments):
+            message = tool_call_message('fetch_blob', dict(handle=handle, **arguments))
+            return function_to_call(af, message, namespace=namespace)['content'].split('\n')
+
+        # 行号从0开始且不含字段名行，读取结果总是附带字段名行
+        rows = fetch(rows='10:13')
+        assert rows[0] == lines[1] and [row.split('\t')[0] for row in rows[1:]] == [r[0] for r in expected[10:13]]
+        # 按字段名（忽略大小写）或序号选择列
+        rows = fetch(rows='0:2', columns=['contract', '1'])
+        assert rows == ['Contract\ttenure'] + [f"{r[2]}\t{r[1]}" for r in expected[:2]]
+        assert fetch(rows='299:')[1:] == ['\t'.join(map(str, expected[-1]))]
+        assert fetch(columns=['Churn'])[0].startswith('读取结果时报错：结果中不存在字段Churn')
+        # 按字节范围读取原样返回
+        assert fetch(start=0, end=10) == ['customerID']
+    finally:
+        run_sql.set_connection_pool(None)
+        pool.close()
+
+
+def test_watchdog_interrupts_slow_cells_and_ctrl_c_cancels_only_the_tool():
+    import os
+    import time
+    import signal
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from fixtures import tool_call_message
+    from data_analyst_agent.core.agent import DataFlowAgent
+    from data_analyst_agent.core.functions import AvailableFunctions
+    from data_analyst_agent.core.watchdog import CELL_TIMEOUT_KEY, cell_timeout
+    from data_analyst_agent.functions_lib import python_inter
+
+    # 默认不限制运行时间，需要时通过cell_timeout或变量空间中的_cell_timeout开启
+    assert cell_timeout({}) is None
+    assert DataFlowAgent(llm_api=StubLlm(), namespace={}, compact_history=False).namespace[CELL_TIMEOUT_KEY] is None
+
+    # 超时：返回超时时间和中断时所在的代码行，之前的变量保留，中断不会泄漏到代码单元之外
+    g = {CELL_TIMEOUT_KEY: 0.3}
+    code = "total = 0\nfor i in range(10 ** 10):\n    total += i\n"
+    start = time.perf_counter()
+    result = python_inter(code, g=g)
+    assert time.perf_counter() - start < 2
+    assert result.startswith('代码执行时报错CellTimeout：运行超过0.3秒被中断') and '第3行：total += i' in result
+    time.sleep(1.2)
+    assert g['total'] > 0 and python_inter("y = total * 0", g=g) == "{'y': 0}"
+
+    def responder(messages, route):
+        last = messages[-1]
+        if isinstance(last, dict) and last['role'] == 'tool':
+            return f"结果：{last['content']}"
+        if messages[-1]['content'] == '慢':
+            return tool_call_message('python_inter', {'py_code': "n = 0\nwhile True:\n    n += 1"})
+        return tool_call_message('python_inter', {'py_code': "m = 2"})
+
+    # 外部函数在线程池或主线程中运行时，Ctrl-C都只中断当前的外部函数，之后会话可以继续使用
+    for executor in (ThreadPoolExecutor(1), None):
+        agent = DataFlowAgent(llm_api=StubLlm(responder), namespace={}, compact_history=False, cell_timeout=None,
+                              available_functions=AvailableFunctions(functions_list=[python_inter]))
+        agent.tool_executor = executor
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT))
+        timer.start()
+        agent.ask('慢')
+        assert agent.last_turn.stop_reason == 'cancelled'
+        # 中断的外部函数调用不进入对话历史，只记录在调用记录中
+        assert agent.messages.history_messages[-1]['content'] == '慢'
+        assert [call['name'] for call in agent.last_turn.tool_trace] == ['python_inter']
+        assert agent.namespace['n'] > 0
+        assert "'m': 2" in agent.ask('快') and agent.last_turn.stop_reason is None
+        if executor is not None:
+            executor.shutdown()
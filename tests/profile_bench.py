@@ -0,0 +1,57 @@
+"""
+profile_data的基准测试：生成不同行数的数据表（浮点、整数、字符串、日期时间列，部分列含缺失值），
+统计数据概况的耗时、报告的token数量，以及HyperLogLog估计的不重复值数量与精确值的误差。
+
+运行方式：python tests/profile_bench.py [--rows 100000,1000000,10000000]
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.core.tokens import get_token_counter
+from data_analyst_agent.functions_lib.run_profile import profile_frame, render_profile
+
+
+def make_frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    monthly = rng.random(rows) * 100 + 20
+    tenure = rng.integers(0, 73, rows)
+    df = pd.DataFrame({
+        'customerID': np.arange(rows),
+        'tenure': tenure,
+        'MonthlyCharges': monthly,
+        'TotalCharges': monthly * tenure + rng.normal(0, 50, rows),
+        'score': rng.normal(0, 1, rows),
+        'Contract': rng.choice(['Month-to-month', 'One year', 'Two year'], rows),
+        'PaymentMethod': rng.choice(['Electronic check', 'Mailed check', 'Bank transfer', 'Credit card'], rows),
+        'signup': pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3000, rows), unit='D'),
+    })
+    df.loc[rng.random(rows) < 0.02, 'TotalCharges'] = np.nan
+    return df
+
+
+def main(args):
+    counter = get_token_counter()
+    print(f"{'行数':>10}{'列数':>6}{'耗时(s)':>10}{'tokens':>8}{'customerID不重复值':>20}{'误差':>8}")
+    for rows in args.rows:
+        df = make_frame(rows)
+        start = time.perf_counter()
+        profile = profile_frame(df)
+        report = render_profile(profile, 'df')
+        elapsed = time.perf_counter() - start
+        estimate = profile['columns'][0]['distinct']
+        print(f"{rows:>10}{df.shape[1]:>6}{elapsed:>10.2f}{counter.count_text(report):>8}{estimate:>20}"
+              f"{estimate / rows - 1:>8.2%}")
+    print(report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=lambda s: [int(x) for x in s.split(',')], default=[100000, 1000000, 10000000])
+    main(parser.parse_args())
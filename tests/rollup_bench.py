@@ -0,0 +1,112 @@
+"""
+汇总表物化的基准测试：在合成的SQLite数据表（默认50万行）上回放一段合成的查询日志，
+日志由少量聚合查询模板（不同的筛选常量、排序和LIMIT）按Zipf分布抽取，并混入少量明细查询；
+其中按字符串字段筛选的模板不会被改写（SQLite与MySQL的排序规则不同），用于检查这类查询仍然查询源数据库。
+对比不使用和使用RollupMaterializer时sql_inter的总耗时，报告改写命中率和估算节省的耗时，并检查两者结果一致。
+
+运行方式：python tests/rollup_bench.py [--rows 500000] [--queries 300]
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.core.rollup import RollupMaterializer
+from data_analyst_agent.functions_lib import run_sql
+from data_analyst_agent.functions_lib.run_sql import sql_inter
+from data_analyst_agent.utils.serialization import decode_results
+
+CONTRACTS = ['Month-to-month', 'One year', 'Two year']
+PAYMENTS = ['Electronic check', 'Mailed check', 'Bank transfer', 'Credit card']
+REGIONS = ['North', 'South', 'East', 'West', 'Central']
+
+TEMPLATES = [
+    lambda rng: "SELECT Contract, AVG(Churn) AS churn_rate, COUNT(*) AS n FROM user_payments GROUP BY Contract",
+    lambda rng: "SELECT CASE WHEN tenure < 12 THEN '0-1y' WHEN tenure < 36 THEN '1-3y' ELSE '3y+' END AS bucket, "
+                "SUM(MonthlyCharges) FROM user_payments GROUP BY bucket ORDER BY 2",
+    lambda rng: f"SELECT Region, COUNT(*) FROM user_payments WHERE tenure >= {rng.integers(0, 72)} "
+                f"GROUP BY Region ORDER BY 2 DESC",
+    lambda rng: f"SELECT PaymentMethod, AVG(MonthlyCharges), MAX(MonthlyCharges) FROM user_payments "
+                f"WHERE Region IN ('{rng.choice(REGIONS)}', '{rng.choice(REGIONS)}') GROUP BY PaymentMethod",
+    lambda rng: f"SELECT Contract, Region, AVG(Churn) FROM user_payments GROUP BY Contract, Region "
+                f"ORDER BY 3 DESC LIMIT {rng.integers(3, 10)}",
+]
+
+
+def create_db(path, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE user_payments (id INTEGER PRIMARY KEY, tenure INTEGER, Contract TEXT, "
+                       "PaymentMethod TEXT, Region TEXT, MonthlyCharges REAL, Churn INTEGER)")
+    connection.executemany("INSERT INTO user_payments VALUES (?, ?, ?, ?, ?, ?, ?)", zip(
+        range(rows), rng.integers(0, 73, rows).tolist(), rng.choice(CONTRACTS, rows).tolist(),
+        rng.choice(PAYMENTS, rows).tolist(), rng.choice(REGIONS, rows).tolist(),
+        np.round(rng.uniform(18, 120, rows), 2).tolist(), (rng.random(rows) < 0.27).astype(int).tolist()))
+    connection.commit()
+    connection.close()
+
+
+def make_log(queries, seed=0):
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, len(TEMPLATES) + 1)
+    log = []
+    for _ in range(queries):
+        if rng.random() < 0.1:
+            log.append(f"SELECT * FROM user_payments WHERE id = {rng.integers(0, 1000)}")
+        else:
+            log.append(TEMPLATES[rng.choice(len(TEMPLATES), p=weights / weights.sum())](rng))
+    return log
+
+
+def replay(log):
+    start = time.perf_counter()
+    results = [decode_results(sql_inter(query))[1] for query in log]
+    return time.perf_counter() - start, results
+
+
+def same(a, b):
+    # ORDER BY的取值相同的行之间顺序不确定，按行比较前先排序
+    if len(a) != len(b):
+        return False
+    a, b = sorted(a, key=repr), sorted(b, key=repr)
+    return all(len(x) == len(y) and all(abs(u - v) < 1e-6 * max(1, abs(v)) if isinstance(v, float) else u == v
+                                        for u, v in zip(x, y)) for x, y in zip(a, b))
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='dataflow_rollup_bench_')
+    path = os.path.join(workdir, 'telco.db')
+    create_db(path, args.rows)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+    log = make_log(args.queries)
+    try:
+        base_seconds, base_results = replay(log)
+        materializer = RollupMaterializer(os.path.join(workdir, 'rollups.db'), min_hits=args.min_hits,
+                                          watermarks={'user_payments': 'id'})
+        run_sql.set_rollup_materializer(materializer)
+        rollup_seconds, rollup_results = replay(log)
+        materializer.wait()
+    finally:
+        run_sql.set_rollup_materializer(None)
+        run_sql.set_connection_pool(None)
+        pool.close()
+
+    mismatched = sum(not same(a, b) for a, b in zip(base_results, rollup_results))
+    print(f"\n回放{len(log)}条查询（{args.rows}行）：直接查询{base_seconds:.2f}秒，使用汇总表{rollup_seconds:.2f}秒"
+          f"（{base_seconds / rollup_seconds:.1f}倍），结果不一致{mismatched}条")
+    print(materializer.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--min_hits', type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+"""
+抽样提取的基准测试：在合成的SQLite数据表（默认200万行）上对比extract_data提取全表与extract_sample抽样提取的
+耗时和内存峰值（tracemalloc），并检查抽样估计值与全表真实值的误差以及置信区间是否覆盖真实值。
+
+运行方式：python tests/sample_bench.py [--rows 2000000] [--size 20000]
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.functions_lib import run_sql
+from data_analyst_agent.functions_lib.run_sql import extract_data, extract_sample
+from data_analyst_agent.utils.sampling import estimate_mean, estimate_proportion
+
+
+def create_db(path, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    contract = rng.choice(['Month-to-month', 'One year', 'Two year'], rows, p=[0.55, 0.25, 0.2])
+    churn_rate = np.select([contract == 'Month-to-month', contract == 'One year'], [0.43, 0.11], 0.03)
+    churn = np.where(rng.random(rows) < churn_rate, 'Yes', 'No')
+    monthly = np.round(rng.uniform(18, 120, rows), 2)
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE user_payments (customerID INTEGER PRIMARY KEY, tenure INTEGER, "
+                       "Contract TEXT, MonthlyCharges REAL, Churn TEXT)")
+    connection.executemany("INSERT INTO user_payments VALUES (?, ?, ?, ?, ?)",
+                           zip(range(rows), rng.integers(0, 73, rows).tolist(), contract.tolist(),
+                               monthly.tolist(), churn.tolist()))
+    connection.commit()
+    connection.close()
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(args):
+    path = os.path.join(tempfile.mkdtemp(prefix='dataflow_sample_bench_'), 'telco.db')
+    create_db(path, args.rows)
+    pool = run_sql.ConnectionPool(factory=lambda: sqlite3.connect(path, check_same_thread=False), size=1)
+    run_sql.set_connection_pool(pool)
+    query = 'SELECT * FROM user_payments'
+    g = {}
+    try:
+        cases = [
+            ('extract_data（全表）', lambda: extract_data(query, 'df', g=g)),
+            (f'extract_sample（size={args.size}）', lambda: extract_sample(query, 'df', size=args.size, g=g)),
+            (f'extract_sample（分层，size={args.size}）',
+             lambda: extract_sample(query, 'df', size=args.size, strata='Contract', g=g)),
+        ]
+        print(f"{'方式':<36}{'耗时(s)':>10}{'内存峰值(MB)':>14}{'行数':>10}")
+        truth = {}
+        for name, function in cases:
+            g.pop('df', None)
+            elapsed, peak = measure(function)
+            df = g['df']
+            print(f"{name:<36}{elapsed:>10.3f}{peak / 1024 ** 2:>14.1f}{len(df):>10}")
+            if not truth:
+                truth = {'MonthlyCharges': df['MonthlyCharges'].mean(), 'Churn': (df['Churn'] == 'Yes').mean(),
+                         'Churn[Two year]': (df.loc[df['Contract'] == 'Two year', 'Churn'] == 'Yes').mean()}
+
+        # 重复抽样，统计95%置信区间覆盖真实值的比例
+        covered = {key: 0 for key in truth}
+        for seed in range(args.repeat):
+            extract_sample(query, 'df', size=args.size, strata='Contract', seed=seed, g=g)
+            df = g['df']
+            estimates = {'MonthlyCharges': estimate_mean(df, 'MonthlyCharges'),
+                         'Churn': estimate_proportion(df, 'Churn', 'Yes'),
+                         'Churn[Two year]': estimate_proportion(df, 'Churn', 'Yes', by='Contract').loc['Two year']}
+            for key, result in estimates.items():
+                covered[key] += result['ci_low'] <= truth[key] <= result['ci_high']
+        print(f"\n{'统计量':<20}{'真实值':>12}{'最后一次估计':>14}{'标准误':>10}{'95%区间覆盖率':>16}")
+        for key, result in estimates.items():
+            print(f"{key:<20}{truth[key]:>12.4f}{result['estimate']:>14.4f}{result['stderr']:>10.4f}"
+                  f"{covered[key] / args.repeat:>16.0%}")
+    finally:
+        run_sql.set_connection_pool(None)
+        pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=50, help='统计置信区间覆盖率时的重复抽样次数')
+    main(parser.parse_args())
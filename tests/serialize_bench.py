@@ -0,0 +1,91 @@
+"""
+查询结果序列化的基准测试：在合成的查询结果上对比原先的json.dumps与encode_results的编码耗时和token数量。
+结果包含两种形状：长表（默认20万行、6列）和宽表（默认500行、80列）；每种形状分为只含整数、浮点数和字符串的数值型结果
+（json.dumps可以直接编码），以及含有DECIMAL、DATETIME、TIME、NULL和二进制值的MySQL类型结果（json.dumps会报错，
+对比时改用default=str）。
+
+运行方式：python tests/serialize_bench.py [--rows 200000] [--wide_rows 500] [--wide_columns 80]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.core.tokens import get_token_counter
+from data_analyst_agent.utils.serialization import encode_results
+
+CONTRACTS = ['Month-to-month', 'One year', 'Two year']
+
+
+def make_value(kind, rng, i):
+    if kind == 'int':
+        return rng.randint(0, 100000)
+    if kind == 'float':
+        return rng.uniform(18, 120)
+    if kind == 'str':
+        return rng.choice(CONTRACTS)
+    if kind == 'decimal':
+        return None if rng.random() < 0.05 else Decimal(f"{rng.uniform(0, 9000):.2f}")
+    if kind == 'datetime':
+        return datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=rng.randint(0, 3 * 10 ** 7))
+    if kind == 'time':
+        return datetime.timedelta(seconds=rng.randint(0, 86400))
+    if kind == 'bytes':
+        return b'\x01' if i % 2 else b'\x00'
+    raise ValueError(kind)
+
+
+def make_results(rows, kinds, seed=0):
+    rng = random.Random(seed)
+    columns = [f"{kind}_{i}" for i, kind in enumerate(kinds)]
+    return columns, tuple(tuple(make_value(kind, rng, i) for kind in kinds) for i in range(rows))
+
+
+def measure(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args):
+    counter = get_token_counter()
+    numeric = ['int', 'str', 'float', 'float', 'int', 'str']
+    mysql = ['int', 'str', 'decimal', 'datetime', 'time', 'bytes']
+    cases = {
+        f'长表-数值型[{args.rows}x6]': make_results(args.rows, numeric),
+        f'长表-MySQL类型[{args.rows}x6]': make_results(args.rows, mysql),
+        f'宽表-数值型[{args.wide_rows}x{args.wide_columns}]':
+            make_results(args.wide_rows, (numeric * args.wide_columns)[:args.wide_columns]),
+        f'宽表-MySQL类型[{args.wide_rows}x{args.wide_columns}]':
+            make_results(args.wide_rows, (mysql * args.wide_columns)[:args.wide_columns]),
+    }
+    print(f"token计数：{counter.name}")
+    print(f"{'结果':<32}{'编码方式':<22}{'耗时(s)':>10}{'字符数':>12}{'token数':>12}")
+    for name, (columns, rows) in cases.items():
+        try:
+            json.dumps(rows)
+            baseline = ('json.dumps', lambda: json.dumps(rows))
+        except TypeError:
+            # 原先的sql_inter在这类结果上直接报错
+            baseline = ('json.dumps(default=str)', lambda: json.dumps(rows, default=str))
+        for label, function in (baseline, ('encode_results', lambda: encode_results(columns, rows))):
+            elapsed, text = measure(function, args.repeat)
+            print(f"{name:<32}{label:<22}{elapsed:>10.3f}{len(text):>12}{counter.count_text(text):>12}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--wide_rows', type=int, default=500)
+    parser.add_argument('--wide_columns', type=int, default=80)
+    parser.add_argument('--repeat', type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,98 @@
+"""
+会话存储的基准测试：对比原先逐次打开markdown文档追加str(list)的方式（append_content_in_doc）和SessionStore，
+统计写入吞吐量（消息/秒）以及恢复一个会话最近N轮对话的延迟。
+原先的文档没有记录边界，无法按会话和轮次读取，恢复延迟只统计读取整个文档的耗时（仍然不包括解析）。
+
+运行方式：python tests/session_store_bench.py [--sessions 20] [--turns 200] [--last 10]
+"""
+import os
+import io
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.core.project import create_or_get_doc, append_content_in_doc, get_file_content
+from data_analyst_agent.core.session_store import SessionStore
+
+
+def make_turn(session, turn):
+    """一轮对话：用户问题、带tool_calls的assistant消息、外部函数结果和最终回答"""
+    return [
+        {'role': 'user', 'content': f'会话{session}第{turn}个问题：请按合同类型统计用户流失率'},
+        {'role': 'assistant', 'content': None, 'tool_calls': [{
+            'id': f'call_{turn}', 'type': 'function',
+            'function': {'name': 'sql_inter',
+                         'arguments': '{"sql_query": "SELECT Contract, AVG(Churn) FROM user_churn GROUP BY Contract"}'},
+        }]},
+        {'role': 'tool', 'tool_call_id': f'call_{turn}', 'name': 'sql_inter',
+         'content': '[["Month-to-month", 0.427], ["One year", 0.112], ["Two year", 0.028]]' * 5},
+        {'role': 'assistant', 'content': '按月付费的用户流失率最高，约为42.7%，两年合同的用户流失率最低。' * 3},
+    ]
+
+
+def bench_markdown(workdir, sessions, turns, last):
+    # 原先的方式只有一个文档，每次追加都重新打开文件
+    doc_id = create_or_get_doc(workdir, 'messages')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for turn in range(turns):
+            for session in range(sessions):
+                append_content_in_doc(doc_id, make_turn(session, turn))
+    write = time.perf_counter() - start
+
+    times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        get_file_content(doc_id)
+        times.append(time.perf_counter() - start)
+    return write, statistics.median(times), os.path.getsize(doc_id)
+
+
+def bench_store(workdir, sessions, turns, last, sync):
+    path = os.path.join(workdir, f'sessions_{sync}.db')
+    store = SessionStore(path, sync=sync)
+    start = time.perf_counter()
+    for turn in range(turns):
+        for session in range(sessions):
+            store.append_turn(f'session-{session}', make_turn(session, turn), project='bench')
+    store.flush()
+    write = time.perf_counter() - start
+    store.close()
+
+    # 重新打开数据库，模拟新进程恢复会话
+    store = SessionStore(path, sync=sync)
+    times = []
+    for i in range(5):
+        start = time.perf_counter()
+        messages = store.load_last_turns(f'session-{i % sessions}', last)
+        times.append(time.perf_counter() - start)
+    assert len(messages) == last * 4
+    store.close()
+    size = sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+    return write, statistics.median(times), size
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='dataflow_store_bench_')
+    messages = args.sessions * args.turns * 4
+    print(f">>> {args.sessions}个会话 x {args.turns}轮，共{messages}条消息，恢复最近{args.last}轮")
+    print(f"{'方式':<24}{'写入(消息/s)':>14}{'恢复延迟(ms)':>14}{'文件大小(MB)':>14}")
+
+    rows = [('markdown追加', bench_markdown(workdir, args.sessions, args.turns, args.last))]
+    for sync in ('off', 'normal', 'full'):
+        rows.append((f'SessionStore(sync={sync})', bench_store(workdir, args.sessions, args.turns, args.last, sync)))
+    for name, (write, resume, size) in rows:
+        print(f"{name:<26}{messages / write:>14.0f}{resume * 1000:>14.3f}{size / 1024 / 1024:>14.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--last', type=int, default=10)
+    main(parser.parse_args())
@@ -0,0 +1,66 @@
+"""
+token计数的基准测试：200条消息的会话，比较逐条编码（无缓存）与ChatMessages带缓存计数的耗时。
+带缓存的计数依次执行append全部消息、逐条pop、再次append全部消息三轮操作。
+
+运行方式：python tests/token_bench.py [--backend heuristic auto]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_analyst_agent.core.messages import ChatMessages
+from data_analyst_agent.core.tokens import TokenCounter, get_token_counter
+
+
+def make_data_dictionary(columns=300):
+    return '\n'.join(
+        f"| column_{i} | 字段{i}的中文说明，用于描述用户的在网时长、合约类型等信息 | VARCHAR(64) |" for i in range(columns)
+    )
+
+
+def make_session(turns=100):
+    session = []
+    for i in range(turns):
+        session.append({"role": "user", "content": f"请统计第{i}个分组中用户的流失率，并按合约类型进行拆分。"})
+        session.append({"role": "assistant", "content": json.dumps(
+            [[f"Month-to-month", i, 0.4271], ["One year", i * 2, 0.1127], ["Two year", i * 3, 0.0283]] * 5)})
+    return session
+
+
+def main(args):
+    data_dictionary = make_data_dictionary()
+    session = make_session()
+
+    for backend in args.backend:
+        counter = get_token_counter(backend)
+        uncached = TokenCounter(counter.tokenizer, cache_size=0)
+
+        start = time.perf_counter()
+        total = sum(uncached.count_message(m) for m in session)
+        uncached_time = time.perf_counter() - start
+
+        hits, misses = counter.hits, counter.misses
+        start = time.perf_counter()
+        msgs = ChatMessages(system_content_list=[data_dictionary], tokenizer=counter)
+        for m in session:
+            msgs.messages_append(m)
+        for _ in range(len(session)):
+            msgs.messages_pop(manual=True)
+        for m in session:
+            msgs.messages_append(m)
+        cached_time = time.perf_counter() - start
+
+        print(f"[{counter.name}] {len(session)}条消息共{total} tokens，"
+              f"逐条编码耗时 {uncached_time * 1000:.2f} ms；"
+              f"ChatMessages append/pop/append 三轮耗时 {cached_time * 1000:.2f} ms，"
+              f"缓存命中 {counter.hits - hits} 次，未命中 {counter.misses - misses} 次")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', nargs='+', default=['heuristic', 'auto'])
+    main(parser.parse_args())